@@ -9,6 +9,8 @@ import re
 import json
 import traceback
 
+import jsoncodec
+
 #-----------------------------------------------------------------------------
 # patterns to look for 
 
@@ -135,6 +137,162 @@ okre4 = re.compile('block-v1:(?P<org>[^+]+)\+(?P<course>[^+]+)\+(?P<semester>[^+
 okre5 = re.compile('/courses/course-v1:(?P<org>[^+]+)\+(?P<course>[^+]+)\+(?P<semester>[^+]+)/courseware/(?P<chapter>[^/]+)/(?P<id>[^/]+)/')
 okre5a = re.compile('i4x-(?P<org>[^-]+)-(?P<course>[^+]+)-(?P<mtype>[^-]+)-(?P<id>[^-]+)')
 
+#-----------------------------------------------------------------------------
+# staged matching
+#
+# Most log lines match none of the patterns above, so each pattern is only tried
+# when a cheap substring check shows it could match.  The stages which depend on
+# just one string (event_type, page, or path) are memoized, since those strings
+# repeat heavily within a tracking log; all the event_type stages are computed
+# together, with one cache lookup per line, and likewise for path.  Each stage
+# returns the same module_id (or None) that its patterns would.
+
+MODULE_ID_CACHE_SIZE = 50000	# entries per memoized stage; a full cache is simply cleared
+
+def memoize_stage(func):
+    cache = {}
+    def stage(s):
+        try:
+            return cache[s]
+        except KeyError:
+            pass
+        result = func(s)
+        if len(cache) >= MODULE_ID_CACHE_SIZE:
+            cache.clear()
+        cache[s] = result
+        return result
+    stage.cache = cache
+    return stage
+
+def okre_mid(rr):
+    return "%s/%s/%s/%s" % (rr.group('org'), rr.group('course'), rr.group('mtype'), rr.group('id'))
+
+def opaque_handler_mid(s):
+    if '/courses/course-v1:' in s:
+        rr = okre1.search(s)
+        if (rr):
+            return okre_mid(rr)
+    return None
+
+def opaque_xblock_mid(s):
+    if '/courses/course-v1:' in s:
+        rr = okre3.search(s)
+        if (rr):
+            return okre_mid(rr)
+    return None
+
+@memoize_stage
+def opaque_course_page(page):
+    '''
+    Return (org, course) for an opaque key course page, else None.
+    '''
+    if '/courses/course-v1:' in page:
+        rr = okre2.search(page)
+        if (rr):
+            return (rr.group('org'), rr.group('course'))
+    return None
+
+@memoize_stage
+def opaque_courseware_page(page):
+    '''
+    Return (org, course) for an opaque key courseware page, else None.
+    '''
+    if '/courses/course-v1:' in page:
+        rr = okre5.search(page)
+        if (rr):
+            return (rr.group('org'), rr.group('course'))
+    return None
+
+@memoize_stage
+def page_close_mid(page):
+    if '/courseware/' in page:
+        rr = cidre7.search(page)
+        if (rr):
+            return rr.group(1) + "/sequential/" + rr.group(2) + '/'
+        rr = cidre8.search(page)
+        if (rr):
+            return rr.group(1) + "/chapter/" + rr.group(2) + '/'
+    return None
+
+def server_event_type_mid(event_type):
+    '''
+    module_id from server event_type alone: forum, sequence, chapter, jump_to_id, and i4x xblock events.
+    '''
+    if not '/courses/' in event_type:
+        return None
+
+    if '/discussion/' in event_type:
+        rr = fidre5.search(event_type)
+        if (rr):
+            return rr.group(1) + "/forum/" + rr.group(3)
+
+        rr = fidre6.search(event_type)
+        if (rr):
+            return rr.group(1) + "/forum/" + rr.group(4)
+
+        rr = fidre7.search(event_type)
+        if (rr):
+            return rr.group(1) + "/forum/new"
+
+        rr = fidre8.search(event_type)
+        if (rr):
+            return rr.group(1) + "/forum/" + rr.group(4)
+
+    if '/courseware/' in event_type:
+        # event of going to sequence and seeing last page visited, eg:
+        rr = cidre6.search(event_type)
+        if (rr):
+            return rr.group(1) + "/sequential/" + rr.group(2) + '/'
+
+        # event of opening a chapter
+        rr = cidre8.search(event_type)
+        if (rr):
+            return rr.group(1) + "/chapter/" + rr.group(2)
+
+    # event of jump_to_id
+    if '/jump_to_id/' in event_type:
+        rr = cidre9.search(event_type)
+        if (rr):
+            return rr.group(1) + "/jump_to_id/" + rr.group(2)
+
+    # event of xblock with i4x
+    return i4x_xblock_mid(event_type)
+
+def i4x_xblock_mid(s):
+    if '/xblock/i4x:;_;_' in s:
+        rr = cidre10.match(s)
+        if (rr):
+            return okre_mid(rr)
+    return None
+
+def i4x_url_match(event_type):
+    '''
+    Return (module_id, is_goto_position) for an event_type containing an i4x:// url, else None.
+    '''
+    if 'i4x://' in event_type:
+        rr = cidre3.search(event_type)
+        if (rr):
+            return (rr.group(1), bool(cidre3a.search(event_type)))
+        rr = cidre3b.search(event_type)
+        if (rr):
+            return (okre_mid(rr), False)
+    return None
+
+@memoize_stage
+def event_type_matches(event_type):
+    '''
+    Return (opaque_handler_mid, opaque_xblock_mid, server_event_type_mid, i4x_url_match) for event_type.
+    '''
+    return (opaque_handler_mid(event_type), opaque_xblock_mid(event_type),
+            server_event_type_mid(event_type), i4x_url_match(event_type))
+
+@memoize_stage
+def path_matches(path):
+    '''
+    Return (opaque_handler_mid, opaque_xblock_mid, i4x_xblock_mid) for path.
+    '''
+    return (opaque_handler_mid(path), opaque_xblock_mid(path), i4x_xblock_mid(path))
+
 #-----------------------------------------------------------------------------
 
 def add_module_id(data, verbose=False):
@@ -166,71 +324,64 @@ def guess_module_id(doc):
     event = doc['event']
     event_type = doc['event_type']
     path = doc.get('context', {}).get('path', '')
-  
+
+    (et_handler_mid, et_xblock_mid, et_server_mid, et_i4x_match) = event_type_matches(event_type)
+
     # opaque keys
 
-    rr = okre1.search(event_type)
-    if (rr):
-        mid = "%s/%s/%s/%s" % (rr.group('org'), rr.group('course'), rr.group('mtype'), rr.group('id'))
-        # sys.stderr.write("ok mid = %s\n" % mid)
-        return mid
-  
-    rr = okre1.search(path)
-    if (rr):
-        mid = "%s/%s/%s/%s" % (rr.group('org'), rr.group('course'), rr.group('mtype'), rr.group('id'))
-        # sys.stderr.write("ok mid = %s\n" % mid)
-        return mid
+    if et_handler_mid:
+        return et_handler_mid
+
+    (path_handler_mid, path_xblock_mid, path_i4x_xblock_mid) = path_matches(path)
+    if path_handler_mid:
+        return path_handler_mid
 
     if ('problem' in event_type and type(event) in [str, unicode] and event.startswith("input_")):
         page = doc.get('page', '') or ''
         # sys.stderr.write("page=%s\n" % page)
-        rr = okre2.search(page)
-        if (rr):
+        org_course = opaque_course_page(page)
+        if org_course:
             rr2 = okre2a.search(event.split('&',1)[0])
             if rr2:
-                mid = "%s/%s/%s/%s" % (rr.group('org'), rr.group('course'), 'problem', rr2.group('id'))
+                mid = "%s/%s/%s/%s" % (org_course[0], org_course[1], 'problem', rr2.group('id'))
+                # sys.stderr.write("ok mid = %s\n" % mid)
+                return mid
+        if 'input_i4x-' in event:
+            rr2 = cidre11a.search(event)
+            if (rr2):
+                mid = "%s/%s/%s/%s" % (rr2.group('org'), rr2.group('course'), rr2.group('mtype'), rr2.group('id'))
                 # sys.stderr.write("ok mid = %s\n" % mid)
                 return mid
-        rr2 = cidre11a.search(event)
-        if (rr2):
-            mid = "%s/%s/%s/%s" % (rr2.group('org'), rr2.group('course'), rr2.group('mtype'), rr2.group('id'))
-            # sys.stderr.write("ok mid = %s\n" % mid)
-            return mid
         sys.stderr.write("ok parse failed on %s" % json.dumps(doc, indent=4))
-  
+
     if (event_type=="problem_graded" and type(event)==list and len(event)>0 and event[0].startswith("input_")):
         page = doc.get('page', '') or ''
         # sys.stderr.write("page=%s\n" % page)
-        rr = okre2.search(page)
-        if (rr):
+        org_course = opaque_course_page(page)
+        if org_course:
             rr2 = okre2a.search(event[0])
             if rr2:
-                mid = "%s/%s/%s/%s" % (rr.group('org'), rr.group('course'), 'problem', rr2.group('id'))
+                mid = "%s/%s/%s/%s" % (org_course[0], org_course[1], 'problem', rr2.group('id'))
+                # sys.stderr.write("ok mid = %s\n" % mid)
+                return mid
+        if 'input_i4x-' in event[0]:
+            rr2 = cidre11a.search(event[0])
+            if (rr2):
+                mid = "%s/%s/%s/%s" % (rr2.group('org'), rr2.group('course'), rr2.group('mtype'), rr2.group('id'))
                 # sys.stderr.write("ok mid = %s\n" % mid)
                 return mid
-        rr2 = cidre11a.search(event[0])
-        if (rr2):
-            mid = "%s/%s/%s/%s" % (rr2.group('org'), rr2.group('course'), rr2.group('mtype'), rr2.group('id'))
-            # sys.stderr.write("ok mid = %s\n" % mid)
-            return mid
         sys.stderr.write("ok parse failed on %s" % json.dumps(doc, indent=4))
 
-    rr = okre3.search(event_type)
-    if (rr):
-        mid = "%s/%s/%s/%s" % (rr.group('org'), rr.group('course'), rr.group('mtype'), rr.group('id'))
-        #sys.stderr.write("ok mid = %s\n" % mid)
-        return mid
-  
-    rr = okre3.search(path)
-    if (rr):
-        mid = "%s/%s/%s/%s" % (rr.group('org'), rr.group('course'), rr.group('mtype'), rr.group('id'))
-        #sys.stderr.write("ok mid = %s\n" % mid)
-        return mid
+    if et_xblock_mid:
+        return et_xblock_mid
+
+    if path_xblock_mid:
+        return path_xblock_mid
 
     if not type(event)==dict:
         event_dict = None
         try:
-            event_dict = json.loads(event)
+            event_dict = jsoncodec.loads_event(event, keep=True)
         except:
             pass
         if type(event_dict)==dict and 'id' in event_dict:
@@ -238,26 +389,27 @@ def guess_module_id(doc):
 
     if (type(event)==dict and 'id' in event and type(event['id']) in [str, unicode]):
         eid = event['id']
-        rr = okre4.search(eid)
-        if (rr):
-            mid = "%s/%s/%s/%s" % (rr.group('org'), rr.group('course'), rr.group('mtype'), rr.group('id'))
-            return mid
-        rr = okre5a.search(eid)
-        if (rr):
-            mid = "%s/%s/%s/%s" % (rr.group('org'), rr.group('course'), rr.group('mtype'), rr.group('id'))
-            #sys.stderr.write("ok mid = %s\n" % mid)
-            return mid
-        if event_type=='play_video' and '/' not in eid:
-            rr = okre5.search(doc.get('page', '') or '')
+        if 'block-v1:' in eid:
+            rr = okre4.search(eid)
+            if (rr):
+                return okre_mid(rr)
+        if 'i4x-' in eid:
+            rr = okre5a.search(eid)
             if (rr):
-                mid = "%s/%s/%s/%s" % (rr.group('org'), rr.group('course'), 'video', eid)
+                mid = okre_mid(rr)
+                #sys.stderr.write("ok mid = %s\n" % mid)
+                return mid
+        if event_type=='play_video' and '/' not in eid:
+            org_course = opaque_courseware_page(doc.get('page', '') or '')
+            if org_course:
+                mid = "%s/%s/%s/%s" % (org_course[0], org_course[1], 'video', eid)
                 return mid
 
     elif (type(event) in [str, unicode]):
-        rr = okre4.search(event)
-        if (rr):
-            mid = "%s/%s/%s/%s" % (rr.group('org'), rr.group('course'), rr.group('mtype'), rr.group('id'))
-            return mid
+        if 'block-v1:' in event:
+            rr = okre4.search(event)
+            if (rr):
+                return okre_mid(rr)
 
     # sys.stderr.write('path=%s\n' % json.dumps(path, indent=4))
     # sys.stderr.write('doc=%s\n' % json.dumps(doc, indent=4))
@@ -273,7 +425,7 @@ def guess_module_id(doc):
 
     if doc['event_source']=='browser':
         try:
-            m = cidre3.search(event['id'])
+            m = cidre3.search(event['id']) if 'i4x://' in event['id'] else None
             if m:
                 # print "="*20 + "checking event id"
                 # special handling for seq_goto or seq_next, so we append seq_num to sequential's module_id
@@ -286,25 +438,23 @@ def guess_module_id(doc):
             pass
 
         if (event_type=='page_close'):
-            rr = cidre7.search(doc['page'])
-            # sys.stderr.write('checking page_close, rr=%s' % rr)
-            if (rr):
-                return rr.group(1) + "/sequential/" + rr.group(2) + '/'
-            rr = cidre8.search(doc['page'])
-            if (rr):
-                return rr.group(1) + "/chapter/" + rr.group(2) + '/'
-  
+            mid = page_close_mid(doc['page'])
+            # sys.stderr.write('checking page_close, mid=%s' % mid)
+            if mid:
+                return mid
+
         try:
           rr = cidre3.search(event.problem)        # for problem_show ajax
           if (rr):
               return rr.group(1)
         except Exception as err:
             pass
-  
+
         if (type(event)==str or type(event)==unicode):
-            rr = cidre5.search(event)
-            if (rr):
-                return rr.group(1) + '/' + rr.group(2) + '/problem/' + rr.group(3)
+            if event.startswith('input_i4x-'):
+                rr = cidre5.search(event)
+                if (rr):
+                    return rr.group(1) + '/' + rr.group(2) + '/problem/' + rr.group(3)
 
         try:
             rr = cidre5.search(event[0])   # for problem_graded events from browser
@@ -312,54 +462,17 @@ def guess_module_id(doc):
                 return rr.group(1) + '/' + rr.group(2) + '/problem/' + rr.group(3)
         except Exception as err:
             pass
-  
-    # server events - ones which do not depend on event (just event_type)
-
-    rr = fidre5.search(event_type)
-    if (rr):
-        return rr.group(1) + "/forum/" + rr.group(3)
-  
-    rr = fidre6.search(event_type)
-    if (rr):
-        return rr.group(1) + "/forum/" + rr.group(4)
-  
-    rr = fidre7.search(event_type)
-    if (rr):
-        return rr.group(1) + "/forum/new"
-  
-    rr = fidre8.search(event_type)
-    if (rr):
-        return rr.group(1) + "/forum/" + rr.group(4)
-  
-    # event of going to sequence and seeing last page visited, eg:
-    rr = cidre6.search(event_type)
-    if (rr):
-        return rr.group(1) + "/sequential/" + rr.group(2) + '/'
-  
-    # event of opening a chapter
-    rr = cidre8.search(event_type)
-    if (rr):
-        return rr.group(1) + "/chapter/" + rr.group(2)
 
-    # event of jump_to_id
-    rr = cidre9.search(event_type)
-    if (rr):
-        return rr.group(1) + "/jump_to_id/" + rr.group(2)
+    # server events - ones which do not depend on event (just event_type)
 
-    # event of xblock with i4x
-    rr = cidre10.match(event_type)
-    if (rr):
-        mid = "%s/%s/%s/%s" % (rr.group('org'), rr.group('course'), rr.group('mtype'), rr.group('id'))
-        # sys.stderr.write("ok mid = %s\n" % mid)
-        return mid
+    if et_server_mid:
+        return et_server_mid
 
-    rr = cidre10.match(path)
-    if (rr):
-        mid = "%s/%s/%s/%s" % (rr.group('org'), rr.group('course'), rr.group('mtype'), rr.group('id'))
-        # sys.stderr.write("ok mid = %s\n" % mid)
-        return mid
+    if path_i4x_xblock_mid:
+        # sys.stderr.write("ok mid = %s\n" % path_i4x_xblock_mid)
+        return path_i4x_xblock_mid
 
-    if type(event) in [str, unicode] and event.startswith('input_'):
+    if type(event) in [str, unicode] and event.startswith('input_') and 'input_i4x-' in event:
         #rr = cidre11.search(doc.get('page', ''))
         rr2 = cidre11a.search(event)
         if (rr2):
@@ -367,27 +480,22 @@ def guess_module_id(doc):
             # sys.stderr.write("ok mid = %s\n" % mid)
             return mid
 
-    rr = cidre3.search(event_type)
-    if (rr):
-        if (cidre3a.search(event_type)):   # handle goto_position specially: append new seq position
+    if et_i4x_match:
+        (mid, is_goto_position) = et_i4x_match
+        if is_goto_position:   # handle goto_position specially: append new seq position
             try:
-                mid = rr.group(1) + '/' + event['POST']['position'][0]
+                mid = mid + '/' + event['POST']['position'][0]
                 return mid
             except Exception as err:
                 sys.stderr.write("Failed to handle goto_position for" + doc.get('_id', '<unknown>') + "\n")
                 sys.stderr.write("%s\n" % json.dumps(doc, indent=4))
-        return rr.group(1)
-  
-    rr = cidre3b.search(event_type)
-    if (rr):
-        mid = "%s/%s/%s/%s" % (rr.group('org'), rr.group('course'), rr.group('mtype'), rr.group('id'))
         return mid
-  
+
     if type(event) in [str, unicode]:
-        rr = cidre3c.search(event)
-        if (rr):
-            mid = "%s/%s/%s/%s" % (rr.group('org'), rr.group('course'), rr.group('mtype'), rr.group('id'))
-            return mid
+        if 'i4x://' in event:
+            rr = cidre3c.search(event)
+            if (rr):
+                return okre_mid(rr)
 
     if (type(event)==str or type(event)==unicode):	# all the rest of the patterns need event to be a dict
         return
@@ -396,11 +504,12 @@ def guess_module_id(doc):
         rr = cidre3.search(event['problem_id'])
         if (rr):
             return rr.group(1)
-  
+
     if (type(event)==dict and event.get('id')): # assumes event is js, not string
-        rr = cidre4.search(event['id'])
-        if (rr):
-            return rr.group(1) + "/" + rr.group(2) + "/video/" + rr.group(3)
+        if '-video-' in event['id']:
+            rr = cidre4.search(event['id'])
+            if (rr):
+                return rr.group(1) + "/" + rr.group(2) + "/video/" + rr.group(3)
 
     return None
 
@@ -408,7 +517,7 @@ def guess_module_id(doc):
 
 def add_moduleid_line(line):
     try:
-        data = json.loads(line)
+        data = jsoncodec.loads(line)
     except Exception as err:
         sys.stderr.write('[addmoduleid] Oops, bad line %s' % line)
         return
@@ -416,7 +525,7 @@ def add_moduleid_line(line):
     try:
         event = data['event']
         if not type(event)==dict:
-            event = json.loads(event)
+            event = jsoncodec.loads(event)
         event_js = True
     except Exception as err:
         event_js = False
@@ -428,7 +537,116 @@ def add_moduleid_line(line):
     # now figure out module_id
     
     add_module_id(data)
-    return json.dumps(data) + '\n'
+    return jsoncodec.dumps(data) + '\n'
+
+#-----------------------------------------------------------------------------
+# unit tests, using py.test
+
+# regression corpus: (log entry, module_id), with module_id values from the original
+# (unstaged) guess_module_id, covering each kind of pattern match
+MODULE_ID_CORPUS = [
+    ({'page': 'https://www.edx.org/courses/MITx/DemoX/Demo_course/courseware/interactive_demonstrations/visualizations/', 'event_source': 'mobile', 'event_type': '/courses/HarvardX/CB22x/2013_Spring/courseware/01356a17b5924b17a04b7fc2426a3798/', 'context': {'path': '/event'}, 'event': {'POST': {}}},
+     'HarvardX/CB22x/chapter/01356a17b5924b17a04b7fc2426a3798'),
+    ({'event_source': 'browser', 'event_type': '/courses/HarvardX/CB22x/2013_Spring/discussion/forum/i4x-HarvardX-CB22x-course-2013_Spring/threads/50ed8e41a2ecea250000000a', 'context': {'path': ''}, 'event': '{"POST": {"body": ["I\'m currently working on my PhD'},
+     'HarvardX/CB22x/forum/50ed8e41a2ecea250000000a'),
+    ({'page': '', 'event_source': 'server', 'event_type': '/courses/HarvardX/CB22x/2013_Spring/discussion/threads/511d113eee508c21000000e6/reply', 'context': {'path': '/courses/MITx/6.00x/2013_Spring/courseware/'}, 'event': {'problem_id': 'i4x://MITx/2.01x/problem/E6_1_1/'}},
+     'HarvardX/CB22x/forum/511d113eee508c21000000e6'),
+    ({'page': None, 'event_source': 'server', 'event_type': '/courses/HarvardX/CB22x/2013_Spring/discussion/i4x-HarvardX-CB22x-course-2013_Spring/threads/create', 'context': {'path': ''}, 'event': 'input_i4x-HarvardX-PH207x-problem-wk2_hw2_HW02p04_2_1=0.0655&input_i4x-HarvardX-PH207x-problem-wk2_hw2_HW02p04_3_1=0.0313'},
+     'HarvardX/CB22x/forum/new'),
+    ({'event_source': 'mobile', 'event_type': '/courses/HarvardX/CB22x/2013_Spring/courseware/69569a7536674a3c87d9675ddb48f100/b6d64278fc1e4da2a0059314c8064e28/', 'event': {'new': 3, 'old': 1, 'id': 'i4x://MITx/DemoX/sequential/visualizations'}},
+     'HarvardX/CB22x/sequential/b6d64278fc1e4da2a0059314c8064e28/'),
+    ({'page': 'https://www.edx.org/courses/HarvardX/CB22x/2013_Spring/courseware/69569a7536674a3c87d9675ddb48f100/d49b3020ecd8418db3854cd8fef8f33a/', 'event_source': 'browser', 'event_type': 'page_close', 'context': {'path': '/courses/MITx/8.MReVx/2T2014/xblock/i4x:;_;_MITx;_8.MReVx;_split_test;_Quiz_Zero_randxyzLQ56GIPQ/handler/log_child_render'}, 'event': {'POST': {}}},
+     'HarvardX/CB22x/sequential/d49b3020ecd8418db3854cd8fef8f33a/'),
+    ({'page': 'https://www.edx.org/courses/HarvardX/CB22x/2013_Spring/courseware/69569a7536674a3c87d9675ddb48f100/d49b3020ecd8418db3854cd8fef8f33a/', 'event_source': 'browser', 'event_type': '/courses/HarvardX/PH207x/2012_Fall/discussion/forum/ph207_BioHW4_P1/threads/50982ebaafd02a1f0000007f', 'event': {'id': '5ddc3c000e2e4e1b947615b1c92d2b8e'}},
+     'HarvardX/PH207x/forum/50982ebaafd02a1f0000007f'),
+    ({'page': 'https://www.edx.org/courses/MITx/DemoX/Demo_course/courseware/interactive_demonstrations/visualizations/', 'event_source': 'browser', 'event_type': 'stop_video', 'context': {}, 'event': 'input_i4x-HarvardX-PH207x-problem-wk2_hw2_HW02p04_2_1=0.0655&input_i4x-HarvardX-PH207x-problem-wk2_hw2_HW02p04_3_1=0.0313'},
+     'HarvardX/PH207x/problem/wk2_hw2_HW02p04'),
+    ({'page': 'https://www.edx.org/courses/HarvardX/PH207x/2012_Fall/courseware/Week_2/Homework_2/', 'event_source': 'browser', 'event_type': 'page_close', 'event': ['input_i4x-MITx-DemoX-problem-Sample_Algebraic_Problem_2_1=3']},
+     'HarvardX/PH207x/sequential/Homework_2/'),
+    ({'page': 'x_module', 'event_source': 'mobile', 'event_type': 'page_close', 'context': {'path': '/event'}, 'event': {'id': 'i4x-HarvardX-PH207x-video-Solutions_to_Prevalence_Questions', 'currentTime': 1}},
+     'HarvardX/PH207x/video/Solutions_to_Prevalence_Questions'),
+    ({'page': 'https://www.edx.org/courses/MITx/DemoX/Demo_course/courseware/interactive_demonstrations/visualizations/', 'event_source': 'mobile', 'event_type': '/courses/MITx/16.101x/2013_SOND/jump_to_id/16101x_Assumptions', 'context': {'path': '/event'}, 'event': 3},
+     'MITx/16.101x/jump_to_id/16101x_Assumptions'),
+    ({'page': None, 'event_source': 'browser', 'event_type': '/courses/MITx/18.01.1x/2T2015/xblock/i4x:;_;_MITx;_18.01.1x;_problem;_ps0A-tab2-problem3/handler/xmodule_handler/input_ajax', 'context': {'path': '/courses/MITx/6.00x/2013_Spring/courseware/'}, 'event': ''},
+     'MITx/18.01.1x/problem/ps0A-tab2-problem3'),
+    ({'page': 'https://www.edx.org/courses/HarvardX/PH207x/2012_Fall/courseware/Week_2/Homework_2/', 'event_source': 'mobile', 'event_type': 'edx.course.enrollment.activated', 'context': {}, 'event': 'i4x://MITx/2.01x/problem/E6_1_1/ in a string'},
+     'MITx/2.01x/problem/E6_1_1'),
+    ({'page': 'https://courses.edx.org/courses/course-v1:MITx+CTL.SC1x_1+2T2015/courseware/eb6a807af0324d9caaaab908133f3e7c/d05755d771d9486aa78ba888fdcc4125/', 'event_source': 'mobile', 'event_type': '/courses/HarvardX/CB22x/2013_Spring/discussion/forum/i4x-HarvardX-CB22x-course-2013_Spring/threads/50ed8e41a2ecea250000000a', 'context': {}, 'event': {'id': 'i4x-MITx-3_086-2x-video-5ddc3c000e2e4e1b947615b1c92d2b8e'}},
+     'MITx/3_086-2x/video/5ddc3c000e2e4e1b947615b1c92d2b8e'),
+    ({'page': 'https://www.edx.org/courses/HarvardX/PH207x/2012_Fall/courseware/Week_2/Homework_2/', 'event_source': 'server', 'event_type': '/courses/MITx/6.00.1x_5/1T2015/xqueue/3516/i4x://MITx/6.00.1x_5/problem/L4:L4_Problem_9/score_update', 'context': {'path': ''}, 'event': '{"POST": {"position": ["4"]}}'},
+     'MITx/6.00.1x_5/problem/L4:L4_Problem_9'),
+    ({'page': 'x_module', 'event_source': 'mobile', 'event_type': 'edx.course.enrollment.activated', 'context': {'path': ''}, 'event': 'block-v1:MITx+6.00.1x_6+2T2015+type@problem+block@abc in a string'},
+     'MITx/6.00.1x_6/problem/abc in a string'),
+    ({'page': 'https://www.edx.org/courses/MITx/DemoX/Demo_course/courseware/interactive_demonstrations/visualizations/', 'event_source': 'server', 'event_type': 'page_close', 'context': {'path': '/courses/course-v1:MITx+6.00.1x_6+2T2015/xblock/block-v1:MITx+6.00.1x_6+2T2015+type@recommender+block@0d6bcca84ae54095b001d338a5b4705b/handler/handle_vote'}, 'event': [1]},
+     'MITx/6.00.1x_6/recommender/0d6bcca84ae54095b001d338a5b4705b'),
+    ({'page': 'https://www.edx.org/courses/HarvardX/PH207x/2012_Fall/courseware/Week_2/Homework_2/', 'event_source': 'server', 'event_type': '/courses/MITx/16.101x/2013_SOND/jump_to_id/16101x_Assumptions/', 'context': {'path': '/courses/course-v1:MITx+6.00.1x_6+2T2015/xblock/block-v1:MITx+6.00.1x_6+2T2015+type@sequential+block@videosequence:Lecture_3'}, 'event': {'id': 'i4x-MITx-3_086-2x-video-5ddc3c000e2e4e1b947615b1c92d2b8e'}},
+     'MITx/6.00.1x_6/sequential/videosequence:Lecture_3'),
+    ({'page': 'x_module', 'event_source': 'browser', 'event_type': 'seq_next', 'event': 'input_i4x-MITx-6_00_1x_5-problem-5bada2f1e64249f996ee1a37df8db810_2_1=abc'},
+     'MITx/6_00_1x_5/problem/5bada2f1e64249f996ee1a37df8db810'),
+    ({'page': 'https://courses.edx.org/courses/course-v1:MITx+8.MechCx_2+2T2015/courseware/Unit_0/Quiz_Zero_randxyzLQ56GIPQ/', 'event_source': 'browser', 'event_type': '/courses/MITx/8.MReVx/2T2014/modx/i4x://MITx/8.MReVx/problem/Week_1_p1/problem_check', 'context': {}, 'event': 'i4x://MITx/2.01x/problem/E6_1_1/ in a string'},
+     'MITx/8.MReVx/problem/Week_1_p1'),
+    ({'event_source': 'mobile', 'event_type': '/courses/MITx/8.MReVx/2T2014/modx/i4x://MITx/8.MReVx/sequential/Week_1/goto_position', 'context': {'path': ''}, 'event': 'i4x://MITx/2.01x/problem/E6_1_1/ in a string'},
+     'MITx/8.MReVx/sequential/Week_1'),
+    ({'page': 'https://www.edx.org/courses/MITx/DemoX/Demo_course/courseware/interactive_demonstrations/visualizations/#', 'event_source': 'server', 'event_type': '/courses/MITx/8.MReVx/2T2014/modx/i4x://MITx/8.MReVx/sequential/Week_1/goto_position', 'context': {}, 'event': {'POST': {'position': ['4']}, 'GET': {}}},
+     'MITx/8.MReVx/sequential/Week_1/4'),
+    ({'page': 'https://courses.edx.org/courses/course-v1:MITx+CTL.SC1x_1+2T2015/courseware/eb6a807af0324d9caaaab908133f3e7c/d05755d771d9486aa78ba888fdcc4125/', 'event_source': 'browser', 'event_type': 'play_video', 'context': {'path': '/courses/MITx/8.MReVx/2T2014/xblock/i4x:;_;_MITx;_8.MReVx;_split_test;_Quiz_Zero_randxyzLQ56GIPQ/handler/log_child_render'}, 'event': ['x']},
+     'MITx/8.MReVx/split_test/Quiz_Zero_randxyzLQ56GIPQ'),
+    ({'page': '', 'event_source': 'server', 'event_type': '/courses/course-v1:MITx+8.MechCx_2+2T2015/xblock/block-v1:MITx+8.MechCx_2+2T2015+type@problem+block@Blocks_on_Ramp_randxyzBILNKOA0/handler/xmodule_handler/problem_check', 'context': {'path': None}, 'event': '{"POST": {"position": ["4"]}}'},
+     'MITx/8.MechCx_2/problem/Blocks_on_Ramp_randxyzBILNKOA0'),
+    ({'page': 'https://courses.edx.org/courses/course-v1:MITx+8.MechCx_2+2T2015/courseware/Unit_0/Quiz_Zero_randxyzLQ56GIPQ/', 'event_source': 'server', 'event_type': '/courses/MITx/18.01.1x/2T2015/xblock/i4x:;_;_MITx;_18.01.1x;_problem;_ps0A-tab2-problem3/handler/xmodule_handler/input_ajax', 'event': 'input_i4x-HarvardX-PH207x-problem-wk2_hw2_HW02p04_2_1=0.0655&input_i4x-HarvardX-PH207x-problem-wk2_hw2_HW02p04_3_1=0.0313'},
+     'MITx/8.MechCx_2/problem/i4x-HarvardX-PH207x-problem-wk2_hw2_HW02p04'),
+    ({'page': 'https://courses.edx.org/courses/course-v1:MITx+8.MechCx_2+2T2015/courseware/Unit_0/Quiz_Zero_randxyzLQ56GIPQ/', 'event_source': 'browser', 'event_type': '/courses/MITx/6.00.1x_5/1T2015/xqueue/3516/i4x://MITx/6.00.1x_5/problem/L4:L4_Problem_9/score_update', 'context': {'path': '/courses/MITx/6.00x/2013_Spring/courseware/'}, 'event': 'input_i4x-MITx-6_00_1x_5-problem-5bada2f1e64249f996ee1a37df8db810_2_1=abc'},
+     'MITx/8.MechCx_2/problem/i4x-MITx-6_00_1x_5-problem-5bada2f1e64249f996ee1a37df8db810'),
+    ({'page': 'https://courses.edx.org/courses/course-v1:MITx+8.MechCx_2+2T2015/courseware/Unit_0/Quiz_Zero_randxyzLQ56GIPQ/', 'event_source': 'mobile', 'event_type': 'problem_graded', 'context': {'path': '/courses/MITx/6.00x/2013_Spring/courseware/'}, 'event': ['input_i4x-MITx-DemoX-problem-Sample_Algebraic_Problem_2_1=3']},
+     'MITx/8.MechCx_2/problem/i4x-MITx-DemoX-problem-Sample_Algebraic_Problem'),
+    ({'page': 'https://courses.edx.org/courses/course-v1:MITx+8.MechCx_2+2T2015/courseware/Unit_0/Quiz_Zero_randxyzLQ56GIPQ/', 'event_source': 'server', 'event_type': '/courses/MITx/6.00.1x_5/1T2015/xqueue/3516/i4x://MITx/6.00.1x_5/problem/L4:L4_Problem_9/score_update', 'event': 'input_i4x-MITx-DemoX-problem-Sample_Algebraic_Problem_2_1_comment=hi'},
+     'MITx/8.MechCx_2/problem/i4x-MITx-DemoX-problem-Sample_Algebraic_Problem_2'),
+    ({'page': 'https://courses.edx.org/courses/course-v1:MITx+8.MechCx_2+2T2015/courseware/Unit_0/Quiz_Zero_randxyzLQ56GIPQ/', 'event_source': 'server', 'event_type': 'play_video', 'context': {}, 'event': {'id': '5ddc3c000e2e4e1b947615b1c92d2b8e'}},
+     'MITx/8.MechCx_2/video/5ddc3c000e2e4e1b947615b1c92d2b8e'),
+    ({'page': 'https://courses.edx.org/courses/course-v1:MITx+CTL.SC1x_1+2T2015/courseware/eb6a807af0324d9caaaab908133f3e7c/d05755d771d9486aa78ba888fdcc4125/', 'event_source': 'browser', 'event_type': '/courses/MITx/18.01.1x/2T2015/xblock/i4x:;_;_MITx;_18.01.1x;_problem;_ps0A-tab2-problem3/handler/xmodule_handler/input_ajax', 'context': {'path': '/courses/MITx/8.MReVx/2T2014/xblock/i4x:;_;_MITx;_8.MReVx;_split_test;_Quiz_Zero_randxyzLQ56GIPQ/handler/log_child_render'}, 'event': 'input_Blocks_on_Ramp_randxyzBILNKOA0_2_1=choice_3'},
+     'MITx/CTL.SC1x_1/problem/Blocks_on_Ramp_randxyzBILNKOA0'),
+    ({'page': 'https://courses.edx.org/courses/course-v1:MITx+CTL.SC1x_1+2T2015/courseware/eb6a807af0324d9caaaab908133f3e7c/d05755d771d9486aa78ba888fdcc4125/', 'event_source': 'server', 'event_type': 'problem_graded', 'event': 'input_i4x-HarvardX-PH207x-problem-wk2_hw2_HW02p04_2_1=0.0655&input_i4x-HarvardX-PH207x-problem-wk2_hw2_HW02p04_3_1=0.0313'},
+     'MITx/CTL.SC1x_1/problem/i4x-HarvardX-PH207x-problem-wk2_hw2_HW02p04'),
+    ({'page': 'https://courses.edx.org/courses/course-v1:MITx+CTL.SC1x_1+2T2015/courseware/eb6a807af0324d9caaaab908133f3e7c/d05755d771d9486aa78ba888fdcc4125/', 'event_source': 'mobile', 'event_type': '/courses/MITx/8.MReVx/2T2014/modx/i4x://MITx/8.MReVx/problem/Week_1_p1/problem_check', 'context': {'path': '/courses/MITx/6.00x/2013_Spring/courseware/'}, 'event': 'input_i4x-MITx-6_00_1x_5-problem-5bada2f1e64249f996ee1a37df8db810_2_1=abc'},
+     'MITx/CTL.SC1x_1/problem/i4x-MITx-6_00_1x_5-problem-5bada2f1e64249f996ee1a37df8db810'),
+    ({'page': 'https://courses.edx.org/courses/course-v1:MITx+CTL.SC1x_1+2T2015/courseware/eb6a807af0324d9caaaab908133f3e7c/d05755d771d9486aa78ba888fdcc4125/', 'event_source': 'browser', 'event_type': 'problem_graded', 'context': {'path': '/event'}, 'event': ['input_i4x-MITx-DemoX-problem-Sample_Algebraic_Problem_2_1=3']},
+     'MITx/CTL.SC1x_1/problem/i4x-MITx-DemoX-problem-Sample_Algebraic_Problem'),
+    ({'page': 'https://courses.edx.org/courses/course-v1:MITx+CTL.SC1x_1+2T2015/courseware/eb6a807af0324d9caaaab908133f3e7c/d05755d771d9486aa78ba888fdcc4125/', 'event_source': 'mobile', 'event_type': 'problem_check', 'context': {}, 'event': 'input_i4x-MITx-DemoX-problem-Sample_Algebraic_Problem_2_1_comment=hi'},
+     'MITx/CTL.SC1x_1/problem/i4x-MITx-DemoX-problem-Sample_Algebraic_Problem_2'),
+    ({'page': 'https://www.edx.org/courses/MITx/DemoX/Demo_course/courseware/interactive_demonstrations/visualizations/', 'event_source': 'browser', 'event_type': '/courses/course-v1:MITx+CTL.SC1x_1+2T2015/xblock/block-v1:MITx+CTL.SC1x_1+2T2015+type@sequential+block@5aff08b86e0e431e8ef29b0fbe52ecb', 'context': {'path': ''}, 'event': 3},
+     'MITx/CTL.SC1x_1/sequential/5aff08b86e0e431e8ef29b0fbe52ecb'),
+    ({'page': 'https://courses.edx.org/courses/course-v1:MITx+CTL.SC1x_1+2T2015/courseware/eb6a807af0324d9caaaab908133f3e7c/d05755d771d9486aa78ba888fdcc4125/', 'event_source': 'mobile', 'event_type': 'play_video', 'context': {}, 'event': {'id': '5ddc3c000e2e4e1b947615b1c92d2b8e'}},
+     'MITx/CTL.SC1x_1/video/5ddc3c000e2e4e1b947615b1c92d2b8e'),
+    ({'page': 'https://www.edx.org/courses/MITx/DemoX/Demo_course/courseware/interactive_demonstrations/', 'event_source': 'browser', 'event_type': 'page_close', 'context': {'path': '/event'}, 'event': {'POST': {}}},
+     'MITx/DemoX/chapter/interactive_demonstrations/'),
+    ({'page': '', 'event_source': 'server', 'event_type': 'problem_check', 'context': {'path': ''}, 'event': 'input_i4x-MITx-DemoX-problem-Sample_Algebraic_Problem_2_1_comment=hi'},
+     'MITx/DemoX/problem/Sample_Algebraic_Problem'),
+    ({'event_source': 'browser', 'event_type': '/courses/MITx/8.MReVx/2T2014/modx/i4x://MITx/8.MReVx/sequential/Week_1/goto_position', 'context': {'path': '/courses/MITx/8.MReVx/2T2014/xblock/i4x:;_;_MITx;_8.MReVx;_split_test;_Quiz_Zero_randxyzLQ56GIPQ/handler/log_child_render'}, 'event': {'new': 3, 'old': 1, 'id': 'i4x://MITx/DemoX/sequential/visualizations'}},
+     'MITx/DemoX/sequential/visualizations'),
+    ({'page': 'https://www.edx.org/courses/MITx/DemoX/Demo_course/courseware/interactive_demonstrations/visualizations/', 'event_source': 'browser', 'event_type': 'page_close', 'context': {'path': '/event'}, 'event': ['x']},
+     'MITx/DemoX/sequential/visualizations/'),
+    ({'page': None, 'event_source': 'browser', 'event_type': 'edx.course.enrollment.activated', 'context': {'path': ''}, 'event': [1]},
+     None),
+    ({'page': 'https://courses.edx.org/courses/course-v1:MITx+CTL.SC1x_1+2T2015/courseware/eb6a807af0324d9caaaab908133f3e7c/d05755d771d9486aa78ba888fdcc4125/', 'event_source': 'mobile', 'event_type': u'/courses/MITx/6.00x/2013_Spring/courseware/ch\xe9/s\xe9q/', 'context': {'path': '/event'}, 'event': []},
+     u'MITx/6.00x/sequential/s\xe9q/'),
+    ({'page': 'https://www.edx.org/courses/MITx/DemoX/Demo_course/courseware/interactive_demonstrations/visualizations/', 'event_source': 'browser', 'event_type': 'seq_goto', 'context': {'path': '/courses/MITx/8.MReVx/2T2014/xblock/i4x:;_;_MITx;_8.MReVx;_split_test;_Quiz_Zero_randxyzLQ56GIPQ/handler/log_child_render'}, 'event': '{"new": 3, "id": "i4x://MITx/DemoX/sequential/visualizations"}'},
+     u'MITx/DemoX/sequential/visualizations/3'),
+]
+
+def test_guess_module_id_corpus():
+    import copy
+    for npass in range(2):	# second pass runs with the memoized stages filled
+        for doc, expected in MODULE_ID_CORPUS:
+            assert guess_module_id(copy.deepcopy(doc)) == expected, doc
+
+def test_memoize_stage_bounded():
+    calls = []
+    stage = memoize_stage(lambda s: calls.append(s) or len(s))
+    assert stage('abc') == 3 and stage('abc') == 3
+    assert calls == ['abc']
+    for k in range(MODULE_ID_CACHE_SIZE + 1):
+        stage(str(k))
+    assert len(stage.cache) <= MODULE_ID_CACHE_SIZE
 
 #-----------------------------------------------------------------------------
 
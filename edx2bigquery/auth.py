@@ -141,6 +141,18 @@ def build_bq_client(**args):
   return discovery.build('bigquery', 'v2',
                          http=get_creds().authorize(httplib2.Http(**args)))
 
+def build_pooled_bq_client(pool_size=None, timeout=480):
+  '''Constructs a bigquery client object which may be shared between threads.
+
+  Requests are made through a bqhttp.PooledHttp, with one set of credentials
+  (refreshed once for all threads) and a pool of up to pool_size kept-alive
+  connections.  Returns (client, pooled_http).
+  '''
+  import bqhttp
+  http = bqhttp.PooledHttp(get_creds(), size=pool_size,
+                           http_factory=lambda: httplib2.Http(timeout=timeout))
+  return (discovery.build('bigquery', 'v2', http=http), http)
+
 def main():
   print_creds(get_creds())
 
@@ -11,7 +11,7 @@ import bqutil
 import copy
 import datetime
 from path import Path as path
-from check_schema_tracking_log import check_schema, schema2dict
+from check_schema_tracking_log import compile_schema, schema2dict
 
 def already_exists(course_id, use_dataset_latest=False):
     '''
@@ -44,6 +44,7 @@ def do_save(cid, caset_in, xbundle, datadir, log_msg, use_local_files, use_datas
     mypath = os.path.dirname(os.path.realpath(__file__))
     the_schema = json.loads(open('%s/schemas/schema_course_axis.json' % mypath).read())['course_axis']
     dict_schema = schema2dict(the_schema)
+    check_axis_schema = compile_schema(dict_schema)
 
     caset = copy.deepcopy(caset_in)
 
@@ -68,7 +69,7 @@ def do_save(cid, caset_in, xbundle, datadir, log_msg, use_local_files, use_datas
             ca['due'] = str(ca['due'])	# datetime to string
         if (ca['data'] is None) or (ca['data']==''):
             ca.pop('data')
-        check_schema(linecnt, ca, the_ds=dict_schema, coerce=True)
+        check_axis_schema(linecnt, ca, coerce=True)
         try:
             # db.course_axis.insert(ca)
             fp.write(json.dumps(ca)+'\n')
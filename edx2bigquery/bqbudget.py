@@ -0,0 +1,196 @@
+#!/usr/bin/python
+#
+# File:   bqbudget.py
+#
+# Bytes-processed budget for BigQuery queries.  The bytes a query processes
+# are what it costs, and a dry run of the query (a jobs.insert with
+# configuration.dryRun set) reports them without running it.
+#
+# When a budget is set (--max-bytes-per-run, or BQ_MAX_BYTES_PER_RUN in
+# edx2bigquery_config), bqutil.create_bq_table dry-runs each query first, and
+# charges its estimated bytes to the query's course (the course dataset, with
+# any _logs, _pcday, or _latest suffix removed).  When the query is done, the
+# charge is settled: replaced by the bytes it actually processed, or refunded
+# if it failed (or failed to be inserted).  A query which would take its
+# course over the budget is refused (BudgetExceeded is raised), or, if the
+# budget defers, is not run, and is listed in budget.deferred, to be run later;
+# QueryDeferred is raised for it, so that the step needing the table fails
+# (rather than going on with a stale table), and can be rerun, eg with
+# nightly --only-changed, which reruns failed steps.
+#
+# As for bqjobs, the jobs service only needs insert(body, projectId), returning
+# a request with execute(), so a fake service can stand in for BigQuery in tests.
+
+import sys
+import threading
+
+import retry
+
+DATASET_SUFFIXES = ['_logs', '_pcday', '_latest']
+
+#-----------------------------------------------------------------------------
+
+class BudgetExceeded(Exception):
+    pass
+
+class QueryDeferred(BudgetExceeded):
+    '''
+    The query is over the budget, and was deferred (listed in BytesBudget.deferred) rather than run.
+    '''
+    pass
+
+def dry_run_bytes(jobs_service, config, project_id):
+    '''
+    Dry-run the job with configuration config (eg {'query': {...}}), in project_id, and return the number of
+    bytes it would process.  Errors in the query (eg bad SQL) are raised, as for the real job.
+    '''
+    body = {'configuration': dict(config, dryRun=True)}
+    job = retry.execute(jobs_service.insert(body=body, projectId=project_id), label='jobs.insert (dry run)')
+    stats = job.get('statistics', {})
+    return int(stats.get('query', {}).get('totalBytesProcessed', stats.get('totalBytesProcessed', 0)))
+
+def course_for_dataset(dataset_id):
+    '''
+    Key for the course which dataset_id belongs to: the dataset, without its _logs, _pcday or _latest suffix.
+    '''
+    for suffix in DATASET_SUFFIXES:
+        if dataset_id.endswith(suffix):
+            return dataset_id[:-len(suffix)]
+    return dataset_id
+
+def format_bytes(nbytes):
+    for unit in ['bytes', 'kB', 'MB', 'GB']:
+        if nbytes < 1024:
+            break
+        nbytes /= 1024.0
+    else:
+        unit = 'TB'
+    return '%.2f %s' % (nbytes, unit)
+
+class BytesBudget(object):
+    '''
+    Maximum bytes processed by the queries of each course, in one run.  totals has the bytes charged so far,
+    per course, and deferred the (dataset_id, table_id, nbytes) of queries deferred for being over budget.
+    '''
+    def __init__(self, max_bytes, defer=False):
+        self.max_bytes = max_bytes
+        self.defer = defer
+        self.totals = {}
+        self.deferred = []
+        self.lock = threading.Lock()		# courses may be run in threads
+
+    def charge(self, dataset_id, table_id, nbytes, logger=None):
+        '''
+        Charge nbytes, the estimated bytes processed by the query creating dataset_id.table_id, to its course.
+        Returns True if the query may be run; raises QueryDeferred if it is deferred, or BudgetExceeded if it
+        is refused.  Queries which are not run are not charged; the charge for a query which is run stands
+        until it is settled.
+        '''
+        course = course_for_dataset(dataset_id)
+        with self.lock:
+            total = self.totals.get(course, 0) + nbytes
+            if total <= self.max_bytes:
+                self.totals[course] = total
+                return True
+            if self.defer:
+                self.deferred.append((dataset_id, table_id, nbytes))
+        msg = "[bqbudget] Query for %s.%s would process %s, taking %s to %s, over the budget of %s" % (
+            dataset_id, table_id, format_bytes(nbytes), course, format_bytes(total), format_bytes(self.max_bytes))
+        if not self.defer:
+            raise BudgetExceeded(msg)
+        if logger is not None:
+            logger(msg + "; deferring it")
+        raise QueryDeferred(msg + "; deferred")
+
+    def settle(self, dataset_id, charged, nbytes):
+        '''
+        Replace the charge of charged bytes, for a query on dataset_id, by the nbytes it actually processed
+        (0 if it failed).
+        '''
+        course = course_for_dataset(dataset_id)
+        with self.lock:
+            self.totals[course] = self.totals.get(course, 0) + nbytes - charged
+
+    def report(self, ofp=sys.stdout):
+        for course in sorted(self.totals):
+            ofp.write("[bqbudget] %s: %s processed (budget %s)\n" % (course, format_bytes(self.totals[course]),
+                                                                    format_bytes(self.max_bytes)))
+        for (dataset_id, table_id, nbytes) in self.deferred:
+            ofp.write("[bqbudget] deferred %s.%s (%s)\n" % (dataset_id, table_id, format_bytes(nbytes)))
+        if self.deferred:
+            ofp.write("[bqbudget] the steps needing the deferred tables failed, and should be rerun\n")
+
+#-----------------------------------------------------------------------------
+# unit tests, using py.test
+
+class FakeRequest(object):
+    def __init__(self, fn):
+        self.fn = fn
+
+    def execute(self):
+        return self.fn()
+
+class FakeDryRunJobsService(object):
+    '''
+    Stands in for the BigQuery jobs service, for dry runs: a query processes the number of bytes in
+    self.nbytes[query] (default 1000), and queries containing "bad" fail.
+    '''
+    def __init__(self):
+        self.nbytes = {}
+        self.bodies = []
+
+    def insert(self, body, projectId):
+        def do_insert():
+            self.bodies.append(body)
+            query = body['configuration']['query']['query']
+            if 'bad' in query:
+                raise Exception('HttpError 400 "Invalid query"')
+            nbytes = self.nbytes.get(query, 1000)
+            return {'status': {'state': 'DONE'},
+                    'statistics': {'totalBytesProcessed': str(nbytes), 'query': {'totalBytesProcessed': str(nbytes)}}}
+        return FakeRequest(do_insert)
+
+def test_dry_run_bytes():
+    service = FakeDryRunJobsService()
+    service.nbytes['select a from t'] = 12345
+    config = {'query': {'query': 'select a from t', 'writeDisposition': 'WRITE_TRUNCATE'}}
+    assert dry_run_bytes(service, config, 'proj') == 12345
+    assert service.bodies[0]['configuration']['dryRun'] is True
+    assert 'dryRun' not in config
+    try:
+        dry_run_bytes(service, {'query': {'query': 'bad sql'}}, 'proj')
+        assert False
+    except Exception as err:
+        assert 'Invalid query' in str(err)
+
+def test_bytes_budget():
+    assert course_for_dataset('MITx__6_002x__2013_Spring_logs') == 'MITx__6_002x__2013_Spring'
+    assert course_for_dataset('MITx__6_002x__2013_Spring_pcday') == 'MITx__6_002x__2013_Spring'
+    assert format_bytes(1536) == '1.50 kB'
+
+    budget = BytesBudget(1000)
+    assert budget.charge('course_a_latest', 't1', 600)
+    assert budget.charge('course_b_latest', 't1', 600)		# budget is per course
+    try:
+        budget.charge('course_a_logs', 't2', 500)
+        assert False
+    except BudgetExceeded as err:
+        assert 'course_a_logs.t2' in str(err)
+    assert budget.totals == {'course_a': 600, 'course_b': 600}
+
+    budget = BytesBudget(1000, defer=True)
+    msgs = []
+    assert budget.charge('course_a', 't1', 600, logger=msgs.append)
+    try:
+        budget.charge('course_a', 't2', 500, logger=msgs.append)
+        assert False
+    except QueryDeferred as err:
+        assert 'course_a.t2' in str(err)
+    assert budget.charge('course_a', 't3', 400, logger=msgs.append)
+    assert budget.deferred == [('course_a', 't2', 500)] and budget.totals == {'course_a': 1000}
+    assert len(msgs) == 1 and 'deferring' in msgs[0]
+
+    budget.settle('course_a_latest', 400, 0)			# t3 failed: refunded
+    budget.settle('course_a', 600, 550)				# t1 processed less than estimated
+    assert budget.totals == {'course_a': 550}
+    assert budget.charge('course_a', 't2', 450)
@@ -0,0 +1,191 @@
+#!/usr/bin/python
+#
+# File:   bqhttp.py
+#
+# Thread-safe HTTP transport for the BigQuery API client.
+#
+# An authorized httplib2.Http (credentials.authorize(http)) can't be used by
+# two threads at once, and refreshes its token by itself, so each thread (or
+# process) used to build its own, with its own credentials and client.
+#
+# PooledHttp stands in for such an Http, for discovery.build(..., http=...):
+# each request borrows an httplib2.Http from a pool (keeping its connections
+# alive for later requests), and the one shared access token is added to its
+# headers.  The token is refreshed once, under a lock, when it has expired or
+# a request gets a 401, however many threads are making requests.
+#
+# After a fork, the child process starts a fresh pool (connections of the
+# parent are not reused), but keeps the credentials and their access token.
+
+import os
+import threading
+
+import edx2bigquery_config
+
+BQ_HTTP_POOL_SIZE = getattr(edx2bigquery_config, 'BQ_HTTP_POOL_SIZE', 16)	# max concurrent requests, per process
+BQ_HTTP_TIMEOUT = 480								# seconds
+
+#-----------------------------------------------------------------------------
+
+def make_http(timeout=BQ_HTTP_TIMEOUT):
+    import httplib2
+    return httplib2.Http(timeout=timeout)
+
+class PooledHttp(object):
+    '''
+    Pool of up to size httplib2.Http objects (made by http_factory), making requests authorized by credentials
+    (an oauth2client Credentials); safe to share between threads.
+    '''
+    def __init__(self, credentials, size=None, http_factory=make_http):
+        self.credentials = credentials
+        self.size = size or BQ_HTTP_POOL_SIZE
+        self.http_factory = http_factory
+        self.refresh_lock = threading.Lock()
+        self.nrefresh = 0
+        self.reset()
+
+    def reset(self):
+        '''
+        Start a new, empty pool (for this process).
+        '''
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.available = threading.Semaphore(self.size)
+        self.idle = []
+        self.ncreated = 0
+
+    def checkout(self):
+        if self.pid != os.getpid():
+            self.reset()
+        self.available.acquire()
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+            self.ncreated += 1
+        try:
+            return self.http_factory()
+        except:
+            self.available.release()
+            raise
+
+    def checkin(self, http):
+        with self.lock:
+            if self.pid == os.getpid():
+                self.idle.append(http)
+                self.available.release()
+
+    def token_expired(self):
+        return not self.credentials.access_token or self.credentials.access_token_expired
+
+    def refresh(self, stale_token=None):
+        '''
+        Refresh the access token, unless another thread has already replaced stale_token (or, if stale_token
+        is None, the token is still valid).
+        '''
+        with self.refresh_lock:
+            if stale_token is None and not self.token_expired():
+                return
+            if stale_token is not None and self.credentials.access_token != stale_token:
+                return
+            self.credentials.refresh(self.http_factory())
+            self.nrefresh += 1
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=5, connection_type=None):
+        '''
+        Same as httplib2.Http.request, authorized with the shared access token.
+        '''
+        if self.token_expired():
+            self.refresh()
+        ntries = 0
+        while True:
+            ntries += 1
+            token = self.credentials.access_token
+            req_headers = dict(headers or {})
+            req_headers['Authorization'] = 'Bearer ' + token
+            http = self.checkout()
+            try:
+                (resp, content) = http.request(uri, method, body=body, headers=req_headers,
+                                               redirections=redirections, connection_type=connection_type)
+            finally:
+                self.checkin(http)
+            # retry once with a new token, unless the body is a stream, which has been read
+            if resp.status != 401 or ntries > 1 or not (body is None or isinstance(body, basestring)):
+                return (resp, content)
+            self.refresh(stale_token=token)
+
+#-----------------------------------------------------------------------------
+# unit tests, using py.test
+
+class FakeCredentials(object):
+    def __init__(self):
+        self.access_token = None
+        self.access_token_expired = False
+        self.nrefresh = 0
+
+    def refresh(self, http):
+        self.nrefresh += 1
+        self.access_token = 'token%d' % self.nrefresh
+
+class FakeResponse(dict):
+    def __init__(self, status):
+        dict.__init__(self, status=str(status))
+        self.status = status
+
+class FakeHttp(object):
+    '''
+    Stands in for httplib2.Http: requests are answered with 401 if their token is not in valid, else with 200.
+    '''
+    def __init__(self, valid, log):
+        self.valid = valid
+        self.log = log
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=5, connection_type=None):
+        token = headers['Authorization'].split()[1]
+        self.log.append((id(self), uri, token))
+        if token not in self.valid:
+            return (FakeResponse(401), 'unauthorized')
+        return (FakeResponse(200), uri)
+
+def test_pooled_http():
+    import time
+    from multiprocessing.pool import ThreadPool
+    creds = FakeCredentials()
+    valid = set(['token1'])
+    log = []
+    def slow_http():
+        http = FakeHttp(valid, log)
+        real_request = http.request
+        def request(*args, **kwargs):
+            time.sleep(0.01)
+            return real_request(*args, **kwargs)
+        http.request = request
+        return http
+    pool = PooledHttp(creds, size=3, http_factory=slow_http)
+
+    tpool = ThreadPool(8)
+    out = tpool.map(lambda k: pool.request('/q/%d' % k)[1], range(40))
+    assert out == ['/q/%d' % k for k in range(40)]
+    assert creds.nrefresh == 1		# token fetched once, for all threads
+    assert pool.ncreated == 3 and len(pool.idle) == 3
+    assert len(set(x[0] for x in log)) == 3
+
+    # token revoked: the first 401 gets one refresh, the others reuse the new token
+    valid.clear()
+    valid.add('token2')
+    del log[:]
+    out = tpool.map(lambda k: pool.request('/r/%d' % k)[0].status, range(20))
+    tpool.close()
+    assert out == [200] * 20
+    assert creds.nrefresh == 2 and pool.nrefresh == 2
+    assert set(x[2] for x in log if x[1].startswith('/r/')) <= set(['token1', 'token2'])
+
+    # still 401 with a fresh token: returned, not retried again
+    valid.clear()
+    (resp, content) = pool.request('/s')
+    assert resp.status == 401 and creds.nrefresh == 3
+
+    # a forked child starts its own pool
+    pool.pid = -1
+    valid.add('token3')
+    assert pool.request('/t')[0].status == 200
+    assert pool.ncreated == 1 and len(pool.idle) == 1
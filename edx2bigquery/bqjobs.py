@@ -0,0 +1,466 @@
+#!/usr/bin/python
+#
+# File:   bqjobs.py
+#
+# Concurrent BigQuery jobs: JobManager.submit inserts a job and returns a
+# JobHandle at once; the manager polls all of its running jobs in one loop,
+# with exponential backoff per job (from BQ_JOB_POLL_MIN up to BQ_JOB_POLL_MAX
+# seconds between jobs.get calls), and keeps at most BQ_MAX_JOBS_IN_FLIGHT jobs
+# running per project, queueing the rest until a slot frees up.  Inserts which
+# fail with transient errors (see retry.is_retryable) are queued again, to be
+# retried after a backoff delay, without holding up the other jobs.  So are jobs
+# submitted with a job_retry policy (eg retry.JOB_RETRY) which finish with a
+# transient error (eg a BigQuery internal error): they are rerun, as a new job.
+#
+# Example:
+#
+#     manager = bqjobs.JobManager()
+#     handles = [bqutil.create_bq_table(dataset, table, sql, job_manager=manager) for (table, sql) in todo]
+#     manager.wait()
+#     jobs = [x.result() for x in handles]	# raises if the job failed
+#
+# The jobs service (bqutil.jobs by default) only needs insert(body, projectId)
+# and get(projectId, jobId), each returning a request with execute(), so a fake
+# service can stand in for BigQuery in tests.
+
+import sys
+import time
+
+import edx2bigquery_config
+import retry
+
+BQ_MAX_JOBS_IN_FLIGHT = getattr(edx2bigquery_config, 'BQ_MAX_JOBS_IN_FLIGHT', 20)	# per project
+BQ_JOB_POLL_MIN = getattr(edx2bigquery_config, 'BQ_JOB_POLL_MIN', 1.0)		# seconds
+BQ_JOB_POLL_MAX = getattr(edx2bigquery_config, 'BQ_JOB_POLL_MAX', 30.0)
+BQ_JOB_POLL_BACKOFF = 1.5
+BQ_JOB_MAX_ERRORS = 10		# consecutive jobs.get failures tolerated per job
+
+#-----------------------------------------------------------------------------
+
+class JobHandle(object):
+    '''
+    Handle for a BigQuery job submitted to a JobManager.
+
+    state is QUEUED (waiting for an in-flight slot), RUNNING, or DONE.  job is the job resource, as
+    last returned by jobs.insert or jobs.get (or the job body, while queued).  submitted and inserted are
+    the (manager clock) times of submission and of the (last) jobs.insert, and nretries counts the retried
+    jobs.insert and failed jobs.get calls, and the reruns of the job (see job_retry).
+    '''
+    def __init__(self, manager, job, project_id, callback=None, job_retry=None):
+        self.manager = manager
+        self.job = job
+        self.body = job
+        self.project_id = project_id
+        self.job_id = job['jobReference']['jobId']
+        self.callback = callback
+        self.job_retry = job_retry
+        self.nruns = 1
+        self.state = 'QUEUED'
+        self.value = None
+        self.exception = None
+        self.poll_interval = manager.min_poll
+        self.next_poll = 0
+        self.nerr = 0
+        self.nretries = 0
+        self.ninsert = 0
+        self.submitted = manager.clock()
+        self.inserted = None
+        self.next_insert = 0
+        self.done_callbacks = []
+
+    def __repr__(self):
+        return '<JobHandle %s %s>' % (self.job_id, self.state)
+
+    def done(self):
+        return self.state=='DONE'
+
+    def result(self):
+        '''
+        Wait for the job, and return the result of its callback (or the final job resource, if there
+        is no callback); raises the exception from the insert, the polling, or the callback, if any.
+        '''
+        self.manager.wait([self])
+        if self.exception is not None:
+            raise self.exception
+        return self.value
+
+    def add_done_callback(self, fn):
+        '''
+        Call fn(handle) when the job is done (or now, if it already is).
+        '''
+        if self.done():
+            fn(self)
+        else:
+            self.done_callbacks.append(fn)
+
+class JobManager(object):
+    '''
+    Submit BigQuery jobs without blocking, and poll them all together.
+    '''
+    def __init__(self, jobs_service=None, max_in_flight=None, min_poll=None, max_poll=None,
+                 backoff=BQ_JOB_POLL_BACKOFF, max_errors=BQ_JOB_MAX_ERRORS, retry_policy=None,
+                 sleep=time.sleep, clock=time.time, verbose=False):
+        self._jobs = jobs_service
+        self.max_in_flight = max_in_flight or BQ_MAX_JOBS_IN_FLIGHT
+        self.min_poll = min_poll or BQ_JOB_POLL_MIN
+        self.max_poll = max_poll or BQ_JOB_POLL_MAX
+        self.backoff = backoff
+        self.max_errors = max_errors
+        self.retry_policy = retry_policy or retry.DEFAULT
+        self.sleep = sleep
+        self.clock = clock
+        self.verbose = verbose
+        self.queued = []
+        self.running = []
+        self.nget = 0
+
+    @property
+    def jobs(self):
+        if self._jobs is None:
+            import bqutil
+            self._jobs = bqutil.jobs
+        return self._jobs
+
+    def in_flight(self, project_id):
+        return len([x for x in self.running if x.project_id==project_id])
+
+    def submit(self, job, project_id, callback=None, job_retry=None):
+        '''
+        Submit job (a job resource body, with jobReference) to run in project_id.  callback(job) is
+        called with the final job resource when the job is done; its return value (or exception) becomes
+        the result of the returned JobHandle.  If the job fails with an error which job_retry (a
+        retry.RetryPolicy) allows retrying, it is rerun, as a new job, after the policy's delay.
+        '''
+        handle = JobHandle(self, job, project_id, callback=callback, job_retry=job_retry)
+        self.queued.append(handle)
+        self.start_queued()
+        return handle
+
+    def start_queued(self):
+        for handle in list(self.queued):
+            if self.in_flight(handle.project_id) >= self.max_in_flight:
+                continue
+            if handle.next_insert > self.clock():	# waiting to retry its insert
+                continue
+            self.queued.remove(handle)
+            self.insert(handle)
+
+    def insert(self, handle):
+        handle.inserted = self.clock()
+        handle.ninsert += 1
+        try:
+            handle.job = self.jobs.insert(body=handle.job, projectId=handle.project_id).execute()
+        except Exception as err:
+            if handle.ninsert > 1 and 'Already Exists' in str(err):
+                pass			# an earlier, failed-looking, insert went through; poll the job
+            elif self.retry_policy.should_retry(err, handle.ninsert):
+                handle.nretries += 1
+                retry.count('jobs.insert')
+                delay = self.retry_policy.delay(handle.ninsert)
+                print "[bqjobs] oops!  Failed to insert job %s, err=%s; retrying in %.1f sec" % (handle.job_id, str(err),
+                                                                                              delay)
+                handle.next_insert = self.clock() + delay
+                self.queued.append(handle)
+                return
+            else:
+                print "[bqjobs] oops!  Failed to insert job=%s" % handle.job
+                self.finish(handle, exception=err)
+                return
+        handle.state = 'RUNNING'
+        handle.next_poll = self.clock() + handle.poll_interval
+        self.running.append(handle)
+        if handle.job.get('status', {}).get('state')=='DONE':
+            self.finish(handle)
+
+    def poll(self):
+        '''
+        One polling pass: jobs.get for each running job which is due, then start queued jobs if
+        slots have freed up.  Returns the number of jobs not yet done.
+        '''
+        now = self.clock()
+        for handle in list(self.running):
+            if handle.next_poll > now:
+                continue
+            try:
+                self.nget += 1
+                handle.job = self.jobs.get(projectId=handle.project_id, jobId=handle.job_id).execute()
+                handle.nerr = 0
+            except Exception as err:
+                handle.nerr += 1
+                handle.nretries += 1
+                retry.count('jobs.get')
+                print "[bqjobs] oops!  Failed to get status of job %s, err=%s" % (handle.job_id, str(err))
+                if handle.nerr > self.max_errors or not self.retry_policy.retryable(err):
+                    self.finish(handle, exception=err)
+                    continue
+            if handle.job.get('status', {}).get('state')=='DONE':
+                self.finish(handle)
+                continue
+            handle.poll_interval = min(handle.poll_interval * self.backoff, self.max_poll)
+            handle.next_poll = now + handle.poll_interval
+        self.start_queued()
+        return len(self.running) + len(self.queued)
+
+    def rerun(self, handle):
+        '''
+        If the job of handle failed with an error its job_retry policy allows retrying, queue it to be run
+        again, as a new job (with the run number appended to its id); returns True if so.
+        '''
+        error = handle.job.get('status', {}).get('errorResult')
+        if handle.job_retry is None or not error:
+            return False
+        err = Exception('%s: %s' % (error.get('reason'), error.get('message')))
+        if not handle.job_retry.should_retry(err, handle.nruns):
+            return False
+        delay = handle.job_retry.delay(handle.nruns)
+        handle.nruns += 1
+        handle.nretries += 1
+        retry.count('job rerun')
+        print "[bqjobs] oops!  Job %s failed, err=%s; rerunning it in %.1f sec" % (handle.job_id, str(err), delay)
+        job_ref = dict(handle.body['jobReference'], jobId='%s_%d' % (handle.body['jobReference']['jobId'], handle.nruns))
+        handle.job = dict(handle.body, jobReference=job_ref)
+        handle.job_id = job_ref['jobId']
+        handle.state = 'QUEUED'
+        handle.ninsert = 0
+        handle.poll_interval = self.min_poll
+        handle.next_insert = self.clock() + delay
+        self.queued.append(handle)
+        return True
+
+    def finish(self, handle, exception=None):
+        if handle in self.running:
+            self.running.remove(handle)
+        if exception is None and self.rerun(handle):
+            return
+        handle.state = 'DONE'
+        handle.exception = exception
+        if exception is None:
+            if self.verbose:
+                print "[bqjobs] job %s done, status=%s" % (handle.job_id, handle.job.get('status'))
+                sys.stdout.flush()
+            if handle.callback is None:
+                handle.value = handle.job
+            else:
+                try:
+                    handle.value = handle.callback(handle.job)
+                except Exception as err:
+                    handle.exception = err
+        for fn in handle.done_callbacks:
+            fn(handle)
+
+    def wait(self, handles=None):
+        '''
+        Poll until the given handles (all submitted jobs, if None) are done.
+        '''
+        while True:
+            if handles is None:
+                todo = self.running + self.queued
+            else:
+                todo = [x for x in handles if not x.done()]
+            if not todo:
+                return
+            self.poll()
+            times = [x.next_poll for x in self.running] + [x.next_insert for x in self.queued if x.next_insert]
+            if not times:
+                continue
+            delay = min(times) - self.clock()
+            if delay > 0:
+                self.sleep(delay)
+
+    def wait_inserted(self, handles):
+        '''
+        Poll until the given handles are inserted (or have failed to be), retrying failed inserts, but
+        without waiting for the jobs to finish: for jobs submitted without waiting, to a manager which
+        will not be waited on.
+        '''
+        while True:
+            todo = [x for x in handles if x.state=='QUEUED']
+            if not todo:
+                return
+            self.poll()
+            todo = [x for x in todo if x.state=='QUEUED']
+            if not todo:
+                return
+            times = [x.next_poll for x in self.running] + [x.next_insert for x in todo]
+            delay = min(times) - self.clock()
+            if delay > 0:
+                self.sleep(delay)
+
+#-----------------------------------------------------------------------------
+# unit tests, using py.test
+
+class FakeRequest(object):
+    def __init__(self, fn):
+        self.fn = fn
+
+    def execute(self):
+        return self.fn()
+
+class FakeJobsService(object):
+    '''
+    Stands in for the BigQuery jobs service: job <jobId> finishes after the number of jobs.get calls
+    in self.ngets[jobId] (default 3); jobs whose id contains "fail" finish with errors.
+    '''
+    def __init__(self, clock):
+        self.clock = clock
+        self.ngets = {}
+        self.gets = {}
+        self.bodies = {}
+        self.inserted = []
+        self.running = set()
+        self.max_running = 0
+        self.get_errors = 0
+        self.insert_errors = []
+
+    def insert(self, body, projectId):
+        def do_insert():
+            if self.insert_errors:
+                raise self.insert_errors.pop(0)
+            job_id = body['jobReference']['jobId']
+            self.inserted.append(job_id)
+            self.running.add(job_id)
+            self.max_running = max(self.max_running, len(self.running))
+            self.gets[job_id] = []
+            self.bodies[job_id] = body
+            return dict(body, status={'state': 'PENDING'})
+        return FakeRequest(do_insert)
+
+    def get(self, projectId, jobId):
+        def do_get():
+            if self.get_errors:
+                self.get_errors -= 1
+                raise Exception("HttpError 503 backend error")
+            self.gets[jobId].append(self.clock())
+            job = dict(self.bodies[jobId], status={'state': 'RUNNING'})
+            if len(self.gets[jobId]) >= self.ngets.get(jobId, 3):
+                self.running.discard(jobId)
+                job['status'] = {'state': 'DONE'}
+                if 'fail' in jobId:
+                    job['status']['errors'] = [{'message': 'bad sql'}]
+                    job['status']['errorResult'] = {'reason': 'invalidQuery', 'message': 'bad sql'}
+            return job
+        return FakeRequest(do_get)
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, dt):
+        self.slept.append(dt)
+        self.now += dt
+
+def make_job(job_id, project_id='proj'):
+    return {'jobReference': {'jobId': job_id, 'projectId': project_id}, 'configuration': {'query': {'query': 'select 1'}}}
+
+def test_job_manager_backoff_and_cap():
+    clock = FakeClock()
+    service = FakeJobsService(clock)
+    manager = JobManager(service, max_in_flight=2, min_poll=1, max_poll=4, backoff=2, sleep=clock.sleep, clock=clock)
+    service.ngets['slow'] = 6
+    handles = [manager.submit(make_job(x), 'proj') for x in ['slow', 'a', 'b', 'c']]
+    other = manager.submit(make_job('other'), 'proj2')
+    assert [x.state for x in handles] == ['RUNNING', 'RUNNING', 'QUEUED', 'QUEUED']
+    assert other.state == 'RUNNING'		# the cap is per project
+
+    manager.wait()
+    assert all(x.done() and x.exception is None for x in handles)
+    assert handles[0].result()['status']['state'] == 'DONE'
+    assert service.max_running == 3
+    assert service.inserted == ['slow', 'a', 'other', 'b', 'c']
+
+    # polls of one job back off exponentially, up to max_poll
+    gets = service.gets['slow']
+    assert [b - a for (a, b) in zip(gets, gets[1:])] == [2, 4, 4, 4, 4]
+    # all jobs are polled in the same loop, so the batch takes little longer than its slowest job (19 sec),
+    # with c finishing 2 sec later, having waited for a slot
+    assert gets[-1] - 1000 == 19
+    assert clock.now - 1000 == service.gets['c'][-1] - 1000 == 21
+    assert manager.nget == sum(len(x) for x in service.gets.values())
+
+def test_job_manager_callbacks_and_errors():
+    clock = FakeClock()
+    service = FakeJobsService(clock)
+    manager = JobManager(service, min_poll=1, max_errors=2, sleep=clock.sleep, clock=clock)
+
+    def check(job):
+        if 'errors' in job['status']:
+            raise Exception('BQ Error creating table %s' % job['status']['errors'][0]['message'])
+        return job['jobReference']['jobId']
+
+    ok = manager.submit(make_job('ok'), 'proj', callback=check)
+    bad = manager.submit(make_job('fail'), 'proj', callback=check)
+    seen = []
+    ok.add_done_callback(lambda h: seen.append(h.job_id))
+    assert ok.result() == 'ok'
+    assert seen == ['ok']
+    try:
+        bad.result()
+        assert False
+    except Exception as err:
+        assert 'bad sql' in str(err)
+
+    # transient jobs.get errors are retried, too many in a row fail the job
+    service.get_errors = 2
+    flaky = manager.submit(make_job('flaky'), 'proj')
+    assert flaky.result()['status']['state'] == 'DONE'
+    assert flaky.nretries == 2 and flaky.inserted == flaky.submitted
+    service.get_errors = 3
+    lost = manager.submit(make_job('lost'), 'proj')
+    manager.wait()
+    assert '503' in str(lost.exception)
+
+def test_job_manager_insert_retries():
+    clock = FakeClock()
+    service = FakeJobsService(clock)
+    policy = retry.RetryPolicy(max_tries=3, base_delay=10, sleep=clock.sleep, random=lambda: 1.0)
+    manager = JobManager(service, min_poll=1, retry_policy=policy, sleep=clock.sleep, clock=clock)
+
+    # a failed insert is retried after a backoff delay, while the other jobs keep running
+    service.insert_errors = [Exception('HttpError 503 backend error')]
+    flaky = manager.submit(make_job('flaky'), 'proj')
+    other = manager.submit(make_job('other'), 'proj')
+    assert flaky.state == 'QUEUED' and other.state == 'RUNNING'
+    assert other.result()['status']['state'] == 'DONE' and not flaky.done()
+    manager.wait()
+    assert flaky.exception is None and flaky.nretries == 1
+    assert service.gets['flaky'][0] == flaky.inserted + 1 == 1000 + 10 + 1
+    assert service.inserted == ['other', 'flaky']
+
+    # permanent errors are not retried, and nor are transient ones beyond max_tries
+    service.insert_errors = [Exception('HttpError 400 Invalid query')]
+    bad = manager.submit(make_job('bad'), 'proj')
+    assert bad.done() and '400' in str(bad.exception)
+    service.insert_errors = [Exception('HttpError 500 oops')] * 3
+    lost = manager.submit(make_job('lost'), 'proj')
+    manager.wait()
+    assert '500' in str(lost.exception) and lost.nretries == 2
+
+    # with a job_retry policy, jobs failing with internal errors are rerun, as new jobs
+    service.insert_errors = []
+    service.ngets['rerun'] = 1
+    def fail_once(job):
+        if job['jobReference']['jobId']=='rerun':
+            job['status']['errorResult'] = {'reason': 'internalError', 'message': 'internal error'}
+        return job
+    orig_get = service.get
+    service.get = lambda projectId, jobId: FakeRequest(lambda: fail_once(orig_get(projectId, jobId).execute()))
+    rerun = manager.submit(make_job('rerun'), 'proj', job_retry=policy)
+    bad = manager.submit(make_job('fail_norerun'), 'proj', job_retry=policy)	# not an internal error
+    manager.wait()
+    service.get = orig_get
+    assert rerun.exception is None and rerun.job_id == 'rerun_2' and rerun.nruns == 2 and rerun.nretries == 1
+    assert service.inserted[-2:] == ['fail_norerun', 'rerun_2'] and bad.nruns == 1
+
+    # wait_inserted retries the insert, but does not wait for the job
+    service.insert_errors = [Exception('HttpError 503 backend error')] * 2
+    nowait = manager.submit(make_job('nowait'), 'proj')
+    manager.wait_inserted([nowait])
+    assert nowait.state == 'RUNNING' and nowait.nretries == 2 and service.inserted[-1] == 'nowait'
+    service.insert_errors = [Exception('HttpError 400 Invalid query')]
+    badnowait = manager.submit(make_job('badnowait'), 'proj')
+    manager.wait_inserted([badnowait])
+    assert '400' in str(badnowait.exception)
@@ -9,38 +9,90 @@
 import datetime
 import getpass
 import json
+import os
 import sys
 import time
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from multiprocessing.pool import ThreadPool
 
-from google.cloud import bigquery
-
-import auth
+import bqbudget
+import bqjobs
+import compact_rows
 import edx2bigquery_config
+import jobstats
+import metadata_cache
+import retry
 from course_key import to_deprecated_course_id_string
 
 
-service = auth.build_bq_client(timeout=480)
+# The BigQuery client is built on first use (not on import, which would load credentials and the API
+# discovery document even for local commands, like split), once: it makes its requests through a
+# bqhttp.PooledHttp, so it may be shared by threads, and used by processes forked after it was built
+# (which start their own connection pools, but keep the credentials and access token).
+SERVICE = {}
+
+def get_service():
+    if 'service' not in SERVICE:
+        import auth
+        (service, http) = auth.build_pooled_bq_client()
+        SERVICE.update({'service': service, 'http': http})
+    return SERVICE
+
+class LazyResource(object):
+    '''
+    Stands in for a BigQuery API resource collection (eg service.jobs()), creating it on first use.
+    '''
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attr):
+        client = get_service()
+        if self.name not in client:
+            client[self.name] = getattr(client['service'], self.name)()
+        return getattr(client[self.name], attr)
 
-projects = service.projects()
-datasets = service.datasets()
-tables = service.tables()
-tabledata = service.tabledata()
-jobs = service.jobs()
+projects = LazyResource('projects')
+datasets = LazyResource('datasets')
+tables = LazyResource('tables')
+tabledata = LazyResource('tabledata')
+jobs = LazyResource('jobs')
 
 PROJECT_NAMES = {}				# used to cache project names, key=project_id
 DEFAULT_PROJECT_ID = getattr(edx2bigquery_config, 'PROJECT_ID', '')
 BIGQUERY_WRITE_DISPOSITION = 'WRITE_TRUNCATE'
 BIGQUERY_MAX_BAD_RECORDS = 50
 
+# table lists and table metadata are cached for this many seconds (0 to disable); tables created, loaded,
+# or deleted through bqutil are invalidated right away.
+BQ_METADATA_CACHE_TTL = getattr(edx2bigquery_config, 'BQ_METADATA_CACHE_TTL', 300)
+METADATA_CACHE = metadata_cache.TTLCache(BQ_METADATA_CACHE_TTL)	# key=(project_id, dataset_id[, table_id])
+
+# table data is read in pages of BQ_TABLEDATA_PAGE_SIZE rows, with up to BQ_TABLEDATA_WORKERS pages being
+# fetched at the same time
+BQ_TABLEDATA_PAGE_SIZE = getattr(edx2bigquery_config, 'BQ_TABLEDATA_PAGE_SIZE', 20000)
+BQ_TABLEDATA_WORKERS = getattr(edx2bigquery_config, 'BQ_TABLEDATA_WORKERS', 4)
+
+# if set (see set_bytes_budget), queries run by create_bq_table are dry-run first, and refused or deferred (both raise) if
+# they would take their course over this bqbudget.BytesBudget
+BYTES_BUDGET = None
+
 
 def default_logger(msg):
     print msg
 
+def set_bytes_budget(max_bytes, defer=False):
+    '''
+    Limit the bytes processed by the queries of each course to max_bytes (no limit if None); queries over
+    the limit are refused (raising bqbudget.BudgetExceeded), or deferred (not run) if defer=True.
+    '''
+    global BYTES_BUDGET
+    BYTES_BUDGET = bqbudget.BytesBudget(max_bytes, defer=defer) if max_bytes else None
+    return BYTES_BUDGET
+
 def get_project_name(project_id=DEFAULT_PROJECT_ID):
     if project_id in PROJECT_NAMES:		# lookup in cache, first
         return PROJECT_NAMES[project_id]
-    for project in projects.list().execute()['projects']:
+    for project in retry.execute(projects.list())['projects']:
       if (project['id'] == project_id) or (project['numericId'] == str(project_id)):
           PROJECT_NAMES[project_id] = project['id']
           return project['id']
@@ -65,7 +117,16 @@ def course_id2dataset(course_id, dtype=None, use_dataset_latest=False):
     return dataset		# default dataset for SQL data
 
 def delete_dataset(dataset, project_id=DEFAULT_PROJECT_ID, delete_contents=False):
-      datasets.delete(datasetId=dataset, projectId=project_id, deleteContents=delete_contents).execute()
+      retry.execute(datasets.delete(datasetId=dataset, projectId=project_id, deleteContents=delete_contents))
+      METADATA_CACHE.invalidate((project_id, dataset), prefix=True)
+
+def invalidate_table_metadata(dataset_id, table_id, project_id=DEFAULT_PROJECT_ID):
+    '''
+    Drop cached metadata for a table which is being changed, and the cached table list and metadata of its dataset.
+    '''
+    METADATA_CACHE.invalidate((project_id, dataset_id))
+    METADATA_CACHE.invalidate((project_id, dataset_id, table_id))
+    METADATA_CACHE.invalidate((project_id, dataset_id, TABLES_META))
 
 def create_dataset_if_nonexistent(dataset, project_id=DEFAULT_PROJECT_ID):
 
@@ -74,7 +135,7 @@ def create_dataset_if_nonexistent(dataset, project_id=DEFAULT_PROJECT_ID):
                      'projectId': project_id}
       dataset = {'datasetReference': dataset_ref}
       try:
-          dataset = datasets.insert(body=dataset, projectId=project_id).execute()
+          dataset = retry.execute(datasets.insert(body=dataset, projectId=project_id))
       except Exception as err:
           if 'Already Exists' in str(err):
               return dataset
@@ -88,7 +149,7 @@ def get_list_of_datasets(project_id=DEFAULT_PROJECT_ID):
     pageToken = None
     while cnt < 10:
         cnt += 1
-        dataset_list = datasets.list(projectId=project_id, maxResults=4000, pageToken=pageToken).execute()
+        dataset_list = retry.execute(datasets.list(projectId=project_id, maxResults=4000, pageToken=pageToken))
         if 'datasets' in dataset_list:
             new_dsets = {x['datasetReference']['datasetId']: x for x in dataset_list['datasets']}
             dsets.update(new_dsets)
@@ -102,12 +163,25 @@ def get_list_of_datasets(project_id=DEFAULT_PROJECT_ID):
     return dsets
 
 def get_projects(project_id=DEFAULT_PROJECT_ID):
-    for project in projects.list().execute()['projects']:
+    for project in retry.execute(projects.list())['projects']:
         if (project['id'] == project_id):
             print 'Found %s: %s' % (project_id, project['friendlyName'])
 
 def get_tables(dataset_id, project_id=DEFAULT_PROJECT_ID, verbose=False):
-    table_list = tables.list(datasetId=dataset_id, projectId=project_id, maxResults=1000).execute()
+    '''
+    tables.list result for a dataset, with the tables from all of its pages.
+    '''
+    table_list = METADATA_CACHE.get((project_id, dataset_id))
+    if table_list is not metadata_cache.MISSING:
+        return dict(table_list)
+    table_list = retry.execute(tables.list(datasetId=dataset_id, projectId=project_id, maxResults=1000))
+    while table_list.get('nextPageToken'):
+        page = retry.execute(tables.list(datasetId=dataset_id, projectId=project_id, maxResults=1000,
+                                         pageToken=table_list.pop('nextPageToken')))
+        table_list['tables'] = table_list.get('tables', []) + page.get('tables', [])
+        table_list['nextPageToken'] = page.get('nextPageToken')
+    table_list.pop('nextPageToken', None)
+    METADATA_CACHE.put((project_id, dataset_id), dict(table_list))
     if verbose:
         for current in table_list['tables']:
             print "table: ", current
@@ -115,6 +189,44 @@ def get_tables(dataset_id, project_id=DEFAULT_PROJECT_ID, verbose=False):
         print "[bqutil] get_tables: oops! dataset=%s, no table info in %s" % (dataset_id, json.dumps(table_list, indent=4))
     return table_list
 
+TABLES_META = '__TABLES__'
+
+def get_tables_metadata(dataset_id, project_id=DEFAULT_PROJECT_ID):
+    '''
+    Metadata of all the tables in a dataset, from a single query of its __TABLES__ meta-table (instead of a
+    tables.get per table), as a dict of table_id -> dict with creationTime and lastModifiedTime (datetimes),
+    numRows and numBytes, like get_bq_table_info.  Cached (see METADATA_CACHE).
+    '''
+    key = (project_id, dataset_id, TABLES_META)
+    meta = METADATA_CACHE.get(key)
+    if meta is metadata_cache.MISSING:
+        sql = ("SELECT table_id, creation_time, last_modified_time, row_count, size_bytes FROM [%s:%s.__TABLES__]"
+               % (project_id, dataset_id))
+        meta = {}
+        for (table_id, ctime, mtime, nrows, nbytes) in get_query_rows(sql, project_id=project_id):
+            meta[table_id] = {'creationTime': bq_timestamp_milliseconds_to_datetime(ctime),
+                              'lastModifiedTime': bq_timestamp_milliseconds_to_datetime(mtime),
+                              'numRows': int(nrows or 0),
+                              'numBytes': int(nbytes or 0),
+                              }
+        METADATA_CACHE.put(key, meta)
+    return dict(meta)
+
+def get_query_rows(sql, project_id=DEFAULT_PROJECT_ID, timeout_ms=60000):
+    '''
+    Run a small (legacy SQL) query with jobs.query, without a destination table, and return its rows, as lists of values.
+    '''
+    ret = retry.execute(jobs.query(projectId=project_id, body={'query': sql, 'timeoutMs': timeout_ms,
+                                                                'useLegacySql': True}))
+    job_id = ret['jobReference']['jobId']
+    rows = ret.get('rows', []) if ret.get('jobComplete') else []
+    while not ret.get('jobComplete') or ret.get('pageToken'):
+        ret = retry.execute(jobs.getQueryResults(projectId=project_id, jobId=job_id, timeoutMs=timeout_ms,
+                                                 pageToken=ret.get('pageToken') if ret.get('jobComplete') else None))
+        if ret.get('jobComplete'):
+            rows += ret.get('rows', [])
+    return [[cell['v'] for cell in row['f']] for row in rows]
+
 def get_list_of_table_ids(dataset_id):
     tables_info = get_tables(dataset_id).get('tables', [])
     table_id_list = [ x['tableReference']['tableId'] for x in tables_info ]
@@ -127,26 +239,149 @@ def convert_data_dict_to_csv(tdata, extra_fields=None):
     If extra_fields is not None, then add data from extra_fields to each row.  
     This can be used, e.g. for adding course_id to a table missing that field.
     '''
-    import unicodecsv as csv
     from StringIO import StringIO
 
     sfp = StringIO()
+    write_csv_rows(sfp, tdata['field_names'], tdata['data'], extra_fields=extra_fields)
+    return sfp.getvalue()
+
+def write_csv_rows(ofp, field_names, rows, extra_fields=None, header=True):
+    '''
+    Write rows (dicts, eg from iter_table_data) to file ofp as CSV, with a header line if header=True.
+    Returns the number of rows written.
+    '''
+    import unicodecsv as csv
+
     extra_fields = extra_fields or {}
     fields = extra_fields.keys()
-    fields += tdata['field_names']
-    dw = csv.DictWriter(sfp, fieldnames=fields)
-    dw.writeheader()
-    for row in tdata['data']:
+    fields += field_names
+    dw = csv.DictWriter(ofp, fieldnames=fields)
+    if header:
+        dw.writeheader()
+    cnt = 0
+    for row in rows:
         row.update(extra_fields)
         dw.writerow(row)
-    return sfp.getvalue()
+        cnt += 1
+    return cnt
+
+def row_converter(fields, convert_timestamps=False, as_tuple=False):
+    '''
+    Return function which converts a tabledata.list row, {'f': [{'v': value}, ...]}, into an OrderedDict
+    of field name and value, for a table with schema fields (or into a tuple of the values, in schema order,
+    if as_tuple=True).  TIMESTAMP values are converted to datetime if convert_timestamps=True.
+    '''
+    field_names = [x['name'] for x in fields]
+    timestamp_cols = [k for k, x in enumerate(fields) if x['type']=='TIMESTAMP'] if convert_timestamps else []
+    def convert(row):
+        values = [cell['v'] for cell in row['f']]
+        for k in timestamp_cols:
+            values[k] = bq_timestamp_milliseconds_to_datetime(values[k], divisor=1)
+        if as_tuple:
+            return tuple(values)
+        return OrderedDict(zip(field_names, values))
+    return convert
+
+def get_table_rows_page(table_ref, startIndex, nrows, http=None):
+    '''
+    Retrieve nrows raw rows of a table, starting at startIndex (tabledata.list may return fewer rows than
+    asked for, if the response would be too large, so this may take several requests).
+    '''
+    rows = []
+    while nrows > 0:
+        data = retry.execute(tabledata.list(startIndex=startIndex, maxResults=nrows, **table_ref), http=http)
+        page = data.get('rows', [])
+        if not page:
+            break
+        rows += page
+        startIndex += len(page)
+        nrows -= len(page)
+    return rows
+
+def get_first_table_rows_page(table_ref, startIndex, nrows):
+    '''
+    Retrieve up to nrows raw rows of a table, starting at startIndex, and the number of rows in the table, as of
+    the read (totalRows of tabledata.list); returns (rows, totalRows).
+    '''
+    data = retry.execute(tabledata.list(startIndex=startIndex, maxResults=max(nrows, 1), **table_ref))
+    total = int(data.get('totalRows', 0))
+    rows = data.get('rows', [])[:nrows]
+    nmore = min(nrows, total - startIndex) - len(rows)
+    if rows and nmore > 0:
+        rows += get_table_rows_page(table_ref, startIndex + len(rows), nmore)
+    return (rows, total)
+
+def iter_table_data(dataset_id, table_id, project_id=DEFAULT_PROJECT_ID, convert_timestamps=False,
+                    startIndex=None, maxResults=None, page_size=None, workers=None, table=None, as_tuple=False):
+    '''
+    Generator yielding the rows of a BQ table, in order, as OrderedDicts of field name and value (or as tuples
+    of values, if as_tuple=True), without keeping the whole table in memory.
+
+    Rows are read in pages of page_size rows (default BQ_TABLEDATA_PAGE_SIZE), with up to workers (default
+    BQ_TABLEDATA_WORKERS) pages being fetched concurrently, ahead of the rows being consumed.
+
+    startIndex  = zero-based index of starting row to read; make this negative to start from the end of table
+    maxResults  = maximum number of rows to yield (all the rows, if None)
+    table       = table info, from get_bq_table_info, if already available
+
+    The number of rows read is that of tabledata.list, when the first page is read, not numRows of the table
+    info, which may be cached from before the table was last written.
+    '''
+    table = table or get_bq_table_info(dataset_id, table_id, project_id)
+    if not table:
+        return
+    start = startIndex or 0
+    page_size = page_size or BQ_TABLEDATA_PAGE_SIZE
+    workers = workers or BQ_TABLEDATA_WORKERS
+    table_ref = dict(datasetId=dataset_id, projectId=project_id, tableId=table_id)
+
+    first_size = page_size if maxResults is None else min(page_size, maxResults)
+    (first, nrows) = get_first_table_rows_page(table_ref, max(start, 0), first_size if start >= 0 else 0)
+    if start < 0:
+        start = max(nrows + start, 0)
+        first = get_table_rows_page(table_ref, start, min(first_size, nrows - start))
+    end = nrows if maxResults is None else min(nrows, start + maxResults)
+
+    convert = row_converter(table['schema']['fields'], convert_timestamps=convert_timestamps, as_tuple=as_tuple)
+    pages = iter(xrange(start + first_size, end, page_size))
+
+    if workers <= 1:
+        for row in first:
+            yield convert(row)
+        for index in pages:
+            for row in get_table_rows_page(table_ref, index, min(page_size, end - index)):
+                yield convert(row)
+        return
+
+    def get_page(index):
+        return get_table_rows_page(table_ref, index, min(page_size, end - index))
+
+    pool = ThreadPool(workers)
+    try:
+        pending = deque()
+        for index in pages:
+            pending.append(pool.apply_async(get_page, (index,)))
+            if len(pending) >= workers:
+                break
+        for row in first:
+            yield convert(row)
+        while pending:
+            rows = pending.popleft().get()
+            for index in pages:		# keep the workers busy with the next page
+                pending.append(pool.apply_async(get_page, (index,)))
+                break
+            for row in rows:
+                yield convert(row)
+    finally:
+        pool.terminate()
 
 def get_table_data(dataset_id, table_id, key=None, logger=default_logger, 
                    project_id=DEFAULT_PROJECT_ID, 
                    return_csv=False,
                    convert_timestamps=False,
                    startIndex=None, maxResults=1000000,
-		   extra_fields=None):
+		   extra_fields=None,
+                   compact=False):
     '''
     Retrieve data from a specific BQ table.  Normally return this as a dict, with
 
@@ -158,52 +393,37 @@ def get_table_data(dataset_id, table_id, key=None, logger=default_logger,
     Arguments:
 
     key         = dict, e.g. {'name': field_name_for_index, 'keymap': function_on_key_values}
-    maxResults  = maximum number of results to return
+    maxResults  = maximum number of rows retrieved per read request
     startIndex  = zero-based index of starting row to read; make this negative to return from 
                   end of table
     return_csv  = return data as CSV (as a big string) if True
     extra_fields = None, or dict giving extra fields which are to be added (e.g. course_id) to the 
                    output; only used when return_csv = True
+    compact     = if True, data is a compact_rows.CompactTable, storing each row as a tuple, and data_by_key
+                  a compact_rows.KeyIndex; rows are read-only dict-like Row objects, taking much less
+                  memory than dicts, for large tables which are only read by field name
+
+    For large tables, iter_table_data (or write_table_data) avoids holding all the rows in memory.
     '''
-    table = get_bq_table_info(dataset_id, table_id, project_id)
+    table = get_bq_table_info(dataset_id, table_id, project_id, cached=False)
     if not table:
         logger('[bqutil.get_table_data] table %s:%s.%s not found!' % (project_id, dataset_id, table_id))
         return None
         
     nrows = int(table['numRows'])
-
-    table_ref = dict(datasetId=dataset_id, projectId=project_id, tableId=table_id)
-    table_ref['maxResults'] = maxResults
-    if startIndex is not None:
-        if startIndex < 0:
-            startIndex = nrows + startIndex
-        if startIndex < 0:			# cannot be negative
-            startIndex = 0
-        table_ref['startIndex'] = startIndex
-
-    data = tabledata.list(**table_ref).execute()
-
-    if not 'rows' in data:
-        logger('[bqutil.get_table_data] No rows in data!  data=%s' % data)
-        return None
-
-    dataRows = int(len(data['rows']))
-    totalRows = int(data['totalRows'])
-    num_rows_expected = (totalRows-(startIndex or 0))
-    multiple_reads = 0
-
-    while (dataRows < num_rows_expected):
-       table_ref['startIndex'] = dataRows
-       data_append = tabledata.list(**table_ref).execute()
-       data['rows'] += data_append['rows']
-       dataRows = int(len(data['rows']))
-       multiple_reads += 1
-
-    if multiple_reads:
-        logger("[bqutil] Total Rows Retrieved: %s (%d read requests, expected %d)" % (dataRows, multiple_reads+1, num_rows_expected))
-
     fields = table['schema']['fields']
     field_names = [x['name'] for x in fields]
+    rows = iter_table_data(dataset_id, table_id, project_id=project_id, convert_timestamps=convert_timestamps,
+                           startIndex=startIndex, page_size=min(maxResults, BQ_TABLEDATA_PAGE_SIZE), table=table,
+                           as_tuple=compact and not return_csv)
+
+    if return_csv:
+        from StringIO import StringIO
+        sfp = StringIO()
+        if not write_csv_rows(sfp, field_names, rows, extra_fields=extra_fields):
+            logger('[bqutil.get_table_data] No rows in table %s.%s' % (dataset_id, table_id))
+            return None
+        return sfp.getvalue()
 
     ret = {'fields': fields,
            'field_names': field_names,
@@ -214,29 +434,46 @@ def get_table_data(dataset_id, table_id, key=None, logger=default_logger,
            'data_by_key': OrderedDict(),
            }
 
-    rows = data.get('rows', [])
-    for row in rows:
-        values = OrderedDict()
-        for i in xrange(0, len(fields)):
-            cell = row['f'][i]
-            # if field is a TIMESTMP then convert to datetime
-            if convert_timestamps and fields[i]['type']=='TIMESTAMP':
-                values[field_names[i]] = bq_timestamp_milliseconds_to_datetime(cell['v'], divisor=1)
-            else:
-                values[field_names[i]] = cell['v']
+    if compact:
+        ret['data'] = compact_rows.CompactTable(field_names)
+        ret['data_by_key'] = compact_rows.KeyIndex(ret['data'])
+        key_pos = field_names.index(key['name']) if key is not None else None
+
+    for values in rows:
         ret['data'].append(values)
         if key is not None:
-            the_key = values[key['name']]
+            the_key = values[key_pos if compact else key['name']]
             if 'keymap' in key:
                 the_key = key['keymap'](the_key)
-            if the_key not in ret['data_by_key']:
+            if compact:
+                ret['data_by_key'].add(the_key, len(ret['data']) - 1)
+            elif the_key not in ret['data_by_key']:
                 ret['data_by_key'][the_key] = values
 
-    if return_csv:
-        return convert_data_dict_to_csv(ret, extra_fields=extra_fields)
+    if not ret['data']:
+        logger('[bqutil.get_table_data] No rows in table %s.%s' % (dataset_id, table_id))
+        return None
 
     return ret
 
+def write_table_data(ofp, dataset_id, table_id, out_fmt='csv', header=True, extra_fields=None,
+                     project_id=DEFAULT_PROJECT_ID, convert_timestamps=True, table=None):
+    '''
+    Write the rows of a BQ table to file ofp as they are retrieved, as CSV (with a header line if header=True,
+    and extra_fields added to each row) or as JSON lines (out_fmt='json').  Returns the number of rows.
+    '''
+    table = table or get_bq_table_info(dataset_id, table_id, project_id, cached=False)
+    rows = iter_table_data(dataset_id, table_id, project_id=project_id, convert_timestamps=convert_timestamps,
+                           table=table)
+    if out_fmt=='csv':
+        field_names = [x['name'] for x in table['schema']['fields']]
+        return write_csv_rows(ofp, field_names, rows, extra_fields=extra_fields, header=header)
+    cnt = 0
+    for row in rows:
+        ofp.write(json.dumps(row) + '\n')
+        cnt += 1
+    return cnt
+
 def delete_zero_size_tables(dataset_id, verbose=False, project_id=DEFAULT_PROJECT_ID):
     '''
     Delete tables which have zero rows, in the specified dataset
@@ -253,7 +490,8 @@ def delete_bq_table(dataset_id, table_id, project_id=DEFAULT_PROJECT_ID):
     Delete specified BQ table
     '''
     table_ref = dict(datasetId=dataset_id, projectId=project_id, tableId=table_id)
-    tables.delete(**table_ref).execute()    
+    retry.execute(tables.delete(**table_ref))    
+    invalidate_table_metadata(dataset_id, table_id, project_id)
 
 def copy_bq_table(dataset_id, table_id, destination_table_id, project_id=DEFAULT_PROJECT_ID):
     '''
@@ -281,7 +519,8 @@ def copy_bq_table(dataset_id, table_id, destination_table_id, project_id=DEFAULT
         }
       }
 
-    insertResponse = jobs.insert(projectId=project_id, body=jobData).execute()
+    insertResponse = retry.execute(jobs.insert(projectId=project_id, body=jobData))
+    invalidate_table_metadata(dataset_id, destination_table_id, project_id)
     return insertResponse
 
 def get_bq_table_size_rows(dataset_id, table_id, project_id=DEFAULT_PROJECT_ID):
@@ -328,32 +567,46 @@ def get_bq_table_last_modified_datetime(dataset_id, table_id, project_id=DEFAULT
         return tinfo['lastModifiedTime']
     return None
 
-def get_bq_table_info(dataset_id, table_id, project_id=DEFAULT_PROJECT_ID):
+def get_bq_table_info(dataset_id, table_id, project_id=DEFAULT_PROJECT_ID, cached=True):
     '''
     Retrieve metadata about a specific BQ table.
+    Cached (see METADATA_CACHE), including "Not Found" errors; with cached=False, retrieved anew (and cached).
     '''
-    table_ref = dict(datasetId=dataset_id, projectId=project_id, tableId=table_id)
-    try:
-        table = tables.get(**table_ref).execute()
-    except Exception as err:
-        if 'Not Found' in str(err):
-            raise
-        table = None
+    key = (project_id, dataset_id, table_id)
+    if not cached:
+        METADATA_CACHE.invalidate(key)
+    table = METADATA_CACHE.get(key)
+    if table is metadata_cache.MISSING:
+        table_ref = dict(datasetId=dataset_id, projectId=project_id, tableId=table_id)
+        try:
+            table = retry.execute(tables.get(**table_ref))
+        except Exception as err:
+            if 'Not Found' in str(err):
+                METADATA_CACHE.put(key, err)
+                raise
+            table = None
+        if table:
+            table['lastModifiedTime'] = bq_timestamp_milliseconds_to_datetime(table['lastModifiedTime'])
+            table['creationTime'] = bq_timestamp_milliseconds_to_datetime(table['creationTime'])
+            METADATA_CACHE.put(key, table)
+    if isinstance(table, Exception):
+        raise table
     if not table:
         return
-    table['lastModifiedTime'] = bq_timestamp_milliseconds_to_datetime(table['lastModifiedTime'])
-    table['creationTime'] = bq_timestamp_milliseconds_to_datetime(table['creationTime'])
-    return table
+    return dict(table)
 
 def get_bq_table(dataset, tablename, sql=None, key=None, allow_create=True, force_query=False, logger=default_logger,
                  depends_on=None,
                  allowLargeResults=False,
                  newer_than=None,
-                 startIndex=None, maxResults=1000000):
+                 startIndex=None, maxResults=1000000,
+                 compact=False):
     '''
     Retrieve data for the specified BQ table if it exists.
     If it doesn't exist, create it, using the provided SQL.
 
+    compact=True returns the data in compact form (see get_table_data).
+
     depends_on may be provided as a list of "dataset.table" strings, which specify which table(s)
     the desired table depends on.  If the desired table exists, but is older than any of the 
     depends_on table(s), then it is recomputed from the sql (assuming the sql was provided).
@@ -406,10 +659,10 @@ def get_bq_table(dataset, tablename, sql=None, key=None, allow_create=True, forc
     if force_query:
         create_bq_table(dataset, tablename, sql, logger=logger, overwrite=True, allowLargeResults=allowLargeResults)
         return get_table_data(dataset, tablename, key=key, logger=logger,
-                              startIndex=startIndex, maxResults=maxResults)
+                              startIndex=startIndex, maxResults=maxResults, compact=compact)
     try:
         ret = get_table_data(dataset, tablename, key=key, logger=logger,
-                             startIndex=startIndex, maxResults=maxResults)
+                             startIndex=startIndex, maxResults=maxResults, compact=compact)
         if ret is None:
             try:
                 tsize = get_bq_table_size_rows(dataset, tablename)
@@ -421,7 +674,7 @@ def get_bq_table(dataset, tablename, sql=None, key=None, allow_create=True, forc
         if 'Not Found' in str(err) and allow_create and (sql is not None) and sql:
             create_bq_table(dataset, tablename, sql, logger=logger, overwrite=True, allowLargeResults=allowLargeResults)
             return get_table_data(dataset, tablename, key=key, logger=logger,
-                                  startIndex=startIndex, maxResults=maxResults)
+                                  startIndex=startIndex, maxResults=maxResults, compact=compact)
         else:
             raise
     return ret
@@ -432,13 +685,25 @@ def create_bq_table(dataset_id, table_id, sql, verbose=False, overwrite=False, w
                     allowLargeResults=False,
                     maximumBillingTier=None,
                     sql_for_description=None,
-                    udfs=None):
+                    udfs=None,
+                    job_manager=None,
+                    dry_run=False,
+                    use_legacy_sql=True,
+                    job_retry=None):
     '''
     Run SQL query to create a new table.
 
     sql: String representation of Google BigQuery SQL expression
     udfs: String representation of Google BigQuery user-defined function (UDF).
          If multiple UDFs in a single query, udfs = list of UDF strings.
+    job_manager: bqjobs.JobManager to submit the query job to; if given, returns the JobHandle
+                 at once, without waiting (handle.result() returns the job, or raises).
+    dry_run: if True, don't run the query; just return the number of bytes it would process.
+    use_legacy_sql: if False, sql is standard SQL.
+    job_retry: retry.RetryPolicy for rerunning the query if the job fails with a transient (eg internal) error.
+
+    If a bytes budget is set (see set_bytes_budget), the query is dry-run first, and charged to the budget;
+    bqbudget.BudgetExceeded is raised if it is refused, or bqbudget.QueryDeferred if it is deferred.
     '''
 
     project_ref = dict(projectId=project_id)
@@ -478,6 +743,9 @@ def create_bq_table(dataset_id, table_id, sql, verbose=False, overwrite=False, w
               }
     if maximumBillingTier:
         config['query']['maximumBillingTier'] = maximumBillingTier
+    if not use_legacy_sql:
+        config['query']['useLegacySql'] = False
+        config['query'].pop('userDefinedFunctionResources')
               
     job_id = 'create_%s_%s_%d' % (dataset_id, table_id, time.time())
     job_ref = {'jobId': job_id,
@@ -485,6 +753,20 @@ def create_bq_table(dataset_id, table_id, sql, verbose=False, overwrite=False, w
     
     job = {'jobReference': job_ref, 'configuration': config}
 
+    settle = None
+    if dry_run or (BYTES_BUDGET is not None):
+        nbytes = bqbudget.dry_run_bytes(jobs, config, project_id)
+        logger("[bqutil] Dry run of query for table %s: would process %s" % (table_id, bqbudget.format_bytes(nbytes)))
+        if dry_run:
+            return nbytes
+        BYTES_BUDGET.charge(dataset_id, table_id, nbytes, logger=logger)
+        def settle(handle):
+            # charge what the query processed, or nothing if it (or its insert) failed
+            processed = 0
+            if 'errorResult' not in handle.job.get('status', {}):
+                processed = int(handle.job.get('statistics', {}).get('query', {}).get('totalBytesProcessed', 0))
+            BYTES_BUDGET.settle(dataset_id, nbytes, processed)
+
     if 'APPEND' in wd:
         logger("[bqutil] Appending to table %s, running job %s" % (table_id, job_id))
     else:
@@ -494,62 +776,19 @@ def create_bq_table(dataset_id, table_id, sql, verbose=False, overwrite=False, w
     if verbose:
         print job
 
-    for k in range(10):
-        try:
-            jobret = jobs.insert(body=job, **project_ref).execute()
-            break
-        except Exception as err:
-            print "[bqutil] oops!  Failed to insert job=%s" % job
-            if (k==9):
-                raise
-            if 'HttpError 500' in str(err):
-                print err
-                print "--> 500 error, retrying in 30 sec"
-                time.sleep(30)
-                continue
-            raise
+    invalidate_table_metadata(dataset_id, table_id, output_project_id)
 
-    if verbose:
-        print "job=", json.dumps(job, indent=4)
-      
-    if verbose:
-        job_list = jobs.list( stateFilter=['pending', 'running'], **project_ref).execute()
-        print "job list: ", job_list
+    def job_done(job):
+        invalidate_table_metadata(dataset_id, table_id, output_project_id)
+        status = job['status']
+        logger( "[bqutil] job status: %s" % status )
 
-    if not wait:
-        return
-
-    # timeoutMs = 5000
-    # job_ref['timeoutMs'] = timeoutMs
-
-    ecnt = 0
-    while job.get('status', {}).get('state', None) <> 'DONE':
-        if 'status' not in job:
-            ecnt += 1
-            if (ecnt == 10):
-                logger("[bqutil] Error!  no job status?  job ret = %s" % job)
-            if (ecnt > 200):
-                raise Exception('BQ Error getting job status')
-        else:
-            ecnt = 0
-        try:
-            time.sleep(5)
-            job = jobs.get(**job_ref).execute()
-        except Exception as err:
-            print "[bqutil] oops!  Failed to execute jobs.get=%s" % (job_ref)
-            print "[bqutil] err=%s" % str(err)
-
-    status = job['status']
-    logger( "[bqutil] job status: %s" % status )
-
-    if 'errors' in status:
-        logger( "[bqutil] ERROR!  %s" % str(status['errors']) )
-        logger( "job = %s" % json.dumps(job, indent=4))
-        emsg = 'BQ Error creating table '
-        emsg += status.get('errorResult', {}).get('message', '')
-        raise Exception(emsg)
-
-    elif status['state']=='DONE':
+        if 'errors' in status:
+            logger( "[bqutil] ERROR!  %s" % str(status['errors']) )
+            logger( "job = %s" % json.dumps(job, indent=4))
+            emsg = 'BQ Error creating table '
+            emsg += status.get('errorResult', {}).get('message', '')
+            raise Exception(emsg)
 
         nbytes = int(job['statistics']['query']['totalBytesProcessed'])
         logger( "[bqutil] Total bytes processed (proportional to $$$ cost): %10.2f kB" % (nbytes/1024.0) )
@@ -573,20 +812,51 @@ def create_bq_table(dataset_id, table_id, sql, verbose=False, overwrite=False, w
             output_project_name = get_project_name(output_project_id)
     
             txt += '\n'
-            txt += 'see job: https://bigquery.cloud.google.com/results/%s:%s\n' % (project_name, job_id)
+            txt += 'see job: https://bigquery.cloud.google.com/results/%s:%s\n' % (project_name, job['jobReference']['jobId'])
             txt += 'see table: https://bigquery.cloud.google.com/table/%s:%s.%s\n' % (output_project_name, dataset_id, table_id)
             logger(txt)
     
             add_description_to_table(dataset_id, table_id, txt, project_id=output_project_id)
+        return job
+
+    return run_job(job, project_id, job_done, wait=wait, verbose=verbose, job_manager=job_manager, job_retry=job_retry,
+                   on_done=settle)
+
+def run_job(job, project_id, job_done, wait=True, verbose=False, job_manager=None, job_retry=None, on_done=None):
+    '''
+    Submit job to a bqjobs.JobManager (a new one, unless job_manager is given), with callback job_done(job)
+    for when it is done.  With job_manager, returns the JobHandle at once; otherwise waits for the job (polling
+    with backoff), and returns the result of job_done, unless wait=False, in which case it only waits for the
+    job to be inserted (retrying the insert), since no one will poll the new manager.  on_done(handle), if
+    given, is called when the job is done, or has failed (eg to be inserted).
+    '''
+    manager = job_manager or bqjobs.JobManager(jobs)
+    handle = manager.submit(job, project_id, callback=job_done, job_retry=job_retry)
+    jobstats.track(handle)
+    if on_done is not None:
+        handle.add_done_callback(on_done)
+
+    if verbose:
+        print "job=", json.dumps(handle.job, indent=4)
+        job_list = retry.execute(jobs.list( stateFilter=['pending', 'running'], projectId=project_id))
+        print "job list: ", job_list
+
+    if job_manager is not None:
+        return handle
+    if not wait:
+        manager.wait_inserted([handle])
+        if handle.exception is not None:	# failed to insert
+            raise handle.exception
+        jobstats.track_unwaited(handle)		# polled at the end of the step, so its stats are recorded
+        return
+    return handle.result()
 
-    return job
-    
 
 def add_description_to_table(dataset_id, table_id, description, append=False, project_id=DEFAULT_PROJECT_ID):
     table_ref = dict(datasetId=dataset_id, projectId=project_id, tableId=table_id)
 
     if append:
-        table = tables.get(**table_ref).execute()
+        table = retry.execute(tables.get(**table_ref))
         old_description = table.get('description', '')
         description = old_description + '\n' + description
 
@@ -599,7 +869,8 @@ def add_description_to_table(dataset_id, table_id, description, append=False, pr
              "tableReference": table_ref
              }
     try:
-        table = tables.patch(body=patch, **table_ref).execute()
+        table = retry.execute(tables.patch(body=patch, **table_ref))
+        METADATA_CACHE.invalidate((project_id, dataset_id, table_id))
     except Exception as err:
         print "[bqutil] oops, failed in adding description to table, patch=%s, err=%s, table=%s" % (patch, str(err), table_id)
         raise
@@ -607,10 +878,12 @@ def add_description_to_table(dataset_id, table_id, description, append=False, pr
 
 def load_data_to_table(dataset_id, table_id, gsfn, schema, wait=True, verbose=False, maxbad=None, 
                        format=None, skiprows=None,
-                       project_id=DEFAULT_PROJECT_ID
+                       project_id=DEFAULT_PROJECT_ID,
+                       job_manager=None,
                        ):
     '''
     Import data file (JSON or CSV) from Google Storage into bigquery table.
+    With job_manager (a bqjobs.JobManager), returns the JobHandle at once.
     '''
 
     project_ref = dict(projectId=project_id)
@@ -646,72 +919,35 @@ def load_data_to_table(dataset_id, table_id, gsfn, schema, wait=True, verbose=Fa
     if verbose:
         print job
 
-    for k in range(10):
-        try:
-            jobret = jobs.insert(body=job, **project_ref).execute()
-            break
-        except Exception as err:
-            print "[bqutil] oops!  Failed to insert job=%s" % job
-            if (k==9):
-                raise
-            if 'HttpError 500' in str(err):
-                print err
-                print "--> 500 error, retrying in 30 sec"
-                time.sleep(30)
-                continue
-            if 'SSL3_GET_RECORD:decryption failed' in str(err):
-                print err
-                print "--> SSL3 error, retrying in 10 sec"
-                time.sleep(10)
-                continue
-            raise
+    invalidate_table_metadata(dataset_id, table_id, project_id)
 
-    job = jobret
+    def job_done(job):
+        invalidate_table_metadata(dataset_id, table_id, project_id)
+        status = job['status']
+        print "[bqutil] job status: ", status
 
-    if verbose:
-        print "job=", json.dumps(job, indent=4)
-      
-    if verbose:
-        job_list = jobs.list( stateFilter=['pending', 'running'], **project_ref).execute()
-        print "job list: ", job_list
+        if 'errors' in status:
+            print "[bqutil] ERROR!  ", status['errors']
+            print "job = ", json.dumps(job, indent=4)
+            raise Exception('BQ Error creating table')
+        else:
+            me = getpass.getuser()
+            project_name = get_project_name(project_id)
+            txt = "Data loaded from %s by %s / bqutil on %s\n" % (gsfn, me, datetime.datetime.now())
+            txt += 'see job: https://bigquery.cloud.google.com/results/%s:%s\n' % (project_name, job_id)
+            txt += 'see table: https://bigquery.cloud.google.com/table/%s:%s.%s\n\n' % (project_name, dataset_id, table_id)
+            add_description_to_table(dataset_id, table_id, txt, project_id=project_id)
+        return job
 
-    if not wait:
-        return
+    return run_job(job, project_id, job_done, wait=wait, verbose=verbose, job_manager=job_manager)
 
-    nerr = 0
-    while job['status']['state'] <> 'DONE':
-        try:
-            job = jobs.get(**job_ref).execute()
-        except Exception as err:
-            if "Internal Error" in str(err):
-                nerr += 1
-                if nerr > 10:
-                    raise
-                time.sleep(10)
-                continue
-
-    status = job['status']
-    print "[bqutil] job status: ", status
-
-    if 'errors' in status:
-        print "[bqutil] ERROR!  ", status['errors']
-        print "job = ", json.dumps(job, indent=4)
-        raise Exception('BQ Error creating table')
-    else:
-        me = getpass.getuser()
-        project_name = get_project_name(project_id)
-        txt = "Data loaded from %s by %s / bqutil on %s\n" % (gsfn, me, datetime.datetime.now())
-        txt += 'see job: https://bigquery.cloud.google.com/results/%s:%s\n' % (project_name, job_id)
-        txt += 'see table: https://bigquery.cloud.google.com/table/%s:%s.%s\n\n' % (project_name, dataset_id, table_id)
-        add_description_to_table(dataset_id, table_id, txt, project_id=project_id)
-
-    return job
-    
 def extract_table_to_gs(dataset_id, table_id, gsfn, format=None, do_gzip=False, wait=True, 
                         verbose=False,
-                        project_id=DEFAULT_PROJECT_ID):
+                        project_id=DEFAULT_PROJECT_ID,
+                        job_manager=None):
     '''
     extract BQ table to a file in google cloud storage.
+    With job_manager (a bqjobs.JobManager), returns the JobHandle at once.
     '''
 
     project_ref = dict(projectId=project_id)
@@ -740,44 +976,21 @@ def extract_table_to_gs(dataset_id, table_id, gsfn, format=None, do_gzip=False,
     if verbose:
         print job
 
-    try:
-        job = jobs.insert(body=job, **project_ref).execute()
-    except Exception as err:
-        print "[bqutil] oops!  Failed to insert job=%s" % job
-        raise
-
-    if verbose:
-        print "job=", json.dumps(job, indent=4)
-      
-    if verbose:
-        job_list = jobs.list( stateFilter=['pending', 'running'], **project_ref).execute()
-        print "job list: ", job_list
-
-    if not wait:
-        return
-
-    nerr = 0
-    while job['status']['state'] <> 'DONE':
-        try:
-            job = jobs.get(**job_ref).execute()
-        except Exception as err:
-            if "Internal Error" in str(err):
-                nerr += 1
-                if nerr > 10:
-                    raise
-                time.sleep(10)
-                continue
+    def job_done(job):
+        status = job['status']
+        print "[bqutil] job status: ", status
 
-    status = job['status']
-    print "[bqutil] job status: ", status
+        if 'errors' in status:
+            print "[bqutil] ERROR!  ", status['errors']
+            print "job = ", json.dumps(job, indent=4)
+            raise Exception('BQ Error creating table')
+        return job
 
-    if 'errors' in status:
-        print "[bqutil] ERROR!  ", status['errors']
-        print "job = ", json.dumps(job, indent=4)
-        raise Exception('BQ Error creating table')
+    return run_job(job, project_id, job_done, wait=wait, verbose=verbose, job_manager=job_manager)
 
 
-def upload_local_data_to_big_query(dataset_id, table_id, schema, course_id, file_name, source_format):
+def upload_local_data_to_big_query(dataset_id, table_id, schema, course_id, file_name, source_format,
+                                   write_disposition=None):
     """
     Uploads local tracking logs to the provided dataset and table id from
     the provided course_id tracking log file.
@@ -788,14 +1001,18 @@ def upload_local_data_to_big_query(dataset_id, table_id, schema, course_id, file
         schema: Schema type to use upon the data.
         course_id: Valid course id of the current proccessed course.
         file_name: File name of the archive that has the tracking log data.
-        source_format: Source format of the file data e.g. JSON, CSV.
+        source_format: Source format of the file data e.g. JSON, CSV, PARQUET.
+        write_disposition: e.g. WRITE_APPEND; defaults to BIGQUERY_WRITE_DISPOSITION.
     """
+    from google.cloud import bigquery
     bigquery_client = bigquery.Client.from_service_account_json(
         getattr(edx2bigquery_config, 'auth_key_file', ''),
     )
     dataset_ref = bigquery_client.dataset(dataset_id)
     table_ref = dataset_ref.table(table_id)
     job_config = get_job_config(schema, source_format)
+    if write_disposition:
+        job_config.write_disposition = write_disposition
 
     with open(file_name, "rb") as source_file:
         job = bigquery_client.load_table_from_file(
@@ -805,6 +1022,7 @@ def upload_local_data_to_big_query(dataset_id, table_id, schema, course_id, file
         )
 
     job_result = job.result()
+    invalidate_table_metadata(dataset_id, table_id)
 
     if job_result.state != 'DONE':
         print(
@@ -832,22 +1050,27 @@ def get_job_config(schema, source_format):
 
     Args:
         schema: Schema type to use upon the data.
-        source_format: Source format of the file data e.g. JSON, CSV.
+        source_format: Source format of the file data e.g. JSON, CSV, PARQUET.
+            Parquet files carry their own schema, so schema is not used for them.
     Returns:
         google.cloud.bigquery.job.LoadJobConfig Object.
     """
+    from google.cloud import bigquery
     job_config = bigquery.LoadJobConfig()
 
     if not source_format:
-        raise Exception('JSON or CSV source_format were not provided.')
+        raise Exception('JSON, CSV or PARQUET source_format were not provided.')
 
     if source_format == 'JSON':
         job_config.source_format = bigquery.SourceFormat.NEWLINE_DELIMITED_JSON
     elif source_format == 'CSV':
         job_config.source_format = bigquery.SourceFormat.CSV
         job_config.skip_leading_rows = 1
+    elif source_format == 'PARQUET':
+        job_config.source_format = bigquery.SourceFormat.PARQUET
 
-    job_config.schema = list(get_configuration_schema(schema))
+    if source_format != 'PARQUET':
+        job_config.schema = list(get_configuration_schema(schema))
     job_config.write_disposition = BIGQUERY_WRITE_DISPOSITION
     # 50 is an arbitrary number.
     job_config.max_bad_records = BIGQUERY_MAX_BAD_RECORDS
@@ -869,6 +1092,7 @@ def get_configuration_schema(schema):
     Raises:
         Exception: When schema argument is empty or None.
     """
+    from google.cloud import bigquery
     if not schema:
         raise Exception('Data schema was not provided. Unable to upload data to Google BigQuery.')
 
@@ -881,6 +1105,235 @@ def get_configuration_schema(schema):
 #
 # assumes live credentials are available (may need GAE stubs)
 
+def test_lazy_client():
+    # importing bqutil must not build the client (nor import auth, which loads the google api libraries)
+    import subprocess
+    out = subprocess.check_output([sys.executable, '-c', 'import sys, bqutil; print "auth" in sys.modules, bqutil.SERVICE'],
+                                  cwd=os.path.dirname(os.path.abspath(__file__)),
+                                  env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)))
+    assert out.split() == ['False', '{}']
+
+def test_iter_table_data():
+    # fake tabledata.list, returning at most 7 rows per request, to check paging and row order
+    class FakeRequest(object):
+        def __init__(self, rows, total):
+            self.rows = rows
+            self.total = total
+        def execute(self, http=None):
+            return dict({'totalRows': str(self.total)}, **({'rows': self.rows} if self.rows else {}))
+    class FakeTabledata(object):
+        def __init__(self):
+            self.requests = []
+            self.total = 50
+        def list(self, startIndex, maxResults, **table_ref):
+            self.requests.append((startIndex, maxResults))
+            return FakeRequest([{'f': [{'v': str(k)}, {'v': '%d.5' % k}]}
+                                for k in range(startIndex, min(startIndex + min(maxResults, 7), self.total))], self.total)
+    table = {'numRows': '50', 'schema': {'fields': [{'name': 'n', 'type': 'INTEGER'}, {'name': 't', 'type': 'TIMESTAMP'}]}}
+    global tabledata
+    orig = tabledata
+    tabledata = FakeTabledata()
+    try:
+        for workers in [1, 3]:
+            rows = list(iter_table_data('ds', 'tab', table=table, page_size=10, workers=workers, convert_timestamps=True))
+            assert [x['n'] for x in rows] == [str(k) for k in range(50)]
+            assert rows[3]['t'] == datetime.datetime(1970, 1, 1, 0, 0, 3, 500000)
+        assert sorted(tabledata.requests)[:3] == [(0, 10), (0, 10), (7, 3)]
+        rows = list(iter_table_data('ds', 'tab', table=table, startIndex=-12, maxResults=5, page_size=10, workers=2))
+        assert [x['n'] for x in rows] == ['38', '39', '40', '41', '42']
+        from StringIO import StringIO
+        sfp = StringIO()
+        assert write_table_data(sfp, 'ds', 'tab', extra_fields={'course_id': 'a/b/c'}, table=table, convert_timestamps=False) == 50
+        assert sfp.getvalue().splitlines()[:2] == ['course_id,n,t', 'a/b/c,0,0.5']
+        rows = list(iter_table_data('ds', 'tab', table=table, maxResults=2, as_tuple=True))
+        assert rows == [('0', '0.5'), ('1', '1.5')]
+
+        # table info from before the table was rewritten: the rows are those of tabledata.list
+        tabledata.total = 65
+        for workers in [1, 3]:
+            rows = list(iter_table_data('ds', 'tab', table=table, page_size=10, workers=workers))
+            assert [x['n'] for x in rows] == [str(k) for k in range(65)]
+        tabledata.total = 20
+        assert len(list(iter_table_data('ds', 'tab', table=table, page_size=10, workers=3))) == 20
+    finally:
+        tabledata = orig
+
+def test_get_table_data_compact():
+    global iter_table_data, get_bq_table_info
+    orig = (iter_table_data, get_bq_table_info)
+    table = {'numRows': '3', 'creationTime': '0', 'lastModifiedTime': '0',
+             'schema': {'fields': [{'name': 'user_id', 'type': 'STRING'}, {'name': 'nchapters', 'type': 'INTEGER'}]}}
+    def fake_iter_table_data(*args, **kwargs):
+        for row in [('1', '4'), ('2', None), ('1', '5')]:
+            yield row if kwargs['as_tuple'] else OrderedDict(zip(['user_id', 'nchapters'], row))
+    iter_table_data = fake_iter_table_data
+    get_bq_table_info = lambda *args, **kwargs: table
+    try:
+        data = get_table_data('ds', 'tab', key={'name': 'user_id'})
+        cdata = get_table_data('ds', 'tab', key={'name': 'user_id'}, compact=True)
+        assert isinstance(cdata['data'], compact_rows.CompactTable)
+        assert [dict(x) for x in cdata['data']] == data['data']
+        assert sorted(cdata['data_by_key'].keys()) == ['1', '2']
+        assert cdata['data_by_key']['1']['nchapters'] == data['data_by_key']['1']['nchapters'] == '4'
+        assert get_table_data('ds', 'tab', return_csv=True, compact=True).splitlines()[1] == '1,4'
+    finally:
+        (iter_table_data, get_bq_table_info) = orig
+
+def test_run_job_without_waiting():
+    global jobs
+    orig = jobs
+    jobs = bqjobs.FakeJobsService(time.time)
+    jobs.insert_errors = [Exception('HttpError 503 backend error')]
+    try:
+        assert run_job(bqjobs.make_job('nowait'), 'proj', None, wait=False) is None
+        assert jobs.inserted == ['nowait']		# the failed insert was retried, though no one waits on the job
+        jobs.insert_errors = [Exception('HttpError 400 Invalid query')]
+        try:
+            run_job(bqjobs.make_job('bad'), 'proj', None, wait=False)
+            assert False
+        except Exception as err:
+            assert '400' in str(err)
+    finally:
+        jobs = orig
+
+def test_run_job_without_waiting_recorded():
+    global jobs
+    import run_ledger
+    import shutil
+    import tempfile
+    orig = jobs
+    jobs = bqjobs.FakeJobsService(time.time)
+    jobs.ngets = {'pcday_1': 1, 'pcday_2': 2}
+
+    @jobstats.job_step
+    def person_day(param, course_id, args=None):
+        for table in ['pcday_1', 'pcday_2']:
+            run_job(bqjobs.make_job(table), 'proj', None, wait=False)
+
+    tmpdir = tempfile.mkdtemp()
+    fn = os.path.join(tmpdir, 'jobstats.json')
+    jobstats.set_file(fn, run_id='run1')
+    orig_ledger = run_ledger.RUN_LEDGER_FILE
+    run_ledger.set_file(os.path.join(tmpdir, 'ledger.sqlite'))
+    try:
+        person_day(None, 'course')
+        after_step = [x['job_id'] for x in jobstats.load_records(fn) if x['kind']=='query']
+        jobstats.wait_unwaited()
+        at_exit = [x['job_id'] for x in jobstats.load_records(fn) if x['kind']=='query']
+    finally:
+        jobstats.set_file(None)
+        run_ledger.set_file(orig_ledger)
+        jobs = orig
+        shutil.rmtree(tmpdir)
+    assert after_step == ['pcday_1']		# polled once when the step ended
+    assert at_exit == ['pcday_1', 'pcday_2']
+    assert jobstats.UNWAITED == []
+
+def test_create_bq_table_dry_run_and_budget():
+    global jobs, BYTES_BUDGET
+    orig = (jobs, BYTES_BUDGET)
+    jobs = bqbudget.FakeDryRunJobsService()
+    jobs.nbytes['select 2'] = 5000
+    try:
+        assert create_bq_table('course_a', 't1', 'select 1', dry_run=True, logger=lambda x: None) == 1000
+        set_bytes_budget(4000)
+        try:
+            create_bq_table('course_a', 't2', 'select 2', logger=lambda x: None)
+            assert False
+        except bqbudget.BudgetExceeded:
+            pass
+        set_bytes_budget(4000, defer=True)
+        try:
+            create_bq_table('course_a_latest', 't2', 'select 2', logger=lambda x: None)
+            assert False
+        except bqbudget.QueryDeferred:
+            pass
+        assert BYTES_BUDGET.deferred == [('course_a_latest', 't2', 5000)]
+        assert all(x['configuration']['dryRun'] for x in jobs.bodies)	# no query was run
+    finally:
+        (jobs, BYTES_BUDGET) = orig
+
+def test_budget_settled_when_job_done():
+    global jobs, BYTES_BUDGET
+    orig = (jobs, BYTES_BUDGET)
+    clock = bqjobs.FakeClock()
+    class FakeService(bqjobs.FakeJobsService):
+        # dry runs estimate 1000 bytes; the queries process 600, or fail
+        def insert(self, body, projectId):
+            if body['configuration'].get('dryRun'):
+                return bqbudget.FakeRequest(lambda: {'statistics': {'query': {'totalBytesProcessed': '1000'}}})
+            return bqjobs.FakeJobsService.insert(self, body, projectId)
+        def get(self, projectId, jobId):
+            request = bqjobs.FakeJobsService.get(self, projectId, jobId)
+            def do_get():
+                job = request.execute()
+                if job['status']['state'] == 'DONE':
+                    job['statistics'] = {'creationTime': '0', 'endTime': '1000', 'query': {'totalBytesProcessed': '600'}}
+                return job
+            return bqbudget.FakeRequest(do_get)
+    jobs = FakeService(clock)
+    manager = bqjobs.JobManager(jobs, min_poll=1, sleep=clock.sleep, clock=clock)
+    quiet = lambda x: None
+    try:
+        set_bytes_budget(2500)
+        ok = create_bq_table('course_a', 't1', 'select 1', overwrite='append', logger=quiet, job_manager=manager)
+        bad = create_bq_table('course_a', 't_fail', 'select 1', overwrite='append', logger=quiet, job_manager=manager)
+        assert BYTES_BUDGET.totals == {'course_a': 2000}			# estimates, while running
+        manager.wait()
+        assert ok.exception is None and bad.exception is not None
+        assert BYTES_BUDGET.totals == {'course_a': 600}			# actual bytes; failed query refunded
+
+        jobs.insert_errors.append(Exception('HttpError 400 "Invalid query"'))
+        try:
+            create_bq_table('course_a', 't2', 'select 1', overwrite='append', logger=quiet, job_manager=manager).result()
+            assert False
+        except Exception as err:
+            assert 'Invalid query' in str(err)
+        assert BYTES_BUDGET.totals == {'course_a': 600}			# not inserted: refunded
+    finally:
+        (jobs, BYTES_BUDGET) = orig
+
+def test_get_tables_metadata():
+    global jobs, tables
+    orig = (jobs, tables)
+    class FakeService(object):
+        def __init__(self):
+            self.calls = []
+        def request(self, name, ret):
+            self.calls.append(name)
+            return bqbudget.FakeRequest(lambda: ret)
+        def query(self, projectId, body):
+            assert '[proj:ds_logs.__TABLES__]' in body['query']
+            return self.request('query', {'jobReference': {'jobId': 'q1'}, 'jobComplete': False})
+        def getQueryResults(self, projectId, jobId, timeoutMs, pageToken=None):
+            row = lambda *vals: {'f': [{'v': x} for x in vals]}
+            if pageToken is None:
+                return self.request('getQueryResults', {'jobComplete': True, 'pageToken': 'p2',
+                                                        'rows': [row('tracklog_20141001', '1412121600000', '1412208000000', '10', '2000')]})
+            return self.request('getQueryResults', {'jobComplete': True,
+                                                    'rows': [row('tracklog_20141002', '1412208000000', '1412294400000', None, None)]})
+        def list(self, datasetId, projectId, maxResults, pageToken=None):
+            table = lambda x: {'tableReference': {'tableId': x}}
+            if pageToken is None:
+                return self.request('list', {'tables': [table('a')], 'nextPageToken': 't2'})
+            return self.request('list', {'tables': [table('b')]})
+    jobs = tables = FakeService()
+    METADATA_CACHE.clear()
+    try:
+        meta = get_tables_metadata('ds_logs', project_id='proj')
+        assert sorted(meta) == ['tracklog_20141001', 'tracklog_20141002']
+        assert meta['tracklog_20141001']['lastModifiedTime'] == datetime.datetime(2014, 10, 2)
+        assert meta['tracklog_20141001']['numRows'] == 10 and meta['tracklog_20141002']['numBytes'] == 0
+        assert get_tables_metadata('ds_logs', project_id='proj') == meta
+        assert jobs.calls == ['query', 'getQueryResults', 'getQueryResults']	# second lookup is cached
+        invalidate_table_metadata('ds_logs', 'tracklog_20141003', project_id='proj')
+        assert METADATA_CACHE.get(('proj', 'ds_logs', TABLES_META)) is metadata_cache.MISSING
+
+        assert [x['tableReference']['tableId'] for x in get_tables('ds', project_id='proj')['tables']] == ['a', 'b']
+    finally:
+        (jobs, tables) = orig
+        METADATA_CACHE.clear()
+
 def test_get_project_name():
     name = get_project_name()
     print name
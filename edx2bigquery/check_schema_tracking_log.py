@@ -37,7 +37,10 @@ def schema2dict(the_schema_in):
 
 ds = schema2dict(schema)
 
-def check_schema(linecnt, data, the_ds=None, path='', coerce=False, the_schema=None):
+def check_schema_uncompiled(linecnt, data, the_ds=None, path='', coerce=False, the_schema=None):
+    '''
+    Original recursive schema check, kept as the reference for check_schema (see compile_schema).
+    '''
 
     global ds
 
@@ -58,7 +61,7 @@ def check_schema(linecnt, data, the_ds=None, path='', coerce=False, the_schema=N
         # allow repeated nested records (see https://cloud.google.com/bigquery/preparing-data-for-bigquery?hl=ja#dataformats)
         if ptype==dict and type(val)==list and the_ds[key].get('mode')=='REPEATED':
             for item in val:
-                check_schema(linecnt, item, the_ds[key]['dict_schema'], path=path + '/' + key, coerce=coerce)
+                check_schema_uncompiled(linecnt, item, the_ds[key]['dict_schema'], path=path + '/' + key, coerce=coerce)
             return
 
         if not type(val)==ptype:
@@ -93,7 +96,109 @@ def check_schema(linecnt, data, the_ds=None, path='', coerce=False, the_schema=N
                                                                                               key, val,
                                                                                               path)
         if ptype==dict:
-            check_schema(linecnt, val, the_ds[key]['dict_schema'], path + "/" + key, coerce=coerce)
+            check_schema_uncompiled(linecnt, val, the_ds[key]['dict_schema'], path + "/" + key, coerce=coerce)
+
+#-----------------------------------------------------------------------------
+# compiled schema checking
+#
+# compile_schema turns a dict schema (from schema2dict) into a checking function,
+# with the per-field work (python type, tolerated types, coercion, nested record
+# checker) all looked up in advance.  Compiled checkers are cached by schema
+# object, so schemas should not be modified once they have been used for checking.
+
+STRING_TYPES = (str, unicode)
+
+# types accepted without complaint, for each python type (see check_schema_uncompiled)
+OK_TYPES = {dict: frozenset([dict]),
+            int: frozenset([int, bool]),
+            float: frozenset([float, int]),
+            unicode: frozenset([unicode, str]),
+            str: frozenset([str, unicode]),
+            }
+
+_compiled_schemas = {}		# id(schema) -> (schema, checker); holds a reference so the id stays valid
+MAX_COMPILED_SCHEMAS = 100	# callers which build a new schema for each course would otherwise grow the cache without bound
+
+def compile_schema(the_ds=None, the_schema=None):
+    '''
+    Return a function checker(linecnt, data, path='', coerce=False) which checks (and optionally
+    coerces) data against the dict schema the_ds, or the BigQuery schema the_schema, or the
+    tracking log schema if neither is given.  Same behavior as check_schema_uncompiled.
+    '''
+    if len(_compiled_schemas) > MAX_COMPILED_SCHEMAS:
+        _compiled_schemas.clear()
+
+    if the_ds is None:
+        if the_schema is not None:
+            key = id(the_schema)
+            if key not in _compiled_schemas:
+                _compiled_schemas[key] = (the_schema, _compile_ds(schema2dict(the_schema)))
+            return _compiled_schemas[key][1]
+        the_ds = ds
+
+    key = id(the_ds)
+    if key not in _compiled_schemas:
+        _compiled_schemas[key] = (the_ds, _compile_ds(the_ds))
+    return _compiled_schemas[key][1]
+
+def _compile_ds(the_ds):
+    fields = {}
+    for key, ent in the_ds.iteritems():
+        ptype = ent['ptype']
+        if ptype==dict:
+            sub_checker = _compile_ds(ent['dict_schema'])
+            repeated = ent.get('mode')=='REPEATED'
+        else:
+            sub_checker = None
+            repeated = False
+        fields[key] = (ptype, OK_TYPES.get(ptype, frozenset([ptype])), sub_checker, repeated)
+
+    def checker(linecnt, data, path='', coerce=False):
+        for key, val in data.iteritems():
+            if val is None:
+                continue
+            field = fields.get(key)
+            if field is None:
+                raise Exception("[check_schema] Oops! field %s is not in the schema, linecnt=%s, path=%s" % (key, linecnt, path))
+            (ptype, ok_types, sub_checker, repeated) = field
+            vtype = type(val)
+
+            if sub_checker is None:
+                if vtype in ok_types:
+                    continue
+                if coerce and vtype in STRING_TYPES:
+                    if ptype==float:
+                        try:
+                            data[key] = float(val)
+                        except Exception as err:
+                            print "Error coercing data for key=%s path=%s, val=%s, err=%s" % (key, path, val, str(err))
+                            data[key] = None
+                        continue
+                    if ptype==int:
+                        try:
+                            data[key] = int(val)
+                        except Exception as err:
+                            print "Error coercing data for key=%s path=%s, val=%s, err=%s" % (key, path, val, str(err))
+                            raise
+                        continue
+                print "[line %d] mismatch type expected %s got %s for key=%s, val=%s, path=%s" % (linecnt, ptype, vtype,
+                                                                                                  key, val, path)
+                continue
+
+            # nested record; a repeated nested record ends the check of this record (as it always has)
+            if repeated and vtype==list:
+                for item in val:
+                    sub_checker(linecnt, item, path + '/' + key, coerce)
+                return
+            if not vtype==dict:
+                print "[line %d] mismatch type expected %s got %s for key=%s, val=%s, path=%s" % (linecnt, ptype, vtype,
+                                                                                                  key, val, path)
+            sub_checker(linecnt, val, path + "/" + key, coerce)
+
+    return checker
+
+def check_schema(linecnt, data, the_ds=None, path='', coerce=False, the_schema=None):
+    compile_schema(the_ds, the_schema)(linecnt, data, path, coerce)
 
 #-----------------------------------------------------------------------------
 
@@ -109,11 +214,113 @@ def do_file(fn):
         data = json.loads(line)
         check_schema(cnt, data, ds)
 
+def benchmark(fp, nrepeat=3):
+    '''
+    Time check_schema_uncompiled against the compiled checker, on (already rephrased) tracking log lines from fp.
+    '''
+    import time
+    records = [json.loads(line) for line in fp]
+    print "Benchmarking schema check on %d records, %d repeats" % (len(records), nrepeat)
+
+    def run(check):
+        best = None
+        for k in range(nrepeat):
+            data = copy.deepcopy(records)
+            t0 = time.time()
+            for cnt, rec in enumerate(data):
+                check(cnt, rec, coerce=True)
+            dt = time.time() - t0
+            best = dt if best is None else min(best, dt)
+        return best
+
+    checker = compile_schema(ds)
+    t_old = run(lambda cnt, rec, coerce: check_schema_uncompiled(cnt, rec, ds, coerce=coerce))
+    t_new = run(lambda cnt, rec, coerce: checker(cnt, rec, coerce=coerce))
+    print "  check_schema_uncompiled: %8.3f sec (%d records/sec)" % (t_old, len(records) / max(t_old, 1e-9))
+    print "  compiled check_schema:   %8.3f sec (%d records/sec)" % (t_new, len(records) / max(t_new, 1e-9))
+    print "  speedup: %.2fx" % (t_old / max(t_new, 1e-9))
+
+#-----------------------------------------------------------------------------
+# unit tests, using py.test
+
+TEST_SCHEMA = [{'name': 'a', 'type': 'INTEGER'},
+               {'name': 'f', 'type': 'FLOAT'},
+               {'name': 's', 'type': 'STRING'},
+               {'name': 'b', 'type': 'BOOLEAN'},
+               {'name': 't', 'type': 'TIMESTAMP'},
+               {'name': 'rec', 'type': 'RECORD', 'fields': [{'name': 'x', 'type': 'INTEGER'},
+                                                            {'name': 'y', 'type': 'FLOAT'}]},
+               {'name': 'reps', 'type': 'RECORD', 'mode': 'REPEATED', 'fields': [{'name': 'z', 'type': 'STRING'},
+                                                                                 {'name': 'n', 'type': 'INTEGER'}]},
+               ]
+
+TEST_DATA = [{'a': 1, 'f': 2.5, 's': u'x', 'b': True, 't': '2015-02-10 00:00:00', 'rec': {'x': 3, 'y': 4}},
+             {'a': '12', 'f': '1.5', 's': 'str', 'b': 0, 'rec': {'x': '7', 'y': 'oops'}},
+             {'a': 'abc'},
+             {'f': 'not-a-float', 'a': 2},
+             {'a': 10**30, 'f': True, 's': 5, 'b': 1.0, 't': [1, 2]},
+             {'a': None, 'rec': None, 'reps': None},
+             {'reps': [{'z': 'p', 'n': '3'}, {'z': 4}], 'a': 'skipped after repeated', 'f': 'x'},
+             {'reps': {'z': u'one'}},
+             {'rec': 'not a record'},
+             {'rec': [{'x': 1}]},
+             {'rec': {'nope': 1}},
+             {'unknown': 1},
+             ]
+
+def _check_outcome(check, data, coerce):
+    from StringIO import StringIO
+    data = copy.deepcopy(data)
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        try:
+            check(7, data, coerce=coerce)
+            err = None
+        except Exception as err:
+            err = (type(err), str(err))
+        output = sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+    return (data, output, err)
+
+def test_compiled_matches_uncompiled():
+    the_ds = schema2dict(TEST_SCHEMA)
+    checker = compile_schema(the_ds)
+    for coerce in [False, True]:
+        for data in TEST_DATA:
+            expected = _check_outcome(lambda n, d, coerce: check_schema_uncompiled(n, d, the_ds, coerce=coerce), data, coerce)
+            assert _check_outcome(checker, data, coerce) == expected
+            assert _check_outcome(lambda n, d, coerce: check_schema(n, d, the_ds=the_ds, coerce=coerce), data, coerce) == expected
+            assert _check_outcome(lambda n, d, coerce: check_schema(n, d, coerce=coerce, the_schema=TEST_SCHEMA), data, coerce) == expected
+
+def test_compiled_tracking_log_schema():
+    data = {'event_type': u'play_video', 'time': u'2015-02-10T16:20:01.123456+00:00', 'event': u'{}',
+            'event_struct': {'currentTime': '123.5', 'speed': 1.5, 'id': u'abc'},
+            'context': {'user_id': '42', 'course_id': u'MITx/8.01x/2013_SOND'}}
+    for coerce in [False, True]:
+        expected = _check_outcome(lambda n, d, coerce: check_schema_uncompiled(n, d, coerce=coerce), data, coerce)
+        assert _check_outcome(check_schema, data, coerce) == expected
+
+def test_compile_schema_cached():
+    the_ds = schema2dict(TEST_SCHEMA)
+    assert compile_schema(the_ds) is compile_schema(the_ds)
+    assert compile_schema(the_schema=TEST_SCHEMA) is compile_schema(the_schema=TEST_SCHEMA)
+    assert compile_schema() is compile_schema(ds)
+
 #-----------------------------------------------------------------------------
 
 if __name__=="__main__":
     cnt = 0
-    if len(sys.argv)>1:
+    if len(sys.argv)>1 and sys.argv[1]=='--benchmark':
+        # usage: check_schema_tracking_log.py --benchmark [rephrased_tracking_log.json.gz]
+        if len(sys.argv)>2:
+            fn = sys.argv[2]
+            benchmark(gzip.GzipFile(fn) if fn.endswith('.gz') else open(fn))
+        else:
+            benchmark(sys.stdin)
+
+    elif len(sys.argv)>1:
         # arguments are filenames; process each file, append "-rephrased" to filename before suffix
         for fn in sys.argv[1:]:
             do_file(fn)
@@ -0,0 +1,239 @@
+#!/usr/bin/python
+#
+# File:   compact_rows.py
+#
+# Compact in-memory form of BigQuery table data, for get_table_data(..., compact=True).
+#
+# Instead of an OrderedDict per row, each row is stored as a tuple of values,
+# with one field name -> position index shared by all rows of the table, and
+# data_by_key maps key values to row positions.  Rows are handed out as Row
+# objects, read-only mappings which look up values through the shared index,
+# so that code using row['field'], row.get('field'), and 'field' in row works
+# unchanged.  Rows take roughly a tenth of the memory of OrderedDicts (see
+# benchmark_memory, run by "python compact_rows.py --benchmark-memory [nrows]").
+
+import collections
+import sys
+
+#-----------------------------------------------------------------------------
+
+class Row(collections.Mapping):
+    '''
+    Read-only dict-like view of one row (tuple of values) of a CompactTable.
+    '''
+    __slots__ = ('index', 'values')
+
+    def __init__(self, index, values):
+        self.index = index
+        self.values = values
+
+    def __getitem__(self, name):
+        return self.values[self.index[name]]
+
+    def get(self, name, default=None):
+        pos = self.index.get(name)
+        if pos is None:
+            return default
+        return self.values[pos]
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __iter__(self):
+        return iter(self.index.field_names)
+
+    def __len__(self):
+        return len(self.values)
+
+    def keys(self):
+        return list(self.index.field_names)
+
+    def __repr__(self):
+        return 'Row(%s)' % ', '.join('%s=%r' % x for x in self.iteritems())
+
+    def to_dict(self):
+        return collections.OrderedDict(zip(self.index.field_names, self.values))
+
+class FieldIndex(dict):
+    '''
+    Field name -> position in the row tuples, shared by all rows of a table.
+    '''
+    def __init__(self, field_names):
+        dict.__init__(self, [(name, k) for k, name in enumerate(field_names)])
+        self.field_names = tuple(field_names)
+
+class CompactTable(object):
+    '''
+    List-like table of rows, stored as tuples, handed out as Row objects.
+    '''
+    def __init__(self, field_names):
+        self.index = FieldIndex(field_names)
+        self.rows = []
+
+    def append(self, values):
+        self.rows.append(tuple(values))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return [Row(self.index, x) for x in self.rows[k]]
+        return Row(self.index, self.rows[k])
+
+    def __iter__(self):
+        index = self.index
+        for values in self.rows:
+            yield Row(index, values)
+
+    def column(self, name):
+        '''
+        List of the values of one field, for all rows.
+        '''
+        pos = self.index[name]
+        return [x[pos] for x in self.rows]
+
+class KeyIndex(collections.MutableMapping):
+    '''
+    data_by_key for a CompactTable: key value -> Row, stored as key value -> row position.
+
+    Items may be set (or deleted), eg to add entries which are not in the table; these are kept
+    separately, as given, and take precedence over the table rows.
+    '''
+    def __init__(self, table):
+        self.table = table
+        self.positions = {}
+        self.extra = collections.OrderedDict()
+
+    def add(self, key, pos):
+        '''
+        Index row pos of the table under key, unless key is already present (the first row wins).
+        '''
+        if key not in self.positions:
+            self.positions[key] = pos
+
+    def __getitem__(self, key):
+        if key in self.extra:
+            return self.extra[key]
+        return Row(self.table.index, self.table.rows[self.positions[key]])
+
+    def __setitem__(self, key, value):
+        self.positions.pop(key, None)
+        self.extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self.extra:
+            del self.extra[key]
+        else:
+            del self.positions[key]
+
+    def __contains__(self, key):
+        return key in self.positions or key in self.extra
+
+    def __iter__(self):
+        for key in self.positions:
+            yield key
+        for key in self.extra:
+            yield key
+
+    def __len__(self):
+        return len(self.positions) + len(self.extra)
+
+#-----------------------------------------------------------------------------
+# memory benchmark
+
+def synthetic_rows(nrows):
+    '''
+    Rows (lists of values, as strings, like tabledata.list returns them) of a synthetic person_course-like table.
+    '''
+    for k in xrange(nrows):
+        yield [str(100000 + k), 'user%d' % k, str(k % 2000), '%d.%d.%d.%d' % (k % 223, k % 199, k % 251, k % 127),
+               '1.4235%05dE9' % (k % 100000), 'US' if k % 3 else 'IN', str(k % 17)]
+
+SYNTHETIC_FIELDS = ['user_id', 'username', 'nevents', 'ip', 'last_event', 'cc', 'nchapters']
+
+def max_rss_mb():
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def load_synthetic(nrows, compact, conn):
+    import time
+    rss0 = max_rss_mb()
+    t0 = time.time()
+    if compact:
+        data = CompactTable(SYNTHETIC_FIELDS)
+        data_by_key = KeyIndex(data)
+        for values in synthetic_rows(nrows):
+            data.append(values)
+            data_by_key.add(values[0], len(data) - 1)
+    else:
+        data = []
+        data_by_key = collections.OrderedDict()
+        for values in synthetic_rows(nrows):
+            row = collections.OrderedDict(zip(SYNTHETIC_FIELDS, values))
+            data.append(row)
+            if values[0] not in data_by_key:
+                data_by_key[values[0]] = row
+    dt_load = time.time() - t0
+    t0 = time.time()
+    total = 0
+    for k in xrange(0, nrows, 7):
+        total += int(data_by_key.get(str(100000 + k), {}).get('nchapters', 0))
+    conn.send((max_rss_mb() - rss0, dt_load, time.time() - t0))
+
+def benchmark_memory(nrows=2000000):
+    '''
+    Compare the memory used by get_table_data's OrderedDict rows and by compact rows, for a synthetic
+    nrows-row table, each loaded in its own process.
+    '''
+    import multiprocessing as mp
+    for compact in [False, True]:
+        (parent, child) = mp.Pipe()
+        proc = mp.Process(target=load_synthetic, args=(nrows, compact, child))
+        proc.start()
+        (mb, dt_load, dt_lookup) = parent.recv()
+        proc.join()
+        print "%-12s %d rows: %8.1f MB, %6.2f sec to build, %6.2f sec for %d key lookups" % (
+            'compact' if compact else 'OrderedDict', nrows, mb, dt_load, dt_lookup, (nrows + 6) / 7)
+        sys.stdout.flush()
+
+#-----------------------------------------------------------------------------
+# unit tests, using py.test
+
+def test_compact_table():
+    data = CompactTable(['user_id', 'username', 'nevents'])
+    data_by_key = KeyIndex(data)
+    for values in [['1', 'alice', '10'], ['2', 'bob', None], ['1', 'alice2', '3']]:
+        data.append(values)
+        data_by_key.add(values[0], len(data) - 1)
+
+    assert len(data) == 3 and len(data_by_key) == 2
+    assert [x['username'] for x in data] == ['alice', 'bob', 'alice2']
+    row = data_by_key['1']
+    assert row['username'] == 'alice'		# first row with the key wins
+    assert row.get('nevents') == '10' and row.get('missing', 'x') == 'x'
+    assert 'nevents' in row and 'missing' not in row
+    assert row.keys() == ['user_id', 'username', 'nevents']
+    assert dict(row) == {'user_id': '1', 'username': 'alice', 'nevents': '10'}
+    assert row == {'user_id': '1', 'username': 'alice', 'nevents': '10'}
+    assert row.to_dict().items()[0] == ('user_id', '1')
+    assert data_by_key.get('3', {}).get('nevents') is None
+    assert data_by_key['2']['nevents'] is None
+    assert data[-1]['username'] == 'alice2' and [x['user_id'] for x in data[:2]] == ['1', '2']
+    assert data.column('nevents') == ['10', None, '3']
+    try:
+        row['missing']
+        assert False
+    except KeyError:
+        pass
+
+    data_by_key['3'] = {'user_id': '3', 'username': 'carol'}
+    data_by_key['2'] = {'user_id': '2', 'username': 'bobby'}
+    assert data_by_key['2']['username'] == 'bobby'
+    assert sorted(data_by_key.keys()) == ['1', '2', '3']
+    del data_by_key['1']
+    assert '1' not in data_by_key and len(data_by_key) == 2
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--benchmark-memory':
+        benchmark_memory(*[int(x) for x in sys.argv[2:3]])
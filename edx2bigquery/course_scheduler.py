@@ -0,0 +1,318 @@
+#!/usr/bin/python
+#
+# File:   course_scheduler.py
+#
+# Scheduler for running a command on many courses in parallel (--parallel),
+# used by main.run_parallel_or_serial.
+#
+# Courses are started longest first, so that a big course isn't left to run
+# alone at the end: a course's cost is its run time the last time the command
+# was run on it (kept in run_times.json, in the log directory), or, for a
+# course not run before, its number of tracking log tables, times the run time
+# per tracking log table of the courses which have been.  Workers take the next
+# course from a shared queue whenever they are free, and worker processes are
+# replaced after max_tasks courses, so that their memory doesn't keep growing.
+#
+# The output of each course goes to its own log file,
+#
+#     <log_dir>/<command>/<course dataset name>.log
+#
+# (and, labeled with the course_id, to stdout), rather than being kept in
+# memory.  Progress, with an estimated time to finish, is printed as each
+# course is done.
+
+import datetime
+import json
+import multiprocessing as mp
+import os
+import sys
+import threading
+import time
+import traceback
+from multiprocessing.pool import ThreadPool
+
+import edx2bigquery_config
+
+COURSE_LOG_DIR = getattr(edx2bigquery_config, 'COURSE_LOG_DIR', 'LOGS/courses')
+WORKER_MAX_TASKS = getattr(edx2bigquery_config, 'WORKER_MAX_TASKS', 10)	# courses per worker process (None: no limit)
+RUN_TIMES_FILE = 'run_times.json'
+
+#-----------------------------------------------------------------------------
+
+def log_filename(log_dir, name, course_id):
+    safe_id = course_id.replace('/', '__').replace(':', '_').replace('+', '_')
+    return os.path.join(log_dir, name, safe_id + '.log')
+
+class CourseLog(object):
+    '''
+    Stands in for stdout while running one course: output goes to the file fn, and to the real stdout,
+    with each line labeled.
+    '''
+    def __init__(self, label, fn, echo=True):
+        self.label = label
+        self.fp = open(fn, 'a')
+        self.echo = echo
+
+    def write(self, msg):
+        self.fp.write(msg)
+        if self.echo:
+            sys.__stdout__.write(msg.replace('\n', '\n[%s] ' % self.label))
+
+    def flush(self):
+        self.fp.flush()
+        sys.__stdout__.flush()
+
+    def close(self):
+        self.fp.close()
+
+class ThreadStdout(object):
+    '''
+    Stands in for sys.stdout while courses are run in threads: each thread writes to its own stream
+    (eg a CourseLog, set by run_task), or else to the real stdout.
+    '''
+    def __init__(self):
+        self.local = threading.local()
+
+    def set_stream(self, stream):
+        self.local.stream = stream
+
+    def stream(self):
+        return getattr(self.local, 'stream', None) or sys.__stdout__
+
+    def write(self, msg):
+        self.stream().write(msg)
+
+    def flush(self):
+        self.stream().flush()
+
+def run_task(task):
+    '''
+    Run function(*args) for one course, with its output going to its log file; returns a dict with the run's
+    name, course_id, success, dt (seconds), error, and logfile.  Module level, so it can be sent to a worker
+    process.
+    '''
+    (function, args, name, course_id, logfn) = task
+    log = CourseLog(course_id, logfn)
+    orig_stdout = sys.stdout
+    threaded = isinstance(sys.stdout, ThreadStdout)
+    if threaded:
+        sys.stdout.set_stream(log)
+    else:
+        sys.stdout = log
+    start = time.time()
+    ret = {'name': name, 'course_id': course_id, 'success': False, 'error': None, 'logfile': logfn}
+    try:
+        print "[RUN] STARTING %s on %s at %s" % (name, course_id, datetime.datetime.now())
+        function(*args)
+        ret['success'] = True
+    except Exception as err:
+        ret['error'] = str(err)
+        traceback.print_exc(file=log)
+    finally:
+        ret['dt'] = time.time() - start
+        print "[RUN] DONE WITH %s on %s, success=%s, dt=%.1f sec" % (name, course_id, ret['success'], ret['dt'])
+        if threaded:
+            sys.stdout.set_stream(None)
+        else:
+            sys.stdout = orig_stdout
+        log.close()
+    return ret
+
+def count_tracklog_tables(course_id):
+    '''
+    Number of tracking log tables of course_id in BigQuery (0 if they can't be listed).
+    '''
+    import bqutil
+    try:
+        tables = bqutil.get_list_of_table_ids(bqutil.course_id2dataset(course_id, dtype='logs'))
+    except Exception:
+        return 0
+    return len([x for x in tables if x.startswith('tracklog_')])
+
+def format_dt(seconds):
+    return str(datetime.timedelta(seconds=int(seconds)))
+
+class RunTimes(object):
+    '''
+    Run time (seconds) and number of tracking log tables, of each command on each course, the last time it
+    was run, kept in the json file fn.
+    '''
+    def __init__(self, fn):
+        self.fn = fn
+        self.data = {}			# name -> course_id -> {'dt': seconds, 'ntracklogs': count or None}
+        if fn and os.path.exists(fn):
+            try:
+                self.data = json.loads(open(fn).read())
+            except Exception as err:
+                print "[course_scheduler] Oops, cannot read run times from %s, err=%s" % (fn, str(err))
+
+    def get(self, name, course_id):
+        return self.data.get(name, {}).get(course_id)
+
+    def update(self, name, course_id, dt, ntracklogs=None):
+        self.data.setdefault(name, {})[course_id] = {'dt': dt, 'ntracklogs': ntracklogs}
+
+    def save(self):
+        if not self.fn:
+            return
+        tmpfn = self.fn + '.tmp'
+        with open(tmpfn, 'w') as ofp:
+            ofp.write(json.dumps(self.data, indent=2, sort_keys=True))
+        os.rename(tmpfn, self.fn)
+
+class CourseScheduler(object):
+    '''
+    Runs function(*make_args(course_id)) for each course, in up to workers processes (or threads, with
+    use_threads), most costly courses first, with the output of each course logged to its own file.
+    '''
+    def __init__(self, name, workers, use_threads=False, log_dir=None, max_tasks=None, count_fn=count_tracklog_tables,
+                 clock=time.time, ofp=sys.stdout):
+        self.name = name
+        self.workers = workers
+        self.use_threads = use_threads
+        self.log_dir = log_dir or COURSE_LOG_DIR
+        self.max_tasks = max_tasks if max_tasks is not None else WORKER_MAX_TASKS
+        self.count_fn = count_fn
+        self.clock = clock
+        self.ofp = ofp
+        self.run_times = RunTimes(os.path.join(self.log_dir, RUN_TIMES_FILE))
+        self.ntracklogs = {}
+        self.estimates = {}
+
+    def estimate(self, courses):
+        '''
+        Set self.estimates, the estimated run time of each course (None if there's nothing to go by).
+        '''
+        rates = []
+        for course_id in courses:
+            last = self.run_times.get(self.name, course_id)
+            if last is not None:
+                self.estimates[course_id] = last['dt']
+                if last.get('ntracklogs'):
+                    rates.append((last['dt'], last['ntracklogs']))
+            else:
+                self.estimates[course_id] = None
+        rate = (sum(x[0] for x in rates) / float(sum(x[1] for x in rates))) if rates else None
+        for course_id in courses:
+            if self.estimates[course_id] is None and self.count_fn is not None:
+                self.ntracklogs[course_id] = self.count_fn(course_id)
+                if rate is not None:
+                    self.estimates[course_id] = self.ntracklogs[course_id] * rate
+        return self.estimates
+
+    def order(self, courses):
+        '''
+        courses, most costly first; courses with no estimate go first (by number of tracking log tables), as
+        they may be big.
+        '''
+        self.estimate(courses)
+        def cost(course_id):
+            est = self.estimates[course_id]
+            if est is None:
+                return (0, -self.ntracklogs.get(course_id, 0))
+            return (1, -est)
+        return sorted(courses, key=cost)
+
+    def progress(self, done, ntotal, start):
+        '''
+        Progress line, with an estimated time to finish: the estimated time of the courses not done, per worker,
+        scaled by how the actual times of those done compared with their estimates.
+        '''
+        elapsed = self.clock() - start
+        nfailed = len([x for x in done if not x['success']])
+        msg = "[course_scheduler] %s: %d/%d courses done" % (self.name, len(done), ntotal)
+        if nfailed:
+            msg += " (%d failed)" % nfailed
+        msg += ", elapsed %s" % format_dt(elapsed)
+        done_ids = set(x['course_id'] for x in done)
+        mean_dt = sum(x['dt'] for x in done) / len(done)
+        def est(course_id):
+            return self.estimates.get(course_id) or mean_dt
+        remaining = sum(est(x) for x in self.estimates if x not in done_ids)
+        scale = sum(x['dt'] for x in done) / max(sum(est(x['course_id']) for x in done), 1e-6)
+        if len(done) < ntotal:
+            msg += ", ETA %s" % format_dt(remaining * scale / self.workers)
+        return msg
+
+    def run(self, function, courses, make_args):
+        '''
+        Run function(*make_args(course_id)) for each course; returns the list of run results (see run_task),
+        in the order of courses.
+        '''
+        ordered = self.order(courses)
+        logdir = os.path.join(self.log_dir, self.name)
+        if not os.path.exists(logdir):
+            os.makedirs(logdir)
+        tasks = [(function, make_args(course_id), self.name, course_id, log_filename(self.log_dir, self.name, course_id))
+                 for course_id in ordered]
+
+        if self.use_threads:
+            pool = ThreadPool(processes=self.workers)
+        else:
+            pool = mp.Pool(processes=self.workers, maxtasksperchild=self.max_tasks or None)
+        start = self.clock()
+        done = []
+        try:
+            for ret in pool.imap_unordered(run_task, tasks, chunksize=1):
+                done.append(ret)
+                self.run_times.update(self.name, ret['course_id'], ret['dt'], self.ntracklogs.get(ret['course_id']))
+                self.ofp.write(self.progress(done, len(tasks), start) + " (last: %s, %.1f sec)\n" % (ret['course_id'],
+                                                                                                      ret['dt']))
+                self.ofp.flush()
+        finally:
+            pool.close()
+            pool.join()
+            self.run_times.save()
+        by_course = dict((x['course_id'], x) for x in done)
+        return [by_course[x] for x in courses if x in by_course]
+
+#-----------------------------------------------------------------------------
+# unit tests, using py.test
+
+def fake_course_run(course_id, nlines):
+    for k in range(nlines):
+        print "%s line %d" % (course_id, k)
+    if 'bad' in course_id:
+        raise Exception('oops')
+
+def test_scheduler():
+    import shutil
+    import tempfile
+    from StringIO import StringIO
+    tmpdir = tempfile.mkdtemp()
+    try:
+        counts = {'a/small/x': 2, 'a/big/x': 50, 'a/bad/x': 10, 'a/new/x': 20}
+        rt = RunTimes(os.path.join(tmpdir, RUN_TIMES_FILE))
+        rt.update('cmd', 'a/small/x', 20.0, 2)
+        rt.update('cmd', 'a/big/x', 500.0, 50)
+        rt.update('cmd', 'a/bad/x', 100.0)
+        rt.save()
+
+        sfp = StringIO()
+        sched = CourseScheduler('cmd', 2, use_threads=True, log_dir=tmpdir, count_fn=counts.get, ofp=sfp)
+        courses = ['a/small/x', 'a/bad/x', 'a/new/x', 'a/big/x']
+        assert sched.order(courses) == ['a/big/x', 'a/new/x', 'a/bad/x', 'a/small/x']
+        assert sched.estimates['a/new/x'] == 200.0		# 20 tracking logs at 10 sec each
+
+        orig_stdout = sys.stdout
+        sys.stdout = ThreadStdout()
+        try:
+            results = sched.run(fake_course_run, courses, lambda course_id: (course_id, 3))
+        finally:
+            sys.stdout = orig_stdout
+        assert [x['course_id'] for x in results] == courses
+        assert [x['success'] for x in results] == [True, False, True, True]
+        assert 'oops' in results[1]['error']
+        out = sfp.getvalue().splitlines()
+        assert len(out) == 4 and '4/4 courses done (1 failed)' in out[-1] and 'ETA' in out[-2]
+
+        logfn = log_filename(tmpdir, 'cmd', 'a/new/x')
+        assert logfn == os.path.join(tmpdir, 'cmd', 'a__new__x.log')
+        lines = open(logfn).read().splitlines()
+        assert lines[1:4] == ['a/new/x line 0', 'a/new/x line 1', 'a/new/x line 2']
+        assert 'Exception: oops' in open(results[1]['logfile']).read()
+
+        rt = RunTimes(os.path.join(tmpdir, RUN_TIMES_FILE))
+        assert rt.get('cmd', 'a/new/x')['ntracklogs'] == 20 and rt.get('cmd', 'a/new/x')['dt'] < 100
+    finally:
+        shutil.rmtree(tmpdir)
@@ -18,6 +18,8 @@ except:
     class edx2bigquery_config(object):
         GS_BUCKET = "gs://dummy-gs-bucket"
 
+import retry
+
 def path_from_course_id(course_id):
     return path(course_id.replace('/', '__'))
 
@@ -52,12 +54,28 @@ def get_gs_file_list(path):
         fnset[fnb] = {'size': size, 'date': date, 'name': name, 'basename': fnb}
     return fnset
 
+class GsutilError(Exception):
+    pass
+
+# gsutil retries transient errors itself, so retry a failed command only a few times, in case of dropped connections
+GSUTIL_RETRY = retry.RetryPolicy(max_tries=3, base_delay=10.0, retryable=lambda err: isinstance(err, GsutilError))
+
 def upload_file_to_gs(src, dst, options='', verbose=False):
     cmd = 'gsutil cp %s %s %s' % (options, src, dst)
     if verbose:
         print "--> %s" % cmd
         sys.stdout.flush()
-    os.system(cmd)
+    def run():
+        status = os.system(cmd)
+        if status & 0x7f:		# killed by a signal, eg control-C
+            raise KeyboardInterrupt
+        if status:
+            raise GsutilError("%s failed with exit status %d" % (cmd, status >> 8))
+    try:
+        retry.call(run, policy=GSUTIL_RETRY, label='gsutil cp')
+    except GsutilError as err:
+        print "[gsutil] oops, %s" % err
+        sys.stdout.flush()
 
 def get_local_file_mtime_in_utc(fn, make_tz_unaware=False):
     statbuf = os.stat(fn)
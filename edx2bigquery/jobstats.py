@@ -0,0 +1,416 @@
+#!/usr/bin/python
+#
+# File:   jobstats.py
+#
+# Per-job telemetry for BigQuery jobs run through bqutil: when a job stats file
+# is set (--jobstats-file, or BQ_JOBSTATS_FILE in edx2bigquery_config), one JSON
+# line is appended to it for each query, load, or extract job, when the job is
+# done, with its times, bytes processed and billed, retries, and queue wait.
+#
+# Jobs are attributed to the step (eg person_day, in a nightly or doall run)
+# and course_id being processed, as set by the job_step decorator on the step
+# functions in main, and to the run (one edx2bigquery invocation, RUN_ID).
+#
+# A step which carries on after an error (eg person_day with
+# stop_on_error=False) notes it with step_failed, so that it is recorded as
+# failed, not done, and its callers can tell (see collect_step_errors).
+# The failed outermost steps are also noted in FAILED (see note_failed), so
+# that with --error-exit-status, main can exit non-zero though it carried on.
+#
+# Jobs submitted without waiting (bqutil.run_job with wait=False) are polled by
+# no one, so they are noted with track_unwaited, and polled once at the end of
+# the (outermost) step which submitted them, and at exit, for up to
+# BQ_JOBSTATS_EXIT_WAIT seconds, so that their stats are recorded too.
+#
+# The retries of API calls and jobs (retry.COUNTS, per label) are appended
+# too, as lines with kind "retries", at the end of each step and at exit.
+#
+# "edx2bigquery jobstats" summarizes a run (by default, the last one in the
+# file): the wall-clock time, job time, and bytes of each step, and the slowest
+# and costliest jobs.
+
+import contextlib
+import functools
+import inspect
+import json
+import os
+import sys
+import threading
+import time
+
+import edx2bigquery_config
+import retry
+import run_ledger
+
+JOBSTATS_FILE = getattr(edx2bigquery_config, 'BQ_JOBSTATS_FILE', None)
+RUN_ID = None
+LOCAL = threading.local()	# LOCAL.context: stack of (step, course_id), innermost last, for each thread
+				# LOCAL.errors: stack of lists of errors noted by step_failed
+RETRIES_RECORDED = {}		# retry.COUNTS, as of the last record_retries
+RETRIES_LOCK = threading.Lock()
+FAILED = []			# (step, course_id, error) of the failed outermost steps and courses, in this process
+EXIT_WAIT = getattr(edx2bigquery_config, 'BQ_JOBSTATS_EXIT_WAIT', 300)
+UNWAITED = []			# (handle, thread ident) of jobs submitted without waiting, not yet seen done
+UNWAITED_LOCK = threading.Lock()
+
+#-----------------------------------------------------------------------------
+
+def set_file(fn, run_id=None):
+    '''
+    Record job stats to file fn (None to stop recording), for the run run_id (default: a new id, from
+    the time and pid).
+    '''
+    global JOBSTATS_FILE, RUN_ID
+    JOBSTATS_FILE = fn
+    RUN_ID = run_id or '%s-%d' % (time.strftime('%Y%m%d-%H%M%S'), os.getpid())
+
+def enabled():
+    return bool(JOBSTATS_FILE)
+
+def context_stack():
+    if not hasattr(LOCAL, 'context'):
+        LOCAL.context = []
+    return LOCAL.context
+
+def error_stack():
+    if not hasattr(LOCAL, 'errors'):
+        LOCAL.errors = []
+    return LOCAL.errors
+
+def step_failed(err):
+    '''
+    Note that the current step failed with err, though it carries on: it, and the steps (and
+    collect_step_errors) it is called from, are then recorded as failed.
+    '''
+    for errors in error_stack():
+        errors.append(str(err) or err.__class__.__name__)
+
+def note_failed(step, course_id, error):
+    '''
+    Note that step failed for course_id (None if not for one course), though the command carries on.
+    '''
+    FAILED.append((step, course_id, error))
+
+@contextlib.contextmanager
+def collect_step_errors():
+    '''
+    Context yielding a list, of the errors noted by step_failed in the context.
+    '''
+    errors = []
+    stack = error_stack()
+    stack.append(errors)
+    try:
+        yield errors
+    finally:
+        stack.pop()
+
+def job_step(fn):
+    '''
+    Decorator for a step function (eg person_day), attributing the jobs run during the call to the step,
+    and to its course_id (or courses) argument, if that is a single course_id; the run of the step for
+    that course is also recorded in the run ledger (as failed, if it raises, or notes an error with
+    step_failed).
+    '''
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        try:
+            callargs = inspect.getcallargs(fn, *args, **kwargs)
+            course_id = callargs.get('course_id') or callargs.get('courses')
+        except TypeError:
+            course_id = None
+        if not isinstance(course_id, basestring):
+            course_id = None
+        context = context_stack()
+        context.append((fn.__name__, course_id))
+        started = time.time()
+        error = None
+        try:
+            with collect_step_errors() as errors:
+                return fn(*args, **kwargs)
+        except Exception as err:
+            error = str(err) or err.__class__.__name__
+            raise
+        finally:
+            context.pop()
+            error = error or '; '.join(errors) or None
+            if course_id:
+                run_ledger.record_step(course_id, fn.__name__, 'failed' if error else 'done', started,
+                                       time.time() - started, run_id=RUN_ID, error=error)
+            if not context:
+                if error:
+                    note_failed(fn.__name__, course_id, error)
+                poll_unwaited()
+                record_retries()
+    return wrapper
+
+def bq_time(ms):
+    if ms is None:
+        return None
+    return int(ms) / 1000.0
+
+def job_record(handle, context=(None, None)):
+    '''
+    Stats for the job of handle (a done bqjobs.JobHandle), submitted in context (step, course_id), as a dict.
+    '''
+    job = handle.job
+    config = job.get('configuration', {})
+    kind = ([x for x in ['query', 'load', 'extract', 'copy'] if x in config] or ['unknown'])[0]
+    table_ref = config.get(kind, {}).get('sourceTable' if kind=='extract' else 'destinationTable', {})
+    stats = job.get('statistics', {})
+    qstats = stats.get('query', {})
+    (step, course_id) = context
+
+    rec = {'run_id': RUN_ID,
+           'step': step,
+           'course_id': course_id,
+           'kind': kind,
+           'job_id': handle.job_id,
+           'project_id': handle.project_id,
+           'dataset': table_ref.get('datasetId'),
+           'table': table_ref.get('tableId'),
+           'error': None,
+           'submitted': handle.submitted,
+           'created': bq_time(stats.get('creationTime')),
+           'started': bq_time(stats.get('startTime')),
+           'ended': bq_time(stats.get('endTime')),
+           'bytes_processed': int(qstats.get('totalBytesProcessed', stats.get('load', {}).get('outputBytes', 0))),
+           'bytes_billed': int(qstats.get('totalBytesBilled', 0)),
+           'retries': handle.nretries,
+           }
+    if handle.exception is not None:
+        rec['error'] = str(handle.exception)
+    elif 'errorResult' in job.get('status', {}):
+        rec['error'] = job['status']['errorResult'].get('message', 'error')
+
+    # queue wait: waiting for a slot in the JobManager, then pending in BigQuery
+    rec['queue_wait'] = (handle.inserted or handle.submitted) - handle.submitted
+    if rec['started'] and rec['created']:
+        rec['queue_wait'] += rec['started'] - rec['created']
+    rec['run_time'] = (rec['ended'] - rec['started']) if (rec['ended'] and rec['started']) else None
+    return rec
+
+def track(handle):
+    '''
+    Record the stats of the job of handle (a bqjobs.JobHandle, just submitted) when it is done, attributed
+    to the current step.
+    '''
+    if enabled():
+        context = (context_stack() or [(None, None)])[-1]
+        handle.add_done_callback(lambda h: record(h, context))
+
+def track_unwaited(handle):
+    '''
+    Note that the job of handle (tracked, and inserted) was submitted without waiting, so that no one polls
+    its JobManager: it is polled by poll_unwaited instead, so that its stats are recorded.
+    '''
+    if enabled() and not handle.done():
+        with UNWAITED_LOCK:
+            UNWAITED.append((handle, threading.current_thread().ident))
+
+def poll_unwaited(timeout=0, this_thread=True):
+    '''
+    Poll the jobs noted by track_unwaited (those submitted by the current thread, if this_thread): once,
+    or until they are done, for up to timeout seconds.  Returns the number not yet done.
+    '''
+    ident = threading.current_thread().ident
+    with UNWAITED_LOCK:
+        handles = [h for (h, t) in UNWAITED if t==ident or not this_thread]
+    if not handles:
+        return 0
+    manager = handles[0].manager
+    deadline = manager.clock() + timeout
+    while True:
+        for handle in handles:
+            handle.next_poll = 0
+            handle.manager.poll()
+        handles = [h for h in handles if not h.done()]
+        if not handles or manager.clock() >= deadline:
+            break
+        manager.sleep(manager.min_poll)
+    with UNWAITED_LOCK:
+        UNWAITED[:] = [(h, t) for (h, t) in UNWAITED if not h.done()]
+    return len(handles)
+
+def wait_unwaited():
+    '''
+    At exit: wait (up to EXIT_WAIT seconds) for the jobs submitted without waiting, to record their stats.
+    '''
+    if not enabled():
+        return
+    left = poll_unwaited(timeout=EXIT_WAIT, this_thread=False)
+    if left:
+        print "[jobstats] %d job(s) submitted without waiting still running at exit; their stats are not recorded" % left
+
+def record(handle, context=(None, None)):
+    '''
+    Append the stats of the job of handle to the job stats file.
+    '''
+    try:
+        line = json.dumps(job_record(handle, context)) + '\n'
+        with open(JOBSTATS_FILE, 'a') as ofp:	# one write per line, so lines from parallel processes don't mix
+            ofp.write(line)
+    except Exception as err:
+        print "[jobstats] oops, failed to record stats for job %s, err=%s" % (handle.job_id, str(err))
+
+def record_retries():
+    '''
+    Append the retries counted in retry.COUNTS since the last call (in this process) to the job stats file.
+    '''
+    if not enabled():
+        return
+    with RETRIES_LOCK:
+        counts = dict(retry.COUNTS)
+        new = dict((label, n - RETRIES_RECORDED.get(label, 0)) for (label, n) in counts.items()
+                   if n > RETRIES_RECORDED.get(label, 0))
+        RETRIES_RECORDED.update(counts)
+    if not new:
+        return
+    try:
+        with open(JOBSTATS_FILE, 'a') as ofp:
+            ofp.write(json.dumps({'run_id': RUN_ID, 'kind': 'retries', 'retries': new, 'pid': os.getpid()}) + '\n')
+    except Exception as err:
+        print "[jobstats] oops, failed to record retries, err=%s" % str(err)
+
+#-----------------------------------------------------------------------------
+# summary, for the jobstats command
+
+def load_records(fn, run_id=None):
+    '''
+    Return the job records in file fn for run run_id (default: the last run in the file).
+    '''
+    recs = []
+    with open(fn) as ifp:
+        for line in ifp:
+            if line.strip():
+                recs.append(json.loads(line))
+    if run_id is None and recs:
+        run_id = recs[-1]['run_id']
+    return [x for x in recs if x['run_id']==run_id]
+
+def summarize(recs, ntop=10, ofp=sys.stdout):
+    '''
+    Write a summary of job records recs: per step, the number of jobs, wall-clock time (first submission to
+    last job end), total job run time and queue wait, and GB processed and billed, slowest first; then the ntop
+    slowest and costliest jobs, and the retries, per label.
+    '''
+    retries = {}
+    for rec in recs:
+        for (label, n) in rec.get('retries', {}).items() if rec['kind']=='retries' else []:
+            retries[label] = retries.get(label, 0) + n
+    recs = [x for x in recs if x['kind']!='retries']
+    if not recs:
+        ofp.write("No jobs found\n")
+        return
+
+    steps = {}
+    for rec in recs:
+        steps.setdefault(rec['step'] or '-', []).append(rec)
+
+    def gb(nbytes):
+        return nbytes / (1024.0**3)
+
+    def span(rlist):
+        ends = [x['ended'] or x['submitted'] for x in rlist]
+        return max(ends) - min(x['submitted'] for x in rlist)
+
+    ofp.write("Run %s: %d jobs\n\n" % (recs[0]['run_id'], len(recs)))
+    ofp.write("%-30s %6s %10s %10s %10s %10s %10s %6s\n" % ('step', 'jobs', 'wall sec', 'run sec', 'queue sec',
+                                                             'GB proc', 'GB billed', 'errors'))
+    for (step, rlist) in sorted(steps.items(), key=lambda x: -span(x[1])):
+        ofp.write("%-30s %6d %10.1f %10.1f %10.1f %10.2f %10.2f %6d\n" % (
+            step, len(rlist), span(rlist),
+            sum(x['run_time'] or 0 for x in rlist),
+            sum(x['queue_wait'] or 0 for x in rlist),
+            gb(sum(x['bytes_processed'] for x in rlist)),
+            gb(sum(x['bytes_billed'] for x in rlist)),
+            len([x for x in rlist if x['error']])))
+
+    def show_jobs(title, rlist, value, fmt):
+        ofp.write("\n%s:\n" % title)
+        for rec in rlist[:ntop]:
+            ofp.write(("    " + fmt + "  %-20s %-40s %s.%s\n") % (value(rec), rec['step'] or '-', rec['course_id'] or '-',
+                                                                 rec['dataset'], rec['table']))
+
+    show_jobs("Slowest jobs (run sec)", sorted(recs, key=lambda x: -(x['run_time'] or 0)),
+              lambda x: x['run_time'] or 0, "%10.1f")
+    show_jobs("Costliest jobs (GB billed)", sorted(recs, key=lambda x: (-x['bytes_billed'], -x['bytes_processed'])),
+              lambda x: gb(x['bytes_billed']), "%10.2f")
+
+    if retries:
+        ofp.write("\nRetries:\n")
+        for (label, n) in sorted(retries.items(), key=lambda x: -x[1]):
+            ofp.write("    %6d  %s\n" % (n, label))
+
+#-----------------------------------------------------------------------------
+# unit tests, using py.test
+
+def test_job_record_and_summary():
+    import bqjobs
+    import shutil
+    import tempfile
+    from StringIO import StringIO
+
+    clock = bqjobs.FakeClock()
+    service = bqjobs.FakeJobsService(clock)
+    manager = bqjobs.JobManager(service, max_in_flight=1, min_poll=1, sleep=clock.sleep, clock=clock)
+
+    @job_step
+    def person_day(param, course_id, args=None):
+        retry.count('tables.get')
+        handles = []
+        for (table, nbytes) in [('pcday_1', 2000), ('pcday_2', 5 * 1024**3)]:
+            job = bqjobs.make_job(table)
+            job['configuration']['query']['destinationTable'] = {'datasetId': 'ds_pcday', 'tableId': table}
+            handles.append(manager.submit(job, 'proj'))
+            track(handles[-1])
+        return handles
+
+    tmpdir = tempfile.mkdtemp()
+    fn = os.path.join(tmpdir, 'jobstats.json')
+    set_file(fn, run_id='run1')
+    RETRIES_RECORDED.update(retry.COUNTS)
+    orig_ledger = run_ledger.RUN_LEDGER_FILE
+    run_ledger.set_file(os.path.join(tmpdir, 'ledger.sqlite'))
+    try:
+        handles = person_day(None, 'MITx/6.002x/2013_Spring')
+        manager.wait()			# jobs finish outside of the step, but are still attributed to it
+        record_retries()		# nothing new
+        recs = load_records(fn)
+        step_rec = run_ledger.get_ledger().get('MITx/6.002x/2013_Spring', 'person_day')
+
+        @job_step
+        def enrollment_day(param, course_id, args=None):
+            try:
+                raise Exception('no tracking logs')
+            except Exception as err:
+                step_failed(err)		# carries on, like enrollment_day in main
+
+        with collect_step_errors() as errors:
+            enrollment_day(None, 'MITx/6.002x/2013_Spring')
+        failed_rec = run_ledger.get_ledger().get('MITx/6.002x/2013_Spring', 'enrollment_day')
+    finally:
+        set_file(None)
+        run_ledger.set_file(orig_ledger)
+        shutil.rmtree(tmpdir)
+    assert context_stack() == []
+    assert step_rec['status'] == 'done' and step_rec['run_id'] == 'run1' and step_rec['duration'] >= 0
+    assert errors == ['no tracking logs'] and error_stack() == []
+    assert failed_rec['status'] == 'failed' and failed_rec['error'] == 'no tracking logs'
+
+    assert recs[0] == {'run_id': 'run1', 'kind': 'retries', 'retries': {'tables.get': 1}, 'pid': os.getpid()}
+    retries = recs.pop(0)
+    assert [x['table'] for x in recs] == ['pcday_1', 'pcday_2']
+    assert recs[0]['step'] == 'person_day' and recs[0]['course_id'] == 'MITx/6.002x/2013_Spring'
+    assert recs[0]['kind'] == 'query' and recs[0]['run_id'] == 'run1' and recs[0]['error'] is None
+    assert recs[0]['queue_wait'] == 0
+    assert recs[1]['queue_wait'] == handles[1].inserted - handles[1].submitted > 0	# waited for the in-flight slot
+
+    recs[1].update({'started': 2000.0, 'ended': 2100.0, 'run_time': 100.0, 'bytes_billed': 5 * 1024**3})
+    sfp = StringIO()
+    summarize(recs + [retries], ofp=sfp)
+    out = sfp.getvalue()
+    assert 'Run run1: 2 jobs' in out
+    assert out.split('Retries:')[1].split() == ['1', 'tables.get']
+    assert [x for x in out.splitlines() if x.startswith('person_day')][0].split()[1] == '2'
+    assert out.split('Slowest jobs')[1].splitlines()[1].strip().startswith('100.0')
+    assert 'ds_pcday.pcday_2' in out.split('Costliest jobs')[1].splitlines()[1]
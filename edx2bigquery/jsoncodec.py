@@ -0,0 +1,143 @@
+#!/usr/bin/python
+#
+# File:   jsoncodec.py
+#
+# JSON encode / decode used by the tracking log and forum rephrasing loops.
+#
+# Parsing uses ujson when it is installed (and JSON_CODEC is not set to "json"
+# in edx2bigquery_config), falling back to the standard library json module
+# otherwise.  Output is always produced by the standard library encoder, so
+# the rephrased lines are byte-for-byte identical whichever parser is used.
+#
+# ujson accepts a few inputs which the standard library rejects (raw control
+# characters inside strings) and mangles lone surrogate escapes, so lines
+# containing either are always handed to the standard library parser.  Any
+# ValueError from ujson (eg integers too large for 64 bits, NaN) also falls
+# back to the standard library, which then decides whether the line is bad.
+
+import json
+import re
+
+import edx2bigquery_config
+
+JSON_CODEC = getattr(edx2bigquery_config, 'JSON_CODEC', 'auto')
+
+ujson = None
+if JSON_CODEC != 'json':
+    try:
+        import ujson
+        # ujson < 2.0 truncates floats unless precise_float is given; 2.x is always precise
+        try:
+            ujson.loads('0.1', precise_float=True)
+            _ujson_loads = lambda s: ujson.loads(s, precise_float=True)
+        except TypeError:
+            _ujson_loads = ujson.loads
+        if _ujson_loads('0.30000000000000004') != 0.30000000000000004:
+            ujson = None
+    except ImportError:
+        ujson = None
+
+_stdlib_loads = json.loads
+_UNSAFE_FOR_UJSON = re.compile(r'[\x00-\x09\x0b-\x1f]|\\u[dD][89abcdefABCDEF]')
+
+_encoder = json.JSONEncoder()
+
+def codec_name():
+    return 'ujson' if ujson is not None else 'json'
+
+def loads(s):
+    '''
+    Decode the JSON string s; same result (and same exceptions) as json.loads(s).
+    '''
+    if ujson is None or _UNSAFE_FOR_UJSON.search(s):
+        return _stdlib_loads(s)
+    try:
+        return _ujson_loads(s)
+    except ValueError:
+        return _stdlib_loads(s)
+
+def dumps(obj):
+    '''
+    Encode obj as JSON; same output as json.dumps(obj) with default arguments.
+    '''
+    return _encoder.encode(obj)
+
+#-----------------------------------------------------------------------------
+# tracking log "event" fields are JSON strings which are decoded once by
+# addmoduleid (to look for an id) and then again by rephrase_tracking_logs.
+# loads_event(s, keep=True) holds on to the decoded value, so that the next
+# loads_event call on the same string object gets it back without re-parsing.
+
+_kept_event = [None, None]
+
+def loads_event(s, keep=False):
+    '''
+    Decode a tracking log event string.  With keep=True, the result is handed to the
+    next loads_event call made with the identical string object (and only that call).
+    '''
+    if _kept_event[0] is s:
+        value = _kept_event[1]
+        _kept_event[0] = _kept_event[1] = None
+        return value
+    value = loads(s)
+    if keep:
+        _kept_event[0] = s
+        _kept_event[1] = value
+    return value
+
+#-----------------------------------------------------------------------------
+# unit tests, using py.test
+
+PARITY_CORPUS = [
+    '{"username": "alice", "event_source": "server", "name": "problem_check", "accept_language": "en-US,en;q=0.8", "time": "2015-02-10T16:18:07.318960+00:00", "agent": "Mozilla/5.0 (Windows NT 6.1; WOW64)", "page": "x_module", "host": "courses.edx.org", "session": "9b9a1b2c3d4e5f", "referer": "https://courses.edx.org/courses/MITx/6.00.1x/3T2014/courseware/Week_1/", "context": {"course_user_tags": {}, "user_id": 12345, "org_id": "MITx", "module": {"display_name": "Exercise 1"}, "course_id": "MITx/6.00.1x/3T2014", "path": "/courses/MITx/6.00.1x/3T2014/xblock/i4x:;_;_MITx;_6.00.1x;_problem;_L1_Problem_1/handler/xmodule_handler/problem_check"}, "ip": "10.0.0.1", "event": {"submission": {"i4x-MITx-6_00_1x-problem-L1_Problem_1_2_1": {"input_type": "formulaequationinput", "question": "", "response_type": "formularesponse", "answer": "3.14159", "variant": "", "correct": true}}, "success": "correct", "grade": 1, "correct_map": {"i4x-MITx-6_00_1x-problem-L1_Problem_1_2_1": {"hint": "", "hintmode": null, "correctness": "correct", "npoints": null, "msg": "", "queuestate": null}}, "state": {"student_answers": {}, "seed": 1, "done": null, "correct_map": {}, "input_state": {"i4x-MITx-6_00_1x-problem-L1_Problem_1_2_1": {}}}, "answers": {"i4x-MITx-6_00_1x-problem-L1_Problem_1_2_1": "3.14159"}, "attempts": 1, "max_grade": 1, "problem_id": "i4x://MITx/6.00.1x/problem/L1_Problem_1"}, "event_type": "problem_check"}\n',
+    '{"username": "bob", "event_source": "browser", "name": "play_video", "time": "2015-02-10T16:20:01.123456+00:00", "agent": "Mozilla/5.0", "page": "https://courses.edx.org/courses/HarvardX/PH207x/2012_Fall/courseware/Week_2/", "host": "courses.edx.org", "session": "", "context": {"user_id": 42, "org_id": "HarvardX", "course_id": "HarvardX/PH207x/2012_Fall", "path": "/event"}, "ip": "10.0.0.2", "event": "{\\"id\\":\\"i4x-HarvardX-PH207x-video-Solutions_to_Prevalence_Questions\\",\\"currentTime\\":123.45600000000002,\\"code\\":\\"html5\\",\\"speed\\":\\"1.50\\"}", "event_type": "play_video"}\n',
+    '{"username": "carol", "event_source": "browser", "time": "2015-02-10T16:21:00.000000+00:00", "page": "https://www.edx.org/courses/HarvardX/PH207x/2012_Fall/courseware/Week_2/Homework_2/", "context": {"course_id": "HarvardX/PH207x/2012_Fall", "path": "/event"}, "event": "input_i4x-HarvardX-PH207x-problem-Homework_2_2_1=0.05&input_i4x-HarvardX-PH207x-problem-Homework_2_3_1=%5B1%2C2%5D", "event_type": "problem_check"}\n',
+    '{"username": "d\\u00e9sir\\u00e9e", "time": "2015-02-10T16:22:00+00:00", "context": {"course_id": "course-v1:MITx+8.MReV+2T2014", "path": "/courses/course-v1:MITx+8.MReV+2T2014/courseware"}, "event": {"POST": {"position": ["2"]}, "GET": {}}, "event_type": "/courses/course-v1:MITx+8.MReV+2T2014/xblock/block-v1:MITx+8.MReV+2T2014+type@sequential+block@abc/handler/xmodule_handler/goto_position", "agent": "\xe6\x97\xa5\xe6\x9c\xac\xe8\xaa\x9e Safari \\ud83d\\ude00"}\n',
+    '{"_id": {"$oid": "5330f5e9e714bdeae575db5e"}, "time": "2015-02-10T16:23:00Z", "event": {"grade": 0.30000000000000004, "max_grade": 1e3, "big": 123456789012345678901234567890, "neg": -0.0, "small": 2.5e-310}, "event_type": "problem_graded"}\n',
+    '{"time": "2015-02-10T16:24:00Z", "event": "\\ud800 lone surrogate", "event_type": "bad_unicode"}\n',
+    '{"time": "2015-02-10T16:25:00Z", "event": "raw\ttab", "event_type": "control_char"}\n',
+    '{"time": "2015-02-10T16:26:00Z", "event": {"value": NaN, "inf": -Infinity}, "event_type": "nan"}\n',
+    '{"time": "2015-02-10T16:27:00Z", "event": "truncated',
+    '{"a": 1} {"b": 2}\n',
+    '\xff\xfe not utf-8\n',
+    '',
+]
+
+def _decode_outcome(decoder, line):
+    try:
+        return ('ok', json.dumps(decoder(line), sort_keys=True))
+    except ValueError:
+        return ('error', None)
+
+def test_loads_parity():
+    for line in PARITY_CORPUS:
+        assert _decode_outcome(loads, line) == _decode_outcome(json.loads, line), line
+
+def test_dumps_parity():
+    for line in PARITY_CORPUS:
+        try:
+            data = json.loads(line)
+        except ValueError:
+            continue
+        assert dumps(data) == json.dumps(data)
+        assert dumps(loads(line)) == json.dumps(data)
+
+def test_loads_event_keep():
+    s = '{"id": "i4x-MITx-8_01x-video-intro"}'
+    first = loads_event(s, keep=True)
+    second = loads_event(s)
+    assert second is first
+    third = loads_event(s)
+    assert third == first and third is not first
+
+def test_rephrase_parity():
+    import rephrase_tracking_logs
+    global ujson
+    saved = ujson
+    fast = [rephrase_tracking_logs.do_rephrase_line(line) for line in PARITY_CORPUS]
+    try:
+        ujson = None
+        slow = [rephrase_tracking_logs.do_rephrase_line(line) for line in PARITY_CORPUS]
+    finally:
+        ujson = saved
+    assert fast == slow
@@ -25,7 +25,6 @@ import time
 
 import dateutil.parser
 
-import auth
 import bqutil
 import edx2bigquery_config
 import gsutil
@@ -65,6 +64,7 @@ def load_all_daily_logs_for_course(course_id, gsbucket="gs://x-data", verbose=Tr
 
     tables = bqutil.get_list_of_table_ids(dataset)
     tables = [x for x in tables if x.startswith('track')]
+    table_meta = None		# modification dates of all the tables, fetched when first needed
   
     if verbose:
         print "-"*77
@@ -91,7 +91,11 @@ def load_all_daily_logs_for_course(course_id, gsbucket="gs://x-data", verbose=Tr
         if tablename in tables:
             skip = True
             if check_dates:
-                table_date = bqutil.get_bq_table_last_modified_datetime(dataset, tablename)
+                if table_meta is None:
+                    table_meta = bqutil.get_tables_metadata(dataset)
+                table_date = table_meta.get(tablename, {}).get('lastModifiedTime')
+                if table_date is None:
+                    table_date = bqutil.get_bq_table_last_modified_datetime(dataset, tablename)
                 if not (table_date > file_date):
                     print "Already have table %s, but %s file_date=%s, table_date=%s; re-loading from gs" % (tablename, fn, file_date, table_date)
                     skip = False
@@ -142,6 +146,13 @@ def load_local_logs_to_biqquery(course_id, start_date, end_date, verbose):
         if not file_name:
             continue
 
+        if file_name.endswith('.tmp') or re.search(r'\.part[0-9]{3}\.parquet$', file_name):
+            continue	# incomplete, or loaded with the parquet file it is a part of
+
+        is_parquet = file_name.endswith('.parquet')
+        if is_parquet and os.path.exists(file_name[:-len('.parquet')] + '.json.gz'):
+            continue	# same day, split in both formats: load the JSON
+
         file_match = re.findall(date_pattern, file_name)
 
         if not file_match and verbose:
@@ -162,14 +173,19 @@ def load_local_logs_to_biqquery(course_id, start_date, end_date, verbose):
             if verbose:
                 logging('Uploading: {} to the table: {}'.format(file_name, table_name))
 
-            bqutil.upload_local_data_to_big_query(
-                dataset_id=dataset_name,
-                table_id=table_name,
-                schema=schema,
-                course_id=course_id,
-                file_name=file_name,
-                source_format=DEFAULT_JSON_SOURCE_FORMAT_NAME,
-            )
+            if is_parquet:
+                # parquet tracklogs (split --split-format=parquet) have flattened columns; see tracklog_parquet
+                import tracklog_parquet
+                tracklog_parquet.load_to_bigquery(dataset_name, table_name, file_name, course_id=course_id)
+            else:
+                bqutil.upload_local_data_to_big_query(
+                    dataset_id=dataset_name,
+                    table_id=table_name,
+                    schema=schema,
+                    course_id=course_id,
+                    file_name=file_name,
+                    source_format=DEFAULT_JSON_SOURCE_FORMAT_NAME,
+                )
         elif verbose:
             logging(
                 'The file with name: {} has a date before or after of the start_date and end_date provided.'.format(
@@ -3,6 +3,7 @@
 # edx2bigquery main entry point
 #
 import argparse
+import atexit
 import copy
 import datetime
 import json
@@ -17,9 +18,6 @@ from opaque_keys import InvalidKeyError
 from opaque_keys.edx.keys import CourseKey, UsageKey
 from path import Path as path
 
-from s3_backend import get_tracking_log_objects, get_sql_data_objects
-from load_course_sql import load_local_sql_files_to_bigquery
-
 
 CURDIR = path(os.path.abspath(os.curdir))
 if os.path.exists(CURDIR / 'edx2bigquery_config.py'):
@@ -28,6 +26,13 @@ if os.path.exists(CURDIR / 'edx2bigquery_config.py'):
 else:
     print "WARNING: edx2bigquery needs a configuration file, ./edx2bigquery_config.py, to operate properly"
 
+import course_scheduler
+import jobstats
+import nightly_planner
+import run_ledger
+import work_queue
+import stepgraph
+
 def is_valid_course_id(course_id):
     """
     Checks if the provided course_id is a valid course id instance.
@@ -142,7 +147,9 @@ def run_parallel_or_serial(function, param, courses, optargs, parallel=False, na
     run function(param, course_id, args) for each course_id in the list courses.
 
     Do this serially if parallel=False.
-    Else run in parallel, using a multiprocessing parallel processing pool.
+    Else run in parallel, using a multiprocessing parallel processing pool, or, if param.parallel_threads,
+    a pool of threads (for steps which mostly wait on BigQuery, sharing one BigQuery client), scheduled by a
+    course_scheduler.CourseScheduler: most costly courses first, with each course's output in its own log file.
     '''
     if not name:
         name = function.__name__
@@ -153,66 +160,45 @@ def run_parallel_or_serial(function, param, courses, optargs, parallel=False, na
             for course_id in courses:
                 ret = function(param, course_id, optargs)
         except Exception as err:
+            jobstats.note_failed(name, course_id, str(err) or err.__class__.__name__)
             print "===> Error running %s on %s, err=%s" % (name, courses, str(err))
             traceback.print_exc()
             sys.stdout.flush()
             ret = {}
         return ret
 
-    pool = mp.Pool(processes=param.max_parallel or MAXIMUM_PARALLEL_PROCESSES)
-    results = []
-    for course_id in courses:
-        runname = "%s on %s" % (name, course_id)
-        runargs = (function, (param, course_id, optargs), SubProcessStdout(course_id), runname)
-        results.append( pool.apply_async(run_capture_stdout, args=(runargs)) )
-
-    output = [p.get() for p in results]
-    print "="*100
+    use_threads = getattr(param, 'parallel_threads', False)
+    scheduler = course_scheduler.CourseScheduler(name, param.max_parallel or MAXIMUM_PARALLEL_PROCESSES,
+                                                 use_threads=use_threads,
+                                                 log_dir=getattr(param, 'course_log_dir', None),
+                                                 max_tasks=getattr(param, 'worker_max_tasks', None))
+    if use_threads:
+        orig_stdout = sys.stdout
+        sys.stdout = course_scheduler.ThreadStdout()
+    try:
+        output = scheduler.run(function, courses, lambda course_id: (param, course_id, optargs))
+    finally:
+        if use_threads:
+            sys.stdout = orig_stdout
     print "="*100
     print "PARALLEL RUN of %s DONE" % name
     print "="*100
-    print "="*100
-    def output_stats():
-        for ret in output:
-            ret = ret or {}
-            print '    [%s] success=%s, dt=%s' % (ret.get('name', name), ret.get('success', 'unknown'), ret.get('dt', 'unknown'))
-    output_stats()
-    print "="*100
     for ret in output:
-        runname = ret.get('name', name)
-        print "="*100 + " [%s]" % runname
-        if 'stdout' in ret:
-            print ret['stdout'].output
-    print "="*100
-    output_stats()
+        print '    [%s] success=%s, dt=%s, log=%s' % (ret['course_id'], ret['success'], course_scheduler.format_dt(ret['dt']),
+                                                   ret['logfile'])
+        if not ret['success']:
+            jobstats.note_failed(name, ret['course_id'], 'failed (see %s)' % ret['logfile'])
     print "="*100
 
-
-def run_capture_stdout(function, args, stdout=None, name="<run>"):
+def exit_status(args):
     '''
-    run function(*args) and capture stdout.  Return dict with time elapsed, output, and success flag.
+    Exit status of the command: with --error-exit-status, 1 if any step or course failed, though the command
+    carried on (eg run_parallel_or_serial catches the error), so that the worker running it as a task can tell.
     '''
-    start = datetime.datetime.now()
-    success = False
-    print "-"*100
-    print "[RUN] STARTING %s at %s" % (name, start)
-    print "-"*100
-    if stdout:
-        sys.stdout = stdout			# overload for multiprocessing, so that we can unravel output streams
-    try:
-        function(*args)
-        errstr = None
-        success = True
-    except Exception as err:
-        errstr = str(err)
-
-    end = datetime.datetime.now()
-    ret = {'start': start, 'end': end, 'dt' : end-start, 'success': success, 'name': name, 'stdout': stdout}
-    print "-"*100
-    print "[RUN] DONE WITH %s, success=%s, dt=%s" % (name, ret['success'], ret['dt'])
-    print "-"*100
-    sys.stdout.flush()
-    return ret
+    if args.error_exit_status and jobstats.FAILED:
+        print "Failed: %s" % ', '.join('%s on %s' % (step, course_id) for (step, course_id, error) in jobstats.FAILED)
+        return 1
+    return 0
 
 #-----------------------------------------------------------------------------
 # run external script
@@ -231,6 +217,7 @@ def run_external_single(param, course_id, args=None):
 #-----------------------------------------------------------------------------
 # main functions for performing analysis
 
+@jobstats.job_step
 def setup_sql(param, args, steps, course_id=None):
     sqlall = steps=='setup_sql'
     if course_id is None:
@@ -269,7 +256,7 @@ def setup_sql(param, args, steps, course_id=None):
         import load_course_sql
         try:
             if param.use_local_files:
-                load_local_sql_files_to_bigquery(
+                load_course_sql.load_local_sql_files_to_bigquery(
                     course_id=course_id,
                     verbose=args.verbose,
                     base_dir=param.the_basedir,
@@ -383,6 +370,7 @@ def analyze_course_single(param, course_id, optargs=None):
         sys.stdout.flush()
         raise
 
+@jobstats.job_step
 def time_on_task(param, course_id, optargs=None, skip_totals=False, just_do_totals=False, suppress_errors=False):
     '''
     update time_task table based on tracking logs
@@ -422,7 +410,9 @@ def time_on_task(param, course_id, optargs=None, skip_totals=False, just_do_tota
         sys.stdout.flush()
         if not suppress_errors:
             raise
+        jobstats.step_failed(err)
 
+@jobstats.job_step
 def time_on_asset(param, course_id, optargs=None, skip_totals=False, just_do_totals=False, suppress_errors=False):
     '''
     update time_on_asset tables based on tracking logs
@@ -485,6 +475,7 @@ def get_logs_from_simple_storage_service(param, args):
         print('--start-date must be specified in this format: YYYYMMDD.')
         exit()
 
+    from s3_backend import get_tracking_log_objects
     try:
         get_tracking_log_objects(
             bucket_name=getattr(edx2bigquery_config, 'AWS_BUCKET_NAME', None),
@@ -508,15 +499,68 @@ def get_mysql_data_from_simple_storage_service(param, args):
     if not getattr(param, 'start_date', None):
         raise Exception('--start-date must be specified in this format: YYYY-MM-DD.')
 
+    from s3_backend import get_sql_data_objects
     get_sql_data_objects(
         bucket_name=getattr(edx2bigquery_config, 'AWS_BUCKET_NAME', None),
         start_date=param.start_date,
     )
 
+def get_split_timezone():
+    '''
+    Return the pytz timezone to use in splitting tracking logs, from TIMEZONE in edx2bigquery_config, or None.
+    '''
+    import pytz
+    timezone_string = None
+    timezone = None
+
+    try:
+        timezone_string = edx2bigquery_config.TIMEZONE
+    except Exception as err:
+        if not str(err)=="'module' object has no attribute 'TIMEZONE'":
+            print "    no timezone specified, timezone_string=%s, err=%s" % (timezone_string, err)
+    if timezone_string:
+        try:
+            timezone = pytz.timezone(timezone_string)
+        except Exception as err:
+            print "  Error!  Cannot parse timezone '%s' err=%s" % (timezone_string, err)
+    return timezone
+
+def stream_logs(param, args, todo):
+    '''
+    Streaming daily_logs: split the tracking log files in the list todo, upload the per-course daily logs straight
+    to google storage (or to the --stream-logs-dir directory, standing in for it), and queue the BigQuery loads.
+    As for daily_logs, only the courses specified (eg by --year2 or --clist) are uploaded and loaded.
+    '''
+    import stream_tracking_logs
+    if param.use_local_files:
+        raise Exception("--stream-logs cannot be used with --use-local-tracking-files")
+    if args.split_format=='parquet':
+        raise Exception("--stream-logs only streams JSON tracking logs, and cannot be used with --split-format=parquet")
+    if args.stream_logs_dir:
+        store = stream_tracking_logs.LocalObjectStore(args.stream_logs_dir)
+    else:
+        store = stream_tracking_logs.GSObjectStore(edx2bigquery_config.GS_BUCKET)
+    stream_tracking_logs.stream_files(todo,
+                                      store,
+                                      course_ids=get_course_ids(args),
+                                      dynamic_dates=args.dynamic_dates,
+                                      timezone=get_split_timezone(),
+                                      workers=args.split_workers,
+                                      verbose=args.verbose,
+                                      )
+
+@jobstats.job_step
 def daily_logs(param, args, steps, course_id=None, verbose=True, wait=False):
     if steps=='daily_logs':
+        if args.stream_logs:
+            # streaming: split, upload to gs, and queue loads into bq, in one pass, without local per-course files
+            if args.dynamic_dates:
+                # each day is uploaded, and loaded, with just this run's events: those of earlier runs would be lost
+                raise Exception("--stream-logs cannot be used with --dynamic-dates")
+            split_logs(param, args, 'stream', args.tlfn)
+            return
         # doing daily_logs, so run split once first, then afterwards logs2gs and logs2bq
-        daily_logs(param, args, 'split', args.tlfn)
+        split_logs(param, args, 'split', args.tlfn)
         for course_id in get_course_ids(args):
             daily_logs(param, args, ['logs2gs', 'logs2bq'], course_id, verbose=args.verbose)
         return
@@ -525,56 +569,12 @@ def daily_logs(param, args, steps, course_id=None, verbose=True, wait=False):
         do_check = not (steps=='split')
         for course_id in get_course_ids(args, do_check=do_check):
             print "---> Processing %s on course_id=%s" % (steps, course_id)
-            daily_logs(param, args, steps, course_id)
+            if steps in ['split', 'stream']:
+                split_logs(param, args, steps, course_id)	# course_id is a tracking log file
+            else:
+                daily_logs(param, args, steps, course_id)
         return
 
-    logs_dir = args.logs_dir or getattr(edx2bigquery_config, 'TRACKING_LOGS_DIRECTORY', '')
-
-    if 'split' in steps:
-        import split_and_rephrase
-        import pytz
-        tlfn = course_id		# tracking log filename
-        if '*' in tlfn:
-            import glob
-            TODO = glob.glob(tlfn)
-            TODO.sort()
-        elif param.split_multiple_files:
-            TODO = list(
-                map(
-                    lambda file: '{}/{}'.format(
-                        logs_dir,
-                        file,
-                    ),
-                    os.listdir(logs_dir),
-                )
-            )
-        else:
-            TODO = [tlfn]
-        for the_tlfn in TODO:
-            print "--> Splitting tracking logs in %s" % the_tlfn
-            timezone_string = None
-            timezone = None
-
-            try:
-                timezone_string = edx2bigquery_config.TIMEZONE
-            except Exception as err:
-                if not str(err)=="'module' object has no attribute 'TIMEZONE'":
-                    print "    no timezone specified, timezone_string=%s, err=%s" % (timezone_string, err)
-            if timezone_string:
-                try:
-                    timezone = pytz.timezone(timezone_string)
-                except Exception as err:
-                    print "  Error!  Cannot parse timezone '%s' err=%s" % (timezone_string, err)
-
-            split_and_rephrase.do_file(
-                the_tlfn,
-                use_local_files=param.use_local_files,
-                logs_dir=logs_dir,
-                dynamic_dates=args.dynamic_dates,
-                timezone=timezone,
-                logfn_keepdir=args.logfn_keepdir,
-            )
-
     if 'logs2gs' in steps:
         import transfer_logs_to_gs
         try:
@@ -585,6 +585,7 @@ def daily_logs(param, args, steps, course_id=None, verbose=True, wait=False):
                                             )
         except Exception as err:
             print err
+            jobstats.step_failed(err)
 
     if 'logs2bq' in steps:
         import load_daily_tracking_logs
@@ -608,6 +609,51 @@ def daily_logs(param, args, steps, course_id=None, verbose=True, wait=False):
             print err
             raise
 
+@jobstats.job_step
+def split_logs(param, args, steps, tlfn):
+    '''
+    Split the tracking log file tlfn (which may be a glob) by course ("split"), or stream it into BigQuery
+    ("stream").  Not part of daily_logs, whose runs are recorded in the run ledger by course_id.
+    '''
+    logs_dir = args.logs_dir or getattr(edx2bigquery_config, 'TRACKING_LOGS_DIRECTORY', '')
+
+    import split_and_rephrase
+    if '*' in tlfn:
+        import glob
+        TODO = glob.glob(tlfn)
+        TODO.sort()
+    elif param.split_multiple_files:
+        TODO = list(
+            map(
+                lambda file: '{}/{}'.format(
+                    logs_dir,
+                    file,
+                ),
+                os.listdir(logs_dir),
+            )
+        )
+    else:
+        TODO = [tlfn]
+    if steps=='stream':
+        stream_logs(param, args, TODO)
+        return
+
+    for the_tlfn in TODO:
+        print "--> Splitting tracking logs in %s" % the_tlfn
+        timezone = get_split_timezone()
+
+        split_and_rephrase.do_file(
+            the_tlfn,
+            use_local_files=param.use_local_files,
+            logs_dir=logs_dir,
+            dynamic_dates=args.dynamic_dates,
+            timezone=timezone,
+            logfn_keepdir=args.logfn_keepdir,
+            workers=args.split_workers,
+            output_format=args.split_format,
+        )
+
+@jobstats.job_step
 def analyze_problems(param, courses, args, do_show_answer=True, do_problem_analysis=True):
     import make_problem_analysis
     for course_id in get_course_ids(courses):
@@ -629,6 +675,7 @@ def analyze_problems(param, courses, args, do_show_answer=True, do_problem_analy
             raise
 
 
+@jobstats.job_step
 def analyze_videos(param, courses, args):
     import make_video_analysis
     for course_id in get_course_ids(courses):
@@ -650,6 +697,7 @@ def analyze_videos(param, courses, args):
             sys.stdout.flush()
             raise
 
+@jobstats.job_step
 def analyze_forum(param, courses, args):
     import make_forum_analysis
     for course_id in get_course_ids(courses):
@@ -784,6 +832,7 @@ def temporal_fingerprints(param, courses, args):
             sys.stdout.flush()
             raise
 
+@jobstats.job_step
 def show_answer_table(param, course_id, args=None):
     import make_problem_analysis
     try:
@@ -797,6 +846,7 @@ def show_answer_table(param, course_id, args=None):
         sys.stdout.flush()
         raise
 
+@jobstats.job_step
 def enrollment_events_table(param, course_id, args=None):
     import make_enrollment_day
     try:
@@ -816,6 +866,7 @@ def enrollment_events_table(param, course_id, args=None):
         sys.stdout.flush()
         raise
 
+@jobstats.job_step
 def analyze_ora(param, courses, args):
     import make_openassessment_analysis
     for course_id in get_course_ids(courses):
@@ -829,7 +880,9 @@ def analyze_ora(param, courses, args):
             print err
             traceback.print_exc()
             sys.stdout.flush()
+            jobstats.step_failed(err)
 
+@jobstats.job_step
 def item_tables(param, courses, args):
     import make_item_tables
     for course_id in get_course_ids(courses):
@@ -842,6 +895,7 @@ def item_tables(param, courses, args):
             print err
             traceback.print_exc()
             sys.stdout.flush()
+            jobstats.step_failed(err)
 
 def irt_report(param, courses, args):
     import make_irt_report
@@ -856,6 +910,7 @@ def irt_report(param, courses, args):
             sys.stdout.flush()
             raise
 
+@jobstats.job_step
 def problem_check(param, courses, args):
     import make_problem_analysis
     for course_id in get_course_ids(courses):
@@ -869,6 +924,16 @@ def problem_check(param, courses, args):
             print err
             traceback.print_exc()
             sys.stdout.flush()
+            jobstats.step_failed(err)
+
+def table_already_exists(param, course_id, step, table, remote_check):
+    '''
+    True if table (an output of step) exists in the dataset of course_id: from the run ledger if it's
+    recorded there, else from remote_check(), a BigQuery table lookup.
+    '''
+    import bqutil
+    dataset = bqutil.course_id2dataset(course_id, use_dataset_latest=param.use_dataset_latest)
+    return run_ledger.output_exists(course_id, step, '%s.%s' % (dataset, table), remote_check)
 
 def axis2bq(param, courses, args, stop_on_error=True):
     import make_course_axis
@@ -881,25 +946,32 @@ def axis2bq(param, courses, args, stop_on_error=True):
         course_axis_pin_dates = {}
 
     for course_id in get_course_ids(courses):
-        if args.skip_if_exists and make_course_axis.axis2bigquery.already_exists(course_id, use_dataset_latest=param.use_dataset_latest):
+        if args.skip_if_exists and table_already_exists(param, course_id, 'axis2bq', 'course_axis',
+                lambda: make_course_axis.axis2bigquery.already_exists(course_id, use_dataset_latest=param.use_dataset_latest)):
             print "--> course_axis for %s already exists, skipping" % course_id
             sys.stdout.flush()
             continue
         pin_date = course_axis_pin_dates.get(course_id)
         if pin_date:
             print "--> course_axis for %s being pinned to data from dump date %s" % (course_id, pin_date)
-        make_course_axis.process_course(
-            course_id,
-            param.the_basedir,
-            param.the_datedir,
-            param.use_dataset_latest,
-            param.use_local_files,
-            args.verbose,
-            pin_date,
-            stop_on_error=stop_on_error,
-        )
+        try:
+            make_course_axis.process_course(
+                course_id,
+                param.the_basedir,
+                param.the_datedir,
+                param.use_dataset_latest,
+                param.use_local_files,
+                args.verbose,
+                pin_date,
+                stop_on_error=True,
+            )
+        except Exception as err:
+            if stop_on_error:
+                raise
+            jobstats.step_failed(err)
 
 
+@jobstats.job_step
 def grades_persistent(param, courses, args):
     import make_grades_persistent
 
@@ -910,9 +982,10 @@ def grades_persistent(param, courses, args):
 
     for course_id in get_course_ids(courses):
         if args.skip_if_exists and \
-                make_grading_policy_table.already_exists(course_id,
-                    use_dataset_latest=param.use_dataset_latest,
-                    table=table):
+                table_already_exists(param, course_id, 'grades_persistent', table,
+                    lambda: make_grading_policy_table.already_exists(course_id,
+                        use_dataset_latest=param.use_dataset_latest,
+                        table=table)):
             print "--> %s for %s already exists, skipping" % (table, course_id)
             sys.stdout.flush()
             continue
@@ -929,6 +1002,7 @@ def grades_persistent(param, courses, args):
                 param.use_dataset_latest,
                 subsection=False)
 
+@jobstats.job_step
 def make_grading_policy(param, courses, args):
     import make_grading_policy_table
 
@@ -940,7 +1014,8 @@ def make_grading_policy(param, courses, args):
         course_axis_pin_dates = {}
 
     for course_id in get_course_ids(courses):
-        if args.skip_if_exists and make_grading_policy_table.already_exists(course_id, use_dataset_latest=param.use_dataset_latest):
+        if args.skip_if_exists and table_already_exists(param, course_id, 'make_grading_policy', 'grading_policy',
+                lambda: make_grading_policy_table.already_exists(course_id, use_dataset_latest=param.use_dataset_latest)):
             print "--> grading_policy for %s already exists, skipping" % course_id
             sys.stdout.flush()
             continue
@@ -953,7 +1028,8 @@ def make_user_partitions_table(param, courses, args):
     import load_user_part
 
     for course_id in get_course_ids(courses):
-        if args.skip_if_exists and load_user_part.already_exists(course_id, use_dataset_latest=param.use_dataset_latest):
+        if args.skip_if_exists and table_already_exists(param, course_id, 'make_user_partitions_table', 'user_partitions',
+                lambda: load_user_part.already_exists(course_id, use_dataset_latest=param.use_dataset_latest)):
             print "--> user_partitions for %s already exists, skipping" % course_id
             sys.stdout.flush()
             continue
@@ -991,6 +1067,7 @@ def research(param, courses, args, check_dates=True, stop_on_error=False):
             if stop_on_error:
                 raise
 
+@jobstats.job_step
 def person_day(param, courses, args, check_dates=True, stop_on_error=True):
     import make_person_course_day
     for course_id in get_course_ids(courses):
@@ -1008,7 +1085,9 @@ def person_day(param, courses, args, check_dates=True, stop_on_error=True):
             sys.stdout.flush()
             if stop_on_error:
                 raise
+            jobstats.step_failed(err)
 
+@jobstats.job_step
 def pcday_trlang(param, courses, args):
     import make_person_course_day
     for course_id in get_course_ids(courses):
@@ -1021,7 +1100,9 @@ def pcday_trlang(param, courses, args):
             print err
             traceback.print_exc()
             sys.stdout.flush()
+            jobstats.step_failed(err)
 
+@jobstats.job_step
 def pcday_ip(param, courses, args):
     import make_person_course_day
     for course_id in get_course_ids(courses):
@@ -1034,8 +1115,10 @@ def pcday_ip(param, courses, args):
             print err
             traceback.print_exc()
             sys.stdout.flush()
+            jobstats.step_failed(err)
 
 
+@jobstats.job_step
 def enrollment_day(param, courses, args):
     import make_enrollment_day
     for course_id in get_course_ids(courses):
@@ -1047,7 +1130,9 @@ def enrollment_day(param, courses, args):
             print err
             traceback.print_exc()
             sys.stdout.flush()
+            jobstats.step_failed(err)
 
+@jobstats.job_step
 def person_course(param, courses, args, just_do_nightly=False, force_recompute=False):
     import make_person_course
     print "[person_course]: for end date, using %s" % (args.end_date or param.DEFAULT_END_DATE)
@@ -1085,13 +1170,15 @@ def person_course(param, courses, args, just_do_nightly=False, force_recompute=F
 def doall(param, course_id, args, stdout=None):
     start = datetime.datetime.now()
     success = False
-    if stdout:
+    if stdout and isinstance(sys.stdout, course_scheduler.ThreadStdout):
+        sys.stdout.set_stream(stdout)		# this thread's output
+    elif stdout:
         sys.stdout = stdout			# overload for multiprocessing, so that we can unravel output streams
     try:
         print "-"*100
         print "DOALL PROCESSING %s" % course_id
         print "-"*100
-        setup_sql(param, course_id, 'setup_sql')
+        setup_sql(param, args, 'setup_sql', course_id=course_id)
         try:
             analyze_problems(param, course_id, args)
         except Exception as err:
@@ -1147,44 +1234,65 @@ def doall(param, course_id, args, stdout=None):
     return ret
 
 
+def make_nightly_planner(param, args):
+    '''
+    nightly_planner.NightlyPlanner for the nightly steps, with their inputs as declared by add_course_steps,
+    and the course fingerprints made when the run was planned (param.nightly_fingerprints), if any.
+    '''
+    graph = stepgraph.StepGraph()
+    add_course_steps(graph, param, None, args, nightly=True)
+    return nightly_planner.make_planner(param, args, nightly_planner.step_inputs(graph.steps.values()),
+                                        fingerprints=getattr(param, 'nightly_fingerprints', None))
+
 def run_nightly_single(param, course_id, args=None):
+    '''
+    Run the nightly steps for course_id.  With nightly --only-changed, just the steps planned for the course
+    (in param.nightly_plans) are run, and those done without errors are recorded in its nightly_planner state.
+    '''
+    plans = getattr(param, 'nightly_plans', None)
+    todo = plans.get(course_id, []) if plans is not None else None
+    done = []
+
+    def run(step, fn, optional=False):
+        if todo is not None and step not in todo:
+            print "--> Skipping %s for %s, its inputs are unchanged" % (step, course_id)
+            return
+        try:
+            with jobstats.collect_step_errors() as errors:
+                fn()
+        except Exception as err:
+            if not optional:
+                raise
+            print "--> Failed in %s with err=%s" % (step, str(err))
+            print "--> continuing with nightly anyway"
+            return
+        if errors:
+            print "--> %s carried on after errors, not recording it as done" % step
+        else:
+            done.append(step)
 
     print "-"*100
     print "NIGHTLY PROCESSING %s" % course_id
     print "-"*100
 
-
-
     try:
-        daily_logs(param, args, ['logs2gs', 'logs2bq'], course_id, verbose=args.verbose, wait=True)
+        run('daily_logs', lambda: daily_logs(param, args, ['logs2gs', 'logs2bq'], course_id, verbose=args.verbose, wait=True))
 
         # Ensure latest problem, video and forum data for person course day
-        try:
-            analyze_problems(param, course_id, args)
-        except Exception as err:
-            print "--> Failed in analyze_problems with err=%s" % str(err)
-            print "--> continuing with nightly anyway"
-        try:
-            analyze_videos(param, course_id, args)
-        except Exception as err:
-            print "--> Failed in analyze_videos with err=%s" % str(err)
-            print "--> continuing with nightly anyway"
-        try:
-            analyze_forum(param, course_id, args)
-        except Exception as err:
-            print "--> Failed in analyze_forum with err=%s" % str(err)
-            print "--> continuing with nightly anyway"
-
-        person_day(param, course_id, args, check_dates=False, stop_on_error=False)
-        enrollment_day(param, course_id, args)
-	enrollment_events_table(param, course_id, args)
-        pcday_ip(param, course_id, args)	# needed for modal IP
-        pcday_trlang(param, course_id, args)
-        person_course(param, course_id, args, just_do_nightly=True, force_recompute=True)
-        problem_check(param, course_id, args)
-        show_answer_table(param, course_id, args)
-        analyze_ora(param, course_id, args)
-        time_on_task(param, course_id, args, skip_totals=True)
+        run('analyze_problems', lambda: analyze_problems(param, course_id, args), optional=True)
+        run('analyze_videos', lambda: analyze_videos(param, course_id, args), optional=True)
+        run('analyze_forum', lambda: analyze_forum(param, course_id, args), optional=True)
+
+        run('person_day', lambda: person_day(param, course_id, args, check_dates=False, stop_on_error=False))
+        run('enrollment_day', lambda: enrollment_day(param, course_id, args))
+        run('enrollment_events_table', lambda: enrollment_events_table(param, course_id, args))
+        run('pcday_ip', lambda: pcday_ip(param, course_id, args))	# needed for modal IP
+        run('pcday_trlang', lambda: pcday_trlang(param, course_id, args))
+        run('person_course', lambda: person_course(param, course_id, args, just_do_nightly=True, force_recompute=True))
+        run('problem_check', lambda: problem_check(param, course_id, args))
+        run('show_answer_table', lambda: show_answer_table(param, course_id, args))
+        run('analyze_ora', lambda: analyze_ora(param, course_id, args))
+        run('time_on_task', lambda: time_on_task(param, course_id, args, skip_totals=True))
 
     except Exception as err:
         print "="*100
@@ -1193,6 +1301,147 @@ def run_nightly_single(param, course_id, args=None):
         sys.stdout.flush()
         raise
 
+    finally:
+        if plans is not None:
+            make_nightly_planner(param, args).save(course_id, done)
+
+
+def add_course_steps(graph, param, course_id, args, nightly=False, stdout=None, only_steps=None):
+    '''
+    Add the doall (or nightly) steps for course_id to graph (a stepgraph.StepGraph), in the order doall (or
+    run_nightly_single) runs them, with the tables each step reads and writes, from which the graph finds
+    which steps can be run concurrently.  Output of the steps goes to stdout, if given.  If only_steps is
+    given, just those steps are added.
+
+    Optional steps (the analyze_* steps) may fail without stopping the others, as in doall and nightly.
+    Steps which carry on after errors (see jobstats.step_failed) are done, but with those errors.
+    '''
+    LOGS = 'tracking_logs'
+
+    def add(name, fn, inputs, outputs, optional=False):
+        if only_steps is not None and name not in only_steps:
+            return
+        def run():
+            if stdout is not None:
+                sys.stdout.set_stream(stdout)		# sys.stdout is a course_scheduler.ThreadStdout during the run
+            try:
+                with jobstats.collect_step_errors() as errors:
+                    fn()
+                if errors:
+                    step.error = '; '.join(errors)
+            finally:
+                if stdout is not None:
+                    sys.stdout.set_stream(None)
+        step = graph.add(name, run, inputs=inputs, outputs=outputs, group=course_id, optional=optional)
+
+    def add_logs():
+        if nightly or not param.skip_log_loading:
+            add('daily_logs', lambda: daily_logs(param, args, ['logs2gs', 'logs2bq'], course_id, verbose=args.verbose, wait=True),
+                [], [LOGS])
+
+    def add_analyses():
+        add('analyze_problems', lambda: analyze_problems(param, course_id, args),
+            ['studentmodule', 'course_axis', LOGS], ['problem_analysis', 'person_problem', 'course_problem', 'show_answer'],
+            optional=True)
+        add('analyze_videos', lambda: analyze_videos(param, course_id, args),
+            ['course_axis', 'person_course', LOGS], ['video_axis', 'video_stats_day', 'video_stats', 'person_course_video_watched'],
+            optional=True)
+        add('analyze_forum', lambda: analyze_forum(param, course_id, args),
+            ['forum', LOGS], ['forum_events', 'forum_person'], optional=True)
+
+    person_day_inputs = [LOGS, 'course_axis', 'video_stats_day', 'forum_events', 'person_problem', 'course_problem']
+    person_course_inputs = [LOGS, 'user_info_combo', 'studentmodule', 'forum', 'grading_policy', 'person_course_day',
+                            'pcday_ip_counts', 'pcday_trlang_counts', 'person_enrollment_verified', 'person_course_video_watched']
+    enrollment_outputs = ['enrollment_events', 'person_enrollment_verified']
+
+    if nightly:
+        add_logs()
+        add_analyses()
+        add('person_day', lambda: person_day(param, course_id, args, check_dates=False, stop_on_error=False),
+            person_day_inputs, ['person_course_day'])
+        add('enrollment_day', lambda: enrollment_day(param, course_id, args), [LOGS], ['enrollday_all'])
+        add('enrollment_events_table', lambda: enrollment_events_table(param, course_id, args), [LOGS], enrollment_outputs)
+        add('pcday_ip', lambda: pcday_ip(param, course_id, args), [LOGS], ['pcday_ip_counts'])
+        add('pcday_trlang', lambda: pcday_trlang(param, course_id, args), [LOGS], ['pcday_trlang_counts'])
+        add('person_course', lambda: person_course(param, course_id, args, just_do_nightly=True, force_recompute=True),
+            person_course_inputs, ['person_course'])
+        add('problem_check', lambda: problem_check(param, course_id, args), [LOGS], ['problem_check'])
+        add('show_answer_table', lambda: show_answer_table(param, course_id, args), [LOGS], ['show_answer'])
+        add('analyze_ora', lambda: analyze_ora(param, course_id, args), [LOGS], ['ora_events'])
+        add('time_on_task', lambda: time_on_task(param, course_id, args, skip_totals=True), [LOGS], ['time_on_task'])
+        return
+
+    add('setup_sql', lambda: setup_sql(param, args, 'setup_sql', course_id=course_id),
+        [], ['user_info_combo', 'studentmodule', 'forum', 'roles'])
+    add_analyses()
+    add('axis2bq', lambda: axis2bq(param, course_id, args, stop_on_error=False), [], ['course_axis'])
+    add_logs()
+    add('pcday_ip', lambda: pcday_ip(param, course_id, args), [LOGS], ['pcday_ip_counts'])
+    add('pcday_trlang', lambda: pcday_trlang(param, course_id, args), [LOGS], ['pcday_trlang_counts'])
+    add('person_day', lambda: person_day(param, course_id, args, stop_on_error=False), person_day_inputs, ['person_course_day'])
+    add('enrollment_day', lambda: enrollment_day(param, course_id, args), [LOGS], ['enrollday_all'])
+    add('enrollment_events_table', lambda: enrollment_events_table(param, course_id, args), [LOGS], enrollment_outputs)
+    add('person_course', lambda: person_course(param, course_id, args), person_course_inputs, ['person_course'])
+    add('problem_check', lambda: problem_check(param, course_id, args), [LOGS], ['problem_check'])
+    add('show_answer_table', lambda: show_answer_table(param, course_id, args), [LOGS], ['show_answer'])
+    add('analyze_ora', lambda: analyze_ora(param, course_id, args), [LOGS], ['ora_events'])
+    add('time_on_task', lambda: time_on_task(param, course_id, args, just_do_totals=True, suppress_errors=True),
+        ['time_on_task'], ['time_on_task_totals'])
+    add('item_tables', lambda: item_tables(param, course_id, args),
+        ['course_axis', 'grading_policy', 'person_course', 'person_problem', 'problem_analysis'], ['course_item', 'person_item'])
+    add('make_grading_policy', lambda: make_grading_policy(param, course_id, args), [], ['grading_policy'])
+    add('grades_persistent', lambda: grades_persistent(param, course_id, args), [], ['grades_persistent'])
+
+    subsection_param = copy.deepcopy(param)
+    subsection_param.subsection = True
+    add('grades_persistent_subsection', lambda: grades_persistent(subsection_param, course_id, args),
+        [], ['grades_persistent_subsection'])
+
+def run_step_graph(param, courses, args, nightly=False):
+    '''
+    Run the doall (or nightly) steps of all the courses as one dependency graph: independent steps, of one
+    course or of different courses, run concurrently, in up to --max-parallel threads.  The output of each
+    course goes to its own log file, as for course_scheduler (and, labeled, to stdout); at the end, prints
+    the log files, and a report of the wall-clock time and critical path of each course.
+    '''
+    name = 'nightly' if nightly else 'doall'
+    log_dir = param.course_log_dir or course_scheduler.COURSE_LOG_DIR
+    if not os.path.exists(os.path.join(log_dir, name)):
+        os.makedirs(os.path.join(log_dir, name))
+    graph = stepgraph.StepGraph()
+    logs = OrderedDict()
+    plans = getattr(param, 'nightly_plans', None) if nightly else None
+    for course_id in courses:
+        logs[course_id] = course_scheduler.CourseLog(course_id, course_scheduler.log_filename(log_dir, name, course_id))
+        add_course_steps(graph, param, course_id, args, nightly=nightly, stdout=logs[course_id],
+                         only_steps=plans.get(course_id, []) if plans is not None else None)
+
+    orig_stdout = sys.stdout
+    sys.stdout = course_scheduler.ThreadStdout()
+    try:
+        success = graph.run(workers=param.max_parallel or MAXIMUM_PARALLEL_PROCESSES)
+    finally:
+        sys.stdout = orig_stdout
+        for log in logs.values():
+            log.close()
+
+    if plans is not None:
+        planner = make_nightly_planner(param, args)
+        for course_id in courses:
+            planner.save(course_id, [x.name for x in graph.steps.values()
+                                     if x.group==course_id and x.state=='done' and not x.error])
+
+    print "="*100
+    print "STEP GRAPH RUN of %s DONE, success=%s" % (name, success)
+    print "="*100
+    for (course_id, log) in logs.items():
+        print "[%s] output in %s" % (course_id, log.fp.name)
+    print "="*100
+    graph.report()
+    print "="*100
+    sys.stdout.flush()
+    return success
+
 
 def list_tables_in_course_db(param, courses, args):
     import bqutil
@@ -1256,6 +1505,11 @@ def get_data_tables(tables, args, course_id_by_table=None, just_status=False, re
     nfound = 0
     nmissing = 0
 
+    # for status, get the metadata of all tables in a dataset with one query, when several of its tables are wanted
+    ntables_by_dataset = {}
+    for table in tables:
+        ntables_by_dataset[table.split('.', 1)[0]] = ntables_by_dataset.get(table.split('.', 1)[0], 0) + 1
+
     for table in tables:
         has_project_id = False
         dataset, tablename = table.split('.', 1)
@@ -1266,7 +1520,10 @@ def get_data_tables(tables, args, course_id_by_table=None, just_status=False, re
 
         if just_status:
             # get table creation date, modification date, and size
-            tinfo = bqutil.get_bq_table_info(dataset, tablename, **optargs) or {}
+            if ntables_by_dataset[table.split('.', 1)[0]] > 1:
+                tinfo = bqutil.get_tables_metadata(dataset, **optargs).get(tablename) or {}
+            else:
+                tinfo = bqutil.get_bq_table_info(dataset, tablename, **optargs) or {}
             datum = OrderedDict([ ('modified',  tinfo.get('lastModifiedTime')),
                                   ('course_id', course_id_by_table[table]),
                                   ('created', tinfo.get('creationTime')),
@@ -1321,36 +1578,36 @@ def get_data_tables(tables, args, course_id_by_table=None, just_status=False, re
                                                                                                     of_dt)
                 continue
 
+        # rows are written out as they are retrieved, rather than first collecting whole tables in memory
         try:
-            bqdat = bqutil.get_table_data(dataset, tablename,
-                                          convert_timestamps=True,
-                                          return_csv=(out_fmt=='csv'), **optargs)
+            tinfo = bqutil.get_bq_table_info(dataset, tablename, project_id=optargs.get('project_id', bqutil.DEFAULT_PROJECT_ID))
         except Exception as err:
-            if args.skip_missing and 'HttpError 404' in str(err):
+            if args.skip_missing and ('HttpError 404' in str(err) or 'Not Found' in str(err)):
                 print "--> missing table [%s.%s] Skipping..." % (dataset, tablename)
                 sys.stdout.flush()
                 continue
             raise
-        if not bqdat:
+        if not tinfo or not int(tinfo['numRows']):
             print "--> No data for [%s.%s]!" % (dataset, tablename)
             sys.stdout.flush()
             continue
-        elif args.combine_into:
+
+        extra_fields = optargs.get('extra_fields') or {}
+        header = extra_fields.keys() + [x['name'] for x in tinfo['schema']['fields']]
+        write_args = dict(out_fmt=out_fmt, extra_fields=extra_fields, table=tinfo,
+                          project_id=optargs.get('project_id', bqutil.DEFAULT_PROJECT_ID))
+        if args.combine_into:
             if out_fmt=='csv':
-                header, data_no_header = bqdat.split('\n',1)
-                if not the_header:
+                write_args['header'] = (the_header is None)		# only one header line, for the first table
+                if the_header is None:
                     the_header = header
-                    cofp.write(bqdat)
-                else:
-                    if not header==the_header:
-                        print "--> ERROR!  Cannot combine data from %s: CSV file header is different" % table
-                        print "Other courses' table file header: %s" % the_header
-                        print "This courses' table file header: %s" % header
-                        raise Exception("[get_course_data] Mismatched table data format")
-                    cofp.write(data_no_header)
-            else:
-                # output JSON - just concatenate
-                cofp.write('\n'.join([ json.dumps(x) for x in bqdat['data'] ]))
+                elif not header==the_header:
+                    print "--> ERROR!  Cannot combine data from %s: CSV file header is different" % table
+                    print "Other courses' table file header: %s" % the_header
+                    print "This courses' table file header: %s" % header
+                    raise Exception("[get_course_data] Mismatched table data format")
+            nrows = bqutil.write_table_data(cofp, dataset, tablename, **write_args)
+            print "--> %d rows" % nrows
 
         else:
             if args.gzip:
@@ -1358,10 +1615,7 @@ def get_data_tables(tables, args, course_id_by_table=None, just_status=False, re
             else:
                 # ofp = codecs.open(ofn, 'w', encoding='utf8')
                 ofp = open(ofn, 'w')
-            if out_fmt=='csv':
-                ofp.write(bqdat)
-            else:
-                ofp.write('\n'.join([ json.dumps(x) for x in bqdat['data'] ]))
+            bqutil.write_table_data(ofp, dataset, tablename, **write_args)
             ofp.close()
 
     if args.combine_into:
@@ -1474,6 +1728,14 @@ daily_logs --tlfn=<path>    : Do all commands (split, logs2gs, logs2bq) to get o
 
                               Accepts the "--year2" flag, to process all courses in the config file's course_id_list.
 
+                              --stream-logs: instead of writing per-course tracklog files into the logs directory, stream
+                                             each course's rephrased log lines into an in-memory gzip buffer, which is
+                                             uploaded to google storage (same path as logs2gs) and loaded into BigQuery
+                                             (same table as logs2bq) as soon as that day's tracking log files are done.
+                                             Load jobs are queued, not waited for.  Also accepts --split-workers.
+                              --stream-logs-dir=<dir>: with --stream-logs, upload into this local directory (with the
+                                             same layout as the google storage bucket) instead, and do not load into BigQuery.
+
 doall <course_id> ...       : run setup_sql, analyze_problems, logs2gs, logs2bq, axis2bq, person_day, enrollment_day,
                               person_course, and problem_check for each of the specified courses.  This is idempotent, and can be run
                               weekly when new SQL dumps come in.
@@ -1482,6 +1744,17 @@ nightly <course_id> ...     : Run sequence of commands for common nightly update
                               This includes logs2gs, logs2bq, person_day, enrollment_day, person_course (forced recompute),
                               and problem_check.
 
+                              With --only-changed, nightly only runs the steps of each course whose inputs (newest
+                              tracking log file and tracklog_* table, SQL data directory, course xml file mtime) have
+                              changed since they last ran (as recorded in the run ledger, see status),
+                              and skips courses with no changes.  --plan-only prints what would be run, and stops.
+
+                              For doall and nightly, --dag runs the steps of all the courses as a dependency graph, built
+                              from the tables each step reads and writes: independent steps (eg pcday_ip, problem_check and
+                              time_on_task, once the logs are loaded), of one course or of several, run concurrently, in up
+                              to --max-parallel threads.  At the end, the wall-clock time, total step time, and critical
+                              path (longest chain of dependent steps) of each course is reported.
+
 --external command <cid>... : Run external command on data from one or more course_id's.  Also uses the --extparam settings.
                               External commands are defined in edx2bigquery_config.  Use --skiprun to create the external script
                               without running.  Use --submit-condor to submit command as a condor job.
@@ -1591,6 +1864,25 @@ split <daily_log_file> ...  : split single-day tracking log files (should be nam
                               --use-local-tracking-files: Specified if the tracking logs will be upload to Google Big Query from local machine.
                                                           Split each course tracking log folder in the current course ID format: course-v1:ORG+COURSE-NUMBER+COURSE-RUN
                               --split-multiple-files: Specified if there are multiple tracking log .gz files to split them all.
+                              --split-workers=N: parse and rephrase the log lines using N worker processes.  The input file is
+                                                 still read once, and the output files are the same as for a serial split.
+                              --split-format=parquet: write DIR/<course>/tracklog-YYYY-MM-DD.parquet columnar files (needs pyarrow),
+                                                      for local analyses, instead of the default json.gz files.  RECORD fields
+                                                      are flattened into columns named eg context__user_id.  Later appends
+                                                      go to part files, tracklog-YYYY-MM-DD.partNNN.parquet.  logs2bq
+                                                      --use-local-tracking-files loads the parquet files (as PARQUET, then
+                                                      rebuilding the RECORD fields with a standard SQL query, which is
+                                                      billed for scanning each day's logs, unlike the free load of the
+                                                      json.gz files); logs2gs only handles the json.gz files.
+
+rephrase_logs_batch <file_glob> ... : rephrase archived tracking log files IN PLACE (each original is kept as old-<file>), e.g.
+                              after a tracking log schema change.  Files are rephrased in parallel, one per process, using
+                              --max-parallel processes (default: one per cpu).  Files which already have an old-<file> are skipped,
+                              so an interrupted batch can simply be re-run; a file with an old-<file> which has not been rephrased
+                              (eg a fresh copy of the raw file) is left alone, with a warning: move the old-<file> away to
+                              rephrase it.  Prints a throughput summary (lines/s, MB/s).
+                              --max-memory=MB: limit each process to this much memory (address space); a file whose rephrasing
+                                               goes over the limit fails, without affecting the other files.
 
 logs2gs <course_id> ...     : transfer compressed daily tracking log files for the specified course_id's to Google cloud storage.
                               Does NOT import the log data into BigQuery.
@@ -1804,6 +2096,31 @@ get_data p_id:d_id.t_id ... : retrieve project:dataset.table data as CSV file, s
 get_table_info <dataset>    : dump meta-data information about the specified dataset.table_id from BigQuery.
                <table_id>
 
+jobstats [<run_id>]         : summarize the BigQuery jobs of a run (by default, the last one), from the job stats file (--jobstats-file,
+                              or BQ_JOBSTATS_FILE in the config), which any command records jobs into when it is set: wall-clock time,
+                              job time, and bytes processed and billed for each step (eg of nightly), and the slowest and costliest jobs.
+
+status [<course_id> ...]    : from the run ledger (--run-ledger, or RUN_LEDGER_FILE in the config; default LOGS/run_ledger.sqlite),
+                              in which each step of each course is recorded as it is run, list the stale steps of the specified
+                              courses (default: all courses in the ledger): those which failed, and those last run before
+                              their local inputs (tracking log files, SQL data directory) changed.  With --verbose, list
+                              every step recorded, with its status, time, and duration.  No BigQuery calls are made.
+                              --skip-if-exists also looks up tables in the ledger, before BigQuery.
+
+enqueue <command> [<course_id> ...]
+                            : add a task for each course (given, or by --clist or --year2) to the work queue (--queue-dir,
+                              or WORK_QUEUE_DIR in the config; default QUEUE), to run command on it, with the other options
+                              given (eg --force-recompute).  Tasks are run by workers, in the order --parallel would run them.
+                              Each task is recorded in the run ledger of the host it runs on, so nightly --only-changed,
+                              which plans from the ledger, can't be enqueued.
+                              eg: edx2bigquery --clist=all enqueue person_course --force-recompute
+
+worker                      : run tasks from the work queue, one at a time, each as an edx2bigquery command, with its output in
+                              the course's log file (--course-log-dir), until there are none left.  Start any number of workers,
+                              on any hosts sharing the queue directory (and the log directory).  A task whose worker stops
+                              renewing its lease (--lease seconds, default WORK_QUEUE_LEASE or 300) is run again by another
+                              worker; a task which fails is retried, up to --max-attempts times (default WORK_QUEUE_MAX_ATTEMPTS or 3).
+
 delete_empty_tables         : delete empty tables form the tracking logs dataset for the specified course_id's, from BigQuery.
             <course_id> ...   Accepts the "--year2" flag, to process all courses in the config file's course_id_list.
 
@@ -1838,6 +2155,12 @@ check_for_duplicates        : check list of courses for duplicates
     parser.add_argument("--extparam", type=str, help="configure parameter for external command, e.g. --extparam irt_type=2pl")
     parser.add_argument("--submit-condor",  help="submit external command as a condor job (must be used with --external)", action="store_true")
     parser.add_argument("--max-parallel", type=int, help="maximum number of parallel processes to run (overrides config) if --parallel is used")
+    parser.add_argument("--course-log-dir", type=str, help="with --parallel or --dag, directory for the log file of each course (default: COURSE_LOG_DIR in the config, or LOGS/courses)")
+    parser.add_argument("--worker-max-tasks", type=int, help="with --parallel, number of courses each worker process runs before being replaced (default: WORKER_MAX_TASKS in the config, or 10)")
+    parser.add_argument("--only-changed", help="for nightly, only run the steps of each course whose inputs (tracking logs, SQL data, course axis) have changed since they last ran", action="store_true")
+    parser.add_argument("--plan-only", help="for nightly, print which courses and steps --only-changed would run, without running them", action="store_true")
+    parser.add_argument("--dag", help="for doall and nightly, run the steps of all the courses as a dependency graph, with independent steps (and courses) run concurrently in up to --max-parallel threads, and report each course's critical path", action="store_true")
+    parser.add_argument("--parallel-threads", help="with --parallel, run courses in threads of one process, sharing one BigQuery client and its connections, instead of in separate processes (for steps which mostly wait on BigQuery)", action="store_true")
     parser.add_argument("--skip-geoip", help="skip geoip (and modal IP) processing in person_course", action="store_true")
     parser.add_argument("--skip-if-exists", help="skip processing in person_course if table already exists", action="store_true")
     parser.add_argument("--skip-log-loading", help="when processing a 'doall' command, skip loading of tracking logs", action="store_true")
@@ -1875,6 +2198,19 @@ check_for_duplicates        : check list of courses for duplicates
     parser.add_argument('courses', nargs = '*', help = 'courses or course directories, depending on the command')
     parser.add_argument('--use-local-tracking-files', help='Use the local tracking log files to upload into BigQuery instead of Google Cloud Storage files.', action="store_true")
     parser.add_argument('--split-multiple-files', help='Split multiples files for the same date.', action="store_true")
+    parser.add_argument("--split-workers", type=int, help="number of worker processes to use for parsing and rephrasing lines, in split")
+    parser.add_argument("--split-format", type=str, default="json", choices=["json", "parquet"], help="for split, format of the per-course tracklog files: json (json.gz, the default) or parquet (loading these into BigQuery runs a billed query over each day's logs)")
+    parser.add_argument("--stream-logs", help="for daily_logs, stream split tracking logs straight to google storage and bigquery, without local per-course files (replaces each day's logs, so not with --dynamic-dates)", action="store_true")
+    parser.add_argument("--stream-logs-dir", type=str, help="for daily_logs --stream-logs, upload to this local directory instead of google storage (no bigquery loads)")
+    parser.add_argument("--max-memory", type=int, help="for rephrase_logs_batch, maximum memory (MB) per process")
+    parser.add_argument("--max-bytes-per-run", type=int, help="dry-run each BigQuery query first, and refuse queries which would take a course over this many bytes processed in the run (overrides BQ_MAX_BYTES_PER_RUN in config)")
+    parser.add_argument("--defer-over-budget", help="with --max-bytes-per-run, skip (defer) queries over the budget, failing only the steps needing them (listed at exit, to be rerun)", action="store_true")
+    parser.add_argument("--jobstats-file", type=str, help="record stats of each BigQuery job (times, bytes, retries) as JSON lines in this file (overrides BQ_JOBSTATS_FILE in config); also read by the jobstats command")
+    parser.add_argument("--run-ledger", type=str, help="SQLite file recording each step run for each course, used by status, nightly --only-changed, and --skip-if-exists (overrides RUN_LEDGER_FILE in config)")
+    parser.add_argument("--queue-dir", type=str, help="for enqueue and worker, the work queue directory, shared by the workers' hosts (overrides WORK_QUEUE_DIR in config)")
+    parser.add_argument("--max-attempts", type=int, help="for enqueue, number of times a task is tried before it is failed (overrides WORK_QUEUE_MAX_ATTEMPTS in config)")
+    parser.add_argument("--error-exit-status", help="exit with status 1 if any course or step failed, though the command carried on (set by worker for the tasks it runs)", action="store_true")
+    parser.add_argument("--lease", type=int, help="for worker, seconds without a heartbeat after which a claimed task is run again by another worker (overrides WORK_QUEUE_LEASE in config)")
     parser.add_argument("--skip-total-assets-table", help="For time_asset command, if provided, the command will only create the table called: time_on_asset_daily", action="store_true")
 
     args = parser.parse_args()
@@ -1902,6 +2238,9 @@ check_for_duplicates        : check list of courses for duplicates
     param.verbose = args.verbose
     param.project_id = args.output_project_id or getattr(edx2bigquery_config, "PROJECT_ID", None)
     param.max_parallel = args.max_parallel
+    param.parallel_threads = args.parallel_threads
+    param.course_log_dir = args.course_log_dir
+    param.worker_max_tasks = args.worker_max_tasks
     param.submit_condor = args.submit_condor
     param.skip_log_loading = args.skip_log_loading
     param.subsection = args.subsection
@@ -1909,6 +2248,20 @@ check_for_duplicates        : check list of courses for duplicates
     param.split_multiple_files = args.split_multiple_files
     param.skip_total_assets_table = args.skip_total_assets_table
 
+    max_bytes_per_run = args.max_bytes_per_run or getattr(edx2bigquery_config, "BQ_MAX_BYTES_PER_RUN", None)
+    if max_bytes_per_run:
+        import bqutil
+        budget = bqutil.set_bytes_budget(max_bytes_per_run, defer=args.defer_over_budget)
+        atexit.register(budget.report)
+
+    if args.command != 'jobstats' and (args.jobstats_file or jobstats.JOBSTATS_FILE):
+        jobstats.set_file(args.jobstats_file or jobstats.JOBSTATS_FILE)
+        atexit.register(jobstats.record_retries)
+        atexit.register(jobstats.wait_unwaited)		# runs first (atexit is last in, first out)
+
+    if args.run_ledger:
+        run_ledger.set_file(args.run_ledger)
+
     # default end date for person_course
     try:
         param.DEFAULT_END_DATE = getattr(edx2bigquery_config, "DEFAULT_END_DATE", "2014-09-21")
@@ -1940,7 +2293,7 @@ check_for_duplicates        : check list of courses for duplicates
         param.ecinfo = ecinfo
         param.parallel = args.parallel
         run_parallel_or_serial(run_external_single, param, courses, args, parallel=args.parallel)
-        sys.exit(0)
+        sys.exit(exit_status(args))
 
     #-----------------------------------------------------------------------------
 
@@ -1955,6 +2308,14 @@ check_for_duplicates        : check list of courses for duplicates
                                   tracking_logs_directory=args.logs_dir or edx2bigquery_config.TRACKING_LOGS_DIRECTORY,
                                   )
 
+    elif (args.command=='rephrase_logs_batch'):
+        import glob
+        from rephrase_tracking_logs import do_rephrase_files
+        files = []
+        for fnglob in args.courses:
+            files += sorted(glob.glob(fnglob)) if ('*' in fnglob or '?' in fnglob) else [fnglob]
+        do_rephrase_files(files, workers=args.max_parallel, max_memory=args.max_memory)
+
     elif (args.command=='rephrase_logs'):
         if args.courses:
             # if arguments are provided, they are taken as filenames of files to be rephrased IN PLACE
@@ -1969,7 +2330,9 @@ check_for_duplicates        : check list of courses for duplicates
                 sys.stdout.write(newline)
 
     elif (args.command=='doall'):
-        if args.parallel:			# run multiple instances in parallel
+        if args.dag:
+            run_step_graph(param, get_course_ids(args), args)
+        elif args.parallel:			# run multiple instances in parallel
             courses = get_course_ids(args)
             pool = mp.Pool(processes=args.max_parallel or MAXIMUM_PARALLEL_PROCESSES)
             stdoutset = {}
@@ -2001,8 +2364,19 @@ check_for_duplicates        : check list of courses for duplicates
 
     elif (args.command=='nightly'):
         courses = get_course_ids(args)
+        if args.only_changed or args.plan_only:
+            planner = make_nightly_planner(param, args)
+            plans = planner.plan(courses)
+            planner.print_plan(plans)
+            if args.plan_only:
+                sys.exit(0)
+            param.nightly_plans = plans
+            param.nightly_fingerprints = planner.fingerprints	# saved as the inputs of the steps done
+            courses = [x for x in courses if plans[x]]
+        if args.dag:
+            sys.exit(0 if run_step_graph(param, courses, args, nightly=True) else 1)
         run_parallel_or_serial(run_nightly_single, param, courses, args, parallel=args.parallel)
-        sys.exit(0)
+        sys.exit(exit_status(args))
 
         for course_id in get_course_ids(args):
             print "-"*100
@@ -2117,12 +2491,60 @@ check_for_duplicates        : check list of courses for duplicates
 
     elif (args.command=='testbq'):
         # test authentication to bigquery - list databases in project
+        import auth
         import bqutil
-        bqutil.auth.print_creds()
+        auth.print_creds()
         print "="*20
         print "list of datasets accessible:"
         print json.dumps(bqutil.get_list_of_datasets().keys(), indent=4)
 
+    elif (args.command=='jobstats'):
+        fn = args.jobstats_file or jobstats.JOBSTATS_FILE
+        if not fn:
+            print "Please specify the job stats file, with --jobstats-file"
+            sys.exit(-1)
+        jobstats.summarize(jobstats.load_records(fn, run_id=(args.courses or [None])[0]))
+
+    elif (args.command=='status'):
+        ledger = run_ledger.get_ledger()
+        if ledger is None:
+            print "Please specify the run ledger file, with --run-ledger"
+            sys.exit(-1)
+        logs_dir = args.logs_dir or getattr(edx2bigquery_config, 'TRACKING_LOGS_DIRECTORY', '')
+        def inputs_mtime(course_id):
+            logs = nightly_planner.local_tracklogs_fingerprint(course_id, logs_dir)
+            (sdir, axis_mtime) = nightly_planner.sql_fingerprint(course_id, param.the_basedir, param.the_datedir,
+                                                                 param.use_dataset_latest)
+            return max([logs[1] if logs else 0, axis_mtime or 0, os.path.getmtime(sdir) if sdir else 0])
+        courses = get_course_ids(args) if (args.courses or args.clist) else None
+        nstale = run_ledger.status_report(ledger, courses, inputs_mtime_fn=inputs_mtime, verbose=args.verbose)
+        print "%d stale steps" % nstale
+
+    elif (args.command=='enqueue'):
+        if not args.courses:
+            print "Please specify the command to enqueue, eg: edx2bigquery --clist=all enqueue person_course"
+            sys.exit(-1)
+        command = args.courses[0]
+        args.courses = args.courses[1:]
+        refused = [x for x in work_queue.ENQUEUE_REFUSED_OPTIONS if x in sys.argv[1:]]
+        if refused:
+            print "Cannot enqueue with %s: the run ledger is local to each worker's host" % ', '.join(refused)
+            sys.exit(-1)
+        courses = get_course_ids(args)
+        ordered = course_scheduler.CourseScheduler(command, 1, log_dir=param.course_log_dir).order(courses)
+        argv = work_queue.task_argv(sys.argv[1:], command, courses,
+                                    drop_flags=['--year2', '--parallel', '--parallel-threads'],
+                                    drop_options=['--clist', '--clist-from-missing-table', '--queue-dir', '--max-attempts',
+                                                  '--max-parallel'])
+        queue = work_queue.WorkQueue(args.queue_dir)
+        tasks = queue.enqueue(command, ordered, argv=argv, max_attempts=args.max_attempts)
+        print "Enqueued %d tasks in %s: %s %s" % (len(tasks), queue.qdir, command, ' '.join(argv))
+        print "queue: %s" % json.dumps(queue.counts(), sort_keys=True)
+
+    elif (args.command=='worker'):
+        queue = work_queue.WorkQueue(args.queue_dir, lease=args.lease)
+        work_queue.Worker(queue, log_dir=param.course_log_dir).run()
+
     elif (args.command=='get_course_tables'):
         courses = get_course_ids(args)
         run_parallel_or_serial(list_tables_in_course_db, param, courses, args, parallel=args.parallel)
@@ -2232,6 +2654,9 @@ check_for_duplicates        : check list of courses for duplicates
                 if tinfo is not None:
                     print "   Deleting %s.%s" % (dataset, tablename)
                     bqutil.delete_bq_table(dataset, tablename)
+                    ledger = run_ledger.get_ledger()
+                    if ledger is not None:
+                        ledger.remove_output(course_id, the_table)
                 else:
                     print "   Missing %s.%s -- skipping" % (dataset, tablename)
             except Exception as err:
@@ -2424,5 +2849,8 @@ check_for_duplicates        : check list of courses for duplicates
         print "Unknown command %s!" % args.command
         sys.exit(-1)
 
+    if exit_status(args):
+        sys.exit(1)
+
 if __name__ == '__main__':
     CommandLine()
@@ -7,6 +7,8 @@
 # compute tables for annual course report
 
 import sys
+import bqjobs
+import bqbudget
 import bqutil
 import gsutil
 import datetime
@@ -26,6 +28,9 @@ class CourseReport(object):
         Compute course report tables, based on combination of all person_course and other individual course tables.
 
         only_step: specify a single course report step to be executed; runs all reports, if None
+
+        The report table queries are independent (except for overall_stats), so they are submitted
+        together, and run concurrently in BigQuery (see bqjobs).
         '''
         
         if only_step and ',' in only_step:
@@ -159,6 +164,8 @@ class CourseReport(object):
         bqutil.create_dataset_if_nonexistent(self.dataset, project_id=output_project_id)
 
         self.nskip = nskip
+        self.job_manager = bqjobs.JobManager()
+        self.pending_tables = []
         if 1:
             self.combine_show_answer_stats_by_course()
             self.make_totals_by_course()
@@ -180,7 +187,9 @@ class CourseReport(object):
             self.make_table_of_n_courses_registered()
             self.make_geographic_distributions()
             ## self.count_tracking_log_events()
+            self.wait_for_tables()	# overall_stats uses broad_stats_by_course and multi_registrations
             self.make_overall_totals()
+            self.wait_for_tables()
     
         print "="*100
         print "Done with course report tables"
@@ -204,7 +213,10 @@ class CourseReport(object):
         return 0
 
     def do_table(self, the_sql, tablename, the_dataset=None, sql_for_description=None, check_skip=True, 
-                 allowLargeResults=False, maximumBillingTier=None):
+                 allowLargeResults=False, maximumBillingTier=None, ignore_errors=False):
+        '''
+        Submit the query for table tablename, without waiting for it; wait_for_tables finishes it.
+        '''
 
         if check_skip:
             if self.skip_or_do_step(tablename) < 0:
@@ -216,18 +228,40 @@ class CourseReport(object):
         print("Computing %s in BigQuery" % tablename)
         sys.stdout.flush()
         try:
-            ret = bqutil.create_bq_table(the_dataset, tablename, the_sql, 
-                                         overwrite=True,
-                                         output_project_id=self.output_project_id,
-                                         sql_for_description=sql_for_description or the_sql,
-                                         allowLargeResults=allowLargeResults,
-                                         maximumBillingTier=maximumBillingTier,
-                                     )
-        except Exception as err:
-            print "ERROR! Failed on SQL="
-            print the_sql
+            handle = bqutil.create_bq_table(the_dataset, tablename, the_sql, 
+                                            overwrite=True,
+                                            output_project_id=self.output_project_id,
+                                            sql_for_description=sql_for_description or the_sql,
+                                            allowLargeResults=allowLargeResults,
+                                            maximumBillingTier=maximumBillingTier,
+                                            job_manager=self.job_manager,
+                                        )
+        except bqbudget.QueryDeferred:
+            self.wait_for_tables()	# finish the tables already submitted, then fail
             raise
+        self.pending_tables.append((the_sql, tablename, the_dataset, handle, ignore_errors))
+
+    def wait_for_tables(self):
+        '''
+        Wait for the queries submitted by do_table, and extract each of their tables to a CSV file in
+        google storage.
+        '''
+        pending = self.pending_tables
+        self.pending_tables = []
+        for (the_sql, tablename, the_dataset, handle, ignore_errors) in pending:
+            try:
+                handle.result()
+            except Exception as err:
+                print "ERROR! Failed on SQL="
+                print the_sql
+                if ignore_errors:
+                    print "====> ERROR: Failed in computing %s, err %s" % (tablename, str(err))
+                    print "====> Continuing anyway"
+                    continue
+                raise
+            self.extract_table(the_dataset, tablename)
 
+    def extract_table(self, the_dataset, tablename):
         gsfn = "%s/%s.csv" % (self.gsbucket, tablename)
         bqutil.extract_table_to_gs(the_dataset, tablename, gsfn, 
                                    format='csv', 
@@ -514,7 +548,8 @@ order by course_id;
             
             sql_for_description = "outer SQL:\n%s\n\nInner SQL:\n%stt_set=%s" % (outer_sql, sub_sql, self.parameters['tott_tables'])
     
-            self.do_table(the_sql, pset['table'], sql_for_description=sql_for_description, check_skip=False, maximumBillingTier=4)
+            self.do_table(the_sql, pset['table'], sql_for_description=sql_for_description, check_skip=False, maximumBillingTier=4,
+                          ignore_errors=True)
 
     def make_course_axis_table(self):
 
@@ -936,8 +971,10 @@ order by course_id;
                                                                                                              log_tables_todo[-1])
             sys.stdout.flush()
 
-            # go through all log files and get size on each
-            row_sizes = [ bqutil.get_bq_table_size_rows(log_dataset, x) for x in log_tables_todo ]
+            # go through all log files and get size on each (from one query of the dataset's table metadata)
+            log_meta = bqutil.get_tables_metadata(log_dataset)
+            row_sizes = [ log_meta[x]['numRows'] if x in log_meta else bqutil.get_bq_table_size_rows(log_dataset, x)
+                          for x in log_tables_todo ]
             
             log_event_counts[course_id] = sum(row_sizes)
             print "                         For %s found %d total tracking log events" % (course_id, log_event_counts[course_id])
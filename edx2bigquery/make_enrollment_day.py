@@ -19,6 +19,7 @@
 import os
 import sys
 import json
+import bqjobs
 import bqutil
 import datetime
 import process_tracking_logs
@@ -93,6 +94,11 @@ def old_process_course(course_id, force_recompute=False):
     pcday_tables_info = bqutil.get_tables(pcd_dataset)
     pcday_tables = [x['tableReference']['tableId'] for x in pcday_tables_info.get('tables', [])]
 
+    # the day's queries run concurrently, but are all done (or have failed) by the time this returns,
+    # eg for the steps which depend on this one, when run as a step graph
+    job_manager = bqjobs.JobManager()
+    handles = []
+
     # print "pcday_tables = ", pcday_tables
 
     log_table_list = log_tables['tables']
@@ -126,8 +132,11 @@ def old_process_course(course_id, force_recompute=False):
     
         sys.stdout.flush()
     
-        bqutil.create_bq_table(pcd_dataset, table_out, the_sql, wait=False)
+        handles.append(bqutil.create_bq_table(pcd_dataset, table_out, the_sql, job_manager=job_manager))
     
+    job_manager.wait(handles)
+    for handle in handles:
+        handle.result()		# raises the error of the first failed query, if any
     print "Done with course %s (end %s)"  % (course_id, datetime.datetime.now())
     print "="*77
     sys.stdout.flush()
@@ -68,7 +68,7 @@ from path import Path as path
 
 import bqutil
 import gsutil
-from check_schema_tracking_log import check_schema, schema2dict
+from check_schema_tracking_log import compile_schema, schema2dict
 from load_course_sql import find_course_sql_dir, get_course_sql_dirdate
 
 
@@ -901,10 +901,11 @@ class PersonCourse(object):
         self.log("Writing output to %s and %s" % (ofn, ofnj))
 
         # write JSON first - it's safer
+        check_pc_schema = compile_schema(self.the_dict_schema)
         cnt = 0
         for key, pcent in self.pctab.iteritems():
             cnt += 1
-            check_schema(cnt, pcent, the_ds=self.the_dict_schema, coerce=True)
+            check_pc_schema(cnt, pcent, coerce=True)
             ofp.write(json.dumps(pcent) + '\n')
         ofp.close()
 
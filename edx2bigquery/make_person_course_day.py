@@ -55,6 +55,7 @@
 import os
 import sys
 import json
+import bqjobs
 import bqutil
 import datetime
 from path import Path as path
@@ -148,6 +149,11 @@ def obsolete_process_course(course_id, force_recompute=False, check_dates=True):
     pcday_tables_info = bqutil.get_tables(pcd_dataset)
     pcday_tables = [x['tableReference']['tableId'] for x in pcday_tables_info.get('tables', [])]
 
+    # the day's queries run concurrently, but are all done (or have failed) by the time this returns,
+    # eg for the steps which depend on this one, when run as a step graph
+    job_manager = bqjobs.JobManager()
+    handles = []
+
     print "pcday_tables = ", pcday_tables
 
     log_table_list = log_tables['tables']
@@ -191,8 +197,11 @@ def obsolete_process_course(course_id, force_recompute=False, check_dates=True):
     
         sys.stdout.flush()
     
-        bqutil.create_bq_table(pcd_dataset, table_out, the_sql, wait=False)
+        handles.append(bqutil.create_bq_table(pcd_dataset, table_out, the_sql, job_manager=job_manager))
     
+    job_manager.wait(handles)
+    for handle in handles:
+        handle.result()		# raises the error of the first failed query, if any
     print "Done with course %s (end %s)"  % (course_id, datetime.datetime.now())
     print "="*77
     sys.stdout.flush()
@@ -217,50 +226,28 @@ def process_course(course_id, force_recompute=False, use_dataset_latest=False, e
 
     dataset = bqutil.course_id2dataset(course_id, use_dataset_latest=use_dataset_latest)
 
-    videoTableExists = False
+    # which of the optional source tables exist: one query of the dataset's table metadata, instead of a
+    # tables.get for each
     try:
-
-        tinfo_video = bqutil.get_bq_table_info(dataset, 'video_stats_day')
-        assert tinfo_video is not None, "Video stats table missing... Not including video stats"
-	videoTableExists = True
-
-    except (AssertionError, Exception) as err:
-        #print " --> Err: missing %s.%s?  Skipping creation of chapter_grades" % (dataset, "course_axis")
+        tables_meta = bqutil.get_tables_metadata(dataset)
+    except Exception as err:
+        print " --> Err: cannot get tables of %s: %s" % (dataset, str(err))
         sys.stdout.flush()
-	pass
-        #return
+        tables_meta = {}
 
-    forumTableExists = False
-    try:
+    videoTableExists = 'video_stats_day' in tables_meta
+    if not videoTableExists:
+        print "Video stats table missing... Not including video stats"
 
-        tinfo_forum = bqutil.get_bq_table_info(dataset, 'forum_events')
-        assert tinfo_forum is not None, "Forum events table missing... Not including forum stats"
-	forumTableExists = True
+    forumTableExists = 'forum_events' in tables_meta
+    if not forumTableExists:
+        print "Forum events table missing... Not including forum stats"
 
-    except (AssertionError, Exception) as err:
-        #print " --> Err: missing %s.%s?  Skipping creation of chapter_grades" % (dataset, "course_axis")
-        sys.stdout.flush()
-	pass
-        #return
-
-    problemTableExists = False
-    try:
-
-        tinfo_personproblem = bqutil.get_bq_table_info(dataset, 'person_problem')
-        tinfo_courseproblem = bqutil.get_bq_table_info(dataset, 'course_problem')
-        tinfo_courseaxis = bqutil.get_bq_table_info(dataset, 'course_axis')
-        tinfo_personcourse = bqutil.get_bq_table_info(dataset, 'person_course')
-	# Check course axis and person course, course problem
-        assert tinfo_personproblem is not None, "Person problem table missing... Not including problem stats"
-        assert tinfo_courseproblem is not None, "Course problem table missing... Not including problem stats"
-        assert tinfo_courseaxis is not None, "Course axis table missing... Not including problem stats"
-        assert tinfo_personcourse is not None, "Person Course table missing... Not including problem stats"
-	problemTableExists = True
-
-    except (AssertionError, Exception) as err:
-        #print " --> Err: missing %s.%s?  Skipping creation of chapter_grades" % (dataset, "course_axis")
-        sys.stdout.flush()
-	pass
+    missing = [x for x in ['person_problem', 'course_problem', 'course_axis', 'person_course'] if x not in tables_meta]
+    problemTableExists = not missing
+    if missing:
+        print "%s table missing... Not including problem stats" % ', '.join(missing)
+    sys.stdout.flush()
 
     PCDAY_SQL_BASE_SELECT = """
 			  SELECT username,
@@ -14,11 +14,11 @@ import os, sys
 import csv
 import re
 import json
-import time
 import gsutil
 import bqutil
 import datetime
 import process_tracking_logs
+import retry
 
 from path import Path as path
 from collections import defaultdict
@@ -1567,29 +1567,22 @@ def compute_problem_check_show_answer_ip(course_id, use_dataset_latest=False, nu
     for i in range(num_partitions): 
       print "--> Running compute_problem_check_show_answer_ip_table SQL for partition %d of %d" % (i + 1, num_partitions)
       sys.stdout.flush()
-      tries = 0 #Counts number of times "internal error occurs."
-      while(tries < 10):
-        try:
-          bqutil.create_bq_table(testing_dataset if testing else dataset,
-                                 dataset+'_'+table if testing else table, 
-                                 sql[i], overwrite=overwrite if i==0 else 'append', allowLargeResults=True,
-                                 sql_for_description="\nNUM_PARTITIONS="+str(num_partitions)+"\n\n"+sql[i])
-          break #Success - no need to keep trying - no internal error occurred.
-        except Exception as err:
-          if 'internal error' in str(err) and tries < 10:
-            tries += 1
-            print "---> Internal Error occurred. Sleeping 100 seconds and retrying."
-            sys.stdout.flush()
-            time.sleep(100) #100 seconds
-            continue
-          elif (num_partitions < 20) and ('internal error' in str(err) or 'Response too large' in str(err) or 'Resources exceeded' in str(err) or u'resourcesExceeded' in str(err)):
-            print err
-            print "="*80,"\n==> SQL query failed! Recursively trying compute_problem_check_show_answer_ip_table again, with 50% more many partitions\n", "="*80
-            return compute_problem_check_show_answer_ip(course_id, use_dataset_latest=use_dataset_latest, overwrite=overwrite, 
-                                                        num_partitions=int(round(num_partitions*1.5)), last_date=last_date,
-                                                        testing=testing, testing_dataset=testing_dataset, project_id=project_id)
-          else:
-            raise err
+      try:
+        # internal errors are rerun (with backoff), before trying more partitions
+        bqutil.create_bq_table(testing_dataset if testing else dataset,
+                               dataset+'_'+table if testing else table, 
+                               sql[i], overwrite=overwrite if i==0 else 'append', allowLargeResults=True,
+                               sql_for_description="\nNUM_PARTITIONS="+str(num_partitions)+"\n\n"+sql[i],
+                               job_retry=retry.JOB_RETRY)
+      except Exception as err:
+        if (num_partitions < 20) and ('internal error' in str(err) or 'Response too large' in str(err) or 'Resources exceeded' in str(err) or u'resourcesExceeded' in str(err)):
+          print err
+          print "="*80,"\n==> SQL query failed! Recursively trying compute_problem_check_show_answer_ip_table again, with 50% more many partitions\n", "="*80
+          return compute_problem_check_show_answer_ip(course_id, use_dataset_latest=use_dataset_latest, overwrite=overwrite, 
+                                                      num_partitions=int(round(num_partitions*1.5)), last_date=last_date,
+                                                      testing=testing, testing_dataset=testing_dataset, project_id=project_id)
+        else:
+          raise err
 
     nfound = bqutil.get_bq_table_size_rows(dataset_id=testing_dataset if testing else dataset, 
                                            table_id=dataset+'_'+table if testing else table,
@@ -2658,41 +2651,26 @@ def compute_show_ans_before(course_id, force_recompute=False, use_dataset_latest
       for i in range(num_partitions): 
         print "--> Running SQL for partition %d of %d" % (i + 1, num_partitions)
         sys.stdout.flush()
-        tries = 0 #Counts number of times "internal error occurs."
-        while(tries < 10):
-          try:
-            bqutil.create_bq_table(testing_dataset if testing else dataset, 
-                                   dataset + '_' + table if testing else table, 
-                                   sql[i], overwrite=True if i==0 else 'append', allowLargeResults=True, 
-                                   sql_for_description="\nNUM_PARTITIONS="+str(num_partitions)+"\n\n"+sql[i], udfs=[udf])
-            break #Success - no need to keep trying - no internal error occurred.
-          except Exception as err:
-            if 'internal error' in str(err) and tries < 10:
-              tries += 1
-              print "---> Internal Error occurred. Sleeping 2 minutes and retrying."
-              sys.stdout.flush()
-              time.sleep(120) #2 minutes
-              continue
-            elif (num_partitions < 300) and ('internal error' in str(err) or 'Response too large' in str(err) or 'Resources exceeded' in str(err) or u'resourcesExceeded' in str(err)):
-              print "---> Resources exceeded. Sleeping 1 minute and retrying."
-              sys.stdout.flush()
-              time.sleep(160) #1 minute
-              print err
-              print "="*80,"\n==> SQL query failed! Recursively trying again, with 50% more many partitions\n", "="*80
-              return compute_show_ans_before(course_id, force_recompute=force_recompute, 
-                                              use_dataset_latest=use_dataset_latest, force_num_partitions=int(round(num_partitions*1.5)), 
-                                              testing=testing, testing_dataset= testing_dataset, 
-                                              project_id = project_id, force_online = force_online,
-                                              problem_check_show_answer_ip_table=problem_check_show_answer_ip_table)
-            else:
-              raise err
+        try:
+          # internal errors are rerun (with backoff), before trying more partitions
+          bqutil.create_bq_table(testing_dataset if testing else dataset, 
+                                 dataset + '_' + table if testing else table, 
+                                 sql[i], overwrite=True if i==0 else 'append', allowLargeResults=True, 
+                                 sql_for_description="\nNUM_PARTITIONS="+str(num_partitions)+"\n\n"+sql[i], udfs=[udf],
+                                 job_retry=retry.JOB_RETRY)
+        except Exception as err:
+          if (num_partitions < 300) and ('internal error' in str(err) or 'Response too large' in str(err) or 'Resources exceeded' in str(err) or u'resourcesExceeded' in str(err)):
+            print err
+            print "="*80,"\n==> SQL query failed! Recursively trying again, with 50% more many partitions\n", "="*80
+            return compute_show_ans_before(course_id, force_recompute=force_recompute, 
+                                            use_dataset_latest=use_dataset_latest, force_num_partitions=int(round(num_partitions*1.5)), 
+                                            testing=testing, testing_dataset= testing_dataset, 
+                                            project_id = project_id, force_online = force_online,
+                                            problem_check_show_answer_ip_table=problem_check_show_answer_ip_table)
+          else:
+            raise err
           
 
-      if num_partitions > 5:
-        print "--> sleeping for 60 seconds to try avoiding bigquery system error - maybe due to data transfer time"
-        sys.stdout.flush()
-        time.sleep(60)
-
   nfound = bqutil.get_bq_table_size_rows(dataset_id=testing_dataset if testing else dataset, 
                                            table_id=dataset+'_'+table if testing else table,
                                            project_id='mitx-research')
@@ -3960,41 +3938,26 @@ def compute_ans_coupling(course_id, force_recompute=False, use_dataset_latest=Tr
       for i in range(num_partitions): 
         print "--> Running SQL for partition %d of %d" % (i + 1, num_partitions)
         sys.stdout.flush()
-        tries = 0 #Counts number of times "internal error occurs."
-        while(tries < 10):
-          try:
-            bqutil.create_bq_table(testing_dataset if testing else dataset, 
-                                   dataset + '_' + table if testing else table, 
-                                   sql[i], overwrite=True if i==0 else 'append', allowLargeResults=True, 
-                                   sql_for_description="\nNUM_PARTITIONS="+str(num_partitions)+"\n\n"+sql[i], udfs=[udf])
-            break #Success - no need to keep trying - no internal error occurred.
-          except Exception as err:
-            if 'internal error' in str(err) and tries < 10:
-              tries += 1
-              print "---> Internal Error occurred. Sleeping 2 minutes and retrying."
-              sys.stdout.flush()
-              time.sleep(120) #2 minutes
-              continue
-            elif (num_partitions < 300) and ('internal error' in str(err) or 'Response too large' in str(err) or 'Resources exceeded' in str(err) or u'resourcesExceeded' in str(err)):
-              print "---> Resources exceeded. Sleeping 1 minute and retrying."
-              sys.stdout.flush()
-              time.sleep(160) #1 minute
-              print err
-              print "="*80,"\n==> SQL query failed! Recursively trying again, with 50% more many partitions\n", "="*80
-              return compute_show_ans_before(course_id, force_recompute=force_recompute, 
-                                              use_dataset_latest=use_dataset_latest, force_num_partitions=int(round(num_partitions*1.5)), 
-                                              testing=testing, testing_dataset= testing_dataset, 
-                                              project_id = project_id, force_online = force_online,
-                                              problem_check_show_answer_ip_table=problem_check_show_answer_ip_table)
-            else:
-              raise err
+        try:
+          # internal errors are rerun (with backoff), before trying more partitions
+          bqutil.create_bq_table(testing_dataset if testing else dataset, 
+                                 dataset + '_' + table if testing else table, 
+                                 sql[i], overwrite=True if i==0 else 'append', allowLargeResults=True, 
+                                 sql_for_description="\nNUM_PARTITIONS="+str(num_partitions)+"\n\n"+sql[i], udfs=[udf],
+                                 job_retry=retry.JOB_RETRY)
+        except Exception as err:
+          if (num_partitions < 300) and ('internal error' in str(err) or 'Response too large' in str(err) or 'Resources exceeded' in str(err) or u'resourcesExceeded' in str(err)):
+            print err
+            print "="*80,"\n==> SQL query failed! Recursively trying again, with 50% more many partitions\n", "="*80
+            return compute_show_ans_before(course_id, force_recompute=force_recompute, 
+                                            use_dataset_latest=use_dataset_latest, force_num_partitions=int(round(num_partitions*1.5)), 
+                                            testing=testing, testing_dataset= testing_dataset, 
+                                            project_id = project_id, force_online = force_online,
+                                            problem_check_show_answer_ip_table=problem_check_show_answer_ip_table)
+          else:
+            raise err
           
 
-      if num_partitions > 5:
-        print "--> sleeping for 60 seconds to try avoiding bigquery system error - maybe due to data transfer time"
-        sys.stdout.flush()
-        time.sleep(60)
-
   nfound = bqutil.get_bq_table_size_rows(dataset_id=testing_dataset if testing else dataset, 
                                            table_id=dataset+'_'+table if testing else table,
                                            project_id='mitx-research')
@@ -57,7 +57,7 @@ from collections import defaultdict
 from path import Path as path
 
 import gsutil
-from check_schema_tracking_log import check_schema, schema2dict
+from check_schema_tracking_log import compile_schema, schema2dict
 from course_key import to_deprecated_course_id_string
 from load_course_sql import find_course_sql_dir
 
@@ -319,9 +319,10 @@ def process_file(course_id, basedir=None, datedir=None, use_dataset_latest=False
     ocsv = csv.DictWriter(openfile('user_info_combo.csv.gz', 'w'), fieldnames=fieldnames)
     ocsv.writeheader()
     
+    check_uic_schema = compile_schema(the_dict_schema)
     for uid in uidset:
         data = uic[uid]
-        check_schema(uid, data, the_ds=the_dict_schema, coerce=True)
+        check_uic_schema(uid, data, coerce=True)
         if ('enrollment_course_id' not in data) and ('certificate_course_id' not in data):
             print "Oops!  missing course_id in user_info_combo line: inconsistent SQL?"
             print "data = %s" % data
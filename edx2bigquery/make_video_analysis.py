@@ -11,6 +11,7 @@ import gsutil
 import bqutil
 import datetime
 import process_tracking_logs
+import retry
 
 from path import Path as path
 from collections import OrderedDict
@@ -458,6 +459,11 @@ def createVideoStats_obsolete( course_id, force_recompute=False, use_dataset_lat
     
 #-----------------------------------------------------------------------------
 
+def youtube_error_retryable(err):
+    return retry.is_retryable(err) or "403" in str(err)	# the youtube API gives 403 for rate limits
+
+YOUTUBE_RETRY = retry.RetryPolicy(max_tries=8, base_delay=1.0, max_delay=MIN_IN_SECS, retryable=youtube_error_retryable)
+
 def get_youtube_api_stats(youtube_id, api_key, part, delay_secs=0):
     '''
     Youtube video duration lookup, using specified API_KEY from configuration file
@@ -466,24 +472,16 @@ def get_youtube_api_stats(youtube_id, api_key, part, delay_secs=0):
     if youtube_id is '': return None
     sleep(delay_secs)
 
+    assert api_key is not None, "[analyze videos] Public API Key is missing from configuration file."
+    #url = "http://gdata.youtube.com/feeds/api/videos/" + youtube_id + "?v=2&alt=jsonc"    # Version 2 API has been deprecated
+    url = "https://www.googleapis.com/youtube/v3/videos?part=" + part + "&id=" + youtube_id + "&key=" + api_key # Version 3.0 API
     try:
-        assert api_key is not None, "[analyze videos] Public API Key is missing from configuration file."
-        #url = "http://gdata.youtube.com/feeds/api/videos/" + youtube_id + "?v=2&alt=jsonc"    # Version 2 API has been deprecated
-        url = "https://www.googleapis.com/youtube/v3/videos?part=" + part + "&id=" + youtube_id + "&key=" + api_key # Version 3.0 API
-        data = urllib2.urlopen(url).read().decode("utf-8")
-    except (AssertionError, Exception) as err:
-        error = str(err)
-        if "504" in error or "403" in error: 
-            # rate-limit issue: try again with double timeout
-            if delay_secs > MIN_IN_SECS:
-                print "[Giving up] %s\n%s" % (youtube_id, url)
-                return None, None
-            new_delay = max(1.0, delay_secs * 2.0)
-            print "[Rate-limit] <%s> - Trying again with delay: %s" % (youtube_id, str(new_delay))
-            return get_youtube_api_stats(youtube_id=youtube_id, api_key=api_key, delay_secs=new_delay)
-        else:
-            print "[Error] <%s> - Unable to get duration.\n%s" % (youtube_id, url)
-
+        data = retry.call(lambda: urllib2.urlopen(url).read().decode("utf-8"), policy=YOUTUBE_RETRY, label='youtube')
+    except Exception as err:
+        if youtube_error_retryable(err):
+            print "[Giving up] %s\n%s" % (youtube_id, url)
+            return None, None
+        print "[Error] <%s> - Unable to get duration.\n%s" % (youtube_id, url)
         raise
         
     d = json.loads(data)
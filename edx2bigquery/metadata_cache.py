@@ -0,0 +1,88 @@
+#!/usr/bin/python
+#
+# File:   metadata_cache.py
+#
+# In-process cache with a time-to-live, used by bqutil for BigQuery table
+# metadata (table lists and tables.get results), which is otherwise fetched
+# over and over for the same datasets in one run.
+#
+# Keys are tuples, eg (project, dataset) or (project, dataset, table), so that
+# everything below a key can be invalidated together.
+
+import time
+
+MISSING = object()		# returned by get for keys not in the cache (or expired)
+
+class TTLCache(object):
+    '''
+    Dict-like cache whose entries expire ttl seconds after being put; hits and misses are counted.
+    '''
+    def __init__(self, ttl, clock=time.time):
+        self.ttl = ttl
+        self.clock = clock
+        self.data = {}			# key -> (expiry time, value)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.data.get(key)
+        if entry is not None and entry[0] > self.clock():
+            self.hits += 1
+            return entry[1]
+        if entry is not None:
+            self.data.pop(key, None)
+        self.misses += 1
+        return MISSING
+
+    def put(self, key, value):
+        if self.ttl > 0:
+            self.data[key] = (self.clock() + self.ttl, value)
+        return value
+
+    def invalidate(self, key, prefix=False):
+        '''
+        Remove key from the cache; with prefix=True, also remove all keys starting with the elements of key.
+        '''
+        self.data.pop(key, None)
+        if prefix:
+            n = len(key)
+            for k in [x for x in self.data.keys() if x[:n]==key]:	# keys() copies, as threads may be adding
+                self.data.pop(k, None)
+
+    def clear(self):
+        self.data = {}
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.data)}
+
+#-----------------------------------------------------------------------------
+# unit tests, using py.test
+
+def test_ttl_cache():
+    now = [100.0]
+    cache = TTLCache(60, clock=lambda: now[0])
+    assert cache.get(('p', 'ds')) is MISSING
+    cache.put(('p', 'ds'), ['a', 'b'])
+    cache.put(('p', 'ds', 'a'), {'numRows': 3})
+    cache.put(('p', 'ds2', 'a'), {'numRows': 4})
+    assert cache.get(('p', 'ds')) == ['a', 'b']
+    assert cache.get(('p', 'ds', 'a')) == {'numRows': 3}
+
+    cache.invalidate(('p', 'ds', 'a'))
+    assert cache.get(('p', 'ds', 'a')) is MISSING
+    assert cache.get(('p', 'ds')) == ['a', 'b']
+    cache.put(('p', 'ds', 'a'), None)
+    assert cache.get(('p', 'ds', 'a')) is None		# None can be cached
+
+    cache.invalidate(('p', 'ds'), prefix=True)
+    assert cache.get(('p', 'ds')) is MISSING
+    assert cache.get(('p', 'ds', 'a')) is MISSING
+    assert cache.get(('p', 'ds2', 'a')) == {'numRows': 4}
+
+    now[0] += 61
+    assert cache.get(('p', 'ds2', 'a')) is MISSING
+    assert cache.stats() == {'hits': 5, 'misses': 5, 'entries': 0}
+
+    cache = TTLCache(0)
+    cache.put('x', 1)
+    assert cache.get('x') is MISSING		# ttl=0 disables caching
@@ -0,0 +1,280 @@
+#!/usr/bin/python
+#
+# File:   nightly_planner.py
+#
+# Plans incremental nightly runs (nightly --only-changed): only the steps of a
+# course whose inputs have changed since they last ran are run, and courses
+# with nothing changed (eg archived courses) are skipped altogether.
+#
+# A course's inputs are fingerprinted as:
+#
+#     logs: the newest local tracking log file (tracklog-*.gz, in the tracking
+#           logs directory) and the latest mtime of those files, or, if there
+#           are none, the newest tracklog_* table in the course's BigQuery logs
+#           dataset (the tables made from local files are left out, since the
+#           run itself makes them)
+#     sql:  the SQL data directory (date) in use
+#     axis: the mtime of the course xml / xbundle file, in that directory
+#
+# The inputs of each step are the fingerprints of the course input tables it
+# reads or makes (see TABLE_FINGERPRINTS; eg daily_logs makes the tracking log
+# tables, from the logs), and the earlier steps it depends on, as declared for
+# the nightly step graph (main.add_course_steps; see step_inputs).
+#
+# After a nightly run, the fingerprint each step which succeeded was planned
+# with is saved as its inputs, in the run ledger (see run_ledger), so that
+# tracking logs arriving during the run are picked up by the next one.  Steps
+# which fail, including those which carry on after errors (see
+# jobstats.step_failed), are not saved.  A step is planned to run if the
+# fingerprint of its inputs has changed since, or it has not succeeded yet, or
+# a step it depends on is planned to run.
+#
+# nightly --plan-only prints the plan, without running anything.
+
+import glob
+import os
+import re
+import sys
+from collections import OrderedDict
+
+import edx2bigquery_config
+import run_ledger
+
+FINGERPRINT_KEYS = ['logs', 'sql', 'axis']
+
+# step graph tables (see main.add_course_steps) which are course inputs, and their fingerprint keys
+TABLE_FINGERPRINTS = {
+    'tracking_logs': 'logs',
+    'user_info_combo': 'sql',
+    'studentmodule': 'sql',
+    'forum': 'sql',
+    'grading_policy': 'sql',
+    'course_axis': 'axis',
+}
+
+def step_inputs(steps):
+    '''
+    Inputs of each of steps (the stepgraph.Steps of one course's nightly run, in order), as an OrderedDict of
+    step name -> fingerprint keys of the tables it reads or writes, and names of the earlier steps it depends on.
+    '''
+    tables = lambda step: step.inputs | step.outputs
+    return OrderedDict((step.name, sorted(set(TABLE_FINGERPRINTS[x] for x in tables(step) if x in TABLE_FINGERPRINTS))
+                        + [x.name for x in step.deps]) for step in steps)
+
+#-----------------------------------------------------------------------------
+# fingerprints
+
+def local_tracklogs_fingerprint(course_id, logs_dir):
+    '''
+    (newest tracking log file name, latest mtime of the tracking log files) for course_id, in logs_dir.
+    '''
+    import gsutil
+    files = glob.glob(os.path.join(logs_dir or '', gsutil.path_from_course_id(course_id), 'tracklog*.gz'))
+    if not files:
+        return None
+    return [os.path.basename(max(files)), int(max(os.path.getmtime(x) for x in files))]
+
+def newest_tracklog_table(course_id):
+    import bqutil
+    try:
+        tables = bqutil.get_list_of_table_ids(bqutil.course_id2dataset(course_id, dtype='logs'))
+    except Exception:
+        return None
+    return max([x for x in tables if re.match('tracklog_\d{8}$', x)] or [None])
+
+def sql_fingerprint(course_id, basedir, datedir=None, use_dataset_latest=False, course_files=None):
+    '''
+    (SQL data directory, mtime of the course xml file in it) for course_id, or (None, None) if not found.
+    '''
+    import load_course_sql
+    try:
+        sdir = load_course_sql.find_course_sql_dir(course_id, basedir=basedir, datedir=datedir,
+                                                   use_dataset_latest=use_dataset_latest, verbose=False)
+    except Exception:
+        return (None, None)
+    if course_files is None:
+        course_files = getattr(edx2bigquery_config, 'COURSE_FILES_PREFIX_NAMES', [])
+    for fn in course_files:
+        if os.path.exists(os.path.join(sdir, fn)):
+            return (str(sdir), int(os.path.getmtime(os.path.join(sdir, fn))))
+    return (str(sdir), None)
+
+def course_fingerprint(course_id, logs_dir, basedir, datedir=None, use_dataset_latest=False):
+    '''
+    Fingerprint of the inputs of course_id, as a dict with keys logs, sql, and axis.
+    '''
+    (sdir, axis_mtime) = sql_fingerprint(course_id, basedir, datedir, use_dataset_latest)
+    return {'logs': local_tracklogs_fingerprint(course_id, logs_dir) or newest_tracklog_table(course_id),
+            'sql': sdir,
+            'axis': axis_mtime,
+            }
+
+#-----------------------------------------------------------------------------
+
+class NightlyPlanner(object):
+    '''
+    Plans nightly steps for courses, from their fingerprints (made by fingerprint_fn(course_id), or given in
+    fingerprints, a dict), the inputs of the steps (see step_inputs), and the inputs of their last successful
+    runs, in ledger (a run_ledger.RunLedger; default, that of the run).
+    '''
+    def __init__(self, fingerprint_fn, step_inputs, ledger=None, fingerprints=None):
+        self.fingerprint_fn = fingerprint_fn
+        self.step_inputs = step_inputs
+        self.ledger = ledger or run_ledger.get_ledger()
+        self.fingerprints = dict(fingerprints or {})
+        self.changed = {}
+
+    def load_state(self, course_id):
+        '''
+        Saved state of course_id: dict of step -> fingerprint of its inputs when it last ran successfully.
+        '''
+        if self.ledger is None:
+            return {}
+        try:
+            steps = self.ledger.steps(course_id)
+        except Exception as err:
+            print "[nightly_planner] Oops, cannot read run ledger for %s, err=%s; planning all steps" % (course_id,
+                                                                                                      str(err))
+            return {}
+        return dict((step, rec['inputs']) for (step, rec) in steps.items()
+                    if rec['status'] == 'done' and rec['inputs'] is not None)
+
+    def fingerprint(self, course_id):
+        if course_id not in self.fingerprints:
+            self.fingerprints[course_id] = self.fingerprint_fn(course_id)
+        return self.fingerprints[course_id]
+
+    def plan_course(self, course_id):
+        '''
+        List of nightly steps to run for course_id (empty if nothing has changed); also sets
+        self.changed[course_id], the inputs which changed for any step.
+        '''
+        state = self.load_state(course_id)
+        fingerprint = self.fingerprint(course_id)
+        steps = []
+        changed = set()
+        for (step, inputs) in self.step_inputs.items():
+            last = state.get(step)
+            if last is None:
+                steps.append(step)
+                changed.add('never run')
+                continue
+            step_changed = [x for x in inputs if x in FINGERPRINT_KEYS and last.get(x) != fingerprint[x]]
+            if step_changed or [x for x in inputs if x in steps]:
+                steps.append(step)
+                changed.update(step_changed)
+        self.changed[course_id] = sorted(changed)
+        return steps
+
+    def plan(self, courses):
+        return OrderedDict((course_id, self.plan_course(course_id)) for course_id in courses)
+
+    def print_plan(self, plans, ofp=sys.stdout):
+        nrun = len([x for x in plans.values() if x])
+        ofp.write("[nightly_planner] %d of %d courses to run, %d unchanged\n" % (nrun, len(plans), len(plans) - nrun))
+        for (course_id, steps) in plans.items():
+            if not steps:
+                ofp.write("    %s: skip (no changes)\n" % course_id)
+            elif len(steps) == len(self.step_inputs):
+                ofp.write("    %s: all steps (%s)\n" % (course_id, ', '.join(self.changed.get(course_id, []))))
+            else:
+                ofp.write("    %s: %s (%s)\n" % (course_id, ', '.join(steps), ', '.join(self.changed.get(course_id, []))))
+        ofp.flush()
+
+    def save(self, course_id, steps_done):
+        '''
+        Record that steps_done (for course_id) have just run successfully, with the fingerprint of the course they
+        were planned with (so that inputs which arrived during the run count as changed, next time).
+        '''
+        if not steps_done or self.ledger is None:
+            return
+        fingerprint = self.fingerprint(course_id)
+        last = self.ledger.steps(course_id)
+        for step in steps_done:
+            rec = last.get(step) or {}
+            self.ledger.record(course_id, step, 'done', started=rec.get('started'), duration=rec.get('duration'),
+                               run_id=rec.get('run_id'),
+                               inputs=dict((x, fingerprint[x]) for x in self.step_inputs[step] if x in FINGERPRINT_KEYS))
+
+def make_planner(param, args, step_inputs, fingerprints=None):
+    '''
+    NightlyPlanner using course_fingerprint, with the tracking logs and SQL directories of the run (unless the
+    fingerprints of the courses are given, eg those made when planning the run).
+    '''
+    logs_dir = args.logs_dir or getattr(edx2bigquery_config, 'TRACKING_LOGS_DIRECTORY', '')
+    def fingerprint(course_id):
+        return course_fingerprint(course_id, logs_dir, param.the_basedir, param.the_datedir, param.use_dataset_latest)
+    return NightlyPlanner(fingerprint, step_inputs, fingerprints=fingerprints)
+
+#-----------------------------------------------------------------------------
+# unit tests, using py.test
+
+def test_step_inputs():
+    import stepgraph
+    graph = stepgraph.StepGraph()
+    for (name, inputs, outputs) in [('daily_logs', [], ['tracking_logs']),
+                                    ('analyze_forum', ['forum', 'tracking_logs'], ['forum_events']),
+                                    ('person_day', ['tracking_logs', 'course_axis', 'forum_events'], ['person_course_day']),
+                                    ('pcday_ip', ['tracking_logs'], ['pcday_ip_counts']),
+                                    ('person_course', ['user_info_combo', 'person_course_day', 'pcday_ip_counts'],
+                                     ['person_course'])]:
+        graph.add(name, None, inputs, outputs, group='a/b/c')
+    inputs = step_inputs(graph.steps.values())
+    assert list(inputs) == ['daily_logs', 'analyze_forum', 'person_day', 'pcday_ip', 'person_course']
+    assert inputs['daily_logs'] == ['logs']
+    assert inputs['analyze_forum'] == ['logs', 'sql', 'daily_logs']
+    assert inputs['person_day'] == ['axis', 'logs', 'daily_logs', 'analyze_forum']
+    assert inputs['person_course'] == ['sql', 'person_day', 'pcday_ip']
+    return inputs
+
+def test_nightly_planner():
+    import shutil
+    import tempfile
+    from StringIO import StringIO
+    inputs = test_step_inputs()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        ledger = run_ledger.RunLedger(os.path.join(tmpdir, 'ledger.sqlite'))
+        prints = {'a/b/c': {'logs': [['tracklog-2017-01-02.json.gz', 100], 1483401600],
+                            'sql': 'SQL/a__b__c/2017-01-01', 'axis': 100},
+                  'a/b/d': {'logs': 'tracklog_20150101', 'sql': 'SQL/a__b__d/2015-01-01', 'axis': 50}}
+        planner = NightlyPlanner(lambda course_id: dict(prints[course_id]), inputs, ledger=ledger)
+        plans = planner.plan(['a/b/c', 'a/b/d'])
+        assert plans['a/b/c'] == list(inputs) and planner.changed['a/b/c'] == ['never run']
+
+        # new tracking logs during the run: saved with the fingerprint the run was planned with
+        prints['a/b/c']['logs'] = [['tracklog-2017-01-03.json.gz', 200], 1483488000]
+        planner.save('a/b/c', plans['a/b/c'])
+        planner.save('a/b/d', [x for x in plans['a/b/d'] if x != 'pcday_ip'])	# pcday_ip failed
+        assert ledger.get('a/b/c', 'daily_logs')['inputs'] == {'logs': [['tracklog-2017-01-02.json.gz', 100],
+                                                                        1483401600]}
+        planner = NightlyPlanner(lambda course_id: dict(prints[course_id]), inputs, ledger=ledger)
+        assert planner.plan_course('a/b/c') == list(inputs)
+        assert planner.changed['a/b/c'] == ['logs']
+        assert planner.plan_course('a/b/d') == ['pcday_ip', 'person_course']
+
+        planner.save('a/b/c', list(inputs))
+        planner = NightlyPlanner(lambda course_id: dict(prints[course_id]), inputs, ledger=ledger)
+        assert planner.plan_course('a/b/c') == []
+
+        # new SQL dump: steps reading SQL data, and those depending on them
+        prints['a/b/c']['sql'] = 'SQL/a__b__c/2017-01-08'
+        planner = NightlyPlanner(lambda course_id: dict(prints[course_id]), inputs, ledger=ledger)
+        assert planner.plan_course('a/b/c') == ['analyze_forum', 'person_day', 'person_course']
+        assert planner.changed['a/b/c'] == ['sql']
+
+        # course fingerprints given (as made when the run was planned)
+        planner = NightlyPlanner(None, inputs, ledger=ledger, fingerprints={'a/b/c': dict(prints['a/b/c'])})
+        assert planner.plan_course('a/b/c') == ['analyze_forum', 'person_day', 'person_course']
+
+        prints['a/b/c']['logs'] = [['tracklog-2017-01-04.json.gz', 300], 1483574400]
+        assert planner.plan_course('a/b/c') == ['analyze_forum', 'person_day', 'person_course']
+
+        sfp = StringIO()
+        planner = NightlyPlanner(lambda course_id: dict(prints[course_id]), inputs, ledger=ledger)
+        planner.print_plan(OrderedDict([('a/b/c', planner.plan_course('a/b/c')), ('a/b/d', [])]), ofp=sfp)
+        out = sfp.getvalue()
+        assert '1 of 2 courses to run, 1 unchanged' in out
+        assert 'a/b/d: skip (no changes)' in out and 'a/b/c: all steps (logs, sql)' in out
+    finally:
+        shutil.rmtree(tmpdir)
@@ -162,7 +162,11 @@ def run_query_on_tracking_logs(SQL, table, course_id, force_recompute=False, use
         max_date = min_date
         print '    min_date = max_date = %s' % min_date
         tablename = 'tracklog_%s' % min_date.replace('-', '')
-        tablesize_mb = bqutil.get_bq_table_size_bytes(log_dataset, tablename) / (1024.0*1024)
+        log_meta = bqutil.get_tables_metadata(log_dataset)	# cached, so one query for all the days
+        if tablename in log_meta:
+            tablesize_mb = log_meta[tablename]['numBytes'] / (1024.0*1024)
+        else:
+            tablesize_mb = bqutil.get_bq_table_size_bytes(log_dataset, tablename) / (1024.0*1024)
         nhashes =  int(math.ceil(tablesize_mb / table_max_size_mb))
         from_datasets = "[%s.%s]" % (log_dataset, tablename)
         print "--> table %s.%s size %s MB > max=%s MB, using %d hashes" % (log_dataset, tablename, tablesize_mb, table_max_size_mb, nhashes)
@@ -26,6 +26,7 @@ from path import Path as path
 from edx2course_axis import date_parse
 import bqutil
 import gsutil
+import jsoncodec
 
 sfn = 'schema_forum.json'
 
@@ -124,7 +125,7 @@ def do_rephrase(data, do_schema_check=True, linecnt=0):
                 ret = check_for_funny_keys(val, name + '/' + key)
                 if ret is True:
                     sys.stderr.write("        coercing section %s to become a string\n" % (name+"/"+key) )
-                    entry[key] = json.dumps(val)
+                    entry[key] = jsoncodec.dumps(val)
         return False
 
     check_for_funny_keys(data)
@@ -144,7 +145,7 @@ def do_rephrase(data, do_schema_check=True, linecnt=0):
 
 def do_rephrase_line(line, linecnt=0):
     try:
-        data = json.loads(line)
+        data = jsoncodec.loads(line)
     except Exception as err:
         sys.stderr.write('oops, bad forum data line %s\n' % line)
         return
@@ -156,7 +157,7 @@ def do_rephrase_line(line, linecnt=0):
         sys.stderr.write(traceback.format_exc())
         return
             
-    return json.dumps(data)+'\n'
+    return jsoncodec.dumps(data)+'\n'
 
 #-----------------------------------------------------------------------------
 
@@ -223,7 +224,7 @@ def rephrase_forum_json_for_course(course_id, gsbucket="gs://x-data",
 
         try:
             #Write CSV row
-            data = json.loads(newline)
+            data = jsoncodec.loads(newline)
             ocsv.writerow( data )
         except Exception as err: 
             print "Error writing CSV output row %s=%s" % ( cnt, data )
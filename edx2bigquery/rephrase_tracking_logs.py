@@ -34,7 +34,10 @@ import traceback
 from math import isnan
 from path import Path as path
 from addmoduleid import add_module_id
-from check_schema_tracking_log import check_schema
+from check_schema_tracking_log import compile_schema
+import jsoncodec
+
+check_tracking_log_schema = compile_schema()	# checker for the default (tracking log) schema
 
 def do_rephrase(data, do_schema_check=True, linecnt=0):
 
@@ -53,7 +56,7 @@ def do_rephrase(data, do_schema_check=True, linecnt=0):
         try:
             event = data['event']
             if not type(event)==dict:
-                event = json.loads(event)
+                event = jsoncodec.loads_event(event)
             event_js = True
         except Exception as err:
             # note - do not erase event even if it can't be loaded as JSON: see how it becomes JSONified below
@@ -76,7 +79,7 @@ def do_rephrase(data, do_schema_check=True, linecnt=0):
     event = None
     if 'event' in data:
         event = data['event']
-        data['event'] = json.dumps(data['event'])
+        data['event'] = jsoncodec.dumps(data['event'])
 
     # now the real rephrasing
 
@@ -110,7 +113,7 @@ def do_rephrase(data, do_schema_check=True, linecnt=0):
                  )):
         data['event_struct'] = event
     elif type(event)==dict:	# default to always including GET and POST when available
-        data['event_struct'] = {'GET': json.dumps(event.get('GET')), 'POST': json.dumps(event.get('POST'))}
+        data['event_struct'] = {'GET': jsoncodec.dumps(event.get('GET')), 'POST': jsoncodec.dumps(event.get('POST'))}
         data['event_struct']['query'] = event.get('query')
     else:
         if 'event_struct' in data:
@@ -124,30 +127,30 @@ def do_rephrase(data, do_schema_check=True, linecnt=0):
         data.pop('_id')
 
     if type(event)==dict and 'POST' in event:
-        post_str = json.dumps(event['POST'])
+        post_str = jsoncodec.dumps(event['POST'])
         event['POST'] = post_str
 
     if type(event)==dict and 'GET' in event:
-        get_str = json.dumps(event['GET'])
+        get_str = jsoncodec.dumps(event['GET'])
         event['GET'] = get_str
 
     if event_type in ['problem_check', 'problem_save', 'problem_reset'] and data['event_source']=='browser':
         if type(event) in [str, unicode]:
-            event = {'data': json.dumps(event)}
+            event = {'data': jsoncodec.dumps(event)}
 
     if type(event) in [str, unicode]:
         #if event and data['event_js']:
         #    sys.stderr.write('unexpected STRING event: ' + json.dumps(data, indent=4) + '\n')
-        event = {'data': json.dumps(event)}
+        event = {'data': jsoncodec.dumps(event)}
 
     if type(event) in [list]:
-        event = {'data': json.dumps(event)}
+        event = {'data': jsoncodec.dumps(event)}
 
     def make_str(key):
         if event is not None and 'state' in event:
             state = event['state']
             if key in state:
-                state[key] = json.dumps(state[key])
+                state[key] = jsoncodec.dumps(state[key])
 
     make_str('input_state')
     make_str('correct_map')
@@ -156,7 +159,7 @@ def do_rephrase(data, do_schema_check=True, linecnt=0):
     def make_str0(key):
         ev = event or {}
         if key in ev:
-            ev[key] = json.dumps(ev[key])
+            ev[key] = jsoncodec.dumps(ev[key])
 
     make_str0('correct_map')
     make_str0('answers')
@@ -170,7 +173,7 @@ def do_rephrase(data, do_schema_check=True, linecnt=0):
     def make_str2(key):
         context = data.get('context', {})
         if key in context:
-            context[key] = json.dumps(context[key])
+            context[key] = jsoncodec.dumps(context[key])
 
     make_str2('course_user_tags')
 
@@ -189,7 +192,7 @@ def do_rephrase(data, do_schema_check=True, linecnt=0):
                 if key in context:
                     agent[key] = context[key]
                     context.pop(key)
-        context['agent'] = json.dumps(agent)
+        context['agent'] = jsoncodec.dumps(agent)
 
     # 31-Jan-15: handle new "module.usage_key" field in context, e.g.:
     #
@@ -241,7 +244,7 @@ def do_rephrase(data, do_schema_check=True, linecnt=0):
         for field_path in field_paths:
             move_field_value(data, vdict, field_path)
             
-        data['mongoid'] = json.dumps(vdict)
+        data['mongoid'] = jsoncodec.dumps(vdict)
 
     # 16-Mar-15: remove event_struct.requested_skip_interval
 
@@ -341,13 +344,13 @@ def do_rephrase(data, do_schema_check=True, linecnt=0):
                 ret = check_for_funny_keys(val, name + '/' + key)
                 if ret is True:
                     sys.stderr.write("        coercing section %s to become a string\n" % (name+"/"+key) )
-                    entry[key] = json.dumps(val)
+                    entry[key] = jsoncodec.dumps(val)
         return False
 
     check_for_funny_keys(data)
 
     try:
-        check_schema(linecnt, data, coerce=True)
+        check_tracking_log_schema(linecnt, data, coerce=True)
     except Exception as err:
         sys.stderr.write('[%d] oops, err=%s, failed in check_schema %s\n' % (linecnt, str(err), json.dumps(data, indent=4)))
         sys.stderr.write(traceback.format_exc())
@@ -356,7 +359,7 @@ def do_rephrase(data, do_schema_check=True, linecnt=0):
 
 def do_rephrase_line(line, linecnt=0):
     try:
-        data = json.loads(line)
+        data = jsoncodec.loads(line)
     except Exception as err:
         sys.stderr.write('oops, bad log line %s\n' % line)
         return
@@ -368,12 +371,15 @@ def do_rephrase_line(line, linecnt=0):
         sys.stderr.write(traceback.format_exc())
         return
             
-    return json.dumps(data)+'\n'
+    return jsoncodec.dumps(data)+'\n'
 
 
 def do_rephrase_file(fn):
     '''
     rephrase lines in filename fn, and overwrite original file when done.
+    The original file is kept, renamed to old-<fn>.  Lines which can't be rephrased are dropped.
+
+    Returns (number of lines, number of bytes) read.
     '''
 
     from load_course_sql import openfile	# only needed in this function
@@ -386,15 +392,194 @@ def do_rephrase_file(fn):
     ofn = fn.dirname() / ("tmp-" + fn.basename())
     ofp = openfile(ofn, 'w')
 
+    nlines = 0
+    nbytes = 0
     for line in openfile(fn):
-        newline = do_rephrase_line(line)
-        ofp.write(newline)
+        nlines += 1
+        nbytes += len(line)
+        newline = do_rephrase_line(line, linecnt=nlines)
+        if newline is not None:
+            ofp.write(newline)
 
     ofp.close()
     
     oldfilename = fn.dirname() / ("old-" + fn.basename())
+    if oldfilename.exists():
+        ofn.remove()
+        raise Exception("[rephrase_tracking_logs] %s already exists, not overwriting it with %s" % (oldfilename, fn))
     print "  --> Done; renaming %s -> %s" % (fn, oldfilename)
     os.rename(fn, oldfilename)
     print "  --> renaming %s -> %s" % (ofn, fn)
     os.rename(ofn, fn)
     sys.stdout.flush()
+    return (nlines, nbytes)
+
+#-----------------------------------------------------------------------------
+# batch rephrasing of archived tracking log files, in parallel
+
+def looks_rephrased(fn, nlines=5):
+    '''
+    True if the first nlines lines of tracking log file fn have all been rephrased (each has the mongoid
+    field which do_rephrase_line makes, holding the old_mongoid).
+    '''
+    from load_course_sql import openfile
+    fp = openfile(fn)
+    try:
+        for (k, line) in enumerate(fp):
+            if k >= nlines:
+                break
+            try:
+                mongoid = json.loads(line).get('mongoid')
+            except ValueError:
+                return False
+            if not (isinstance(mongoid, basestring) and 'old_mongoid' in mongoid):
+                return False
+    finally:
+        fp.close()
+    return True
+
+def rephrase_status(fn):
+    '''
+    Return "done" if tracking log file fn has already been rephrased in place (there is an old-<fn> sibling,
+    and fn's lines are rephrased), "interrupted" if it was rephrased but the final rename did not happen,
+    "conflict" if there is an old-<fn> sibling but fn has not been rephrased (eg it was replaced by a new
+    copy of the raw file), else "todo".
+    '''
+    fn = path(fn)
+    if not (fn.dirname() / ("old-" + fn.basename())).exists():
+        return "todo"
+    if fn.exists():
+        return "done" if looks_rephrased(fn) else "conflict"
+    if (fn.dirname() / ("tmp-" + fn.basename())).exists():
+        return "interrupted"
+    return "todo"
+
+def set_memory_limit(max_memory):
+    '''
+    Limit the address space of this process to max_memory MB (pool worker initializer), so that a runaway
+    worker gets a MemoryError instead of pushing the machine into swap.
+    '''
+    if max_memory:
+        import resource
+        nbytes = int(max_memory) * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (nbytes, nbytes))
+
+def rephrase_file_worker(fn):
+    '''
+    Pool worker: rephrase fn in place.  Returns (fn, nlines, nbytes, error).
+    '''
+    try:
+        (nlines, nbytes) = do_rephrase_file(fn)
+        return (fn, nlines, nbytes, None)
+    except (Exception, MemoryError) as err:
+        tmpfn = path(fn).dirname() / ("tmp-" + path(fn).basename())
+        if tmpfn.exists():
+            tmpfn.remove()
+        sys.stderr.write("[rephrase_tracking_logs] failed to rephrase %s, err=%s\n" % (fn, str(err)))
+        sys.stderr.write(traceback.format_exc())
+        return (fn, 0, 0, str(err) or err.__class__.__name__)
+
+def do_rephrase_files(files, workers=None, max_memory=None):
+    '''
+    Rephrase the tracking log files in the list files in place, using a pool of worker processes (one
+    per cpu by default), each limited to max_memory MB if given.  Files which already have an old-
+    sibling (from a previous run) are skipped, and old- files themselves are ignored; a file with an
+    old- sibling which does not look rephrased is left alone, with a warning (counted as conflicts).  A
+    tmp- file left by a run interrupted just before its final rename is renamed into place.
+
+    Prints a throughput summary (MB being uncompressed log data), and returns a dict of counts.
+    '''
+    import time
+    import multiprocessing as mp
+
+    todo = []
+    stats = {'skipped': 0, 'done': 0, 'failed': 0, 'conflicts': 0, 'lines': 0, 'bytes': 0}
+    for fn in files:
+        fn = path(fn)
+        if fn.basename().startswith('old-'):
+            continue
+        if fn.basename().startswith('tmp-'):
+            orig_fn = fn.dirname() / fn.basename()[4:]
+            if rephrase_status(orig_fn)=="interrupted":
+                print "Finishing interrupted rephrase: renaming %s -> %s" % (fn, orig_fn)
+                os.rename(fn, orig_fn)
+                stats['skipped'] += 1
+            continue
+        status = rephrase_status(fn)
+        if status=="done":
+            print "Already rephrased %s (skipping)" % fn
+            stats['skipped'] += 1
+            continue
+        if status=="conflict":
+            print "WARNING: %s has not been rephrased, but %s exists (from an earlier run?); not rephrasing it.  " \
+                "Move the old- file away to rephrase it again." % (fn, fn.dirname() / ("old-" + fn.basename()))
+            stats['conflicts'] += 1
+            continue
+        todo.append(fn)
+    sys.stdout.flush()
+
+    t0 = time.time()
+    pool = mp.Pool(processes=workers or mp.cpu_count(), initializer=set_memory_limit, initargs=(max_memory,))
+    try:
+        for (fn, nlines, nbytes, error) in pool.imap_unordered(rephrase_file_worker, todo):
+            if error:
+                print "===> FAILED to rephrase %s: %s" % (fn, error)
+                stats['failed'] += 1
+            else:
+                stats['done'] += 1
+                stats['lines'] += nlines
+                stats['bytes'] += nbytes
+            sys.stdout.flush()
+    except:
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+
+    dt = max(time.time() - t0, 1e-6)
+    stats['seconds'] = dt
+    if stats['conflicts']:
+        print "WARNING: %d files not rephrased, because of existing old- files" % stats['conflicts']
+    print "Rephrased %d files (%d skipped, %d failed): %d lines, %.1f MB in %.1f sec = %.0f lines/s, %.2f MB/s" % (
+        stats['done'], stats['skipped'], stats['failed'], stats['lines'], stats['bytes'] / 1.0e6, dt,
+        stats['lines'] / dt, stats['bytes'] / 1.0e6 / dt)
+    sys.stdout.flush()
+    return stats
+
+#-----------------------------------------------------------------------------
+# unit tests, using py.test
+
+def test_do_rephrase_files():
+    import shutil
+    import tempfile
+    tmpdir = path(tempfile.mkdtemp())
+    try:
+        lines = [json.dumps({'time': '2015-02-10T16:20:01.123456+00:00', 'event_type': 'page_close', 'event_source': 'browser',
+                             'course_id': 'MITx/8.01x/2013_SOND', 'event': '', 'page': 'page-%d' % k}) + '\n'
+                 for k in range(20)]
+        for name in ['a.log.gz', 'b.log.gz', 'c.log.gz', 'd.log.gz']:
+            fp = gzip.GzipFile(tmpdir / name, 'w')
+            fp.write(''.join(lines) + 'not a json line\n')
+            fp.close()
+        do_rephrase_file(tmpdir / 'b.log.gz')					# b was already done
+        os.rename(tmpdir / 'c.log.gz', tmpdir / 'tmp-c.log.gz')			# c was interrupted just before its final rename
+        shutil.copy(tmpdir / 'tmp-c.log.gz', tmpdir / 'old-c.log.gz')
+        shutil.copy(tmpdir / 'd.log.gz', tmpdir / 'old-d.log.gz')		# d is raw, but has an old- file
+        assert rephrase_status(tmpdir / 'd.log.gz') == "conflict"
+
+        stats = do_rephrase_files(sorted(tmpdir.glob('*.gz')), workers=2, max_memory=4096)
+        assert (stats['done'], stats['skipped'], stats['failed'], stats['conflicts'], stats['lines']) == (1, 2, 0, 1, 21)
+        assert sorted(x.basename() for x in tmpdir.files()) == ['a.log.gz', 'b.log.gz', 'c.log.gz', 'd.log.gz',
+                                                                'old-a.log.gz', 'old-b.log.gz', 'old-c.log.gz',
+                                                                'old-d.log.gz']
+        try:
+            do_rephrase_file(tmpdir / 'd.log.gz')
+            assert False, 'overwrote old-d.log.gz'
+        except Exception as err:
+            assert 'already exists' in str(err)
+        assert not (tmpdir / 'tmp-d.log.gz').exists()
+        out = [json.loads(x) for x in gzip.GzipFile(tmpdir / 'a.log.gz')]
+        assert [x['page'] for x in out] == ['page-%d' % k for k in range(20)]
+        assert rephrase_status(tmpdir / 'a.log.gz') == "done"
+    finally:
+        shutil.rmtree(tmpdir)
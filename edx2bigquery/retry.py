@@ -0,0 +1,183 @@
+#!/usr/bin/python
+#
+# File:   retry.py
+#
+# Retries, with jittered exponential backoff, for BigQuery, google storage, and
+# other google API calls.
+#
+# is_retryable classifies errors: HTTP 429 and 5xx, rateLimitExceeded,
+# backendError and internalError reasons, and dropped connections are worth
+# retrying; anything else (eg 404 Not Found, or bad SQL) is raised right away.
+#
+# Example:
+#
+#     table = retry.execute(tables.get(**table_ref))
+#     bqutil.create_bq_table(dataset, table, sql, job_retry=retry.JOB_RETRY)
+#
+# (bqjobs.JobManager retries job inserts itself, and reruns failed jobs with a
+# job_retry policy, so calls submitting jobs are not wrapped in retry.call.)
+#
+# Retries are counted, per label, in COUNTS, which jobstats records; the
+# JobManager also counts those of each job in its handle.
+
+import httplib
+import random
+import re
+import socket
+import sys
+import time
+
+import edx2bigquery_config
+
+RETRY_MAX_TRIES = getattr(edx2bigquery_config, 'RETRY_MAX_TRIES', 8)
+RETRY_BASE_DELAY = getattr(edx2bigquery_config, 'RETRY_BASE_DELAY', 1.0)		# seconds
+RETRY_MAX_DELAY = getattr(edx2bigquery_config, 'RETRY_MAX_DELAY', 60.0)
+
+RETRYABLE_STATUS = set([429, 500, 502, 503, 504])
+RETRYABLE_REASONS = ['rateLimitExceeded', 'userRateLimitExceeded', 'backendError', 'internalError',
+                     'internal error', 'SSL3_GET_RECORD:decryption failed']
+
+COUNTS = {}		# label -> number of retries
+
+#-----------------------------------------------------------------------------
+
+def error_status(err):
+    '''
+    HTTP status of err (an apiclient HttpError, urllib2 HTTPError, or message with "HttpError <status>"), or None.
+    '''
+    resp = getattr(err, 'resp', None)
+    if resp is not None and getattr(resp, 'status', None):
+        return int(resp.status)
+    if isinstance(getattr(err, 'code', None), int):
+        return err.code
+    m = re.search('HttpError (\d\d\d)', str(err))
+    if m:
+        return int(m.group(1))
+    return None
+
+def is_retryable(err):
+    '''
+    True if err is a transient error, worth retrying.
+    '''
+    if error_status(err) in RETRYABLE_STATUS:
+        return True
+    if isinstance(err, (socket.error, httplib.HTTPException)):
+        return True
+    msg = str(err) + str(getattr(err, 'content', ''))
+    return any(x in msg for x in RETRYABLE_REASONS)
+
+class RetryPolicy(object):
+    '''
+    Up to max_tries tries, for errors which retryable(err) says are transient, with delays doubling from
+    base_delay up to max_delay (each jittered between half and all of that).
+    '''
+    def __init__(self, max_tries=None, base_delay=None, max_delay=None, retryable=is_retryable,
+                 sleep=time.sleep, random=random.random):
+        self.max_tries = max_tries or RETRY_MAX_TRIES
+        self.base_delay = base_delay or RETRY_BASE_DELAY
+        self.max_delay = max_delay or RETRY_MAX_DELAY
+        self.retryable = retryable
+        self.sleep = sleep
+        self.random = random
+
+    def delay(self, nretry):
+        '''
+        Seconds to wait before retry number nretry (starting at 1).
+        '''
+        delay = min(self.max_delay, self.base_delay * (2 ** (nretry - 1)))
+        return delay * (0.5 + 0.5 * self.random())
+
+    def should_retry(self, err, ntries):
+        return ntries < self.max_tries and self.retryable(err)
+
+DEFAULT = RetryPolicy()
+
+# for re-running BigQuery jobs which failed with internal errors (bqjobs job_retry)
+JOB_RETRY = RetryPolicy(max_tries=10, base_delay=30.0, max_delay=240.0)
+
+def count(label):
+    COUNTS[label] = COUNTS.get(label, 0) + 1
+
+def call(fn, policy=None, label='call', on_retry=None):
+    '''
+    Return fn(), retrying transient errors according to policy (default DEFAULT).  on_retry(err, delay) is
+    called before each retry.
+    '''
+    policy = policy or DEFAULT
+    ntries = 0
+    while True:
+        ntries += 1
+        try:
+            return fn()
+        except Exception as err:
+            if not policy.should_retry(err, ntries):
+                raise
+            delay = policy.delay(ntries)
+            count(label)
+            print "[retry] %s failed (try %d of %d), retrying in %.1f sec: %s" % (label, ntries, policy.max_tries,
+                                                                                 delay, str(err)[:400])
+            sys.stdout.flush()
+            if on_retry is not None:
+                on_retry(err, delay)
+            policy.sleep(delay)
+
+def execute(request, http=None, policy=None, label=None):
+    '''
+    request.execute() (with http, if given), for an apiclient request, retrying transient errors.
+    '''
+    if label is None:
+        label = getattr(request, 'methodId', None) or 'execute'
+    if http is None:
+        return call(request.execute, policy=policy, label=label)
+    return call(lambda: request.execute(http=http), policy=policy, label=label)
+
+#-----------------------------------------------------------------------------
+# unit tests, using py.test
+
+class FakeHttpError(Exception):
+    def __init__(self, status, content=''):
+        Exception.__init__(self, '<HttpError %d "%s">' % (status, content))
+        self.resp = type('Resp', (object,), {'status': status})()
+        self.content = content
+
+def test_is_retryable():
+    assert is_retryable(FakeHttpError(503))
+    assert is_retryable(FakeHttpError(429))
+    assert is_retryable(FakeHttpError(403, '{"reason": "rateLimitExceeded"}'))
+    assert not is_retryable(FakeHttpError(403, '{"reason": "accessDenied"}'))
+    assert not is_retryable(FakeHttpError(404, 'Not Found: Table x:y.z'))
+    assert is_retryable(Exception('HttpError 500 when requesting ...'))
+    assert is_retryable(Exception('BQ Error creating table An internal error occurred'))
+    assert not is_retryable(Exception('BQ Error creating table Field foo not found'))
+    assert is_retryable(socket.timeout('timed out'))
+
+def test_call_backoff():
+    slept = []
+    policy = RetryPolicy(max_tries=5, base_delay=2, max_delay=10, sleep=slept.append, random=lambda: 1.0)
+    errors = [FakeHttpError(500), FakeHttpError(503), FakeHttpError(429), FakeHttpError(500)]
+    def flaky():
+        if errors:
+            raise errors.pop(0)
+        return 'ok'
+    retries = []
+    assert call(flaky, policy=policy, label='test.flaky', on_retry=lambda err, delay: retries.append(delay)) == 'ok'
+    assert slept == retries == [2, 4, 8, 10]
+    assert COUNTS['test.flaky'] == 4
+
+    policy.random = lambda: 0.0
+    assert [policy.delay(k) for k in range(1, 5)] == [1, 2, 4, 5]	# jittered down to half
+
+    def not_found():
+        raise FakeHttpError(404)
+    try:
+        call(not_found, policy=policy)
+        assert False
+    except FakeHttpError:
+        pass
+    del slept[:]
+    errors = [FakeHttpError(500)] * 6
+    try:
+        call(flaky, policy=policy)
+        assert False
+    except FakeHttpError:
+        assert len(slept) == 4		# gave up after max_tries
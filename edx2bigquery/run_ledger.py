@@ -0,0 +1,324 @@
+#!/usr/bin/python
+#
+# File:   run_ledger.py
+#
+# Local run ledger (an SQLite database): for each (course_id, step), the
+# status, start time, duration, and error of its last run, the hash (and
+# value) of its inputs, and the outputs known to exist (with when they were
+# last confirmed to).
+#
+# Steps (the functions in main decorated with jobstats.job_step) are recorded
+# as they finish.  The ledger is then used
+#
+#     - for --skip-if-exists checks, instead of looking up tables in BigQuery
+#       each time (a table confirmed to exist is recorded as an output, and
+#       trusted to, without looking it up again, for RUN_LEDGER_OUTPUT_MAX_AGE
+#       seconds, default a day, since the table may be deleted outside of
+#       edx2bigquery),
+#     - by nightly --only-changed, for the input fingerprints of the steps,
+#     - by the status command, to list failed and stale steps of many courses
+#       at once, without any remote calls.
+#
+# The ledger file is RUN_LEDGER_FILE in edx2bigquery_config (default
+# LOGS/run_ledger.sqlite), or --run-ledger; None turns it off.  Writers in
+# several processes (eg with --parallel) are serialized by SQLite.
+
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+import edx2bigquery_config
+
+RUN_LEDGER_FILE = getattr(edx2bigquery_config, 'RUN_LEDGER_FILE', 'LOGS/run_ledger.sqlite')
+OUTPUT_MAX_AGE = getattr(edx2bigquery_config, 'RUN_LEDGER_OUTPUT_MAX_AGE', 24 * 3600)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS steps (
+    course_id TEXT NOT NULL,
+    step TEXT NOT NULL,
+    status TEXT NOT NULL,
+    started REAL,
+    duration REAL,
+    run_id TEXT,
+    error TEXT,
+    inputs_hash TEXT,
+    inputs TEXT,
+    outputs TEXT,
+    PRIMARY KEY (course_id, step)
+)
+'''
+
+FIELDS = ['course_id', 'step', 'status', 'started', 'duration', 'run_id', 'error', 'inputs_hash', 'inputs', 'outputs']
+
+LEDGER = {}		# pid -> RunLedger, as a connection can't be used after a fork
+
+#-----------------------------------------------------------------------------
+
+def inputs_hash(inputs):
+    if inputs is None:
+        return None
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+class RunLedger(object):
+    '''
+    Run ledger in the SQLite database file fn; may be shared by the threads of a process.
+    '''
+    def __init__(self, fn):
+        self.fn = fn
+        dirname = os.path.dirname(fn)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(fn, timeout=60, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.lock:
+            self.conn.execute(SCHEMA)
+            self.conn.commit()
+
+    def record(self, course_id, step, status, started=None, duration=None, run_id=None, error=None, inputs=None,
+               outputs=None):
+        '''
+        Record the last run of step for course_id.  Inputs and outputs (dict of output -> time it was confirmed
+        to exist) which are not given (None) are kept from the previous record.
+        '''
+        with self.lock:
+            self.conn.execute('''INSERT OR REPLACE INTO steps (%s)
+                                 SELECT ?, ?, ?, ?, ?, ?, ?,
+                                        COALESCE(?, (SELECT inputs_hash FROM steps WHERE course_id=? AND step=?)),
+                                        COALESCE(?, (SELECT inputs FROM steps WHERE course_id=? AND step=?)),
+                                        COALESCE(?, (SELECT outputs FROM steps WHERE course_id=? AND step=?))''' % ', '.join(FIELDS),
+                              (course_id, step, status, started, duration, run_id, error,
+                               inputs_hash(inputs), course_id, step,
+                               json.dumps(inputs) if inputs is not None else None, course_id, step,
+                               json.dumps(outputs) if outputs is not None else None, course_id, step))
+            self.conn.commit()
+
+    def add_outputs(self, course_id, step, outputs, confirmed=None):
+        '''
+        Record that outputs (eg table names) of step for course_id exist, as of confirmed (default now),
+        marking the step done if it is not in the ledger.
+        '''
+        confirmed = confirmed or time.time()
+        row = self.get(course_id, step)
+        if row is None:
+            self.record(course_id, step, 'done', outputs=dict((x, confirmed) for x in outputs))
+        else:
+            known = row['outputs'] or {}
+            known.update((x, confirmed) for x in outputs)
+            with self.lock:
+                self.conn.execute('UPDATE steps SET outputs=? WHERE course_id=? AND step=?',
+                                  (json.dumps(known), course_id, step))
+                self.conn.commit()
+
+    def remove_output(self, course_id, output):
+        '''
+        Forget output (eg a deleted table) of any step of course_id.
+        '''
+        for (step, rec) in self.steps(course_id).items():
+            if output in (rec['outputs'] or []):
+                with self.lock:
+                    self.conn.execute('UPDATE steps SET outputs=? WHERE course_id=? AND step=?',
+                                      (json.dumps(dict((x, t) for (x, t) in rec['outputs'].items() if x != output)),
+                                       course_id, step))
+                    self.conn.commit()
+
+    def as_dict(self, row):
+        ret = dict(zip(FIELDS, row))
+        for field in ['inputs', 'outputs']:
+            if ret[field] is not None:
+                ret[field] = json.loads(ret[field])
+        if isinstance(ret['outputs'], list):		# outputs recorded without times: to be confirmed again
+            ret['outputs'] = dict((x, 0) for x in ret['outputs'])
+        return ret
+
+    def query(self, where='1', params=()):
+        with self.lock:
+            rows = self.conn.execute('SELECT %s FROM steps WHERE %s ORDER BY course_id, started' % (', '.join(FIELDS),
+                                                                                                   where), params).fetchall()
+        return [self.as_dict(x) for x in rows]
+
+    def get(self, course_id, step):
+        rows = self.query('course_id=? AND step=?', (course_id, step))
+        return rows[0] if rows else None
+
+    def steps(self, course_id):
+        '''
+        dict of step -> record, for course_id.
+        '''
+        return dict((x['step'], x) for x in self.query('course_id=?', (course_id,)))
+
+    def courses(self):
+        with self.lock:
+            return [x[0] for x in self.conn.execute('SELECT DISTINCT course_id FROM steps ORDER BY course_id')]
+
+    def has_output(self, course_id, step, output, max_age=None):
+        '''
+        True if output of step for course_id is recorded, and (if max_age is given) was confirmed to exist
+        less than max_age seconds ago.
+        '''
+        row = self.get(course_id, step)
+        if row is None or output not in (row['outputs'] or {}):
+            return False
+        return max_age is None or time.time() - row['outputs'][output] < max_age
+
+    def delete(self, course_id, step=None):
+        with self.lock:
+            if step is None:
+                self.conn.execute('DELETE FROM steps WHERE course_id=?', (course_id,))
+            else:
+                self.conn.execute('DELETE FROM steps WHERE course_id=? AND step=?', (course_id, step))
+            self.conn.commit()
+
+def set_file(fn):
+    global RUN_LEDGER_FILE
+    RUN_LEDGER_FILE = fn
+    LEDGER.clear()
+
+def get_ledger():
+    '''
+    The RunLedger of this process, or None if there's no ledger file (or it can't be opened).
+    '''
+    pid = os.getpid()
+    if pid not in LEDGER:
+        LEDGER.clear()
+        LEDGER[pid] = None
+        if RUN_LEDGER_FILE:
+            try:
+                LEDGER[pid] = RunLedger(RUN_LEDGER_FILE)
+            except Exception as err:
+                print "[run_ledger] Oops, cannot open run ledger %s, not recording steps; err=%s" % (RUN_LEDGER_FILE,
+                                                                                                  str(err))
+    return LEDGER[pid]
+
+def record_step(course_id, step, status, started, duration, run_id=None, error=None):
+    '''
+    Record a step run in the ledger, if there is one; errors are printed, not raised, so that they don't
+    stop the run.
+    '''
+    ledger = get_ledger()
+    if ledger is None or not course_id:
+        return
+    try:
+        ledger.record(course_id, step, status, started=started, duration=duration, run_id=run_id, error=error)
+    except Exception as err:
+        print "[run_ledger] Oops, failed to record %s for %s, err=%s" % (step, course_id, str(err))
+
+def output_exists(course_id, step, output, remote_check, max_age=None):
+    '''
+    True if output (eg a table) of step for course_id exists: if the ledger has it, confirmed less than
+    max_age (default OUTPUT_MAX_AGE) seconds ago, without calling remote_check(); otherwise if
+    remote_check() (eg a BigQuery table lookup) is true, in which case it is recorded (as confirmed now) in
+    the ledger, or else forgotten.
+    '''
+    ledger = get_ledger()
+    max_age = OUTPUT_MAX_AGE if max_age is None else max_age
+    if ledger is not None and ledger.has_output(course_id, step, output, max_age=max_age):
+        return True
+    exists = remote_check()
+    if ledger is not None:
+        if exists:
+            ledger.add_outputs(course_id, step, [output])
+        elif ledger.has_output(course_id, step, output):
+            ledger.remove_output(course_id, output)
+    return exists
+
+#-----------------------------------------------------------------------------
+# status command
+
+def stale_steps(ledger, course_id, inputs_mtime=None):
+    '''
+    Steps of course_id which failed, or (if inputs_mtime, the time its local inputs last changed, is given)
+    were last run before inputs_mtime; list of (record, reason).
+    '''
+    stale = []
+    for (step, rec) in sorted(ledger.steps(course_id).items()):
+        if rec['status'] != 'done':
+            stale.append((rec, rec['status'] + ((': %s' % rec['error'][:100]) if rec['error'] else '')))
+        elif inputs_mtime and rec['started'] and rec['started'] < inputs_mtime:
+            stale.append((rec, 'inputs changed since %s' % time.strftime('%Y-%m-%d %H:%M', time.localtime(rec['started']))))
+    return stale
+
+def status_report(ledger, courses=None, inputs_mtime_fn=None, verbose=False, ofp=sys.stdout):
+    '''
+    Write, for each course (default: all courses in the ledger), the number of steps recorded, and its stale
+    steps (see stale_steps; inputs_mtime_fn(course_id) gives the time its local inputs last changed); with
+    verbose, all of its steps.  Returns the number of stale steps.
+    '''
+    nstale = 0
+    for course_id in (courses or ledger.courses()):
+        steps = ledger.steps(course_id)
+        stale = stale_steps(ledger, course_id, inputs_mtime_fn(course_id) if inputs_mtime_fn else None)
+        nstale += len(stale)
+        ofp.write("%s: %d steps recorded, %d stale\n" % (course_id, len(steps), len(stale)))
+        for (rec, reason) in stale:
+            ofp.write("    STALE %-30s %s\n" % (rec['step'], reason))
+        if verbose:
+            for step in sorted(steps, key=lambda x: steps[x]['started'] or 0):
+                rec = steps[step]
+                when = time.strftime('%Y-%m-%d %H:%M', time.localtime(rec['started'])) if rec['started'] else '-'
+                ofp.write("    %-36s %-8s %s %8s sec\n" % (step, rec['status'], when,
+                                                          '%.1f' % rec['duration'] if rec['duration'] is not None else '-'))
+    return nstale
+
+#-----------------------------------------------------------------------------
+# unit tests, using py.test
+
+def test_run_ledger():
+    import shutil
+    import tempfile
+    from StringIO import StringIO
+    tmpdir = tempfile.mkdtemp()
+    try:
+        ledger = RunLedger(os.path.join(tmpdir, 'LOGS', 'ledger.sqlite'))
+        ledger.record('a/b/c', 'person_day', 'done', started=1000.0, duration=30.0, inputs={'logs': ['x', 1]})
+        ledger.record('a/b/c', 'person_course', 'failed', started=1100.0, duration=5.0, error='oops')
+        ledger.record('a/b/c', 'person_day', 'done', started=2000.0, duration=31.0)		# keeps inputs
+        rec = ledger.get('a/b/c', 'person_day')
+        assert rec['inputs'] == {'logs': ['x', 1]} and rec['inputs_hash'] == inputs_hash({'logs': ['x', 1]})
+        assert rec['started'] == 2000.0 and rec['duration'] == 31.0
+        assert ledger.get('a/b/c', 'axis2bq') is None
+        assert ledger.courses() == ['a/b/c']
+
+        calls = []
+        def remote_check():
+            calls.append(1)
+            return True
+        orig = dict(LEDGER)
+        LEDGER.clear()
+        LEDGER[os.getpid()] = ledger
+        try:
+            assert output_exists('a/b/c', 'axis2bq', 'course_axis', remote_check)
+            assert output_exists('a/b/c', 'axis2bq', 'course_axis', remote_check)
+            assert len(calls) == 1				# second time, from the ledger
+            assert ledger.get('a/b/c', 'axis2bq')['status'] == 'done'
+            record_step('a/b/c', 'axis2bq', 'done', 3000.0, 2.0)
+            assert list(ledger.get('a/b/c', 'axis2bq')['outputs']) == ['course_axis']
+            ledger.remove_output('a/b/c', 'course_axis')
+            assert ledger.get('a/b/c', 'axis2bq')['outputs'] == {}
+            assert output_exists('a/b/c', 'axis2bq', 'course_axis', remote_check) and len(calls) == 2
+
+            # confirmed too long ago: looked up again, and forgotten if it's gone
+            ledger.add_outputs('a/b/c', 'axis2bq', ['course_axis'], confirmed=time.time() - OUTPUT_MAX_AGE - 60)
+            assert output_exists('a/b/c', 'axis2bq', 'course_axis', remote_check) and len(calls) == 3
+            assert output_exists('a/b/c', 'axis2bq', 'course_axis', remote_check) and len(calls) == 3
+            assert not output_exists('a/b/c', 'axis2bq', 'course_axis', lambda: False, max_age=0)
+            assert ledger.get('a/b/c', 'axis2bq')['outputs'] == {}
+        finally:
+            LEDGER.clear()
+            LEDGER.update(orig)
+
+        sfp = StringIO()
+        assert status_report(ledger, inputs_mtime_fn=lambda course_id: 2500.0, ofp=sfp) == 2
+        out = sfp.getvalue()
+        assert 'a/b/c: 3 steps recorded, 2 stale' in out
+        assert 'STALE person_course' in out and 'failed: oops' in out
+        assert 'STALE person_day' in out and 'STALE axis2bq' not in out
+
+        ledger.delete('a/b/c', 'person_course')
+        assert sorted(ledger.steps('a/b/c')) == ['axis2bq', 'person_day']
+    finally:
+        shutil.rmtree(tmpdir)
@@ -10,21 +10,86 @@
 
 import datetime
 import gzip
-import json
+import multiprocessing as mp
 import os
 import re
 import string
 import sys
+from collections import OrderedDict, deque
 
 import dateutil.parser
 import pytz
 
 import edx2bigquery_config
+import jsoncodec
 from rephrase_tracking_logs import do_rephrase
 
-ofpset = {}
-
 LOGS_DIR = "TRACKING_LOGS"
+SPLIT_BATCH_SIZE = 10000	# number of lines per batch sent to each worker, for parallel split
+MAX_OPEN_OUTPUT_FILES = getattr(edx2bigquery_config, 'MAX_OPEN_OUTPUT_FILES', 256)
+SPLIT_CHECKPOINT_LINES = getattr(edx2bigquery_config, 'SPLIT_CHECKPOINT_LINES', 500000)
+
+#-----------------------------------------------------------------------------
+
+class OutputFilePool(object):
+    '''
+    Pool of open output files, keyed by course output directory name, with at most max_open
+    files open at any one time.  When the limit is reached, the least recently used file is
+    closed; it is re-opened in append mode the next time it is written to.  For gzip files,
+    each re-open starts a new gzip member, so every output file stays a valid (concatenated)
+    gzip stream.
+    '''
+    def __init__(self, max_open=MAX_OPEN_OUTPUT_FILES):
+        self.max_open = max_open
+        self.open_files = OrderedDict()		# ofn -> file object, least recently used first
+        self.filenames = {}			# ofn -> (actual filename, do_zip), for re-opening
+        self.nevicted = 0
+        self.journal = None			# SplitJournal, told about each newly opened output file
+
+    def __contains__(self, ofn):
+        return ofn in self.filenames
+
+    def __getitem__(self, ofn):
+        ofp = self.open_files.pop(ofn, None)
+        if ofp is None:
+            (ofn_actual, do_zip) = self.filenames[ofn]
+            ofp = self._open(ofn_actual, 'a', do_zip)
+        self.open_files[ofn] = ofp		# now the most recently used
+        return ofp
+
+    def open(self, ofn, ofn_actual, mode, do_zip):
+        if self.journal is not None:
+            self.journal.record_open(ofn, ofn_actual)
+        ofp = self._open(ofn_actual, mode, do_zip)
+        self.filenames[ofn] = (ofn_actual, do_zip)
+        self.open_files[ofn] = ofp
+        return ofp
+
+    def _open(self, ofn_actual, mode, do_zip):
+        while self.open_files and len(self.open_files) >= self.max_open:
+            (old_ofn, old_ofp) = self.open_files.popitem(last=False)
+            old_ofp.close()
+            self.nevicted += 1
+        if ofn_actual.endswith('.parquet'):
+            import tracklog_parquet
+            return tracklog_parquet.ParquetTracklogWriter(ofn_actual, mode)
+        if do_zip:
+            return gzip.GzipFile(ofn_actual, mode)
+        return open(ofn_actual, mode)
+
+    def close_files(self):
+        '''
+        Close all open files; they are re-opened in append mode the next time they are written to.
+        '''
+        for ofp in self.open_files.values():
+            ofp.close()
+        self.open_files.clear()
+
+    def close_all(self):
+        self.close_files()
+        self.filenames.clear()
+
+ofpset = OutputFilePool()
 
 #-----------------------------------------------------------------------------
 
@@ -62,17 +127,131 @@ def guess_course_id(data, org="MITx"):
     return ''	# no guess
  
 #-----------------------------------------------------------------------------
+# dates for dynamic_dates: the date string for each tracking log line, from its "time" field.
+#
+# edX times are ISO-8601, like 2015-02-10T05:17:08.011728+00:00, so the date is usually found directly
+# from the string, instead of with dateutil.parser.parse, which is slow.  For a timezone, the local
+# date boundaries are computed once per (date, hour, UTC offset) of the time string, and cached.
+# Any other time format falls back to dateutil, as does an hour which has a timezone (DST) transition.
 
+time_re = re.compile(r'(\d{4}-\d\d-\d\d)T([01]\d|2[0-3]):([0-5]\d):([0-5]\d)(?:\.\d+)?(Z|[+-]\d\d:?\d\d)?$')
 
-def do_split(line, use_local_files, linecnt=0, run_rephrase=True, date=None, do_zip=False, org='MITx', logs_dir=LOGS_DIR,
-             dynamic_dates=False, timezone=None):
+DATESTR_CACHE_SIZE = 10000	# cached (date, hour, UTC offset) entries; a full cache is simply cleared
+_datestr_cache = {}
+
+def dateutil_datestr(the_time, timezone=None):
     '''
-    if dynamic_dates=True, then use the date on each tracking log line for the date string in the filename.
-    
-    if timezone is specified (as a pytz timezone), and if dynamic_dates=True, then use the timezone in parsing dates,
-    instead of the default UTC.
+    Date string (-YYYY-MM-DD) for the_time, using dateutil.
+    '''
+    dt = dateutil.parser.parse(the_time)
+    if timezone:
+        dt = dt.astimezone(timezone)
+    return '-' + dt.strftime('%Y-%m-%d')
+
+def get_datestr(the_time, timezone=None):
+    '''
+    Date string (-YYYY-MM-DD) for the_time, in timezone if given; same as dateutil_datestr.
+    '''
+    m = time_re.match(the_time) if type(the_time) in [str, unicode] else None
+    if m is None:
+        return dateutil_datestr(the_time, timezone)
+
+    (date, hour, minute, second, offset) = m.groups()
+    key = (timezone, date, hour, offset)
+    try:
+        bounds = _datestr_cache[key]
+    except KeyError:
+        bounds = _datestr_bounds(date, hour, offset, timezone)
+        if len(_datestr_cache) >= DATESTR_CACHE_SIZE:
+            _datestr_cache.clear()
+        _datestr_cache[key] = bounds
+
+    if bounds is None:
+        return dateutil_datestr(the_time, timezone)
+    (boundary, datestr_before, datestr_after) = bounds
+    if int(minute) * 60 + int(second) < boundary:
+        return datestr_before
+    return datestr_after
+
+def _datestr_bounds(date, hour, offset, timezone):
+    '''
+    For time strings with the given date, hour, and UTC offset: return (boundary, datestr_before, datestr_after),
+    where boundary is the number of seconds into the hour at which the date (in timezone) changes, or 3600
+    if it does not change.  Return None if the date should be found using dateutil instead.
+    '''
+    try:
+        start = datetime.datetime.strptime(date, '%Y-%m-%d') + datetime.timedelta(hours=int(hour))
+    except ValueError:
+        return None		# eg a date like 2015-02-30
+    if start.year < 1900:
+        return None		# strftime can't format these
+
+    if not timezone:
+        datestr = '-' + str(date)
+        return (3600, datestr, datestr)
+    if offset is None:
+        return None		# naive time, which can't be converted to timezone
+
+    if offset=='Z':
+        utcoffset = datetime.timedelta(0)
+    else:
+        sign = -1 if offset[0]=='-' else 1
+        utcoffset = sign * datetime.timedelta(hours=int(offset[1:3]), minutes=int(offset[-2:]))
+        if abs(utcoffset) >= datetime.timedelta(hours=24):
+            return None
+    start = pytz.utc.localize(start - utcoffset).astimezone(timezone)
+    end = (start + datetime.timedelta(seconds=3599)).astimezone(timezone)
+    if start.utcoffset() != end.utcoffset():
+        return None		# timezone transition during this hour
+
+    naive_start = start.replace(tzinfo=None)
+    next_midnight = datetime.datetime.combine(naive_start.date() + datetime.timedelta(days=1), datetime.time())
+    boundary = (next_midnight - naive_start).total_seconds()
+    if boundary != int(boundary):
+        return None		# UTC offset with seconds
+    boundary = min(3600, int(boundary))
+    return (boundary, '-' + naive_start.strftime('%Y-%m-%d'), '-' + next_midnight.strftime('%Y-%m-%d'))
+
+def benchmark_dates(fn=None, timezone=None, nsynthetic=50000):
+    '''
+    Time get_datestr against dateutil_datestr, on the times from tracking log file fn (or on synthetic
+    times, one per second or so), checking that they give the same date strings.
+    '''
+    import time
+    if fn:
+        fp = gzip.GzipFile(fn) if fn.endswith('.gz') else open(fn)
+        times = []
+        for line in fp:
+            try:
+                times.append(jsoncodec.loads(line)['time'])
+            except Exception as err:
+                continue
+    else:
+        start = datetime.datetime(2015, 2, 10)
+        times = [(start + datetime.timedelta(seconds=k*0.9)).strftime('%Y-%m-%dT%H:%M:%S.%f+00:00') for k in range(nsynthetic)]
+
+    results = {}
+    for func in [dateutil_datestr, get_datestr]:
+        _datestr_cache.clear()
+        t0 = time.time()
+        results[func] = [func(x, timezone) for x in times]
+        dt = time.time() - t0
+        print "%s: %d times in %.2f sec (%.1f usec per time)" % (func.__name__, len(times), dt, dt * 1e6 / max(len(times), 1))
+    assert results[dateutil_datestr]==results[get_datestr]
+    print "same date strings for all %d times (timezone=%s)" % (len(times), timezone)
+
+#-----------------------------------------------------------------------------
+
+
+def split_line(line, use_local_files, linecnt=0, run_rephrase=True, date=None, org='MITx',
+               dynamic_dates=False, timezone=None, output_format='json'):
+    '''
+    Parse and rephrase a single tracking log line, without writing anything.
+
+    Returns (ofn, datestr, output_line), with ofn being the course output directory name, or None if the
+    line is to be skipped.  Used by do_split, and by the worker processes of the parallel split.
+    For output_format='parquet', the rephrased data dict is returned instead of output_line.
     '''
-    
     line = line.strip()
     if not line.startswith('{'):
         # bug workaround for very old logs
@@ -81,18 +260,14 @@ def do_split(line, use_local_files, linecnt=0, run_rephrase=True, date=None, do_
             line = line[26:]
 
     try:
-        data = json.loads(line)
+        data = jsoncodec.loads(line)
     except Exception as err:
         sys.stderr.write('[%d] oops, bad log line err=%s, line=%s\n' % (linecnt, str(err), line))
         return
 
     # determine the date to be used for the filename
     if dynamic_dates:
-        the_time = data['time']	        # "time": "2015-02-10T05:17:08.011728+00:00"
-        dt = dateutil.parser.parse(the_time)
-        if timezone:
-            dt = dt.astimezone(timezone)
-        datestr = '-' + dt.strftime('%Y-%m-%d')
+        datestr = get_datestr(data['time'], timezone)	        # "time": "2015-02-10T05:17:08.011728+00:00"
     else:
         if date is None:
             datestr = ''
@@ -125,6 +300,16 @@ def do_split(line, use_local_files, linecnt=0, run_rephrase=True, date=None, do_
 
     # determine output filename
     ofn = cid.replace('/','__') if not use_local_files else original_course_id
+
+    if output_format=='parquet':
+        return (ofn, datestr, data)
+    return (ofn, datestr, jsoncodec.dumps(data)+'\n')
+
+
+def write_split_output(ofn, datestr, output_line, do_zip=False, logs_dir=LOGS_DIR, dynamic_dates=False, output_format='json'):
+    '''
+    Write one rephrased tracking log line to the output file for course directory ofn.
+    '''
     mode = 'w'
     if dynamic_dates:
         mode = 'a'	# note - append to file!
@@ -135,19 +320,290 @@ def do_split(line, use_local_files, linecnt=0, run_rephrase=True, date=None, do_
         ofp_dir = '%s/%s' % (logs_dir, ofn)
         if not os.path.exists(ofp_dir):
             os.mkdir(ofp_dir)
-        if not do_zip:
+        if output_format=='parquet':
+            ofn_actual = '%s/tracklog%s.parquet' % (ofp_dir, datestr)
+        elif not do_zip:
             ofn_actual = '%s/tracklog%s.json' % (ofp_dir, datestr)
-            ofp = open(ofn_actual, mode)
         else:
             ofn_actual = '%s/tracklog%s.json.gz' % (ofp_dir, datestr)
-            ofp = gzip.GzipFile(ofn_actual, mode)
-        ofpset[ofn] = ofp
+        ofp = ofpset.open(ofn, ofn_actual, mode, do_zip)
+
+    ofp.write(output_line)
+
+
+def do_split(line, use_local_files, linecnt=0, run_rephrase=True, date=None, do_zip=False, org='MITx', logs_dir=LOGS_DIR,
+             dynamic_dates=False, timezone=None, output_format='json'):
+    '''
+    if dynamic_dates=True, then use the date on each tracking log line for the date string in the filename.
+    
+    if timezone is specified (as a pytz timezone), and if dynamic_dates=True, then use the timezone in parsing dates,
+    instead of the default UTC.
+
+    output_format is "json" (newline delimited JSON files) or "parquet" (see tracklog_parquet).
+    '''
+    ret = split_line(line, use_local_files, linecnt=linecnt, run_rephrase=run_rephrase, date=date, org=org,
+                     dynamic_dates=dynamic_dates, timezone=timezone, output_format=output_format)
+    if ret is None:
+        return
+    (ofn, datestr, output_line) = ret
+    write_split_output(ofn, datestr, output_line, do_zip=do_zip, logs_dir=logs_dir, dynamic_dates=dynamic_dates,
+                       output_format=output_format)
+
+#-----------------------------------------------------------------------------
+# parallel split: the input is read (and decompressed) once, in the parent process, and batches of
+# lines are fanned out to a pool of worker processes, which do the JSON parsing, rephrasing, and
+# schema checking.  The workers return the output lines, which the parent writes in input order,
+# so that the per-course output files have exactly the same content as from a serial split.
+
+def split_lines_batch(args):
+    '''
+    Worker function for the parallel split: run split_line on a batch of lines.
+    Returns list of (ofn, datestr, output_line), in input order.
+    '''
+    (lines, linecnt, use_local_files, date, dynamic_dates, timezone, output_format) = args
+    ret = []
+    for line in lines:
+        linecnt += 1
+        try:
+            result = split_line(line, use_local_files, linecnt=linecnt, run_rephrase=True, date=date,
+                                dynamic_dates=dynamic_dates, timezone=timezone, output_format=output_format)
+        except Exception as err:
+            print "[split_and_rephrase] ===> OOPS, failed err=%s in parsing line %s" % (str(err), line)
+            sys.stdout.flush()
+            raise
+        if result is not None:
+            ret.append(result)
+    return ret
+
+def do_split_parallel(fp, workers, use_local_files, date=None, do_zip=True, logs_dir=LOGS_DIR,
+                      dynamic_dates=False, timezone=None, batch_size=SPLIT_BATCH_SIZE, write_output=None,
+                      journal=None, offset=0, linecnt=0, output_format='json'):
+    '''
+    Split all the lines from the file object fp, using a pool of worker processes.
+
+    At most 2*workers batches are in flight at any time, so memory use stays bounded
+    regardless of the input file size.  Returns the number of lines processed.
+
+    write_output(ofn, datestr, output_line) is called for each output line, in input order;
+    it defaults to writing the per-course files in logs_dir.
+
+    If journal (a SplitJournal) is given, checkpoints are made as batches are written;
+    offset and linecnt give the input position of fp at the start (when resuming).
+    '''
+    if write_output is None:
+        def write_output(ofn, datestr, output_line):
+            write_split_output(ofn, datestr, output_line, do_zip=do_zip, logs_dir=logs_dir, dynamic_dates=dynamic_dates,
+                               output_format=output_format)
+
+    pool = mp.Pool(processes=workers)
+    pending = deque()		# (AsyncResult, line count and input offset at end of batch)
+    cnt = linecnt
+    nbytes = offset
+
+    def write_results(results):
+        for (ofn, datestr, output_line) in results:
+            write_output(ofn, datestr, output_line)
+        sys.stdout.write('.')
+        sys.stdout.flush()
+
+    def submit(lines):
+        result = pool.apply_async(split_lines_batch, ((lines, cnt, use_local_files, date, dynamic_dates, timezone, output_format),))
+        pending.append((result, cnt + len(lines), nbytes + sum(len(x) for x in lines)))
+
+    def write_next():
+        (result, batch_cnt, batch_nbytes) = pending.popleft()
+        write_results(result.get())
+        if journal is not None:
+            journal.maybe_checkpoint(batch_nbytes, batch_cnt)
+
+    try:
+        lines = []
+        for line in fp:
+            lines.append(line)
+            if len(lines) < batch_size:
+                continue
+            submit(lines)
+            (cnt, nbytes) = pending[-1][1:]
+            lines = []
+            if len(pending) >= 2*workers:
+                write_next()
+        if lines:
+            submit(lines)
+            (cnt, nbytes) = pending[-1][1:]
+        while pending:
+            write_next()
+    except:
+        pool.terminate()
+        raise
+
+    pool.close()
+    pool.join()
+    return cnt - linecnt
+
+#-----------------------------------------------------------------------------
 
-    ofp.write(json.dumps(data)+'\n')
+def get_tracking_log_date(fn):
+    '''
+    Return the date (YYYY-MM-DD) of tracking log file fn, from its filename, using TRACKING_LOG_REGEX_DATE_PATTERN,
+    or None if the filename has no date.
+    '''
+    date_pattern = getattr(edx2bigquery_config, 'TRACKING_LOG_REGEX_DATE_PATTERN', '')
+    date_match = re.search(date_pattern, fn)
+    return date_match.group(1) if date_match else None
 
 #-----------------------------------------------------------------------------
+# checkpointed split: progress journal, for resuming an interrupted split
+
+class SplitJournal(object):
+    '''
+    Progress journal for the split of one tracking log file, kept in the META directory while the
+    split is in progress, so that an interrupted split can be resumed from its last checkpoint,
+    without losing or duplicating events.  One JSON record per line:
+
+      {"type": "start", "input": fn, "size": input file size, "mtime": input file mtime, "dynamic_dates": ...}
+      {"type": "open", "ofn": ofn, "path": output file, "size": its size before being opened (-1 if it did not exist)}
+      {"type": "ckpt", "offset": bytes of (uncompressed) input done, "linecnt": lines done, "files": {ofn: [path, size]}}
+
+    Sizes are in bytes, except for parquet files, which are only written when closed: their size is the number of rows.
+
+    At a checkpoint, all output files are closed first (completing their gzip members), so the output
+    file sizes recorded match the input offset.  An "open" record is written before its file is opened,
+    since opening may truncate the file (or, with dynamic dates, append to an existing file).
+
+    On resume, each output file is truncated back to its size at the last checkpoint; files first opened
+    after the checkpoint are restored to their size before opening (or removed), and the split continues
+    from the checkpoint's input offset.
+    '''
+    def __init__(self, jfn, fn, dynamic_dates=False, checkpoint_lines=None):
+        self.jfn = jfn
+        self.fn = fn
+        self.dynamic_dates = dynamic_dates
+        self.checkpoint_lines = checkpoint_lines or SPLIT_CHECKPOINT_LINES
+        self.ckpt_linecnt = 0
+        self.pool = None
+        self.jfp = None
+
+    def input_signature(self):
+        stat = os.stat(self.fn)
+        return {'type': 'start', 'input': self.fn, 'size': stat.st_size, 'mtime': int(stat.st_mtime),
+                'dynamic_dates': self.dynamic_dates}
+
+    def read_records(self):
+        records = []
+        if not os.path.exists(self.jfn):
+            return records
+        for line in open(self.jfn):
+            try:
+                records.append(jsoncodec.loads(line))
+            except Exception as err:
+                break		# last record incomplete (interrupted while it was being written)
+        return records
+
+    def resume(self, pool):
+        '''
+        Roll the output files back to the last checkpoint, if there is a journal from an interrupted split
+        of the same input file, and start journalling the opening of files in pool.
+        Returns (input offset, line count) at which to resume; (0, 0) means start from the beginning.
+        '''
+        records = self.read_records()
+        start = self.input_signature()
+        ckpt = None
+        if records and records[0]==start:
+            ckpts = [x for x in records if x['type']=='ckpt']
+            if ckpts:
+                ckpt = ckpts[-1]
+        elif records:
+            print "[split_and_rephrase] input %s changed since the journal %s was written; starting over" % (self.fn, self.jfn)
+
+        # roll back output files
+        ckpt_files = ckpt['files'] if ckpt else {}
+        restored = set()
+        for rec in records:
+            if rec['type']!='open' or rec['path'] in restored:
+                continue
+            restored.add(rec['path'])	# first open record has the size before the split started
+            if rec['ofn'] in ckpt_files and ckpt_files[rec['ofn']][0]==rec['path']:
+                continue
+            truncate_file(rec['path'], rec['size'])
+        for ofn, (path, size) in ckpt_files.items():
+            truncate_file(path, size)
+            pool.filenames[ofn] = (path, path.endswith('.gz'))	# so later writes append to it
+
+        self.jfp = open(self.jfn, 'a' if ckpt else 'w')
+        if not ckpt:
+            self.write_record(start)
+        self.pool = pool
+        pool.journal = self
+        if not ckpt:
+            return (0, 0)
+        self.ckpt_linecnt = ckpt['linecnt']
+        return (ckpt['offset'], ckpt['linecnt'])
+
+    def write_record(self, rec, sync=False):
+        self.jfp.write(jsoncodec.dumps(rec) + '\n')
+        self.jfp.flush()
+        if sync:
+            os.fsync(self.jfp.fileno())
+
+    def record_open(self, ofn, path):
+        size = output_file_size(path) if os.path.exists(path) else -1
+        self.write_record({'type': 'open', 'ofn': ofn, 'path': path, 'size': size})
+
+    def maybe_checkpoint(self, offset, linecnt):
+        if linecnt - self.ckpt_linecnt >= self.checkpoint_lines:
+            self.checkpoint(offset, linecnt)
+
+    def checkpoint(self, offset, linecnt):
+        self.pool.close_files()
+        files = dict((ofn, [path, output_file_size(path)]) for ofn, (path, do_zip) in self.pool.filenames.items())
+        self.write_record({'type': 'ckpt', 'offset': offset, 'linecnt': linecnt, 'files': files}, sync=True)
+        self.ckpt_linecnt = linecnt
+
+    def finish(self):
+        '''
+        Split completed: the journal is no longer needed.
+        '''
+        self.pool.journal = None
+        self.jfp.close()
+        os.unlink(self.jfn)
+
+def output_file_size(path):
+    if path.endswith('.parquet'):
+        import tracklog_parquet
+        return tracklog_parquet.num_rows(path)
+    return os.path.getsize(path)
+
+def truncate_file(path, size):
+    '''
+    Truncate file to size bytes (rows, for parquet files); size=-1 means the file should not exist.
+    '''
+    if size < 0 and path.endswith('.parquet'):
+        import tracklog_parquet
+        tracklog_parquet.remove_tracklog(path)		# and its part files
+    elif size < 0:
+        if os.path.exists(path):
+            os.unlink(path)
+    elif path.endswith('.parquet'):
+        if os.path.exists(path):
+            import tracklog_parquet
+            tracklog_parquet.truncate_tracklog(path, size)
+    elif os.path.exists(path) and os.path.getsize(path) > size:
+        with open(path, 'r+b') as fp:
+            fp.truncate(size)
+
+def do_file(fn, use_local_files, logs_dir=LOGS_DIR, dynamic_dates=False, timezone=None, logfn_keepdir=False, workers=None,
+            output_format='json'):
+    '''
+    Split and rephrase tracking log file fn, into per-course tracklog files in logs_dir.
 
-def do_file(fn, use_local_files, logs_dir=LOGS_DIR, dynamic_dates=False, timezone=None, logfn_keepdir=False):
+    If workers > 1, then the parsing and rephrasing of lines is done in parallel, using that many
+    worker processes; the output is the same as for the serial split.
+
+    Progress is checkpointed every SPLIT_CHECKPOINT_LINES lines, in a journal in logs_dir/META;
+    if the split of fn is interrupted, the next do_file for fn resumes from the last checkpoint.
+
+    With output_format='parquet', the per-course files are tracklog-YYYY-MM-DD.parquet (see tracklog_parquet).
+    '''
     if fn.endswith('.gz'):
         fp = gzip.GzipFile(fn)
         if logfn_keepdir:
@@ -172,44 +628,181 @@ def do_file(fn, use_local_files, logs_dir=LOGS_DIR, dynamic_dates=False, timezon
     print "Processing %s -> %s (%s)" % (fn, ofn, datetime.datetime.now())
     sys.stdout.flush()
 
-    date_pattern = getattr(edx2bigquery_config, 'TRACKING_LOG_REGEX_DATE_PATTERN', '')
-    date_match = re.search(date_pattern, fn)
-
-    the_date = date_match.group(1) if date_match else None
-
-    cnt = 0
-    for line in fp:
-        cnt += 1
-        try:
-            newline = do_split(line, use_local_files, linecnt=cnt, run_rephrase=True, date=the_date, do_zip=True, logs_dir=logs_dir,
-                               dynamic_dates=dynamic_dates, timezone=timezone)
-        except Exception as err:
-            print "[split_and_rephrase] ===> OOPS, failed err=%s in parsing line %s" % (str(err), line)
-            raise
-        if ((cnt % 10000)==0):
-            sys.stdout.write('.')
-            sys.stdout.flush()
-    print
+    the_date = get_tracking_log_date(fn)
 
     mdir = '%s/META' % logs_dir
     if not os.path.exists(mdir):
         os.mkdir(mdir)
+    journal = SplitJournal('%s/%s.journal' % (mdir, os.path.basename(ofn)), fn, dynamic_dates=dynamic_dates)
+    (offset, cnt) = journal.resume(ofpset)
+    if cnt:
+        print "Resuming from checkpoint at line %d (input offset %d), journal %s" % (cnt, offset, journal.jfn)
+        sys.stdout.flush()
+        fp.seek(offset)
+
+    if workers and workers > 1:
+        print "Using %d worker processes" % workers
+        sys.stdout.flush()
+        do_split_parallel(fp, workers, use_local_files, date=the_date, do_zip=True, logs_dir=logs_dir,
+                          dynamic_dates=dynamic_dates, timezone=timezone, journal=journal, offset=offset, linecnt=cnt,
+                          output_format=output_format)
+    else:
+        for line in fp:
+            cnt += 1
+            try:
+                newline = do_split(line, use_local_files, linecnt=cnt, run_rephrase=True, date=the_date, do_zip=True, logs_dir=logs_dir,
+                                   dynamic_dates=dynamic_dates, timezone=timezone, output_format=output_format)
+            except Exception as err:
+                print "[split_and_rephrase] ===> OOPS, failed err=%s in parsing line %s" % (str(err), line)
+                raise
+            offset += len(line)
+            journal.maybe_checkpoint(offset, cnt)
+            if ((cnt % 10000)==0):
+                sys.stdout.write('.')
+                sys.stdout.flush()
+    print
+
     open(ofn, 'a').write(' ') 	    # mark META
 
     # close all file pointers
-    for fn, fp in ofpset.items():
-        fp.close()
-        ofpset.pop(fn)
+    if ofpset.nevicted:
+        print "(re-opened output files %d times, to keep at most %d open)" % (ofpset.nevicted, ofpset.max_open)
+        ofpset.nevicted = 0
+    ofpset.close_all()
+    journal.finish()
 
     print "...done (%s)" % datetime.datetime.now()
     
     sys.stdout.flush()
 
+#-----------------------------------------------------------------------------
+# unit tests, using py.test
+
+def run_split_in_child(fn, logs_dir, dynamic_dates=False, workers=None, kill_at=None):
+    '''
+    Run do_file in a child process, with a checkpoint every 25 lines; the child kills itself
+    (SIGKILL) when it gets to line kill_at.  Returns the child's exit code.
+    '''
+    import signal
+    def child():
+        global split_line, SPLIT_CHECKPOINT_LINES
+        SPLIT_CHECKPOINT_LINES = 25
+        if kill_at:
+            real_split_line = split_line
+            def crashing_split_line(line, *args, **kwargs):
+                if kwargs.get('linecnt')==kill_at:
+                    os.kill(os.getpid(), signal.SIGKILL)
+                return real_split_line(line, *args, **kwargs)
+            split_line = crashing_split_line
+        sys.stdout = open(os.devnull, 'w')
+        sys.stderr = sys.stdout
+        os.chdir(os.path.dirname(logs_dir))	# do_file marks completion in the current directory
+        do_file(fn, False, logs_dir=logs_dir, dynamic_dates=dynamic_dates, workers=workers)
+    proc = mp.Process(target=child)
+    proc.start()
+    proc.join()
+    return proc.exitcode
+
+def read_split_output(logs_dir):
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(logs_dir):
+        if os.path.basename(dirpath)=='META':
+            continue
+        for fn in filenames:
+            files[os.path.join(os.path.relpath(dirpath, logs_dir), fn)] = gzip.GzipFile(os.path.join(dirpath, fn)).read()
+    return files
+
+DATESTR_TEST_TIMES = ['2015-02-10T05:17:08.011728+00:00', '2015-02-10T23:59:59.999999+00:00', '2015-02-10T05:17:08Z',
+                      '2015-02-10T05:17:08+0530', '2015-02-10T05:17:08', '2015-02-10 05:17:08+00:00', '2015-02-10T23:59:60Z',
+                      '2015-02-30T01:00:00Z', '2015-02-10T24:00:00Z', '0999-01-01T00:00:00Z', '2015-02-10T05:17+00:00',
+                      '2015-02-10T05:17:08+25:00', u'2015-02-10T05:17:08.123-07:00', 'not a time', None]
+
+def test_get_datestr():
+    timezones = [None] + [pytz.timezone(x) for x in ['UTC', 'America/New_York', 'Asia/Kolkata', 'Australia/Lord_Howe',
+                                                     'America/Sao_Paulo']]
+    times = list(DATESTR_TEST_TIMES)
+    for start in [datetime.datetime(2015, 2, 21), datetime.datetime(2015, 10, 3)]:	# days with DST transitions
+        for k in range(400):
+            t = start + datetime.timedelta(seconds=k*113*60 + k % 60)
+            times += [t.strftime('%Y-%m-%dT%H:%M:%S.%f') + x for x in ['+00:00', '-05:00', '+05:30']]
+
+    def result(func, the_time, timezone):
+        try:
+            return func(the_time, timezone)
+        except Exception as err:
+            return type(err)
+
+    _datestr_cache.clear()
+    for timezone in timezones:
+        for the_time in times:
+            expected = result(dateutil_datestr, the_time, timezone)
+            got = result(get_datestr, the_time, timezone)
+            assert (got, type(got)) == (expected, type(expected)), (the_time, timezone)
+    assert _datestr_cache
+
+def test_resume_after_kill():
+    import json
+    import random
+    import shutil
+    import tempfile
+    global get_tracking_log_date
+    tmpdir = tempfile.mkdtemp()
+    orig_get_date = get_tracking_log_date
+    get_tracking_log_date = lambda fn: '2015-02-10'
+    try:
+        rnd = random.Random(7)
+        fn = os.path.join(tmpdir, 'tracking.log-20150210.gz')
+        fp = gzip.GzipFile(fn, 'w')
+        for k in range(200):
+            if k % 50 == 17:
+                fp.write('not a json line\n')
+                continue
+            data = {'time': '2015-02-%02dT%02d:%02d:00+00:00' % (10 + k // 120, k % 24, k % 60),
+                    'event_type': rnd.choice(['play_video', 'seq_goto', 'problem_check']), 'event_source': 'browser',
+                    'context': {'course_id': ['MITx/8.01x/2013_SOND', 'course-v1:HarvardX+PH207x+1T2016',
+                                              'MITx/6.00x/2013_Spring'][k % 3]},
+                    'event': {'id': 'i4x-MITx-8_01x-video-v%d' % k}, 'n': k,
+                    'pad': '%x' % rnd.getrandbits(64000)}	# incompressible, so output reaches the files before a kill
+            fp.write(json.dumps(data) + '\n')
+        fp.close()
+
+        for dynamic_dates in [False, True]:
+            results = []
+            for case in ['reference', 'killed']:
+                logs_dir = os.path.join(tmpdir, '%s-%s' % (case, dynamic_dates))
+                os.makedirs(os.path.join(logs_dir, 'MITx__8.01x__2013_SOND'))
+                ofp = gzip.GzipFile(os.path.join(logs_dir, 'MITx__8.01x__2013_SOND', 'tracklog-2015-02-10.json.gz'), 'w')
+                ofp.write('{"earlier": "output"}\n')	# appended to with dynamic dates, else overwritten
+                ofp.close()
+                if case=='killed':
+                    # one kill before the first checkpoint, then at random lines
+                    for kill_at in [20] + sorted(rnd.sample(range(26, 201), 4)):
+                        assert run_split_in_child(fn, logs_dir, dynamic_dates, kill_at=kill_at) == -9
+                        assert [x for x in os.listdir(os.path.join(logs_dir, 'META')) if x.endswith('.journal')]
+                    workers = 2 if dynamic_dates else None
+                else:
+                    workers = None
+                assert run_split_in_child(fn, logs_dir, dynamic_dates, workers=workers) == 0
+                assert not [x for x in os.listdir(os.path.join(logs_dir, 'META')) if x.endswith('.journal')]
+                results.append(read_split_output(logs_dir))
+            assert results[0] == results[1]
+            assert len(results[0]) == 3
+            lines = sum([x.splitlines() for x in results[0].values()], [])
+            assert len(lines) == 196 + (1 if dynamic_dates else 0)
+    finally:
+        get_tracking_log_date = orig_get_date
+        shutil.rmtree(tmpdir)
+
 #-----------------------------------------------------------------------------
 
 if __name__=="__main__":
 
-    if len(sys.argv)>1:
+    if len(sys.argv)>1 and sys.argv[1]=="--benchmark-dates":
+        # usage: split_and_rephrase.py --benchmark-dates [tracking_log_file [timezone]]
+        args = sys.argv[2:]
+        benchmark_dates(args[0] if args else None, pytz.timezone(args[1]) if len(args)>1 else None)
+
+    elif len(sys.argv)>1:
         # arguments are filenames; process each file
 
         if sys.argv[1]=="--logsdir":
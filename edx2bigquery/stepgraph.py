@@ -0,0 +1,244 @@
+#!/usr/bin/python
+#
+# File:   stepgraph.py
+#
+# Dependency graph of processing steps (eg the doall and nightly steps of each
+# course), run with independent steps concurrently.
+#
+# Each step declares the tables it reads (inputs) and writes (outputs), and
+# belongs to a group (its course).  Dependencies follow from the order in
+# which the steps of a group are added, as for the sequence of calls they
+# replace: a step runs after each earlier step of its group which
+#
+#     - writes a table it reads,
+#     - writes a table it writes, or
+#     - reads a table it writes,
+#
+# so that every step sees the same tables as when the steps are run one after
+# another.  Steps of different groups are independent.
+#
+# A step which fails cancels the steps of its group which have not yet
+# started, unless it is optional, in which case its dependents run anyway
+# (like a failed analyze_forum, in doall).
+#
+# After a run, report() gives, for each group, its wall-clock time, the total
+# time of its steps, and its critical path: the chain of dependent steps with
+# the longest total time, which bounds how fast the group can be done.
+
+import Queue
+import sys
+import time
+import traceback
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+#-----------------------------------------------------------------------------
+
+class Step(object):
+    '''
+    Step name of group, running fn(); state is pending, running, done, failed, or skipped.
+    '''
+    def __init__(self, name, fn, inputs=(), outputs=(), group=None, optional=False):
+        self.name = name
+        self.fn = fn
+        self.inputs = set(inputs)
+        self.outputs = set(outputs)
+        self.group = group
+        self.optional = optional
+        self.deps = []
+        self.state = 'pending'
+        self.start = None
+        self.end = None
+        self.error = None
+
+    @property
+    def key(self):
+        return (self.group, self.name)
+
+    @property
+    def duration(self):
+        if self.start is None or self.end is None:
+            return 0
+        return self.end - self.start
+
+    def depends_on(self, other):
+        '''
+        True if self, added after other (of the same group), must run after it.
+        '''
+        return bool((other.outputs & (self.inputs | self.outputs)) or (other.inputs & self.outputs))
+
+    def __repr__(self):
+        return '<Step %s of %s: %s>' % (self.name, self.group, self.state)
+
+class StepGraph(object):
+    '''
+    Steps, in the order added, with their dependencies; run them with run(), concurrently in up to
+    workers threads.
+    '''
+    def __init__(self, clock=time.time, verbose=True):
+        self.steps = OrderedDict()		# key (group, name) -> Step
+        self.clock = clock
+        self.verbose = verbose
+
+    def add(self, name, fn, inputs=(), outputs=(), group=None, optional=False):
+        step = Step(name, fn, inputs, outputs, group=group, optional=optional)
+        if step.key in self.steps:
+            raise Exception("[stepgraph] duplicate step %s for %s" % (name, group))
+        step.deps = [x for x in self.steps.values() if x.group==group and step.depends_on(x)]
+        self.steps[step.key] = step
+        return step
+
+    def groups(self):
+        return list(OrderedDict((x.group, 1) for x in self.steps.values()))
+
+    def log(self, msg):
+        if self.verbose:
+            sys.__stdout__.write("[stepgraph] %s\n" % msg)
+            sys.__stdout__.flush()
+
+    def run_step(self, step, done):
+        try:
+            step.fn()
+            step.state = 'done'
+        except Exception as err:
+            step.error = str(err)
+            step.state = 'failed'
+            traceback.print_exc()
+        step.end = self.clock()
+        done.put(step)
+
+    def ready(self, step):
+        '''
+        True if step can be started, False if it must wait; skips the step (returning False) if a
+        dependency was skipped, or failed without being optional.
+        '''
+        for dep in step.deps:
+            if dep.state in ['pending', 'running']:
+                return False
+            if dep.state == 'skipped' or (dep.state == 'failed' and not dep.optional):
+                step.state = 'skipped'
+                return False
+        return True
+
+    def run(self, workers=4):
+        '''
+        Run all the steps, each as soon as its dependencies are done, in up to workers threads.  Returns
+        True if no non-optional step failed or was skipped.
+        '''
+        pool = ThreadPool(workers)
+        done = Queue.Queue()
+        nrunning = 0
+        try:
+            while True:
+                for step in self.steps.values():	# in order added, so dependencies come first
+                    if step.state == 'pending' and nrunning < workers and self.ready(step):
+                        step.state = 'running'
+                        step.start = self.clock()
+                        self.log("starting %s for %s" % (step.name, step.group))
+                        pool.apply_async(self.run_step, (step, done))
+                        nrunning += 1
+                if not nrunning:
+                    break
+                step = done.get()
+                nrunning -= 1
+                self.log("%s %s for %s, dt=%.1f sec%s" % (step.state, step.name, step.group, step.duration,
+                                                         (", err=%s" % step.error) if step.error else ""))
+                if step.state == 'failed' and not step.optional:
+                    for other in self.steps.values():
+                        if other.group == step.group and other.state == 'pending':
+                            other.state = 'skipped'
+        finally:
+            pool.close()
+        return not [x for x in self.steps.values() if x.state in ['failed', 'skipped'] and not x.optional]
+
+    def critical_path(self, group):
+        '''
+        The chain of dependent steps of group with the longest total duration, as a list of Steps.
+        '''
+        best = {}			# key -> (total duration, path) of the longest chain ending at that step
+        for step in self.steps.values():
+            if step.group != group:
+                continue
+            prev = max([best[x.key] for x in step.deps] or [(0, [])], key=lambda x: x[0])
+            best[step.key] = (prev[0] + step.duration, prev[1] + [step])
+        if not best:
+            return []
+        return max(best.values(), key=lambda x: x[0])[1]
+
+    def report(self, ofp=sys.stdout):
+        '''
+        Write, for each group, its wall-clock time, serial time (total of its steps), and critical path, and
+        any failed or skipped steps.
+        '''
+        for group in self.groups():
+            steps = [x for x in self.steps.values() if x.group == group]
+            ran = [x for x in steps if x.start is not None]
+            wall = (max(x.end for x in ran) - min(x.start for x in ran)) if ran else 0
+            path = self.critical_path(group)
+            ofp.write("[stepgraph] %s: wall %.1f sec, serial %.1f sec, critical path %.1f sec\n" % (
+                group, wall, sum(x.duration for x in steps), sum(x.duration for x in path)))
+            ofp.write("    critical path: %s\n" % ' -> '.join('%s (%.1f)' % (x.name, x.duration) for x in path))
+            for step in steps:
+                if step.state in ['failed', 'skipped']:
+                    ofp.write("    %s %s%s\n" % (step.state, step.name, (": %s" % step.error) if step.error else ""))
+
+#-----------------------------------------------------------------------------
+# unit tests, using py.test
+
+def test_dependencies():
+    graph = StepGraph(verbose=False)
+    noop = lambda: None
+    a = graph.add('logs', noop, outputs=['tracking_logs'], group='c1')
+    b = graph.add('videos', noop, inputs=['tracking_logs', 'person_course'], outputs=['video_stats_day'], group='c1')
+    c = graph.add('pcday', noop, inputs=['tracking_logs', 'video_stats_day'], outputs=['person_course_day'], group='c1')
+    d = graph.add('ip', noop, inputs=['tracking_logs'], outputs=['pcday_ip_counts'], group='c1')
+    e = graph.add('pc', noop, inputs=['person_course_day', 'pcday_ip_counts'], outputs=['person_course'], group='c1')
+    f = graph.add('logs', noop, outputs=['tracking_logs'], group='c2')
+    assert b.deps == [a] and c.deps == [a, b] and d.deps == [a]
+    assert e.deps == [b, c, d]		# b reads the person_course which e replaces
+    assert f.deps == []
+    assert graph.critical_path('c3') == []
+
+def test_run_concurrently():
+    import threading
+    graph = StepGraph(verbose=False)
+    order = []
+    started = threading.Event()
+    def step(name, wait_for=None, fail=False):
+        def fn():
+            if wait_for is not None:
+                assert wait_for.wait(5)		# only returns if 'ip' runs at the same time
+            order.append(name)
+            if name == 'ip':
+                started.set()
+            if fail:
+                raise Exception('%s failed' % name)
+        return fn
+    graph.add('logs', step('logs'), outputs=['logs'], group='c1')
+    graph.add('pcday', step('pcday', wait_for=started), inputs=['logs'], outputs=['pcday'], group='c1')
+    graph.add('ip', step('ip'), inputs=['logs'], outputs=['ip'], group='c1')
+    graph.add('pc', step('pc'), inputs=['pcday', 'ip'], outputs=['pc'], group='c1')
+    graph.add('forum', step('forum', fail=True), outputs=['forum'], group='c2', optional=True)
+    graph.add('pcday', step('pcday2', fail=True), inputs=['forum'], outputs=['pcday'], group='c2')
+    graph.add('pc', step('pc2'), inputs=['pcday'], outputs=['pc'], group='c2')
+    graph.add('grades', step('grades2'), outputs=['grades'], group='c2')
+    assert not graph.run(workers=4)
+
+    assert order.index('logs') < order.index('ip') < order.index('pcday') < order.index('pc')
+    assert 'pcday2' in order				# ran, though the optional forum step failed
+    assert 'pc2' not in order and graph.steps[('c2', 'pc')].state == 'skipped'
+    assert graph.steps[('c2', 'forum')].error == 'forum failed'
+    assert graph.steps[('c1', 'pc')].state == 'done'
+
+    # critical path, from the step times
+    for (name, start, end) in [('logs', 0, 10), ('pcday', 10, 50), ('ip', 10, 20), ('pc', 50, 55)]:
+        graph.steps[('c1', name)].start = start
+        graph.steps[('c1', name)].end = end
+    assert [x.name for x in graph.critical_path('c1')] == ['logs', 'pcday', 'pc']
+    from StringIO import StringIO
+    sfp = StringIO()
+    graph.report(ofp=sfp)
+    out = sfp.getvalue()
+    assert 'c1: wall 55.0 sec, serial 65.0 sec, critical path 55.0 sec' in out
+    assert 'logs (10.0) -> pcday (40.0) -> pc (5.0)' in out
+    assert 'skipped pc\n' in out
@@ -0,0 +1,388 @@
+#!/usr/bin/python
+#
+# File:   stream_tracking_logs.py
+#
+# streaming version of daily_logs: split -> logs2gs -> logs2bq, without the
+# intermediate per-course tracklog files in TRACKING_LOGS.
+#
+# Rephrased tracking log lines are written straight into per-course, per-day
+# gzip buffers, kept in memory.  At most MAX_STREAM_BUFFERS buffers are open,
+# holding at most STREAM_BUFFER_MEMORY bytes in all: beyond that, the least
+# recently used buffers are spilled to temporary files (each spill ending a
+# gzip member, as with OutputFilePool in split_and_rephrase), and re-opened
+# in memory if more lines come for them.  As soon as a buffer is complete, it is uploaded to google storage, at the same
+# path logs2gs would use (<bucket>/<course>/DAILY/tracklog-YYYY-MM-DD.json.gz),
+# and the BigQuery load job for its tracklog_YYYYMMDD table is queued, as
+# logs2bq would do.  Uploads run in background threads, while the next
+# tracking log file is being split.
+#
+# A buffer is complete when the tracking log files for its day have been
+# processed (consecutive files with the same date go into the same buffers).
+# With dynamic dates, where one day's events may come from any of the tracking
+# log files, buffers are completed after all the files have been processed.
+# Since each upload replaces the day's object, and its load replaces the day's
+# table, events of a day from an earlier run would be lost: so daily_logs
+# refuses --stream-logs with --dynamic-dates, unlike the file-based split,
+# which appends to the day's local file.
+#
+# For offline testing, a local directory can stand in for google storage
+# (LocalObjectStore); in that case no BigQuery load jobs are started.
+
+import datetime
+import gzip
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from collections import OrderedDict
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
+
+import edx2bigquery_config
+import gsutil
+import split_and_rephrase
+
+MAX_STREAM_BUFFERS = getattr(edx2bigquery_config, 'MAX_STREAM_BUFFERS', split_and_rephrase.MAX_OPEN_OUTPUT_FILES)
+STREAM_BUFFER_MEMORY = getattr(edx2bigquery_config, 'STREAM_BUFFER_MEMORY', 256 * 1024 * 1024)	# bytes, all buffers
+UPLOAD_THREADS = 4
+
+#-----------------------------------------------------------------------------
+
+class GSObjectStore(object):
+    '''
+    Google cloud storage, written to using gsutil.
+    '''
+    def __init__(self, gsbucket):
+        self.gsbucket = gsbucket
+        self.can_load = True
+
+    def path_for(self, course_dir, fn):
+        return '%s/%s/DAILY/%s' % (self.gsbucket, course_dir, fn)
+
+    def put(self, fp, dst):
+        proc = subprocess.Popen(['gsutil', '-q', 'cp', '-', dst], stdin=subprocess.PIPE)
+        shutil.copyfileobj(fp, proc.stdin)
+        proc.stdin.close()
+        if proc.wait():
+            raise Exception("[stream_tracking_logs] gsutil upload to %s failed, return code %s" % (dst, proc.returncode))
+
+class LocalObjectStore(object):
+    '''
+    Local directory standing in for google storage, with the same layout below it.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        self.can_load = False
+
+    def path_for(self, course_dir, fn):
+        return os.path.join(self.directory, course_dir, 'DAILY', fn)
+
+    def put(self, fp, dst):
+        ddir = os.path.dirname(dst)
+        if not os.path.exists(ddir):
+            os.makedirs(ddir)
+        with open(dst + '.tmp', 'wb') as ofp:
+            shutil.copyfileobj(fp, ofp)
+        os.rename(dst + '.tmp', dst)
+
+#-----------------------------------------------------------------------------
+
+class StreamBuffer(object):
+    '''
+    gzip data for one course and day: in memory while open, and in the temporary file spill_fn once spilled.
+    '''
+    def __init__(self, datestr, spill_fn):
+        self.datestr = datestr
+        self.spill_fn = spill_fn
+        self.spilled = False
+        self.mem = None
+        self.zfp = None
+        self.size = 0			# bytes in memory
+
+    def write(self, line):
+        '''
+        Write line; returns the change in the number of bytes in memory.
+        '''
+        if self.zfp is None:
+            self.mem = StringIO()
+            self.zfp = gzip.GzipFile('tracklog%s.json' % self.datestr, 'wb', fileobj=self.mem)
+        self.zfp.write(line)
+        size = self.mem.tell()
+        delta = size - self.size
+        self.size = size
+        return delta
+
+    def spill(self):
+        '''
+        End the gzip member in memory, and append it to the spill file; returns the bytes freed.
+        '''
+        if self.zfp is None:
+            return 0
+        self.zfp.close()
+        with open(self.spill_fn, 'ab') as ofp:
+            ofp.write(self.mem.getvalue())
+        self.spilled = True
+        (self.zfp, self.mem) = (None, None)
+        (freed, self.size) = (self.size, 0)
+        return freed
+
+    def finish(self):
+        '''
+        End the buffer; returns a file object with its gzip data, positioned at the start.
+        '''
+        if not self.spilled:
+            self.zfp.close()
+            self.mem.seek(0)
+            return self.mem
+        self.spill()
+        return open(self.spill_fn, 'rb')
+
+class StreamingLogWriter(object):
+    '''
+    Collects rephrased tracking log lines into per-course, per-day gzip buffers; flush() uploads
+    the current buffers and queues their BigQuery loads.
+
+    If course_ids is given, only lines for those courses are kept.  At most max_buffers buffers are
+    kept in memory, with at most max_memory bytes in all; least recently used buffers are spilled to disk.
+    '''
+    def __init__(self, store, course_ids=None, load=True, verbose=True, upload_threads=UPLOAD_THREADS,
+                 max_buffers=None, max_memory=None):
+        self.store = store
+        self.load = load and store.can_load
+        self.verbose = verbose
+        if course_ids is None:
+            self.course_dirs = None
+        else:
+            # split un-mangles opaque keys course_id's, eg course-v1:MITx+6.00.2x_3+1T2015 -> MITx/6.00.2x_3/1T2015
+            course_ids = [x.split('course-v1:',1)[1].replace('+','/') if x.startswith('course-v1:') else x for x in course_ids]
+            self.course_dirs = set(gsutil.path_from_course_id(x) for x in course_ids)
+        self.buffers = {}		# (course_dir, datestr) -> StreamBuffer
+        self.in_memory = OrderedDict()	# keys of the buffers in memory, least recently used first
+        self.max_buffers = max_buffers or MAX_STREAM_BUFFERS
+        self.max_memory = max_memory or STREAM_BUFFER_MEMORY
+        self.memory = 0			# bytes in memory, in all buffers
+        self.spill_dir = None
+        self.nspilled = 0
+        self.pool = ThreadPool(upload_threads)
+        self.pending = []		# (course_dir, datestr, dst, AsyncResult), for uploads in progress
+        self.datasets = set()
+        self.nlines = 0
+        self.nskipped = 0
+        self.nuploaded = 0
+        self.nloads = 0
+
+    def write(self, ofn, datestr, output_line):
+        key = (ofn, datestr)
+        buf = self.buffers.get(key)
+        if buf is None:
+            if self.course_dirs is not None and ofn not in self.course_dirs:
+                self.nskipped += 1
+                return
+            if self.spill_dir is None:
+                self.spill_dir = tempfile.mkdtemp(prefix='stream_tracking_logs')
+            buf = StreamBuffer(datestr, os.path.join(self.spill_dir, '%d.json.gz' % len(self.buffers)))
+            self.buffers[key] = buf
+        if key in self.in_memory:
+            del self.in_memory[key]
+        self.in_memory[key] = True		# now the most recently used
+        self.memory += buf.write(output_line)
+        self.nlines += 1
+        while self.in_memory and (len(self.in_memory) > self.max_buffers or self.memory > self.max_memory):
+            (old_key, dummy) = self.in_memory.popitem(last=False)
+            self.memory -= self.buffers[old_key].spill()
+            self.nspilled += 1
+
+    def flush(self):
+        '''
+        Finish all current buffers, and start uploading them.
+        '''
+        for (ofn, datestr), buf in sorted(self.buffers.items()):
+            fp = buf.finish()
+            dst = self.store.path_for(ofn, 'tracklog%s.json.gz' % datestr)
+            self.pending.append((ofn, datestr, dst, self.pool.apply_async(self.upload, (fp, dst, buf))))
+        self.buffers = {}
+        self.in_memory.clear()
+        self.memory = 0
+        self.start_loads()
+
+    def upload(self, fp, dst, buf):
+        try:
+            self.store.put(fp, dst)
+        finally:
+            fp.close()
+            if buf.spilled:
+                os.remove(buf.spill_fn)
+
+    def start_loads(self, wait=False):
+        '''
+        Queue BigQuery load jobs for the uploads which have finished (or, with wait=True, for all of them).
+        Load jobs are started from this (the main) thread only.
+        '''
+        still_pending = []
+        for (ofn, datestr, dst, result) in self.pending:
+            if not (wait or result.ready()):
+                still_pending.append((ofn, datestr, dst, result))
+                continue
+            result.get()		# raises if the upload failed
+            self.nuploaded += 1
+            if self.verbose:
+                print "[stream_tracking_logs] uploaded %s" % dst
+                sys.stdout.flush()
+            if self.load:
+                self.load_table(ofn, datestr, dst)
+        self.pending = still_pending
+
+    def load_table(self, ofn, datestr, gsfn):
+        import bqutil
+        import load_daily_tracking_logs
+        if not datestr:
+            print "[stream_tracking_logs] no date for %s, not loading it into BigQuery" % gsfn
+            return
+        dataset = bqutil.course_id2dataset(ofn, dtype="logs")
+        if dataset not in self.datasets:
+            bqutil.create_dataset_if_nonexistent(dataset)
+            self.datasets.add(dataset)
+        tablename = "tracklog_%s" % datestr[1:].replace('-','')	# YYYYMMDD for compatibility with table wildcards
+        schema = load_daily_tracking_logs.get_tracking_log_schema()
+        bqutil.load_data_to_table(dataset, tablename, gsfn, schema, wait=False, maxbad=1000)
+        self.nloads += 1
+
+    def close(self):
+        '''
+        Wait for all uploads to finish, and queue the remaining load jobs.
+        '''
+        try:
+            self.start_loads(wait=True)
+        finally:
+            self.pool.close()
+            self.pool.join()
+            if self.spill_dir is not None:
+                shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+#-----------------------------------------------------------------------------
+
+def stream_file(fn, writer, dynamic_dates=False, timezone=None, workers=None):
+    '''
+    Split and rephrase tracking log file fn, sending the output lines to writer.
+    '''
+    if fn.endswith('.gz'):
+        fp = gzip.GzipFile(fn)
+    else:
+        fp = open(fn)
+
+    print "Streaming %s (%s)" % (fn, datetime.datetime.now())
+    sys.stdout.flush()
+
+    the_date = split_and_rephrase.get_tracking_log_date(fn)
+
+    if workers and workers > 1:
+        split_and_rephrase.do_split_parallel(fp, workers, False, date=the_date, dynamic_dates=dynamic_dates,
+                                             timezone=timezone, write_output=writer.write)
+    else:
+        cnt = 0
+        for line in fp:
+            cnt += 1
+            try:
+                ret = split_and_rephrase.split_line(line, False, linecnt=cnt, date=the_date,
+                                                    dynamic_dates=dynamic_dates, timezone=timezone)
+            except Exception as err:
+                print "[stream_tracking_logs] ===> OOPS, failed err=%s in parsing line %s" % (str(err), line)
+                raise
+            if ret is not None:
+                writer.write(*ret)
+            if ((cnt % 10000)==0):
+                sys.stdout.write('.')
+                sys.stdout.flush()
+    print
+    fp.close()
+
+def stream_files(fnset, store, course_ids=None, dynamic_dates=False, timezone=None, workers=None, load=True, verbose=True,
+                 max_buffers=None, max_memory=None):
+    '''
+    Split and rephrase each of the tracking log files in fnset, uploading the per-course daily
+    tracking logs to store, and queueing the BigQuery load jobs for them (if the store is google storage
+    and load=True).  Returns the StreamingLogWriter, for its counts.
+    '''
+    writer = StreamingLogWriter(store, course_ids=course_ids, load=load, verbose=verbose, max_buffers=max_buffers,
+                                max_memory=max_memory)
+    fnset = list(fnset)
+    dates = [split_and_rephrase.get_tracking_log_date(fn) for fn in fnset]
+    try:
+        for k, fn in enumerate(fnset):
+            stream_file(fn, writer, dynamic_dates=dynamic_dates, timezone=timezone, workers=workers)
+            if not dynamic_dates and dates[k:k+2]!=[dates[k]]*2:	# next file (if any) is for another day
+                writer.flush()
+        writer.flush()
+    finally:
+        writer.close()
+
+    print "[stream_tracking_logs] %d lines, %d skipped (other courses), %d files uploaded, %d load jobs queued, %d buffer spills (%s)" % (
+        writer.nlines, writer.nskipped, writer.nuploaded, writer.nloads, writer.nspilled, datetime.datetime.now())
+    sys.stdout.flush()
+    return writer
+
+#-----------------------------------------------------------------------------
+# unit tests, using py.test
+
+def test_stream_files_local_store():
+    import json
+    tmpdir = tempfile.mkdtemp()
+    try:
+        lines = [{'time': '2015-02-10T16:20:01.123456+00:00', 'event_type': 'play_video', 'event_source': 'browser',
+                  'context': {'course_id': 'MITx/8.01x/2013_SOND'}, 'event': {'id': 'i4x-MITx-8_01x-video-abc'}},
+                 {'time': '2015-02-10T16:21:00+00:00', 'event_type': 'page_close', 'event_source': 'browser', 'page': '',
+                  'context': {'course_id': 'course-v1:HarvardX+PH207x+1T2016'}, 'event': ''},
+                 {'time': '2015-02-10T16:22:00+00:00', 'event_type': 'seq_goto', 'event_source': 'browser',
+                  'context': {'course_id': 'MITx/8.01x/2013_SOND'}, 'event': {'new': 2}},
+                 ]
+        fn = os.path.join(tmpdir, 'edx-events-2015-02-10.log.gz')
+        fp = gzip.GzipFile(fn, 'w')
+        for data in lines:
+            fp.write(json.dumps(data) + '\n')
+        fp.write('not a json line\n')
+        fp.close()
+
+        store = LocalObjectStore(os.path.join(tmpdir, 'gs'))
+        orig_get_date = split_and_rephrase.get_tracking_log_date
+        split_and_rephrase.get_tracking_log_date = lambda fn: '2015-02-10'
+        try:
+            writer = stream_files([fn], store, course_ids=['MITx/8.01x/2013_SOND'], verbose=False)
+        finally:
+            split_and_rephrase.get_tracking_log_date = orig_get_date
+
+        assert (writer.nlines, writer.nskipped, writer.nuploaded, writer.nloads) == (2, 1, 1, 0)
+        ofn = store.path_for('MITx__8.01x__2013_SOND', 'tracklog-2015-02-10.json.gz')
+        out = [json.loads(x) for x in gzip.GzipFile(ofn)]
+        assert [x['event_type'] for x in out] == ['play_video', 'seq_goto']
+        assert out[0]['module_id'] == 'MITx/8_01x/video/abc'
+        assert not os.path.exists(store.path_for('HarvardX__PH207x__1T2016', 'tracklog-2015-02-10.json.gz'))
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_spill_buffers():
+    import json
+    tmpdir = tempfile.mkdtemp()
+    try:
+        store = LocalObjectStore(tmpdir)
+        writer = StreamingLogWriter(store, verbose=False, max_buffers=2, max_memory=10**9)
+        expected = {}
+        for k in range(300):
+            key = ('course%d' % (k % 3), '-2015-02-%02d' % (10 + k % 2))
+            line = json.dumps({'k': k}) + '\n'
+            writer.write(key[0], key[1], line)
+            expected.setdefault(key, []).append(line)
+            assert len(writer.in_memory) <= 2
+        assert writer.nspilled > 100 and len(writer.buffers) == 6
+        writer.flush()
+        writer.close()
+        assert not os.path.exists(writer.spill_dir)
+        for ((ofn, datestr), lines) in expected.items():
+            assert list(gzip.GzipFile(store.path_for(ofn, 'tracklog%s.json.gz' % datestr))) == lines
+
+        writer = StreamingLogWriter(store, verbose=False, max_buffers=100, max_memory=1)	# every write spills
+        writer.write('course0', '-2015-02-10', 'x\n')
+        assert writer.memory == 0 and writer.nspilled == 1
+        writer.close()
+    finally:
+        shutil.rmtree(tmpdir)
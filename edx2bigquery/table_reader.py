@@ -22,11 +22,9 @@ import sys
 import threading
 import time
 
-# Imports from the Google API client:
-from apiclient.errors import HttpError
-
 # Imports from files in this directory:
-import auth
+import bqutil
+import retry
 
 READ_CHUNK_SIZE= 64 * 1024
 
@@ -44,7 +42,7 @@ class TableReader:
       start_index=None, read_count=None, next_page_token=None):
     self.project_id = project_id
     self.dataset_id = dataset_id
-    self.bq_service = auth.build_bq_client()
+    self.bq_service = bqutil.get_service()['service']
     self.next_page_token = next_page_token
     self.next_index = start_index
     self.rows_left = read_count
@@ -53,10 +51,10 @@ class TableReader:
   def get_table_info(self):
     '''Returns a tuple of (modified time, row count) for the table.'''
 
-    table = self.bq_service.tables().get(
+    table = retry.execute(self.bq_service.tables().get(
         projectId=self.project_id,
         datasetId=self.dataset_id,
-        tableId=self.table_id).execute()
+        tableId=self.table_id))
     last_modified = int(table.get('lastModifiedTime', 0))
     row_count = int(table.get('numRows', 0))
     print '%s last modified at %d' % (
@@ -102,33 +100,23 @@ class TableReader:
     return read_msg
 
   def read_one_page(self, max_results=READ_CHUNK_SIZE):
-    '''Reads one page from the table.'''
+    '''Reads one page from the table, retrying rate limit and server errors.'''
 
-    while True:
-      try:
-        if self.rows_left is not None and self.rows_left < max_results:
-          max_results = self.rows_left
-
-        data = self.bq_service.tabledata().list(
-            projectId=self.project_id,
-            datasetId=self.dataset_id,
-            tableId=self.get_table_id(),
-            startIndex=self.next_index,
-            pageToken=self.next_page_token,
-            maxResults=max_results).execute()
-        next_page_token = data.get('pageToken', None)
-        rows = data.get('rows', [])
-        print self.make_read_message(len(rows), max_results)
-        is_done = self.advance(rows, next_page_token)
-        return (is_done, rows)
-      except HttpError, err:
-        # If the error is a rate limit or connection error, wait and
-        # try again.
-        if err.resp.status in [403, 500, 503]:
-          print '%s: Retryable error %s, waiting' % (
-              self.thread_id, err.resp.status,)
-          time.sleep(5)
-        else: raise
+    if self.rows_left is not None and self.rows_left < max_results:
+      max_results = self.rows_left
+
+    data = retry.execute(self.bq_service.tabledata().list(
+        projectId=self.project_id,
+        datasetId=self.dataset_id,
+        tableId=self.get_table_id(),
+        startIndex=self.next_index,
+        pageToken=self.next_page_token,
+        maxResults=max_results), label='tabledata.list')
+    next_page_token = data.get('pageToken', None)
+    rows = data.get('rows', [])
+    print self.make_read_message(len(rows), max_results)
+    is_done = self.advance(rows, next_page_token)
+    return (is_done, rows)
 
   def read(self, result_handler, snapshot_time=None):
     '''Reads an entire table until the end or we hit a row limit.'''
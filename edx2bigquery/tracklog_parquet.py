@@ -0,0 +1,516 @@
+#!/usr/bin/python
+#
+# File:   tracklog_parquet.py
+#
+# Parquet (columnar) tracking log files, as an alternative to the newline
+# delimited JSON tracklog-YYYY-MM-DD.json.gz files made by split_and_rephrase.
+#
+# Columns follow schemas/schema_tracking_log.json, with rows written in row
+# groups of PARQUET_ROW_GROUP_SIZE rows, so local analyses can read just the
+# columns they need.  RECORD fields are flattened, into one column per leaf
+# field, named with "__" between the levels, eg context__user_id: pyarrow 0.16,
+# the last release for python 2, can't write nested struct columns.
+# iter_tracklog_rows puts the records back together.
+#
+# Parquet files can't be appended to, so a file is written to <file>.tmp and
+# renamed into place when closed; opening in append mode (eg after the file
+# was closed by the split's pool of open files, or at a checkpoint) writes a
+# new part file, tracklog-YYYY-MM-DD.partNNN.parquet, next to it, rather than
+# rewriting the data already written.  The readers, num_rows, and
+# truncate_tracklog take the file and its parts together.
+#
+# Rows are buffered until there are PARQUET_ROW_GROUP_SIZE of them for a
+# file; when more than PARQUET_MAX_BUFFERED_ROWS rows are buffered in all
+# (over all the open files), the file with the most is written out.
+#
+# BigQuery can load the parquet files (load_to_bigquery), but not into the
+# nested tracking log schema, because of the flattened columns: they are
+# loaded into a staging table (parquet_staging_<table>, named so that it isn't
+# taken for a tracklog_* table), from which restructure_sql rebuilds the RECORD
+# fields.  That query scans, and is billed for, the whole day's logs, which the
+# load of a json.gz file is not.
+#
+# Needs pyarrow, which is optional: it is only imported when parquet files are
+# used.
+
+import datetime
+import glob
+import os
+import re
+
+import dateutil.parser
+
+import edx2bigquery_config
+import jsoncodec
+import local_util
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+PARQUET_ROW_GROUP_SIZE = getattr(edx2bigquery_config, 'PARQUET_ROW_GROUP_SIZE', 50000)
+PARQUET_COMPRESSION = getattr(edx2bigquery_config, 'PARQUET_COMPRESSION', 'snappy')
+PARQUET_MAX_BUFFERED_ROWS = getattr(edx2bigquery_config, 'PARQUET_MAX_BUFFERED_ROWS', 200000)	# over all open files
+
+STRING_TYPES = (str, unicode)
+
+#-----------------------------------------------------------------------------
+
+def check_pyarrow():
+    if pa is None:
+        raise Exception("[tracklog_parquet] pyarrow is needed for parquet tracking log files; please install it (pip install pyarrow)")
+
+def get_tracking_log_schema():
+    return local_util.get_schema_from_file('schema_tracking_log')['tracking_log']
+
+def arrow_type(field):
+    '''
+    pyarrow type for (non-RECORD) BigQuery schema field.
+    '''
+    return {'STRING': pa.string(),
+            'INTEGER': pa.int64(),
+            'FLOAT': pa.float64(),
+            'BOOLEAN': pa.bool_(),
+            'TIMESTAMP': pa.timestamp('us', tz='UTC'),
+            }[field['type']]
+
+def leaf_fields(fields, prefix=''):
+    '''
+    List of (column name, field) for the leaf fields of BigQuery schema fields, with RECORD fields flattened.
+    '''
+    leaves = []
+    for field in fields:
+        if field['type']=='RECORD':
+            leaves += leaf_fields(field['fields'], prefix + field['name'] + '__')
+        else:
+            leaves.append((prefix + field['name'], field))
+    return leaves
+
+def arrow_schema(fields):
+    check_pyarrow()
+    return pa.schema([pa.field(name, arrow_type(field)) for (name, field) in leaf_fields(fields)])
+
+def column_names(columns, schema=None):
+    '''
+    Parquet column names for the given columns, which may be leaf columns (context__user_id, or context.user_id),
+    or RECORD fields (eg context), meaning all of their leaf columns.
+    '''
+    names = [name for (name, field) in leaf_fields(schema or get_tracking_log_schema())]
+    ret = []
+    for col in columns:
+        col = col.replace('.', '__')
+        if col in names:
+            ret.append(col)
+        else:
+            ret += [x for x in names if x.startswith(col + '__')]
+    return ret
+
+#-----------------------------------------------------------------------------
+# conversion of values to the column types
+
+time_re = re.compile(r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.(\d{1,6})\d*)?(Z|[+-]\d\d:?\d\d)?$')
+EPOCH = datetime.datetime(1970, 1, 1)
+
+def time_to_usec(the_time):
+    '''
+    Microseconds since the epoch (UTC) for tracking log time string the_time, or None if it can't be parsed.
+    Times without a UTC offset are taken to be UTC, as BigQuery does.
+    '''
+    if not type(the_time) in STRING_TYPES:
+        return None
+    try:
+        m = time_re.match(the_time)
+        if m:
+            (year, month, day, hour, minute, second, frac, offset) = m.groups()
+            dt = datetime.datetime(int(year), int(month), int(day), int(hour), int(minute), int(second),
+                                   int(frac.ljust(6, '0')) if frac else 0)
+            if offset and offset!='Z':
+                sign = -1 if offset[0]=='-' else 1
+                dt -= sign * datetime.timedelta(hours=int(offset[1:3]), minutes=int(offset[-2:]))
+        else:
+            dt = dateutil.parser.parse(the_time)
+            if dt.tzinfo is not None:
+                dt = dt.astimezone(dateutil.tz.tzutc()).replace(tzinfo=None)
+    except Exception as err:
+        return None
+    delta = dt - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+def _to_string(val):
+    if type(val) in STRING_TYPES:
+        return val
+    return jsoncodec.dumps(val)
+
+def _to_int(val):
+    try:
+        return int(val)
+    except Exception as err:
+        return None
+
+def _to_float(val):
+    try:
+        return float(val)
+    except Exception as err:
+        return None
+
+def _to_bool(val):
+    if type(val)==bool:
+        return val
+    if type(val) in STRING_TYPES and val.lower() in ['true', 'false']:
+        return val.lower()=='true'
+    return None
+
+def converter(field):
+    '''
+    Return function which converts a (rephrased) tracking log value to the python value for the column
+    of (non-RECORD) BigQuery schema field; values which can't be converted become null.
+    '''
+    convert = {'STRING': _to_string,
+               'INTEGER': _to_int,
+               'FLOAT': _to_float,
+               'BOOLEAN': _to_bool,
+               'TIMESTAMP': time_to_usec,
+               }[field['type']]
+    def convert_value(val):
+        if val is None:
+            return None
+        return convert(val)
+    return convert_value
+
+#-----------------------------------------------------------------------------
+# part files
+
+def part_path(path, k):
+    return '%s.part%03d.parquet' % (path[:-len('.parquet')], k)
+
+def part_paths(path):
+    '''
+    The existing files making up parquet tracking log path: path itself, then its part files, in order.
+    '''
+    parts = sorted(glob.glob(path[:-len('.parquet')] + '.part[0-9][0-9][0-9].parquet'))
+    return ([path] if os.path.exists(path) else []) + parts
+
+def remove_tracklog(path):
+    for fn in part_paths(path):
+        os.unlink(fn)
+
+#-----------------------------------------------------------------------------
+
+OPEN_WRITERS = set()		# ParquetTracklogWriters with buffered rows, for PARQUET_MAX_BUFFERED_ROWS
+
+class ParquetTracklogWriter(object):
+    '''
+    Parquet tracking log file, written one row (rephrased tracking log dict, or JSON line) at a time.
+    Same interface as the file objects used for the split output files (write, close).  In append mode,
+    rows go to a new part file (see part_paths).
+    '''
+    def __init__(self, path, mode='w', schema=None, row_group_size=None, max_buffered_rows=None):
+        check_pyarrow()
+        self.path = path
+        existing = part_paths(path)
+        if mode=='a' and existing:
+            self.out_path = part_path(path, len(existing))
+        else:
+            remove_tracklog(path)
+            self.out_path = path
+        self.tmp_path = self.out_path + '.tmp'
+        self.fields = schema or get_tracking_log_schema()
+        self.schema = arrow_schema(self.fields)
+        self.row_group_size = row_group_size or PARQUET_ROW_GROUP_SIZE
+        self.max_buffered_rows = max_buffered_rows or PARQUET_MAX_BUFFERED_ROWS
+        self.rows = []
+        self.nrows = 0
+        self.writer = pq.ParquetWriter(self.tmp_path, self.schema, compression=PARQUET_COMPRESSION)
+
+    def write(self, data):
+        if type(data) in STRING_TYPES:
+            data = jsoncodec.loads(data)
+        self.rows.append(data)
+        OPEN_WRITERS.add(self)
+        if len(self.rows) >= self.row_group_size:
+            self.flush()
+        elif len(self.rows) % 1000 == 0 and sum(len(x.rows) for x in OPEN_WRITERS) > self.max_buffered_rows:
+            max(OPEN_WRITERS, key=lambda x: len(x.rows)).flush()
+
+    def flush(self):
+        '''
+        Write out the buffered rows, as one row group.
+        '''
+        OPEN_WRITERS.discard(self)
+        if not self.rows:
+            return
+        arrays = self.column_arrays(self.rows, self.fields)
+        self.nrows += len(self.rows)
+        self.rows = []
+        self.writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+
+    def column_arrays(self, records, fields):
+        '''
+        List of arrays for the leaf columns of fields, from records (list of dicts, or None for missing records).
+        '''
+        arrays = []
+        for field in fields:
+            name = field['name']
+            values = [x.get(name) if x is not None else None for x in records]
+            if field['type']=='RECORD':
+                values = [x if type(x)==dict else None for x in values]
+                if any(values):
+                    arrays += self.column_arrays(values, field['fields'])
+                else:
+                    arrays += [pa.array([None] * len(values), type=arrow_type(x)) for (col, x) in leaf_fields(field['fields'])]
+            else:
+                convert = converter(field)
+                arrays.append(pa.array([convert(x) for x in values], type=arrow_type(field)))
+        return arrays
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        if self.nrows or self.out_path == self.path:
+            os.rename(self.tmp_path, self.out_path)
+        else:
+            os.unlink(self.tmp_path)		# empty part
+
+def num_rows(path):
+    '''
+    Number of rows in parquet tracking log path, and its parts (from their footers).
+    '''
+    check_pyarrow()
+    return sum(pq.ParquetFile(fn).metadata.num_rows for fn in part_paths(path))
+
+def truncate_tracklog(path, nrows):
+    '''
+    Keep only the first nrows rows of parquet tracking log path (and its parts).
+    '''
+    check_pyarrow()
+    for fn in part_paths(path):
+        pf = pq.ParquetFile(fn)
+        if pf.metadata.num_rows <= nrows:
+            nrows -= pf.metadata.num_rows
+            continue
+        if nrows <= 0 and fn != path:
+            os.unlink(fn)
+            continue
+        writer = pq.ParquetWriter(fn + '.tmp', pf.schema.to_arrow_schema(), compression=PARQUET_COMPRESSION)
+        for k in range(pf.num_row_groups):
+            if nrows <= 0:
+                break
+            table = pf.read_row_group(k)
+            if table.num_rows > nrows:
+                table = table.slice(0, nrows)
+            writer.write_table(table)
+            nrows -= table.num_rows
+        writer.close()
+        os.rename(fn + '.tmp', fn)
+
+#-----------------------------------------------------------------------------
+# reading
+
+def read_tracklog(path, columns=None):
+    '''
+    Read parquet tracking log file into a pyarrow Table (with flattened columns), with just the given
+    columns (all if None); see column_names.
+    '''
+    check_pyarrow()
+    columns = column_names(columns) if columns else None
+    tables = [pq.read_table(fn, columns=columns) for fn in part_paths(path)]
+    return tables[0] if len(tables)==1 else pa.concat_tables(tables)
+
+def iter_tracklog_rows(path, columns=None):
+    '''
+    Yield the rows of parquet tracking log file as (nested) dicts, with just the given columns (all if None),
+    reading one row group at a time.  Null values are left out, as are records with no values.
+    '''
+    check_pyarrow()
+    columns = column_names(columns) if columns else None
+    for (pf, k) in [(pf, k) for pf in [pq.ParquetFile(fn) for fn in part_paths(path)] for k in range(pf.num_row_groups)]:
+        data = pf.read_row_group(k, columns=columns).to_pydict()
+        names = [(x, x.split('__')) for x in data.keys()]
+        for values in zip(*[data[x] for (x, parts) in names]):
+            row = {}
+            for ((name, parts), val) in zip(names, values):
+                if val is None:
+                    continue
+                rec = row
+                for part in parts[:-1]:
+                    rec = rec.setdefault(part, {})
+                rec[parts[-1]] = val
+            yield row
+
+def convert_tracklog(src, dst, schema=None):
+    '''
+    Convert newline delimited JSON tracking log file src (eg tracklog-2015-02-10.json.gz) to parquet file dst.
+    Returns the number of rows.
+    '''
+    from load_course_sql import openfile
+    writer = ParquetTracklogWriter(dst, schema=schema)
+    cnt = 0
+    for line in openfile(src):
+        writer.write(line)
+        cnt += 1
+    writer.close()
+    return cnt
+
+#-----------------------------------------------------------------------------
+# loading into BigQuery
+
+def restructure_sql(source_table, schema=None):
+    '''
+    Standard SQL query rebuilding the RECORD fields of the tracking log schema from the flattened columns of
+    source_table (dataset.table, loaded from parquet tracking log files).
+    '''
+    def select(fields, prefix):
+        exprs = []
+        for field in fields:
+            if field['type']=='RECORD':
+                exprs.append('STRUCT(%s) AS %s' % (', '.join(select(field['fields'], prefix + field['name'] + '__')),
+                                                   field['name']))
+            else:
+                exprs.append('%s%s AS %s' % (prefix, field['name'], field['name']))
+        return exprs
+    return 'SELECT %s FROM `%s`' % (',\n  '.join(select(schema or get_tracking_log_schema(), '')), source_table)
+
+def load_to_bigquery(dataset_id, table_id, path, course_id=None):
+    '''
+    Load parquet tracking log path (and its parts) into BigQuery table dataset_id.table_id, with the tracking
+    log schema: the files are loaded as they are (sourceFormat PARQUET) into a staging table, from which the
+    table is made by restructure_sql (a billed query, scanning the whole staging table).
+    '''
+    import bqutil
+    staging = 'parquet_staging_%s' % table_id
+    try:
+        for (k, fn) in enumerate(part_paths(path)):
+            bqutil.upload_local_data_to_big_query(dataset_id, staging, None, course_id, fn, 'PARQUET',
+                                                  write_disposition='WRITE_TRUNCATE' if k==0 else 'WRITE_APPEND')
+        bqutil.create_bq_table(dataset_id, table_id, restructure_sql('%s.%s' % (dataset_id, staging)),
+                               overwrite=True, use_legacy_sql=False)
+    finally:
+        try:
+            bqutil.delete_bq_table(dataset_id, staging)
+        except Exception as err:
+            print "[tracklog_parquet] Oops, failed to delete staging table %s.%s, err=%s" % (dataset_id, staging,
+                                                                                             str(err))
+
+#-----------------------------------------------------------------------------
+# unit tests, using py.test
+
+def test_time_to_usec():
+    assert time_to_usec('1970-01-01T00:00:01.5+00:00') == 1500000
+    assert time_to_usec('2015-02-10T05:17:08.011728+00:00') == time_to_usec('2015-02-10T00:17:08.011728-05:00')
+    assert time_to_usec('2015-02-10T05:17:08Z') == time_to_usec('2015-02-10 05:17:08') == 1423545428000000
+    assert time_to_usec('2015-02-30T05:17:08Z') is None
+    assert time_to_usec('not a time') is None
+    assert time_to_usec(12) is None
+
+def test_parquet_tracklog():
+    import pytest
+    import shutil
+    import tempfile
+    pytest.importorskip('pyarrow')
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fn = os.path.join(tmpdir, 'tracklog-2015-02-10.parquet')
+        rows = [{'time': '2015-02-10T05:17:%02d.000001+00:00' % k, 'username': 'user%d' % k, 'event_type': 'seq_goto',
+                 'context': {'user_id': k, 'course_id': 'MITx/8.01x/2013_SOND'},
+                 'event_struct': {'new': str(k), 'old': k, 'done': 'x', 'state': {'done': True}},
+                 'event': '{"new": %d}' % k} for k in range(5)]
+        writer = ParquetTracklogWriter(fn, row_group_size=2)
+        for row in rows[:3]:
+            writer.write(row)
+        writer.close()
+        writer = ParquetTracklogWriter(fn, mode='a', row_group_size=2)
+        writer.write(jsoncodec.dumps(rows[3]))
+        writer.write(rows[4])
+        writer.close()
+
+        assert num_rows(fn) == 5
+        assert pq.ParquetFile(fn).num_row_groups == 2
+        assert part_paths(fn) == [fn, os.path.join(tmpdir, 'tracklog-2015-02-10.part001.parquet')]	# not rewritten
+        assert pq.ParquetFile(part_paths(fn)[1]).metadata.num_rows == 2
+        writer = ParquetTracklogWriter(fn, mode='a')
+        writer.close()
+        assert len(part_paths(fn)) == 2					# no empty part
+        out = list(iter_tracklog_rows(fn, columns=['username', 'context', 'event_struct.new', 'event_struct__state']))
+        assert [x['username'] for x in out] == ['user%d' % k for k in range(5)]
+        assert out[2]['context'] == {'user_id': 2, 'course_id': 'MITx/8.01x/2013_SOND'}
+        assert out[2]['event_struct'] == {'new': 2, 'state': {'done': True}}
+        table = read_tracklog(fn, columns=['time', 'context.user_id'])
+        assert table.schema.names == ['time', 'context__user_id']
+        assert table.column(0).type == pa.timestamp('us', tz='UTC')
+        assert table.column(1).to_pylist() == range(5)
+
+        truncate_tracklog(fn, 4)
+        assert [x['username'] for x in iter_tracklog_rows(fn, columns=['username'])] == ['user%d' % k for k in range(4)]
+        truncate_tracklog(fn, 2)
+        assert [x['username'] for x in iter_tracklog_rows(fn, columns=['username'])] == ['user0', 'user1']
+        assert sorted(os.listdir(tmpdir)) == ['tracklog-2015-02-10.parquet']
+
+        writer = ParquetTracklogWriter(fn, row_group_size=2)		# mode w: replaces the file
+        writer.write(rows[0])
+        writer.close()
+        assert num_rows(fn) == 1
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_max_buffered_rows():
+    import pytest
+    import shutil
+    import tempfile
+    pytest.importorskip('pyarrow')
+    tmpdir = tempfile.mkdtemp()
+    try:
+        writers = [ParquetTracklogWriter(os.path.join(tmpdir, 'tracklog-2015-02-1%d.parquet' % k), row_group_size=10**6,
+                                         max_buffered_rows=2500) for k in range(3)]
+        for k in range(3000):
+            writers[k % 3].write({'username': 'user%d' % k})
+        assert sum(len(x.rows) for x in writers) <= 2500 and sum(x.nrows for x in writers) >= 500
+        for writer in writers:
+            writer.close()
+        assert OPEN_WRITERS == set()
+        assert sum(num_rows(x.path) for x in writers) == 3000
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_restructure_sql():
+    fields = [{'name': 'time', 'type': 'TIMESTAMP'},
+              {'name': 'context', 'type': 'RECORD', 'fields': [{'name': 'user_id', 'type': 'INTEGER'},
+                                                               {'name': 'module', 'type': 'RECORD',
+                                                                'fields': [{'name': 'usage_key', 'type': 'STRING'}]}]}]
+    assert restructure_sql('ds.parquet_staging_t', fields) == ('SELECT time AS time,\n  STRUCT(context__user_id AS user_id, '
+                                                        'STRUCT(context__module__usage_key AS usage_key) AS module) '
+                                                        'AS context FROM `ds.parquet_staging_t`')
+
+def test_load_to_bigquery_staging():
+    import bqutil
+    calls = []
+    def upload(dataset_id, table_id, schema, course_id, fn, format, write_disposition=None):
+        calls.append(('load', table_id, os.path.basename(fn), write_disposition))
+        if 'part002' in fn:
+            raise Exception('load failed')
+    orig = (bqutil.upload_local_data_to_big_query, bqutil.create_bq_table, bqutil.delete_bq_table, part_paths)
+    bqutil.upload_local_data_to_big_query = upload
+    bqutil.create_bq_table = lambda dataset_id, table_id, sql, **kwargs: calls.append(('query', table_id))
+    bqutil.delete_bq_table = lambda dataset_id, table_id: calls.append(('delete', table_id))
+    try:
+        globals()['part_paths'] = lambda path: [path]
+        load_to_bigquery('c_logs', 'tracklog_20150210', 'tracklog-2015-02-10.parquet')
+        assert calls == [('load', 'parquet_staging_tracklog_20150210', 'tracklog-2015-02-10.parquet', 'WRITE_TRUNCATE'),
+                         ('query', 'tracklog_20150210'), ('delete', 'parquet_staging_tracklog_20150210')]
+        assert not calls[0][1].startswith('track')	# not listed as a tracking log table
+
+        del calls[:]
+        globals()['part_paths'] = lambda path: [path, path.replace('.parquet', '.part001.parquet'),
+                                                path.replace('.parquet', '.part002.parquet')]
+        try:
+            load_to_bigquery('c_logs', 'tracklog_20150210', 'tracklog-2015-02-10.parquet')
+            assert False
+        except Exception as err:
+            assert str(err) == 'load failed'
+        assert [x[0] for x in calls] == ['load', 'load', 'load', 'delete']	# staging table deleted anyway
+        assert calls[1][3] == 'WRITE_APPEND'
+    finally:
+        (bqutil.upload_local_data_to_big_query, bqutil.create_bq_table, bqutil.delete_bq_table,
+         globals()['part_paths']) = orig
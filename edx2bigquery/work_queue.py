@@ -0,0 +1,487 @@
+#!/usr/bin/python
+#
+# File:   work_queue.py
+#
+# Work queue for running a command on many courses on several hosts:
+#
+#     edx2bigquery --clist=all enqueue person_course --force-recompute
+#     edx2bigquery worker		(on each host, as many as wanted)
+#
+# The queue is a directory (WORK_QUEUE_DIR, or --queue-dir; default QUEUE),
+# on a filesystem shared by the hosts, holding one json file per task (a
+# command, with its options, for one course):
+#
+#     pending/<task_id>.json		waiting to be run
+#     claimed/<task_id>@<worker>.json	being run by worker
+#     done/<task_id>.json
+#     failed/<task_id>.json		failed max_attempts times
+#
+# A worker claims a task by touching its file and renaming it from pending to
+# claimed, which only one worker can do (the touch starts the lease, which
+# would otherwise date from when the task was enqueued).  While the task runs (as an edx2bigquery
+# subprocess, with its output going to the course's log file, as for
+# --parallel), the worker touches the claimed file every few seconds: that is
+# its lease.  A claimed file not touched for lease seconds (its worker died, or
+# its host went away) is put back into pending by any other worker, and the
+# task is run again.  A task which fails (its command exits non-zero: tasks
+# are run with --error-exit-status, so that includes a course or step failing
+# though the command carried on) is retried, after a delay, up to
+# max_attempts times in all.
+#
+# Tasks are run in the order enqueued; enqueue puts the courses in the order
+# --parallel would (most costly first).  A worker exits when there are no
+# tasks pending or claimed.
+#
+# Lease times are compared with file mtimes, so the clocks of the hosts should
+# agree to well within the lease.
+#
+# The run ledger (see run_ledger) is not shared: each task records its steps
+# in the ledger of the host it runs on (an SQLite file, which is not safe to
+# share over a network filesystem).  So nightly --only-changed, which plans
+# from the ledger, cannot be enqueued (see ENQUEUE_REFUSED_OPTIONS), and
+# status shows only the tasks run on its host.
+
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import course_scheduler
+import edx2bigquery_config
+
+WORK_QUEUE_DIR = getattr(edx2bigquery_config, 'WORK_QUEUE_DIR', 'QUEUE')
+WORK_QUEUE_LEASE = getattr(edx2bigquery_config, 'WORK_QUEUE_LEASE', 300)		# seconds
+WORK_QUEUE_MAX_ATTEMPTS = getattr(edx2bigquery_config, 'WORK_QUEUE_MAX_ATTEMPTS', 3)
+WORK_QUEUE_RETRY_DELAY = getattr(edx2bigquery_config, 'WORK_QUEUE_RETRY_DELAY', 60)	# seconds, times the attempts so far
+EDX2BIGQUERY_COMMAND = getattr(edx2bigquery_config, 'EDX2BIGQUERY_COMMAND', ['edx2bigquery'])	# to run a task
+
+STATES = ['pending', 'claimed', 'done', 'failed']
+
+# options which can't be used with enqueue, as they rely on the run ledger being shared by the workers
+ENQUEUE_REFUSED_OPTIONS = ['--only-changed']
+
+#-----------------------------------------------------------------------------
+
+def worker_name():
+    return '%s-%d' % (socket.gethostname(), os.getpid())
+
+class WorkQueue(object):
+    '''
+    Work queue in the directory qdir.
+    '''
+    def __init__(self, qdir=None, lease=None, clock=time.time):
+        self.qdir = qdir or WORK_QUEUE_DIR
+        self.lease = lease or WORK_QUEUE_LEASE
+        self.clock = clock
+        for state in STATES:
+            if not os.path.exists(self.dir(state)):
+                try:
+                    os.makedirs(self.dir(state))
+                except OSError:
+                    pass				# made by another worker
+
+    def dir(self, state):
+        return os.path.join(self.qdir, state)
+
+    def files(self, state):
+        return sorted(x for x in os.listdir(self.dir(state)) if x.endswith('.json'))
+
+    def read(self, fn):
+        try:
+            return json.loads(open(fn).read())
+        except (IOError, OSError, ValueError):
+            return None				# moved (or being written) by another worker
+
+    def write(self, fn, task):
+        '''
+        Write task to the file fn, atomically (readers never see it half written).
+        '''
+        tmpfn = os.path.join(os.path.dirname(fn), '.%s.tmp' % os.path.basename(fn))
+        with open(tmpfn, 'w') as ofp:
+            ofp.write(json.dumps(task, indent=2, sort_keys=True))
+        os.rename(tmpfn, fn)
+
+    def move(self, src, dst):
+        '''
+        Rename src to dst; False if src is gone (another worker moved it first).
+        '''
+        try:
+            os.rename(src, dst)
+            return True
+        except OSError:
+            return False
+
+    def counts(self):
+        return dict((state, len(self.files(state))) for state in STATES)
+
+    def enqueue(self, command, courses, argv=(), max_attempts=None):
+        '''
+        Add a task for each course_id in courses, to run command (with options argv) on it; tasks are run in
+        the order of courses.  Returns the list of tasks.
+        '''
+        prefix = time.strftime('%Y%m%d-%H%M%S', time.localtime(self.clock()))
+        tasks = []
+        for (k, course_id) in enumerate(courses):
+            task = {'task_id': '%s-%05d-%s' % (prefix, k, command),
+                    'command': command,
+                    'course_id': course_id,
+                    'argv': list(argv),
+                    'attempts': 0,
+                    'max_attempts': max_attempts or WORK_QUEUE_MAX_ATTEMPTS,
+                    'not_before': None,
+                    'enqueued': self.clock(),
+                    'errors': [],
+                    }
+            self.write(os.path.join(self.dir('pending'), task['task_id'] + '.json'), task)
+            tasks.append(task)
+        return tasks
+
+    def claim(self, worker):
+        '''
+        Claim the first pending task which is due, for worker; returns (task, claimed file name), or (None, None)
+        if there is none.
+        '''
+        now = self.clock()
+        for fn in self.files('pending'):
+            src = os.path.join(self.dir('pending'), fn)
+            task = self.read(src)
+            if task is None or (task['not_before'] and task['not_before'] > now):
+                continue
+            claimed = os.path.join(self.dir('claimed'), '%s@%s.json' % (task['task_id'], worker))
+            try:
+                os.utime(src, (now, now))		# start the lease, so it isn't reaped as soon as it's claimed
+            except OSError:
+                continue				# claimed by another worker
+            if not self.move(src, claimed):
+                continue
+            task = self.read(claimed)			# as claimed (it may have been updated since read above)
+            if task is None:
+                continue				# lost the claim (reaped by another worker)
+            task['worker'] = worker
+            task['claimed'] = now
+            self.write(claimed, task)
+            return (task, claimed)
+        return (None, None)
+
+    def heartbeat(self, claimed):
+        '''
+        Renew the lease on the task in the claimed file; False if it has been lost (the task was put back
+        into pending, by another worker).
+        '''
+        try:
+            os.utime(claimed, None)
+            return True
+        except OSError:
+            return False
+
+    def retry_or_fail(self, task, src, error, delay=True):
+        '''
+        Move the task in src (which this worker holds) back to pending, to run again (after a delay, if delay),
+        or to failed if it has been tried max_attempts times.
+        '''
+        task['attempts'] += 1
+        task['errors'].append(error)
+        task.pop('worker', None)
+        if task['attempts'] >= task['max_attempts']:
+            state = 'failed'
+        else:
+            state = 'pending'
+            task['not_before'] = (self.clock() + WORK_QUEUE_RETRY_DELAY * task['attempts']) if delay else None
+        self.write(src, task)
+        self.move(src, os.path.join(self.dir(state), task['task_id'] + '.json'))
+        return state
+
+    def finish(self, task, claimed, success, error=None):
+        '''
+        Record the outcome of a task run from the claimed file; returns its new state (None if the lease had
+        been lost, in which case the task is left to the worker which has it now).
+        '''
+        held = claimed + '.finishing'
+        if not self.move(claimed, held):
+            return None
+        if success:
+            task['attempts'] += 1
+            task['finished'] = self.clock()
+            self.write(held, task)
+            self.move(held, os.path.join(self.dir('done'), task['task_id'] + '.json'))
+            return 'done'
+        return self.retry_or_fail(task, held, error)
+
+    def reap(self, ofp=sys.stdout):
+        '''
+        Put tasks whose lease has expired (their worker is gone) back into pending, counting the attempt;
+        returns the number reaped.
+        '''
+        now = self.clock()
+        nreaped = 0
+        for fn in self.files('claimed'):
+            claimed = os.path.join(self.dir('claimed'), fn)
+            try:
+                if os.path.getmtime(claimed) > now - self.lease:
+                    continue
+            except OSError:
+                continue
+            held = claimed + '.reaping'
+            if not self.move(claimed, held):
+                continue
+            task = self.read(held)
+            if task is None:
+                continue
+            state = self.retry_or_fail(task, held, 'lease expired (worker %s)' % task.get('worker'), delay=False)
+            ofp.write("[work_queue] %s for %s: lease of %s expired, now %s\n" % (task['command'], task['course_id'],
+                                                                               fn.split('@', 1)[-1][:-5], state))
+            nreaped += 1
+        return nreaped
+
+#-----------------------------------------------------------------------------
+
+def run_subprocess(task, logfp, heartbeat):
+    '''
+    Run task as an edx2bigquery command, with its output going to logfp; heartbeat() is called every few seconds
+    while it runs, and the command is killed if it returns False.  Returns (success, error); the command is run
+    with --error-exit-status, so that a course or step failing fails the task, though the command carries on.
+    '''
+    cmd = list(EDX2BIGQUERY_COMMAND) + ['--error-exit-status'] + task['argv'] + [task['command'], task['course_id']]
+    logfp.write("[work_queue] running %s\n" % ' '.join(cmd))
+    logfp.flush()
+    proc = subprocess.Popen(cmd, stdout=logfp, stderr=subprocess.STDOUT)
+    while proc.poll() is None:
+        if not heartbeat():
+            proc.kill()
+            proc.wait()
+            return (False, 'lease lost')
+        time.sleep(1)
+    if proc.returncode:
+        return (False, 'exit code %s' % proc.returncode)
+    return (True, None)
+
+class Worker(object):
+    '''
+    Runs tasks from queue (a WorkQueue), one at a time, with run_fn(task, logfp, heartbeat) (default: as an
+    edx2bigquery subprocess), logging each course's output to its own file in log_dir.
+    '''
+    def __init__(self, queue, log_dir=None, run_fn=run_subprocess, name=None, poll=10, sleep=time.sleep,
+                 ofp=sys.stdout):
+        self.queue = queue
+        self.log_dir = log_dir or course_scheduler.COURSE_LOG_DIR
+        self.run_fn = run_fn
+        self.name = name or worker_name()
+        self.poll = poll
+        self.sleep = sleep
+        self.ofp = ofp
+        self.results = []
+
+    def log(self, msg):
+        self.ofp.write("[work_queue] %s: %s\n" % (self.name, msg))
+        self.ofp.flush()
+
+    def heartbeat_fn(self, claimed):
+        '''
+        heartbeat() for run_fn: renews the lease (at most every lease/4 seconds), and returns False once it's lost.
+        '''
+        state = {'last': 0, 'ok': True}
+        lock = threading.Lock()
+        def heartbeat():
+            with lock:
+                if state['ok'] and self.queue.clock() - state['last'] >= self.queue.lease / 4.0:
+                    state['ok'] = self.queue.heartbeat(claimed)
+                    state['last'] = self.queue.clock()
+                return state['ok']
+        return heartbeat
+
+    def run_one(self, task, claimed):
+        logfn = course_scheduler.log_filename(self.log_dir, task['command'], task['course_id'])
+        if not os.path.exists(os.path.dirname(logfn)):
+            try:
+                os.makedirs(os.path.dirname(logfn))
+            except OSError:
+                pass
+        self.log("running %s on %s (attempt %d of %d)" % (task['command'], task['course_id'], task['attempts'] + 1,
+                                                          task['max_attempts']))
+        start = time.time()
+        with open(logfn, 'a') as logfp:
+            logfp.write("[work_queue] %s: task %s (%s), attempt %d, at %s\n" % (self.name, task['task_id'],
+                                                                               task['command'], task['attempts'] + 1,
+                                                                               time.ctime()))
+            logfp.flush()
+            try:
+                (success, error) = self.run_fn(task, logfp, self.heartbeat_fn(claimed))
+            except Exception as err:
+                (success, error) = (False, str(err))
+        state = self.queue.finish(task, claimed, success, error)
+        dt = time.time() - start
+        self.log("%s on %s: %s, dt=%.1f sec%s, log=%s" % (task['command'], task['course_id'], state or 'lease lost', dt,
+                                                          (", err=%s" % error) if error else "", logfn))
+        self.results.append({'course_id': task['course_id'], 'state': state, 'dt': dt, 'logfile': logfn})
+
+    def run(self):
+        '''
+        Run tasks until there are none pending or claimed (by other workers); returns the results.
+        '''
+        self.log("starting, queue %s" % self.queue.qdir)
+        while True:
+            self.queue.reap(ofp=self.ofp)
+            (task, claimed) = self.queue.claim(self.name)
+            if task is not None:
+                self.run_one(task, claimed)
+                continue
+            counts = self.queue.counts()
+            if not counts['pending'] and not counts['claimed']:
+                break
+            self.sleep(self.poll)		# tasks waiting to be retried, or running elsewhere (whose lease may expire)
+        counts = self.queue.counts()
+        self.log("no more tasks; ran %d (%d done); queue: %s" % (len(self.results),
+                                                                 len([x for x in self.results if x['state']=='done']),
+                                                                 ', '.join('%d %s' % (counts[x], x) for x in STATES)))
+        return self.results
+
+def task_argv(argv, command, courses, drop_flags=(), drop_options=()):
+    '''
+    The options of argv (an edx2bigquery command line, without the program name) to pass on to each task of
+    "enqueue command": without enqueue and command, the courses, the flags in drop_flags, and the options
+    (with their values) in drop_options.
+    '''
+    ret = []
+    argv = list(argv)
+    positional = ['enqueue', command]
+    courses = set(courses)
+    while argv:
+        arg = argv.pop(0)
+        if positional and arg == positional[0]:
+            positional.pop(0)
+        elif arg in drop_options:
+            if argv:
+                argv.pop(0)
+        elif arg in courses or arg in drop_flags or arg.split('=', 1)[0] in drop_options:
+            pass
+        else:
+            ret.append(arg)
+    return ret
+
+#-----------------------------------------------------------------------------
+# unit tests, using py.test
+
+class FakeClock(object):
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+def test_task_argv():
+    argv = ['--clist=all', '--force-recompute', 'enqueue', 'person_course', '--max-attempts', '2', '--year2', '-v']
+    assert task_argv(argv, 'person_course', [], drop_flags=['--year2'],
+                     drop_options=['--clist', '--max-attempts']) == ['--force-recompute', '-v']
+    argv = ['enqueue', 'logs2bq', 'a/b/c', 'a/b/d', '--dataset-latest']
+    assert task_argv(argv, 'logs2bq', ['a/b/c', 'a/b/d']) == ['--dataset-latest']
+
+def test_claim_starts_lease():
+    import shutil
+    import tempfile
+    from StringIO import StringIO
+    tmpdir = tempfile.mkdtemp()
+    try:
+        clock = FakeClock(time.time())
+        queue = WorkQueue(os.path.join(tmpdir, 'QUEUE'), lease=60, clock=clock)
+        queue.enqueue('person_course', ['a/b/c', 'a/b/d'])
+        for fn in queue.files('pending'):	# enqueued long before it's claimed
+            os.utime(os.path.join(queue.dir('pending'), fn), (clock.now - 600, clock.now - 600))
+
+        # another worker reaps just after the claiming rename: the new claim is left alone
+        reaped = []
+        orig_move = queue.move
+        def move(src, dst):
+            ret = orig_move(src, dst)
+            if dst.endswith('@host1-1.json'):
+                reaped.append(queue.reap(ofp=StringIO()))
+            return ret
+        queue.move = move
+        (task, claimed) = queue.claim('host1-1')
+        assert reaped == [0] and task['course_id'] == 'a/b/c' and os.path.exists(claimed)
+
+        # the claimed file is gone before it's read: the claim is lost
+        def move(src, dst):
+            ret = orig_move(src, dst)
+            if dst.endswith('@host2-1.json'):
+                os.rename(dst, dst + '.reaping')
+            return ret
+        queue.move = move
+        assert queue.claim('host2-1') == (None, None)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_run_subprocess_failing_course():
+    global EDX2BIGQUERY_COMMAND
+    import shutil
+    import tempfile
+    orig = EDX2BIGQUERY_COMMAND
+    tmpdir = tempfile.mkdtemp()
+    EDX2BIGQUERY_COMMAND = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')]
+    task = {'command': 'setup_sql', 'course_id': 'MITx/6.002x/2013_Spring',
+            'argv': ['--course-base-dir', os.path.join(tmpdir, 'no_such_dir'),
+                     '--run-ledger', os.path.join(tmpdir, 'ledger.sqlite')]}
+    try:
+        with open(os.path.join(tmpdir, 'task.log'), 'w') as logfp:
+            ret = run_subprocess(task, logfp, lambda: True)
+        log = open(os.path.join(tmpdir, 'task.log')).read()
+    finally:
+        EDX2BIGQUERY_COMMAND = orig
+        shutil.rmtree(tmpdir)
+    assert 'Cannot find course SQL directory' in log	# setup_sql carries on after the error...
+    assert ret == (False, 'exit code 1')		# ...but the task fails
+
+def test_work_queue():
+    import shutil
+    import tempfile
+    from StringIO import StringIO
+    tmpdir = tempfile.mkdtemp()
+    try:
+        clock = FakeClock(time.time())
+        queue = WorkQueue(os.path.join(tmpdir, 'QUEUE'), lease=60, clock=clock)
+        queue.enqueue('person_course', ['a/big/x', 'a/bad/x', 'a/lost/x', 'a/small/x'], argv=['--force-recompute'],
+                      max_attempts=2)
+        assert queue.counts() == {'pending': 4, 'claimed': 0, 'done': 0, 'failed': 0}
+
+        # a worker on another host claims a/big/x, and dies
+        (task, claimed) = queue.claim('host1-1')
+        assert task['course_id'] == 'a/big/x' and task['argv'] == ['--force-recompute']
+        assert claimed.endswith('-00000-person_course@host1-1.json')
+        os.utime(claimed, (clock.now - 120, clock.now - 120))
+
+        ran = []
+        def run_fn(task, logfp, heartbeat):
+            ran.append(task['course_id'])
+            print >> logfp, "processing %s" % task['course_id']
+            assert heartbeat()
+            if ran.count('a/lost/x') == 1 and task['course_id'] == 'a/lost/x':	# stalls, and another worker reaps it
+                clock.now += 1000
+                assert queue.reap(ofp=StringIO()) == 1
+                assert not heartbeat()
+            if 'bad' in task['course_id']:
+                return (False, 'exit code 1')
+            return (True, None)
+
+        sfp = StringIO()
+        worker = Worker(queue, log_dir=os.path.join(tmpdir, 'LOGS'), run_fn=run_fn, name='host2-7', poll=1,
+                        sleep=lambda dt: setattr(clock, 'now', clock.now + dt), ofp=sfp)
+        results = worker.run()
+        assert 'lease of host1-1 expired, now pending' in sfp.getvalue()
+
+        # a/big/x: reaped, then run; a/bad/x: failed twice; a/lost/x: lease lost, so run again
+        assert ran[0] == 'a/big/x'
+        assert sorted(ran) == ['a/bad/x', 'a/bad/x', 'a/big/x', 'a/lost/x', 'a/lost/x', 'a/small/x']
+        assert [x['state'] for x in results if x['course_id'] == 'a/lost/x'] == [None, 'done']
+        assert queue.counts() == {'pending': 0, 'claimed': 0, 'done': 3, 'failed': 1}
+        failed = json.loads(open(os.path.join(queue.dir('failed'), queue.files('failed')[0])).read())
+        assert failed['course_id'] == 'a/bad/x' and failed['errors'] == ['exit code 1', 'exit code 1']
+        big = json.loads(open(os.path.join(queue.dir('done'), queue.files('done')[0])).read())
+        assert big['course_id'] == 'a/big/x' and big['attempts'] == 2
+        assert big['errors'] == ['lease expired (worker host1-1)']
+
+        logfn = course_scheduler.log_filename(os.path.join(tmpdir, 'LOGS'), 'person_course', 'a/small/x')
+        assert 'processing a/small/x' in open(logfn).read()
+    finally:
+        shutil.rmtree(tmpdir)